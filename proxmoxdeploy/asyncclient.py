@@ -0,0 +1,165 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Concurrent execution of ProxmoxClient operations.
+"""
+
+from multiprocessing.pool import ThreadPool
+import functools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Operations of ProxmoxClient that can be submitted.
+OPERATIONS = (
+    "get_version", "get_next_vmid", "get_free_vmid", "get_nodes",
+    "get_storage", "get_seed_storage", "get_storage_profile", "get_max_cpu",
+    "get_max_memory", "get_max_disk_size", "create_vm", "upload",
+    "attach_seed_iso", "attach_base_disk", "start_vm",
+    "attach_serial_console", "prefetch_image", "get_image_cache_status",
+    "get_task_status", "wait_for_task", "get_vms", "get_vm_config",
+    "ping_guest_agent", "probe_guests",
+)
+
+
+class AsyncProxmoxClient(object):
+    """
+    Runs operations of a ProxmoxClient concurrently, from a pool of worker
+    threads. Every operation of OPERATIONS is available as a method with the
+    same arguments, which returns immediately with an AsyncResult. Call get()
+    on the result to wait for the return value of the operation, or for the
+    exception it raised.
+
+    Many operations can be in flight at once. Their load on the node is
+    bounded separately for API calls, commands and uploads, by semaphores
+    around the session of the client. An operation waits for a slot only
+    while it makes a call, not while it runs.
+
+    The client itself stays synchronous, and can still be used directly.
+    """
+    def __init__(self, client, workers=32, max_api_calls=8, max_commands=8,
+                 max_uploads=2):
+        """
+        Parameters
+        ----------
+        client: ProxmoxClient
+            Client to run the operations with.
+        workers: int
+            Amount of operations to run at the same time.
+        max_api_calls: int
+            Amount of API calls to make at the same time.
+        max_commands: int
+            Amount of commands to run on the node at the same time.
+        max_uploads: int
+            Amount of files to upload to the node at the same time.
+        """
+        self.client = client
+        self.api_calls = threading.BoundedSemaphore(max_api_calls)
+        self.commands = threading.BoundedSemaphore(max_commands)
+        self.uploads = threading.BoundedSemaphore(max_uploads)
+        self._pool = ThreadPool(workers)
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._limit(client._get_ssh_session())
+
+    def _limit(self, session):
+        """
+        Wraps the calls of the session, so they take a slot of the matching
+        semaphore.
+        """
+        def limited(semaphore, func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with semaphore:
+                    return func(*args, **kwargs)
+            return wrapper
+
+        session.request = limited(self.api_calls, session.request)
+        session._exec = limited(self.commands, session._exec)
+        session.upload_file_obj = limited(self.uploads,
+                                          session.upload_file_obj)
+        if hasattr(session, "upload_stream"):
+            session.upload_stream = limited(self.uploads,
+                                            session.upload_stream)
+
+    def __getattr__(self, name):
+        if name not in OPERATIONS:
+            raise AttributeError(name)
+        return functools.partial(self.submit, getattr(self.client, name))
+
+    @property
+    def pending(self):
+        """
+        Amount of submitted operations that did not finish yet.
+        """
+        return self._pending
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Runs a function in the pool of worker threads.
+
+        Returns
+        -------
+        AsyncResult of the function.
+        """
+        with self._idle:
+            self._pending += 1
+        return self._pool.apply_async(self._run, (func, args, kwargs))
+
+    def _run(self, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._idle:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def join(self):
+        """
+        Blocks until all submitted operations are finished, including
+        operations submitted while waiting.
+        """
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+    def map(self, func, iterable):
+        """
+        Runs a function for every item concurrently, and waits for all of
+        them.
+
+        Returns
+        -------
+        List of the return values, in the order of the items.
+        """
+        results = [self.submit(func, item) for item in iterable]
+        return [result.get() for result in results]
+
+    def close(self):
+        """
+        Waits for all submitted operations, and stops the worker threads.
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,335 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+"""
+End-to-end deployment benchmarks against a fake Proxmox node. Results can be
+stored as a baseline, and later results compared against it to catch
+performance regressions.
+"""
+
+from . import cache
+from .cloudinit.templates import QUESTIONS
+from .deploy import deploy
+from .fake import (FakeAPIServer, FakeHTTPSession, FakeProxmoxAPI,
+                   FakeProxmoxNode)
+from .httpsapi import HTTPSTransport
+from .journal import DeployJournal
+from .proxmox import ProxmoxClient
+from .service import DeployService
+from collections import OrderedDict
+from contextlib import contextmanager
+from shutil import rmtree
+import json
+import logging
+import os
+import tempfile
+import time
+
+# Metrics that describe how the benchmarks ran. Results are only comparable
+# to a baseline with the same configuration.
+CONFIGURATION_METRICS = ("batch.vms", "batch.workers")
+# Throughput metrics, of which higher values are better. The other compared
+# metrics are timings, of which lower values are better.
+HIGHER_IS_BETTER = ("batch.vms_per_minute",)
+# Timings shorter than this are too noisy to compare, in seconds.
+MIN_COMPARED_SECONDS = 0.25
+# API backends that can be benchmarked.
+BACKENDS = ("ssh", "https")
+# API token of the stand-in API server.
+BENCHMARK_TOKEN = "benchmark=secret"
+
+logger = logging.getLogger(__name__)
+
+
+def create_image(directory, size):
+    """
+    Creates a sparse raw image to deploy.
+
+    Parameters
+    ----------
+    directory: str
+        Directory to create the image in.
+    size: int
+        Size of the image in bytes.
+
+    Returns
+    -------
+    Filename of the image.
+    """
+    filename = os.path.join(directory, "benchmark-disk1.img")
+    with open(filename, "wb") as image:
+        image.truncate(size)
+    return filename
+
+
+@contextmanager
+def fake_api(node, backend="ssh"):
+    """
+    Serves the API of a fake node with the given backend. With "https", API
+    calls are sent to a stand-in API server on localhost over a pool of
+    keep-alive connections, like HTTPSProxmoxAPI does. The server does not
+    use TLS, so the handshakes it saves are not part of the measurements.
+
+    Yields
+    ------
+    Tuple of the FakeProxmoxAPI, and the FakeAPIServer or None.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {0}".format(backend))
+    if backend == "ssh":
+        yield FakeProxmoxAPI(node), None
+        return
+    server = FakeAPIServer(node, token=BENCHMARK_TOKEN)
+    server.start()
+    transport = HTTPSTransport("127.0.0.1", server.port,
+                               token=BENCHMARK_TOKEN, scheme="http")
+    try:
+        yield FakeProxmoxAPI(node, FakeHTTPSession(node, transport)), server
+    finally:
+        transport.close()
+        server.stop()
+
+
+def _api_metrics(node, server):
+    metrics = OrderedDict([("api_calls", node.api_calls)])
+    if server is not None:
+        metrics['api_connections'] = server.connections
+    return metrics
+
+
+def _cloudinit_answers(name, image):
+    cloudinit = QUESTIONS.flatten_answers()
+    cloudinit.update(name=name, image=image, ssh_root_keys=[],
+                     start_vm=True)
+    return cloudinit
+
+
+def benchmark_single(node_options, image, backend="ssh"):
+    """
+    Measures a single deployment through the same pipeline as the interactive
+    command, minus the questions.
+
+    Parameters
+    ----------
+    node_options: dict
+        Keyword arguments for FakeProxmoxNode.
+    image: str
+        Filename of the image to deploy.
+    backend: str
+        API backend to use, one of BACKENDS.
+
+    Returns
+    -------
+    Dict of measurements.
+    """
+    node = FakeProxmoxNode(**node_options)
+    with fake_api(node, backend) as (fake, server):
+        return _benchmark_single(node, ProxmoxClient(fake), server, image)
+
+
+def _benchmark_single(node, api, server, image):
+    proxmox = {"node": node.name, "storage": api.get_storage(node.name)[0],
+               "cpu": 1, "cpu_family": "host", "memory": 512, "disk": 1,
+               "vmid": int(api.get_next_vmid())}
+    node.reset_counters()
+
+    journal = DeployJournal(proxmox=proxmox,
+                            cloudinit=_cloudinit_answers("single", image))
+    start = time.time()
+    timer = deploy(api, journal)
+    return OrderedDict([
+        ("seconds", time.time() - start),
+        ("phases", timer.as_dict()),
+        ("bytes_transferred", node.bytes_uploaded),
+    ] + _api_metrics(node, server).items() + [
+        ("commands", node.commands),
+    ])
+
+
+def benchmark_batch(node_options, image, vms, workers, backend="ssh"):
+    """
+    Measures many concurrent deployments through the deployment service.
+
+    Parameters
+    ----------
+    node_options: dict
+        Keyword arguments for FakeProxmoxNode.
+    image: str
+        Filename of the image to deploy.
+    vms: int
+        Amount of VMs to deploy.
+    workers: int
+        Amount of deployments to run concurrently.
+    backend: str
+        API backend to use, one of BACKENDS.
+
+    Returns
+    -------
+    Dict of measurements.
+    """
+    node = FakeProxmoxNode(**node_options)
+    with fake_api(node, backend) as (fake, server):
+        return _benchmark_batch(node, ProxmoxClient(fake), server, image,
+                                vms, workers)
+
+
+def _benchmark_batch(node, api, server, image, vms, workers):
+    service = DeployService(api, "benchmark", os.path.dirname(image),
+                            workers=workers)
+    service.start()
+    node.reset_counters()
+
+    start = time.time()
+    for index in range(vms):
+        service.submit({"name": "batch-{0}".format(index), "image": image,
+                        "ssh_root_keys": [], "disk": 1})
+    service.wait()
+    seconds = time.time() - start
+
+    failed = [job for job in service.list_jobs() if job.status == "failed"]
+    for job in failed:
+        logger.error("Deployment {0} failed: {1}".format(job.id, job.error))
+    return OrderedDict([
+        ("vms", vms),
+        ("workers", workers),
+        ("failed", len(failed)),
+        ("seconds", seconds),
+        ("vms_per_minute", (vms - len(failed)) / seconds * 60),
+        ("average_phases", service.status()['average_phases']),
+        ("bytes_transferred", node.bytes_uploaded),
+    ] + _api_metrics(node, server).items() + [
+        ("commands", node.commands),
+    ])
+
+
+def run_benchmarks(node_options, image=None, image_size=64 * 1024 ** 2,
+                   vms=20, workers=4, backend="ssh"):
+    """
+    Runs the single and batch benchmarks. Caches are kept in a temporary
+    directory, so every run starts cold.
+
+    Returns
+    -------
+    Dict with the "single" and "batch" results.
+    """
+    work_dir = tempfile.mkdtemp(prefix="proxmox-deploy-benchmark-")
+    old_cache_dir = cache.CACHE_DIR
+    cache.CACHE_DIR = os.path.join(work_dir, "cache")
+    try:
+        if not image:
+            image_dir = os.path.join(work_dir, "images")
+            os.mkdir(image_dir)
+            image = create_image(image_dir, image_size)
+        results = OrderedDict()
+        logger.info("Running single deployment benchmark")
+        results['single'] = benchmark_single(node_options, image, backend)
+        logger.info("Running batch deployment benchmark")
+        results['batch'] = benchmark_batch(node_options, image, vms, workers,
+                                           backend)
+        return results
+    finally:
+        cache.CACHE_DIR = old_cache_dir
+        rmtree(work_dir)
+
+
+def flatten_results(results, prefix=""):
+    """
+    Flattens nested results into a dict of dotted metric names to values.
+    """
+    metrics = OrderedDict()
+    for key, value in results.iteritems():
+        if isinstance(value, dict):
+            metrics.update(flatten_results(value, prefix + key + "."))
+        else:
+            metrics[prefix + key] = value
+    return metrics
+
+
+def is_compared(metric):
+    """
+    Whether a metric is a timing or throughput, which are compared against
+    the baseline. Counts, such as failed deployments and API calls, are not.
+    """
+    return metric in HIGHER_IS_BETTER or "seconds" in metric or \
+        "phases" in metric
+
+
+def compare_configurations(results, baseline):
+    """
+    Compares the configuration of results against that of a baseline.
+
+    Returns
+    -------
+    List of (metric, baseline value, value) tuples of CONFIGURATION_METRICS
+    that differ.
+    """
+    current = flatten_results(results)
+    expected = flatten_results(baseline)
+    return [(metric, expected.get(metric), current.get(metric))
+            for metric in CONFIGURATION_METRICS
+            if expected.get(metric) != current.get(metric)]
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Compares the timings and throughput of results against a baseline. Use
+    compare_configurations to check whether they are comparable first.
+
+    Parameters
+    ----------
+    results: dict
+        Results of run_benchmarks.
+    baseline: dict
+        Earlier results of run_benchmarks.
+    tolerance: float
+        Fraction a metric may be worse than the baseline.
+
+    Returns
+    -------
+    List of (metric, baseline value, value) tuples of regressed metrics.
+    """
+    current = flatten_results(results)
+    regressions = []
+    for metric, expected in flatten_results(baseline).iteritems():
+        value = current.get(metric)
+        if value is None or not is_compared(metric):
+            continue
+        if metric not in HIGHER_IS_BETTER:
+            if max(value, expected) < MIN_COMPARED_SECONDS:
+                continue
+            regressed = value > expected * (1 + tolerance)
+        else:
+            regressed = value < expected * (1 - tolerance)
+        if regressed:
+            regressions.append((metric, expected, value))
+    return regressions
+
+
+def load_baseline(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as _file:
+        return json.load(_file, object_pairs_hook=OrderedDict)
+
+
+def save_baseline(filename, results):
+    with open(filename, "w") as _file:
+        json.dump(results, _file, indent=2)
+
+
+def get_default_baseline():
+    return os.path.join(cache.get_cache_dir("benchmarks"), "baseline.json")
@@ -0,0 +1,233 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+"""
+Block level synchronisation of files, in the style of rsync. The receiver
+sends signatures of the fixed size blocks of its old version of a file. The
+sender rolls a weak checksum over the new version, finds the blocks the
+receiver already has, and sends a delta of block references and literal
+data. The receiver rebuilds the new version from its old version and the
+delta.
+
+The weak checksum rolls per sector of 512 bytes instead of per byte, which
+matches how data moves around in disk images, and keeps the work per byte in
+zlib.
+
+This module is also run on the Proxmox node, by passing its source to
+``python -c``. It must only use the standard library, and run on both
+Python 2 and 3.
+"""
+
+from collections import deque
+import hashlib
+import struct
+import sys
+import zlib
+
+SECTOR_SIZE = 512
+DEFAULT_BLOCK_SIZE = 64 * 1024
+_BASE = 1000003
+_MODULUS = 2 ** 61 - 1
+
+
+def _sector_checksum(sector):
+    return zlib.adler32(sector) & 0xffffffff
+
+
+def _weak_checksum(sector_checksums):
+    weak = 0
+    for checksum in sector_checksums:
+        weak = (weak * _BASE + checksum) % _MODULUS
+    return weak
+
+
+def _strong_checksum(block):
+    return hashlib.md5(block).hexdigest()
+
+
+def write_signatures(_file, block_size, output):
+    """
+    Writes the weak and strong checksum of every full block of a file, one
+    block per line.
+    """
+    while True:
+        block = _file.read(block_size)
+        if len(block) < block_size:
+            break
+        sectors = [_sector_checksum(block[offset:offset + SECTOR_SIZE])
+                   for offset in range(0, block_size, SECTOR_SIZE)]
+        output.write("{0} {1}\n".format(_weak_checksum(sectors),
+                                        _strong_checksum(block)))
+
+
+def read_signatures(text):
+    """
+    Parses signatures written by write_signatures.
+
+    Returns
+    -------
+    Dict mapping weak checksums to dicts mapping strong checksums to the
+    index of the block.
+    """
+    signatures = {}
+    for index, line in enumerate(text.splitlines()):
+        weak, strong = line.split()
+        signatures.setdefault(int(weak), {}).setdefault(strong, index)
+    return signatures
+
+
+def compute_delta(_file, signatures, block_size, output):
+    """
+    Writes the delta that turns the old version of a file into the new
+    version in _file. The delta is a sequence of records: "C" with the index
+    of a block of the old version to copy, "D" with literal data, and "E" to
+    end the delta.
+
+    Returns
+    -------
+    Tuple of the SHA256 digest of the new version, the amount of bytes copied
+    from the old version, and the amount of literal bytes in the delta.
+    """
+    sectors_per_block = block_size // SECTOR_SIZE
+    leading_factor = pow(_BASE, sectors_per_block - 1, _MODULUS)
+    digest = hashlib.sha256()
+    window = deque()
+    checksums = deque()
+    literal = []
+    stats = {"copied": 0, "literal": 0}
+
+    def read_sector():
+        sector = _file.read(SECTOR_SIZE)
+        if sector:
+            digest.update(sector)
+        return sector
+
+    def fill():
+        while len(window) < sectors_per_block:
+            sector = read_sector()
+            if not sector:
+                break
+            window.append(sector)
+            checksums.append(_sector_checksum(sector))
+
+    def flush_literal():
+        if literal:
+            data = b"".join(literal)
+            output.write(b"D" + struct.pack(">I", len(data)) + data)
+            stats['literal'] += len(data)
+            del literal[:]
+
+    fill()
+    weak = _weak_checksum(checksums)
+    while len(window) == sectors_per_block and \
+            len(window[-1]) == SECTOR_SIZE:
+        if weak in signatures:
+            index = signatures[weak].get(_strong_checksum(b"".join(window)))
+            if index is not None:
+                flush_literal()
+                output.write(b"C" + struct.pack(">Q", index))
+                stats['copied'] += block_size
+                window.clear()
+                checksums.clear()
+                fill()
+                weak = _weak_checksum(checksums)
+                continue
+
+        literal.append(window.popleft())
+        leading = checksums.popleft()
+        if len(literal) == sectors_per_block:
+            flush_literal()
+        sector = read_sector()
+        if not sector:
+            break
+        window.append(sector)
+        checksums.append(_sector_checksum(sector))
+        weak = ((weak - leading * leading_factor) * _BASE +
+                checksums[-1]) % _MODULUS
+
+    literal.extend(window)
+    flush_literal()
+    output.write(b"E")
+    return (digest.hexdigest(), stats['copied'], stats['literal'])
+
+
+def apply_delta(old, delta, new, block_size):
+    """
+    Rebuilds the new version of a file from the old version and a delta.
+
+    Returns
+    -------
+    The SHA256 digest of the new version.
+    """
+    digest = hashlib.sha256()
+    while True:
+        record = delta.read(1)
+        if record == b"C":
+            index, = struct.unpack(">Q", delta.read(8))
+            old.seek(index * block_size)
+            data = old.read(block_size)
+        elif record == b"D":
+            size, = struct.unpack(">I", delta.read(4))
+            data = delta.read(size)
+        elif record == b"E":
+            return digest.hexdigest()
+        else:
+            raise ValueError("Corrupt delta")
+        digest.update(data)
+        new.write(data)
+
+
+def hash_file(_file):
+    digest = hashlib.sha256()
+    for block in iter(lambda: _file.read(DEFAULT_BLOCK_SIZE), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def main(argv):
+    """
+    Commands run on the node:
+
+      signatures <file> <block size>            Print block signatures.
+      apply <old> <delta> <new> <block size>    Rebuild a file from a delta.
+      hash <file>                               Hash a file.
+
+    apply and hash print the SHA256 digest of the file, and store it in
+    <file>.sha256 as well.
+    """
+    if argv[0] == "signatures":
+        with open(argv[1], "rb") as _file:
+            write_signatures(_file, int(argv[2]), sys.stdout)
+        return
+    if argv[0] == "apply":
+        with open(argv[1], "rb") as old, open(argv[2], "rb") as delta, \
+                open(argv[3], "wb") as new:
+            digest = apply_delta(old, delta, new, int(argv[4]))
+        filename = argv[3]
+    elif argv[0] == "hash":
+        with open(argv[1], "rb") as _file:
+            digest = hash_file(_file)
+        filename = argv[1]
+    else:
+        raise SystemExit("Unknown command: {0}".format(argv[0]))
+    with open(filename + ".sha256", "w") as _file:
+        _file.write(digest + "\n")
+    sys.stdout.write(digest + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
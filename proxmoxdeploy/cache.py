@@ -0,0 +1,51 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .version import NAME
+import errno
+import os
+
+# Override to store cached data somewhere else than the XDG cache directory.
+CACHE_DIR = None
+
+
+def get_cache_dir(*subdirs):
+    """
+    Get a directory for persistent cached data, creating it if needed. By
+    default, this is a directory in $XDG_CACHE_HOME (~/.cache).
+
+    Parameters
+    ----------
+    subdirs: str
+        Path components of the subdirectory within the cache directory.
+
+    Returns
+    -------
+    Absolute path of the directory.
+    """
+    base = CACHE_DIR
+    if not base:
+        base = os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or
+            os.path.join(os.path.expanduser("~"), ".cache"), NAME)
+    path = os.path.join(base, *subdirs)
+    try:
+        os.makedirs(path)
+    except OSError as oe:
+        if oe.errno != errno.EEXIST:
+            raise
+    return path
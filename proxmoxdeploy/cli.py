@@ -15,17 +15,44 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see http://www.gnu.org/licenses/.
 
-from .cloudinit.templates import ask_cloudinit_questions
-from .cloudinit import generate_seed_iso
+from .asyncclient import AsyncProxmoxClient
+from .cloudinit.templates import QUESTIONS, ask_cloudinit_questions, \
+    list_images
+from .conversion import ConversionEngine, CACHE_MODES, save_settings
+from .deploy import build_report, deploy
+from .discovery import ClusterDiscovery
 from .exceptions import CommandInvocationException
-from .proxmox import ProxmoxClient, ask_proxmox_questions
+from .history import ThroughputHistory
+from .httpsapi import HTTPSProxmoxAPI, API_PORT
+from .imagecache import NodeImageCache, NODE_CACHE_DIR
+from .ippool import IPPoolManager
+from .journal import DeployJournal
+from .metrics import EventStreamWriter, PhaseTimer, ProgressLogger
+from .plan import DeployPlan
+from .preseed import load_preseed, save_preseed
+from .proxmox import ProxmoxClient, ask_proxmox_questions, IMPORT_MODES, \
+    PROXMOX_ANSWER_KEYS
+from .questions import AnswerIndex, get_preseed_keys, record_answers
+from .readiness import ReadinessWaiter
+from .service import DeployService, ImageCatalog, create_server
+from .throttle import NodeThrottle, TokenBucket, IONICE_CLASSES
+from .upload import BufferPool, StreamingUploader, DEFAULT_BUFFER_COUNT, \
+    DEFAULT_BUFFER_SIZE
 from .version import NAME, VERSION, BUILD, DESCRIPTION
 from argparse import ArgumentParser
+from collections import OrderedDict
 from configobj import ConfigObj
+from contextlib import contextmanager
 from proxmoxer import ProxmoxAPI, ResourceException
+import getpass
+import json
 import logging
 import os
+import signal
 import sys
+import tempfile
+import threading
+import time
 
 root_logger = logging.getLogger(None)
 root_logger.addHandler(logging.StreamHandler())
@@ -34,7 +61,7 @@ base_logger.setLevel(logging.INFO)
 logger = logging.getLogger("proxmoxdeploy.cli")
 
 
-def get_arguments():
+def load_config(argv=None):
     initial_parser = ArgumentParser(add_help=False)
     initial_parser.add_argument("--config", metavar="CFG", type=str,
                                 help="Config file to load")
@@ -42,13 +69,16 @@ def get_arguments():
                                 default=False,
                                 help="Display version information and exit")
 
-    args, unknown_args = initial_parser.parse_known_args()
+    args, unknown_args = initial_parser.parse_known_args(argv)
 
     config = {}
     if args.config:
         config = ConfigObj(args.config)
+    return config
 
-    parser = ArgumentParser(description=DESCRIPTION)
+
+def get_parser(config, prog=None, description=DESCRIPTION):
+    parser = ArgumentParser(prog=prog, description=description)
     parser.add_argument("--config", metavar="CFG", type=str,
                         help="Config file to load.")
     parser.add_argument("--proxmox-host", metavar="HOST", type=str,
@@ -56,80 +86,976 @@ def get_arguments():
                         help="Proxmox API host.")
     parser.add_argument("--proxmox-port", metavar="PORT", type=int,
                         default=config.get("proxmox-port", 22),
-                        help="Proxmox API port.")
+                        help="SSH port of the Proxmox host.")
     parser.add_argument("--proxmox-user", metavar="USER", type=str,
                         default=config.get("proxmox-user", "root"),
                         help="Proxmox API user.")
+    parser.add_argument("--proxmox-backend", type=str,
+                        default=config.get("proxmox-backend", "openssh"),
+                        choices=("openssh", "https"),
+                        help="How API calls are made. openssh runs pvesh "
+                             "over SSH for every call, https sends them to "
+                             "the API over a pool of keep-alive connections. "
+                             "Commands and uploads always use SSH.")
+    parser.add_argument("--proxmox-api-port", metavar="PORT", type=int,
+                        default=config.get("proxmox-api-port", API_PORT),
+                        help="Port of the Proxmox API, for the https "
+                             "backend.")
+    parser.add_argument("--proxmox-token", metavar="NAME=SECRET", type=str,
+                        default=config.get("proxmox-token", None),
+                        help="API token of the user, for the https backend. "
+                             "Without a token, the password is read from "
+                             "the PROXMOX_PASSWORD environment variable, or "
+                             "asked for.")
+    parser.add_argument("--proxmox-ca-file", metavar="FILE", type=str,
+                        default=config.get("proxmox-ca-file", None),
+                        help="CA bundle to verify the certificate of the "
+                             "API with, for the https backend.")
+    parser.add_argument("--no-verify-ssl", action="store_false",
+                        dest="verify_ssl", default=True,
+                        help="Do not verify the certificate of the API.")
+    parser.add_argument("--api-connections", metavar="N", type=int,
+                        default=config.get("api-connections", 8),
+                        help="Maximum amount of connections to the API, for "
+                             "the https backend.")
     parser.add_argument("--cloud-images-dir", metavar="DIR", type=str,
                         default=config.get("cloud-images-dir", None),
-                        help="Directory containing Cloud images.")
-    args = parser.parse_args()
+                        help="Directory containing Cloud images. Images "
+                             "can also be given as an HTTP(S) URL.")
+    parser.add_argument("--trace", metavar="FILE", type=str, default=None,
+                        help="Record all API calls, commands and uploads to "
+                             "a trace file, for use with the replay command.")
+    parser.add_argument("--events-file", metavar="FILE", type=str,
+                        default=None,
+                        help="Append transfer progress events to a file, as "
+                             "one JSON object per line.")
+    parser.add_argument("--progress-interval", metavar="SECONDS",
+                        type=float, default=5.0,
+                        help="Interval between progress reports of "
+                             "transfers.")
+    parser.add_argument("--node-cache-dir", metavar="DIR", type=str,
+                        default=config.get("node-cache-dir", NODE_CACHE_DIR),
+                        help="Directory on the Proxmox node to cache images "
+                             "in.")
+    parser.add_argument("--bandwidth-limit", metavar="MB/S", type=float,
+                        default=config.get("bandwidth-limit", None),
+                        help="Maximum rate of all uploads together, and of "
+                             "downloads by the node.")
+    parser.add_argument("--node-bandwidth-limit", metavar="MB/S",
+                        type=float,
+                        default=config.get("node-bandwidth-limit", None),
+                        help="Maximum rate of all uploads to a single node "
+                             "together.")
+    parser.add_argument("--storage-bandwidth-limit", metavar="STORAGE=MB/S",
+                        type=str, action="append", default=None,
+                        help="Maximum rate of conversions into a storage, "
+                             "shared by the conversions running at the same "
+                             "time. Use * as storage to limit all storages. "
+                             "Can be given multiple times.")
+    parser.add_argument("--storage-conversions", metavar="N", type=int,
+                        default=2,
+                        help="Maximum amount of conversions into a storage "
+                             "with a bandwidth limit at the same time. Each "
+                             "gets an equal share of the bandwidth.")
+    parser.add_argument("--ionice-class", type=str, default=None,
+                        choices=sorted(IONICE_CLASSES),
+                        help="I/O scheduling class of conversions and other "
+                             "heavy commands on the node.")
+    parser.add_argument("--ionice-level", metavar="LEVEL", type=int,
+                        default=None, choices=range(8),
+                        help="Priority within the I/O scheduling class, from "
+                             "0 (highest) to 7.")
+    parser.add_argument("--nice", metavar="N", type=int, default=None,
+                        help="CPU niceness of heavy commands on the node.")
+    parser.add_argument("--max-iowait", metavar="PERCENT", type=float,
+                        default=None,
+                        help="Postpone uploads and conversions while the I/O "
+                             "wait of the node is above this percentage, and "
+                             "lower the bandwidth of later conversions.")
+    parser.add_argument("--convert-coroutines", metavar="N", type=int,
+                        default=None, choices=range(1, 17),
+                        help="Amount of parallel coroutines of qemu-img "
+                             "conversions. Overrides the tuned settings of "
+                             "all storages.")
+    parser.add_argument("--convert-cache", metavar="MODE", type=str,
+                        default=None, choices=CACHE_MODES,
+                        help="Cache mode of the disk an image is converted "
+                             "into. Overrides the tuned settings of all "
+                             "storages.")
+    parser.add_argument("--convert-unordered-writes", type=str, default=None,
+                        choices=("yes", "no"),
+                        help="Allow qemu-img to write the disk an image is "
+                             "converted into out of order. Overrides the "
+                             "tuned settings of all storages.")
+    parser.add_argument("--import-mode", type=str,
+                        default=config.get("import-mode", "auto"),
+                        choices=IMPORT_MODES,
+                        help="How base disks are imported. native lets "
+                             "Proxmox 7.2 or later import the image while "
+                             "attaching the disk, convert converts the image "
+                             "into an allocated disk. auto uses native "
+                             "imports, unless unsupported or throttled.")
+    parser.add_argument("--delta-sync", action="store_true", default=False,
+                        help="Cache local images on the node when they are "
+                             "deployed, and only send the blocks that "
+                             "changed when a new version of an uncompressed "
+                             "image is deployed.")
+    parser.add_argument("--upload-buffers", metavar="N", type=int,
+                        default=DEFAULT_BUFFER_COUNT,
+                        help="Amount of buffers shared by all uploads.")
+    parser.add_argument("--upload-buffer-size", metavar="KB", type=int,
+                        default=DEFAULT_BUFFER_SIZE // 1024,
+                        help="Size of every upload buffer.")
+    parser.add_argument("--wait-ready", action="store_true", default=False,
+                        help="Wait until started VMs booted and cloud-init "
+                             "finished, and report how long that took.")
+    parser.add_argument("--ready-timeout", metavar="SECONDS", type=int,
+                        default=config.get("ready-timeout", 900),
+                        help="Seconds to wait for a VM to become ready.")
+    parser.add_argument("--no-cloud-init-check", action="store_false",
+                        dest="check_cloud_init", default=True,
+                        help="Consider VMs ready once they booted, without "
+                             "logging in to check whether cloud-init "
+                             "finished.")
+    parser.add_argument("--capture-console", action="store_true",
+                        default=False,
+                        help="Capture the serial console of started VMs "
+                             "during their first boot, and derive how long "
+                             "each stage of the boot took. Implies "
+                             "--wait-ready.")
+    return parser
+
 
+def check_arguments(args):
     if not args.proxmox_host:
         logger.error("No Proxmox API host was supplied.")
         sys.exit(1)
 
-    if not args.cloud_images_dir:
-        logger.error("No directory containing Cloud images specified.")
+    args.proxmox_port = str(args.proxmox_port)
+
+
+def get_arguments(argv=None):
+    config = load_config(argv)
+    parser = get_parser(config)
+    parser.add_argument("--resume", metavar="JOURNAL", type=str, nargs="?",
+                        const="latest", default=None,
+                        help="Resume a failed deployment from its journal. "
+                             "Without JOURNAL, the most recent journal for "
+                             "the Proxmox host is used.")
+    parser.add_argument("--report", metavar="FILE", type=str, default=None,
+                        help="Write a JSON report of the deployment, with "
+                             "the time spent in each phase and, with "
+                             "--wait-ready, the time until the VM booted and "
+                             "cloud-init finished. With --plan, the plan is "
+                             "written instead.")
+    parser.add_argument("--plan", action="store_true", default=False,
+                        help="Only plan the deployment, without changing "
+                             "anything: show its VM id, whether the image "
+                             "is cached, what is transferred and allocated, "
+                             "and how long each phase is expected to take, "
+                             "from the throughput of earlier deployments.")
+    parser.add_argument("--no-early-upload", action="store_false",
+                        dest="early_upload",
+                        default=not config.get("no-early-upload", False),
+                        help="Don't upload the chosen image into the image "
+                             "cache of the node while the other questions "
+                             "are answered. The node needs python3 to cache "
+                             "images.")
+    parser.add_argument("--preseed", metavar="FILE", type=str,
+                        default=config.get("preseed", None),
+                        help="Answer questions from a preseed file, instead "
+                             "of asking them.")
+    parser.add_argument("--profile", metavar="NAME", type=str, default=None,
+                        help="Profile of the preseed file to answer "
+                             "questions from, or to record answers as.")
+    parser.add_argument("--answer", metavar="KEY=VALUE", type=str,
+                        action="append", default=[],
+                        help="Answer a question, overriding the preseed "
+                             "file. Can be given multiple times.")
+    parser.add_argument("--defaults", action="store_true", default=False,
+                        help="Answer questions that are not preseeded with "
+                             "their default, instead of asking them.")
+    parser.add_argument("--record", metavar="FILE", type=str, default=None,
+                        help="Record the answers to a preseed file, as "
+                             "--profile, for later deployments. The "
+                             "hostname and VM id are not recorded.")
+    args = parser.parse_args(argv)
+    check_arguments(args)
+    return args
+
+
+def get_serve_arguments(argv=None):
+    config = load_config(argv)
+    parser = get_parser(
+        config, prog="{0} serve".format(NAME),
+        description="Run {0} as a long running deployment service, which "
+                    "accepts deployments over HTTP.".format(NAME))
+    parser.add_argument("--listen", metavar="HOST:PORT", type=str,
+                        default=config.get("listen", "127.0.0.1:8850"),
+                        help="Address to listen on.")
+    parser.add_argument("--socket", metavar="PATH", type=str,
+                        default=config.get("socket", None),
+                        help="Unix socket to listen on, instead of --listen.")
+    parser.add_argument("--workers", metavar="N", type=int,
+                        default=config.get("workers", 2),
+                        help="Amount of deployments to run concurrently.")
+    parser.add_argument("--max-api-calls", metavar="N", type=int,
+                        default=config.get("max-api-calls", 8),
+                        help="Amount of API calls all deployments together "
+                             "make at the same time.")
+    parser.add_argument("--max-commands", metavar="N", type=int,
+                        default=config.get("max-commands", 8),
+                        help="Amount of commands all deployments together "
+                             "run on the node at the same time.")
+    parser.add_argument("--max-uploads", metavar="N", type=int,
+                        default=config.get("max-uploads", 2),
+                        help="Amount of uploads all deployments together "
+                             "run at the same time.")
+    parser.add_argument("--fake", action="store_true", default=False,
+                        help="Deploy to a local fake Proxmox node instead, "
+                             "for testing.")
+    args = parser.parse_args(argv)
+    if args.fake:
+        args.proxmox_host = args.proxmox_host or "fake"
+    check_arguments(args)
+
+    host, _, port = args.listen.rpartition(":")
+    args.listen = (host or "127.0.0.1", int(port))
+    return args
+
+
+def get_benchmark_arguments(argv=None):
+    # The benchmark pulls in the fake node, so only import it when needed.
+    from .benchmark import BACKENDS
+    parser = ArgumentParser(
+        prog="{0} benchmark".format(NAME),
+        description="Benchmark deployments against a fake Proxmox node.")
+    parser.add_argument("--image", metavar="FILE", type=str, default=None,
+                        help="Image to deploy. By default, a sparse raw "
+                             "image of --image-size is created.")
+    parser.add_argument("--image-size", metavar="MB", type=int, default=64,
+                        help="Size of the created image.")
+    parser.add_argument("--vms", metavar="N", type=int, default=20,
+                        help="Amount of VMs to deploy in the batch benchmark.")
+    parser.add_argument("--workers", metavar="N", type=int, default=4,
+                        help="Amount of concurrent deployments in the batch "
+                             "benchmark.")
+    parser.add_argument("--api-latency", metavar="SECONDS", type=float,
+                        default=0.1,
+                        help="Latency of every API call. With the https "
+                             "backend, it adds to the actual round trip of "
+                             "the call.")
+    parser.add_argument("--backend", type=str, default="ssh",
+                        choices=BACKENDS,
+                        help="API backend to benchmark. https sends API "
+                             "calls to a stand-in API server on localhost.")
+    parser.add_argument("--command-latency", metavar="SECONDS", type=float,
+                        default=0.1, help="Latency of every SSH command.")
+    parser.add_argument("--proxmox-version", metavar="VERSION", type=str,
+                        default="7.4-1",
+                        help="Proxmox version of the fake node. From 7.2, "
+                             "base disks are imported by a Proxmox task.")
+    parser.add_argument("--bandwidth", metavar="MB/S", type=float,
+                        default=100, help="Upload bandwidth to the node.")
+    parser.add_argument("--disk-bandwidth", metavar="MB/S", type=float,
+                        default=500,
+                        help="Bandwidth of conversions on the node.")
+    parser.add_argument("--baseline", metavar="FILE", type=str,
+                        default=None,
+                        help="Baseline to compare against. Defaults to the "
+                             "baseline in the cache directory.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        default=False,
+                        help="Store the results as the new baseline.")
+    parser.add_argument("--tolerance", metavar="FRACTION", type=float,
+                        default=0.2,
+                        help="Fraction a metric may be worse than the "
+                             "baseline before it is a regression.")
+    return parser.parse_args(argv)
+
+
+def get_replay_arguments(argv=None):
+    parser = ArgumentParser(
+        prog="{0} replay".format(NAME),
+        description="Replay a recorded deployment against a fake Proxmox "
+                    "node, with the recorded timings.")
+    parser.add_argument("trace", metavar="TRACE", type=str,
+                        help="Trace file recorded with --trace.")
+    parser.add_argument("--speed", metavar="FACTOR", type=float, default=1.0,
+                        help="Replay speed, recorded latencies are divided "
+                             "by this factor.")
+    parser.add_argument("--image", metavar="FILE", type=str, default=None,
+                        help="Image to upload. Defaults to the recorded "
+                             "image, or a sparse file of the recorded size if "
+                             "it does not exist locally.")
+    return parser.parse_args(argv)
+
+
+def watch_transfers(args, api):
+    """
+    Reports the progress of transfers to the log, and to the events file.
+    """
+    api.monitor.interval = args.progress_interval
+    api.monitor.add_listener(ProgressLogger(logger))
+    if args.events_file:
+        api.monitor.add_listener(EventStreamWriter(args.events_file))
+
+
+def get_image_cache(args, throttle=None):
+    limit_rate = None
+    if args.bandwidth_limit:
+        limit_rate = args.bandwidth_limit * 1024 ** 2
+    return NodeImageCache(args.node_cache_dir,
+                          sync_local_images=args.delta_sync,
+                          limit_rate=limit_rate, throttle=throttle)
+
+
+def get_throttle(args):
+    """
+    Get a throttle for the heavy work on a single node.
+    """
+    storage_rates = {}
+    for limit in args.storage_bandwidth_limit or []:
+        storage, _, rate = limit.rpartition("=")
+        try:
+            storage_rates[storage or "*"] = int(float(rate) * 1024 ** 2)
+        except ValueError:
+            logger.error("Invalid storage bandwidth limit: {0}".format(limit))
+            sys.exit(1)
+    if args.storage_conversions < 1:
+        logger.error("Invalid amount of storage conversions: {0}"
+                     .format(args.storage_conversions))
         sys.exit(1)
+    max_iowait = None
+    if args.max_iowait is not None:
+        max_iowait = args.max_iowait / 100.0
+    return NodeThrottle(ionice_class=args.ionice_class,
+                        ionice_level=args.ionice_level, nice=args.nice,
+                        storage_rates=storage_rates, max_iowait=max_iowait,
+                        max_conversions=args.storage_conversions)
+
+
+def get_limiter(args):
+    """
+    Get the limiter shared by all clients, which caps the rate of all uploads
+    together.
+    """
+    if not args.bandwidth_limit:
+        return None
+    if not hasattr(args, "limiter"):
+        args.limiter = TokenBucket(args.bandwidth_limit * 1024 ** 2)
+    return args.limiter
+
+
+def get_config_section(args, name):
+    """
+    Get a section of the config file, or an empty dict if there is none.
+    """
+    if not args.config:
+        return {}
+    return ConfigObj(args.config).get(name, {})
+
+
+def get_converter(args):
+    """
+    Get a conversion engine with the tuned settings in the config file, and
+    the settings given on the command line.
+    """
+    config = get_config_section(args, "conversion")
+    overrides = {}
+    if args.convert_coroutines is not None:
+        overrides['coroutines'] = args.convert_coroutines
+    if args.convert_cache is not None:
+        overrides['target_cache'] = args.convert_cache
+    if args.convert_unordered_writes is not None:
+        overrides['unordered_writes'] = args.convert_unordered_writes == "yes"
+    return ConversionEngine(config, overrides)
 
-    args.proxmox_port = str(args.proxmox_port)
 
+def get_node_limiter(args):
+    """
+    Get a limiter for the uploads to a single node, which also counts against
+    the limiter shared by all clients.
+    """
+    if not args.node_bandwidth_limit:
+        return get_limiter(args)
+    return TokenBucket(args.node_bandwidth_limit * 1024 ** 2,
+                       parent=get_limiter(args))
+
+
+def get_prefetch_arguments(argv=None):
+    config = load_config(argv)
+    parser = get_parser(
+        config, prog="{0} prefetch".format(NAME),
+        description="Copy images into the image cache of Proxmox nodes ahead "
+                    "of deployments, so deployments find them there.")
+    parser.add_argument("images", metavar="IMAGE", type=str, nargs="*",
+                        help="Images to prefetch, by path or filename in the "
+                             "cloud images directory, or HTTP(S) URL.")
+    parser.add_argument("--all", action="store_true", default=False,
+                        help="Prefetch all images in the cloud images "
+                             "directory.")
+    parser.add_argument("--nodes", metavar="HOST", type=str, nargs="+",
+                        default=None,
+                        help="Proxmox hosts to prefetch to. Defaults to "
+                             "--proxmox-host.")
+    parser.add_argument("--concurrency", metavar="N", type=int,
+                        default=config.get("prefetch-concurrency", 2),
+                        help="Amount of images to transfer to every node "
+                             "at the same time.")
+    parser.add_argument("--check", action="store_true", default=False,
+                        help="Only report which images are cached, without "
+                             "transferring anything.")
+    args = parser.parse_args(argv)
+    check_arguments(args)
     return args
 
 
-def interact_with_user(args, api):
-    proxmox_answers = ask_proxmox_questions(api)
+def get_ip_pools_arguments(argv=None):
+    config = load_config(argv)
+    parser = get_parser(
+        config, prog="{0} ip-pools".format(NAME),
+        description="Reconcile the IP pools against the VMs of the cluster, "
+                    "and show their usage.")
+    parser.add_argument("--release", metavar="POOL:ADDRESS", type=str,
+                        nargs="+", default=[],
+                        help="Return addresses to their pool.")
+    args = parser.parse_args(argv)
+    check_arguments(args)
+    return args
+
+
+def get_tune_conversion_arguments(argv=None):
+    config = load_config(argv)
+    parser = get_parser(
+        config, prog="{0} tune-conversion".format(NAME),
+        description="Find the fastest settings to convert images into a "
+                    "storage with, and store them in the config file.")
+    parser.add_argument("--node", metavar="NODE", type=str, default=None,
+                        help="Node to tune conversions on. Defaults to the "
+                             "first node.")
+    parser.add_argument("--storage", metavar="STORAGE", type=str,
+                        required=True,
+                        help="Storage to tune conversions into.")
+    parser.add_argument("--size", metavar="MB", type=int, default=1024,
+                        help="Size of the test image.")
+    parser.add_argument("--rounds", metavar="N", type=int, default=1,
+                        help="Amount of conversions per settings, of which "
+                             "the fastest counts.")
+    args = parser.parse_args(argv)
+    check_arguments(args)
+    return args
+
+
+def get_proxmox_api(args, host=None):
+    host = host or args.proxmox_host
+    if args.proxmox_backend == "openssh":
+        return ProxmoxAPI(host, port=args.proxmox_port, timeout=600,
+                          user=args.proxmox_user, backend="openssh")
+    password = None
+    if not args.proxmox_token:
+        password = os.environ.get("PROXMOX_PASSWORD")
+        if password is None:
+            password = getpass.getpass("Password for {0}@{1}: ".format(
+                args.proxmox_user, host))
+    return HTTPSProxmoxAPI(host, user=args.proxmox_user,
+                           port=args.proxmox_port,
+                           api_port=args.proxmox_api_port,
+                           token=args.proxmox_token, password=password,
+                           connections=args.api_connections,
+                           verify_ssl=args.verify_ssl,
+                           ca_file=args.proxmox_ca_file)
+
+
+def get_client(args, host=None):
+    throttle = get_throttle(args)
+    api = ProxmoxClient(get_proxmox_api(args, host),
+                        image_cache=get_image_cache(args, throttle),
+                        limiter=get_node_limiter(args), throttle=throttle,
+                        converter=get_converter(args),
+                        storage_overrides=get_config_section(
+                            args, "storage-profiles"),
+                        import_mode=args.import_mode,
+                        history=ThroughputHistory.open())
+    watch_transfers(args, api)
+    pool = BufferPool(args.upload_buffers, args.upload_buffer_size * 1024)
+    StreamingUploader(pool).install(api._get_ssh_session())
+    if args.trace:
+        from .trace import TraceRecorder
+        if not hasattr(args, "recorder"):
+            logger.info("Recording trace to {0}".format(args.trace))
+            args.recorder = TraceRecorder(args.trace)
+        args.recorder.install(api._get_ssh_session())
+    return api
+
+
+def get_ip_pools(args):
+    """
+    Get the IP pools of the [ip-pools] section of the config file.
+    """
+    if not hasattr(args, "ip_pools"):
+        args.ip_pools = IPPoolManager(get_config_section(args, "ip-pools"))
+    return args.ip_pools
+
+
+class ForegroundFilter(logging.Filter):
+    """
+    Only passes warnings and errors of threads other than the one that
+    created the filter.
+    """
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.thread = threading.current_thread().ident
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or \
+            record.thread == self.thread
+
+
+@contextmanager
+def quiet_logging():
+    """
+    Only logs warnings and errors of background threads, so their work doesn't
+    interrupt the questions. The thread asking the questions logs as usual.
+    """
+    log_filter = ForegroundFilter()
+    for handler in root_logger.handlers:
+        handler.addFilter(log_filter)
+    try:
+        yield
+    finally:
+        for handler in root_logger.handlers:
+            handler.removeFilter(log_filter)
+
+
+def get_preseed(args):
+    """
+    Get the answers of the preseed file and --answer options.
+    """
+    preseed = {}
+    if args.preseed:
+        preseed = load_preseed(args.preseed, args.profile)
+    for answer in args.answer:
+        key, sep, value = answer.partition("=")
+        if not sep:
+            raise ValueError("Invalid answer, expected KEY=VALUE: {0}"
+                             .format(answer))
+        preseed[key] = value
+    keys = AnswerIndex.get(sorted(get_preseed_keys(QUESTIONS) |
+                                  set(PROXMOX_ANSWER_KEYS) | set(["image"])))
+    for key in preseed:
+        error = keys.check(key)
+        if error:
+            raise ValueError("Unknown question {0}".format(
+                error.replace("invalid answer ", "")))
+    return preseed
+
+
+def record_preseed(args, proxmox_answers):
+    """
+    Records the answers of the session to a preseed file.
+    """
+    answers = OrderedDict(
+        (key, str(proxmox_answers[key])) for key in PROXMOX_ANSWER_KEYS
+        if key != "vmid")
+    answers.update(record_answers(QUESTIONS))
+    del answers['name']
+    save_preseed(args.record, answers, args.profile)
+
+
+def interact_with_user(args, api, discovery=None, preseed=None):
+    """
+    Asks the cloud-init questions, and then the Proxmox questions. With a
+    discovery, the Proxmox questions are answered from the discovered
+    cluster, and the chosen image is uploaded while the other questions are
+    answered, if enabled. Preseeded questions are not asked. With --plan,
+    nothing is uploaded and no address is taken from an IP pool.
+    """
+    ip_pools = get_ip_pools(args)
+    image_chosen = None
+    if discovery is not None and args.early_upload and not args.plan:
+        image_chosen = discovery.upload
     cloudinit_answers = ask_cloudinit_questions(
-        cloud_images_dir=args.cloud_images_dir)
+        cloud_images_dir=args.cloud_images_dir, ip_pools=ip_pools.keys(),
+        image_chosen=image_chosen, preseed=preseed, defaults=args.defaults)
+    proxmox_answers = ask_proxmox_questions(discovery or api, preseed,
+                                            args.defaults)
+    if cloudinit_answers.get("ip_pool") and not args.plan:
+        # Reconciling reads the config of every VM, so only do it when an
+        # address is actually taken from a pool.
+        ip_pools.reconcile(api)
+        cloudinit_answers.update(ip_pools.allocate(
+            cloudinit_answers['ip_pool'], proxmox_answers['vmid'],
+            cloudinit_answers['name']))
+        logger.info("Using IP address {0}".format(
+            cloudinit_answers['ip_address']))
     return (proxmox_answers, cloudinit_answers)
 
 
+def load_journal(args):
+    filename = args.resume
+    if filename == "latest":
+        filename = DeployJournal.find_latest(args.proxmox_host)
+        if not filename:
+            logger.error("No deployment to resume for {0}"
+                         .format(args.proxmox_host))
+            sys.exit(1)
+    logger.info("Resuming deployment from {0}".format(filename))
+    return DeployJournal.load(filename)
+
+
+def serve(argv):
+    """
+    Runs the deployment service until interrupted.
+    """
+    args = get_serve_arguments(argv)
+    if args.fake:
+        from .fake import FakeProxmoxAPI
+        throttle = get_throttle(args)
+        api = ProxmoxClient(FakeProxmoxAPI(),
+                            image_cache=get_image_cache(args, throttle),
+                            limiter=get_node_limiter(args),
+                            throttle=throttle, converter=get_converter(args),
+                            storage_overrides=get_config_section(
+                                args, "storage-profiles"),
+                            import_mode=args.import_mode)
+        watch_transfers(args, api)
+    else:
+        api = get_client(args)
+
+    # openssh_wrapper arms SIGALRM to time out commands, but it can only
+    # install a handler from the main thread. Ignore the signal, so a slow
+    # command in a worker thread can't terminate the service.
+    signal.signal(signal.SIGALRM, signal.SIG_IGN)
+
+    service = DeployService(api, args.proxmox_host, args.cloud_images_dir,
+                            workers=args.workers,
+                            max_api_calls=args.max_api_calls,
+                            max_commands=args.max_commands,
+                            max_uploads=args.max_uploads,
+                            wait_ready=args.wait_ready,
+                            ready_timeout=args.ready_timeout,
+                            check_cloud_init=args.check_cloud_init,
+                            capture_console=args.capture_console,
+                            ip_pools=get_ip_pools(args))
+    logger.info("Warming up caches")
+    service.start()
+
+    server = create_server(service, listen=args.listen,
+                           socket_path=args.socket)
+    logger.info("Listening on {0}".format(
+        args.socket or "{0}:{1}".format(*args.listen)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping")
+    finally:
+        server.server_close()
+
+
+def prefetch(argv):
+    """
+    Copies images into the image cache of Proxmox nodes, and reports which
+    images were already cached.
+    """
+    args = get_prefetch_arguments(argv)
+    catalog = ImageCatalog(args.cloud_images_dir)
+    images = list(catalog.get()) if args.all else []
+    for image in args.images:
+        resolved = catalog.resolve(image)
+        if not resolved:
+            logger.error("Unknown image: {0}".format(image))
+            sys.exit(1)
+        images.append(resolved)
+    if not images:
+        logger.error("No images to prefetch")
+        sys.exit(1)
+
+    # Commands run from worker threads, see serve.
+    signal.signal(signal.SIGALRM, signal.SIG_IGN)
+
+    hosts = args.nodes or [args.proxmox_host]
+    clients = dict((host, AsyncProxmoxClient(
+        get_client(args, host), workers=args.concurrency,
+        max_uploads=args.concurrency)) for host in hosts)
+
+    def run(client, host, image):
+        start = time.time()
+        try:
+            if args.check:
+                status = client.client.get_image_cache_status(image)
+            else:
+                logger.info("Prefetching {0} to {1}".format(image, host))
+                status = client.client.prefetch_image(image)
+        except Exception as e:
+            logger.error("Failed to prefetch {0} to {1}: {2}".format(
+                image, host, e))
+            status = "failed"
+        return (host, image, status, time.time() - start)
+
+    pending = [clients[host].submit(run, clients[host], host, image)
+               for host in hosts for image in images]
+    results = [result.get() for result in pending]
+    for client in clients.values():
+        client.close()
+
+    logger.info("")
+    for host, image, status, elapsed in results:
+        logger.info("{0:<20} {1:<10} {2:>8.1f}s  {3}".format(
+            host, status, elapsed, image))
+    if any(result[2] == "failed" for result in results):
+        sys.exit(1)
+
+
+def manage_ip_pools(argv):
+    """
+    Reconciles the IP pools, and shows their usage.
+    """
+    args = get_ip_pools_arguments(argv)
+    pools = get_ip_pools(args)
+    if not pools:
+        logger.error("No IP pools in the config file")
+        sys.exit(1)
+    for release in args.release:
+        pool, _, address = release.partition(":")
+        if pool not in pools or address not in pools[pool]:
+            logger.error("{0} is not in an IP pool".format(release))
+            sys.exit(1)
+        pools[pool].release(address)
+    pools.reconcile(get_client(args))
+    for name, status in pools.status().iteritems():
+        logger.info("{0:<20} {1:<18} {2:>6} used {3:>6} free".format(
+            name, status['subnet'], status['used'], status['free']))
+
+
+def tune_conversion(argv):
+    """
+    Benchmarks conversion settings for a storage, and stores the fastest
+    settings in the config file.
+    """
+    args = get_tune_conversion_arguments(argv)
+    api = get_client(args)
+    node = args.node or api.get_nodes()[0]
+    logger.info("Tuning conversions into {0} on {1}".format(args.storage,
+                                                            node))
+    settings, _ = api.tune_conversion(node, args.storage,
+                                      args.size * 1024, args.rounds)
+    logger.info("Fastest settings: {0}".format(settings))
+    key = "{0}/{1}".format(node, args.storage)
+    if args.config:
+        save_settings(args.config, key, settings)
+        logger.info("Stored the settings in {0}".format(args.config))
+    else:
+        logger.info("Use --config to store the settings, or add them to "
+                    "the config file:")
+        logger.info("[conversion]")
+        logger.info("    [[{0}]]".format(key))
+        for name, value in sorted(settings.as_config().items()):
+            logger.info("    {0} = {1}".format(name, value))
+
+
+def benchmark(argv):
+    """
+    Runs the benchmarks, and compares the results against the baseline.
+    """
+    from .benchmark import run_benchmarks, flatten_results, \
+        compare_configurations, compare_results, load_baseline, \
+        save_baseline, get_default_baseline
+    args = get_benchmark_arguments(argv)
+    # Only report the results, not the progress of every deployment.
+    base_logger.setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+    node_options = {
+        "api_latency": args.api_latency,
+        "command_latency": args.command_latency,
+        "bandwidth": int(args.bandwidth * 1024 ** 2),
+        "disk_bandwidth": int(args.disk_bandwidth * 1024 ** 2),
+        "version": args.proxmox_version,
+    }
+    results = run_benchmarks(node_options, image=args.image,
+                             image_size=args.image_size * 1024 ** 2,
+                             vms=args.vms, workers=args.workers,
+                             backend=args.backend)
+    for metric, value in flatten_results(results).iteritems():
+        logger.info("{0:<45} {1:>14.3f}".format(metric, value))
+
+    baseline_file = args.baseline or get_default_baseline()
+    if args.save_baseline:
+        save_baseline(baseline_file, results)
+        logger.info("Saved baseline to {0}".format(baseline_file))
+        return
+
+    baseline = load_baseline(baseline_file)
+    if baseline is None:
+        logger.info("No baseline found at {0}".format(baseline_file))
+        return
+    mismatches = compare_configurations(results, baseline)
+    for metric, expected, value in mismatches:
+        logger.error("Configuration differs from the baseline: {0} is {1} "
+                     "(baseline {2})".format(metric, value, expected))
+    if mismatches:
+        logger.error("Not comparing against {0}, save a new baseline with "
+                     "--save-baseline".format(baseline_file))
+        sys.exit(1)
+    regressions = compare_results(results, baseline,
+                                  tolerance=args.tolerance)
+    for metric, expected, value in regressions:
+        logger.error("Regression in {0}: {1:.3f} (baseline {2:.3f})".format(
+            metric, value, expected))
+    if regressions:
+        sys.exit(1)
+    logger.info("No regressions against {0}".format(baseline_file))
+
+
+def _find_replay_image(events, image):
+    if os.path.exists(image):
+        return image
+    name = os.path.basename(image)
+    sizes = [event['request_size'] for event in events
+             if event['type'] == "upload" and
+             event['remote_path'].endswith(name)]
+    if not sizes:
+        logger.error("Image {0} not found, and not in the trace".format(image))
+        sys.exit(1)
+    image = os.path.join(tempfile.mkdtemp(prefix="proxmox-deploy-replay-"),
+                         name)
+    logger.info("Image not found, using sparse file of {0} bytes".format(
+        sizes[0]))
+    with open(image, "wb") as _file:
+        _file.truncate(sizes[0])
+    return image
+
+
+def replay(argv):
+    """
+    Replays a recorded deployment, and compares its timings with the trace.
+    """
+    from .trace import create_replay_api, get_recorded_deployment, \
+        load_trace, summarize_trace
+    args = get_replay_arguments(argv)
+    events = load_trace(args.trace)
+    deployment = get_recorded_deployment(events)
+    if not deployment:
+        logger.error("Trace contains no deployment to replay")
+        sys.exit(1)
+    proxmox, cloudinit = deployment
+    cloudinit['image'] = _find_replay_image(
+        events, args.image or cloudinit['image'])
+
+    api = ProxmoxClient(create_replay_api(events, speed=args.speed))
+    session = api._get_ssh_session()
+    start = time.time()
+    timer = deploy(api, DeployJournal(proxmox=proxmox, cloudinit=cloudinit))
+    duration = time.time() - start
+
+    for phase, elapsed in timer.as_dict().iteritems():
+        logger.info("{0:<30} {1:>10.3f}s".format(phase, elapsed))
+    summary = summarize_trace(events)
+    for _type in ("api", "command", "upload"):
+        if _type in summary:
+            logger.info("Recorded {0:<8} calls: {1[count]:>5}, "
+                        "{1[latency]:>10.3f}s, {1[bytes]:>12} bytes".format(
+                            _type, summary[_type]))
+    logger.info("Recorded duration {0:.3f}s, replayed in {1:.3f}s".format(
+        summary['duration'], duration))
+    logger.info("{0} calls matched the trace, {1} did not".format(
+        session.matched, len(session.unmatched)))
+
+
+def plan_deployment(args, api, proxmox, cloudinit):
+    """
+    Shows the plan of a deployment, instead of deploying it.
+    """
+    plan = DeployPlan(api, ip_pools=get_ip_pools(args))
+    plan.add(proxmox, cloudinit)
+    logger.info("")
+    plan.log(logger)
+    if args.report:
+        with open(args.report, "w") as _file:
+            json.dump(plan.as_dict(), _file, indent=2)
+        logger.info("Wrote plan to {0}".format(args.report))
+    if plan.summary()['problems']:
+        sys.exit(1)
+
+
+COMMANDS = {
+    "serve": serve,
+    "prefetch": prefetch,
+    "ip-pools": manage_ip_pools,
+    "tune-conversion": tune_conversion,
+    "benchmark": benchmark,
+    "replay": replay,
+}
+
+
 def main():
     logger.info("{0} version {1} (build {2}) starting...".format(
         NAME, VERSION, BUILD))
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     args = get_arguments()
-    api = ProxmoxClient(ProxmoxAPI(args.proxmox_host, port=args.proxmox_port,
-                                   timeout=600, user=args.proxmox_user,
-                                   backend="openssh"))
+    api = get_client(args)
 
-    logger.info("Asking user for configuration input")
-    try:
-        (proxmox, cloudinit) = interact_with_user(args, api)
-        context = dict(proxmox, **cloudinit)
-    except KeyboardInterrupt:
-        logger.info("Aborted by user")
-        sys.exit(0)
+    if args.resume:
+        journal = load_journal(args)
+        if args.plan:
+            return plan_deployment(args, api, journal.proxmox,
+                                   journal.cloudinit)
+    else:
+        # Commands run from the discovery threads, see serve.
+        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+        images = list_images(args.cloud_images_dir)
+        discovery = ClusterDiscovery(
+            api, image=images[0] if images else None).start()
+        logger.info("Asking user for configuration input")
+        try:
+            preseed = get_preseed(args)
+            with quiet_logging():
+                (proxmox, cloudinit) = interact_with_user(args, api,
+                                                          discovery, preseed)
+        except KeyboardInterrupt:
+            discovery.cancel()
+            logger.info("Aborted by user")
+            sys.exit(0)
+        except ValueError as e:
+            discovery.cancel()
+            logger.error(e)
+            sys.exit(1)
+        except:
+            discovery.cancel()
+            raise
+        if args.record:
+            record_preseed(args, proxmox)
+        if args.plan:
+            return plan_deployment(args, api, proxmox, cloudinit)
+        # The guest agent shows that the VM booted, if the image has it.
+        proxmox['agent'] = args.wait_ready or args.capture_console
+        journal = DeployJournal.create(args.proxmox_host, proxmox, cloudinit)
+        if discovery.uploading:
+            logger.info("Waiting for the upload of the image to finish")
+        status = discovery.wait_for_upload()
+        if status is not None:
+            logger.info("Image cache on the node: {0}".format(status))
+
+    if args.trace:
+        args.recorder.record_deployment(journal.proxmox, journal.cloudinit)
 
     logger.info("")
     logger.info("")
     logger.info("Starting provisioning process")
 
+    timer = PhaseTimer()
     try:
-        api.create_vm(node=proxmox['node'], vmid=proxmox['vmid'],
-                      name=cloudinit['name'], cpu=proxmox['cpu'],
-                      cpu_family=proxmox['cpu_family'],
-                      memory=proxmox['memory'], vlan_id=cloudinit['vlan_id'])
+        deploy(api, journal, timer=timer)
     except ResourceException:
-        logger.error("Failed to create VM")
+        if not journal.is_done("create_vm"):
+            logger.error("Failed to create VM")
+        else:
+            logger.error("Provisioning failed")
+        logger.error("Resume with: --resume {0}".format(journal.filename))
         sys.exit(1)
-
-    try:
-        cloudinit_iso = generate_seed_iso(context=context)
-        logger.debug("File generated at: {0}".format(cloudinit_iso))
-
-        logger.info("Uploading cloud-init seed ISO to Proxmox")
-        api.attach_seed_iso(node=proxmox['node'], storage=proxmox["storage"],
-                            vmid=proxmox['vmid'], iso_file=cloudinit_iso)
-        logger.info("Uploading cloud image to Proxmox")
-        disk_size = proxmox['disk'] * 1024 ** 2
-        api.attach_base_disk(node=proxmox['node'], storage=proxmox["storage"],
-                             vmid=proxmox['vmid'],
-                             img_file=cloudinit['image'],
-                             disk_size=disk_size)
-        logger.info("Adding serial console to VM")
-        api.attach_serial_console(node=proxmox['node'], vmid=proxmox['vmid'])
     except CommandInvocationException as cie:
         logger.error("Provisioning failed")
         if hasattr(cie, "stdout") or hasattr(cie, "stderr"):
@@ -138,16 +1064,28 @@ def main():
             logger.error(cie.stdout)
         if hasattr(cie, "stderr"):
             logger.error(cie.stderr)
+        logger.error("Resume with: --resume {0}".format(journal.filename))
         sys.exit(1)
-    finally:
-        if os.path.exists(cloudinit_iso):
-            logger.debug("Removing seed ISO file")
-            os.remove(cloudinit_iso)
 
-    if cloudinit['start_vm']:
-        logger.info("Starting VM")
-        api.start_vm(node=proxmox['node'], vmid=proxmox['vmid'])
+    guest = None
+    if (args.wait_ready or args.capture_console) and \
+            journal.is_done("start_vm"):
+        logger.info("Waiting for the VM to become ready")
+        waiter = ReadinessWaiter(api, timeout=args.ready_timeout,
+                                 check_cloud_init=args.check_cloud_init,
+                                 capture_console=args.capture_console)
+        guest = waiter.add_deployment(journal)
+        waiter.wait([guest])
+        waiter.stop()
+        if guest.console is not None:
+            for stage, seconds in guest.console.profile.iteritems():
+                logger.info("{0:<20} {1:>8.1f}s".format(stage, seconds))
+    if args.report:
+        with open(args.report, "w") as _file:
+            json.dump(build_report(journal, timer, guest), _file, indent=2)
+        logger.info("Wrote report to {0}".format(args.report))
 
+    journal.remove()
     logger.info("Virtual Machine provisioning completed")
 
 if __name__ == "__main__":
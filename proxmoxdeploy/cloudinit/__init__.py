@@ -15,11 +15,13 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see http://www.gnu.org/licenses/.
 
+from ..cache import get_cache_dir
 from ..exceptions import CommandInvocationException
-from .templates import generate_user_data, generate_meta_data
+from .templates import render_seed_data
 from distutils.spawn import find_executable
 from shutil import rmtree
 from subprocess import Popen, PIPE
+import hashlib
 import logging
 import os
 import shlex
@@ -43,6 +45,9 @@ if not BUILDISO_COMMAND:
         "genisoimage (Linux) or mkisofs (FreeBSD) command is missing, "
         "make sure it is installed.")
 
+# Amount of seed ISOs kept in the local cache. The least recently used ones
+# are removed first.
+MAX_CACHED_SEED_ISOS = 64
 CLI_ECHO_COMMANDS = False
 CLI_ECHO_COMMAND_MESSAGE = "  Running command: `{0}`"
 CLI_COMMAND_PREFIX = ""
@@ -98,6 +103,44 @@ def call_cli(command, error_message=None, expected_return_code=0):
     return (stdout, stderr)
 
 
+def seed_data_digest(seed_data):
+    """
+    Calculates a digest over rendered seed files. Identical seed files result
+    in an identical digest, and therefore an identical seed ISO.
+
+    Parameters
+    ----------
+    seed_data: dict
+        Mapping of seed filename to contents, as returned by render_seed_data.
+
+    Returns
+    -------
+    Hex encoded SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    for filename in sorted(seed_data):
+        digest.update(filename)
+        digest.update("\0")
+        digest.update(hashlib.sha256(seed_data[filename]).digest())
+    return digest.hexdigest()
+
+
+def _build_seed_iso(seed_data, output_file):
+    temp_dir = tempfile.mkdtemp(prefix="cloudinit-seed-iso")
+    logger.info("Generating cloud-init seed files at {0}".format(temp_dir))
+    try:
+        for filename, data in seed_data.iteritems():
+            with open(os.path.join(temp_dir, filename), "wb") as seed_file:
+                seed_file.write(data)
+
+        logger.info("Generating cloud-init seed ISO at {0}"
+                    .format(output_file))
+        call_cli(BUILDISO_COMMAND.format(output_file, temp_dir))
+    finally:
+        logger.info("Removing cloud-init temp files")
+        rmtree(temp_dir)
+
+
 def generate_seed_iso(context, output_file=None):
     """
     Calls genisofs to create an cloud-init compatible ISO file. This ISO file
@@ -117,14 +160,73 @@ def generate_seed_iso(context, output_file=None):
         output_file = tempfile.mkstemp(prefix="cloudinit-seed-iso-",
                                        suffix=".iso")[1]
 
-    temp_dir = tempfile.mkdtemp(prefix="cloudinit-seed-iso")
-    logger.info("Generating cloud-init seed files at {0}".format(temp_dir))
-    generate_user_data(os.path.join(temp_dir, "user-data"), context)
-    generate_meta_data(os.path.join(temp_dir, "meta-data"), context)
+    _build_seed_iso(render_seed_data([context])[0], output_file)
+    return output_file
 
-    logger.info("Generating cloud-init seed ISO at {0}".format(output_file))
-    call_cli(BUILDISO_COMMAND.format(output_file, temp_dir))
 
-    logger.info("Removing cloud-init temp files")
-    rmtree(temp_dir)
-    return output_file
+def generate_cached_seed_iso(context):
+    """
+    Like generate_seed_iso, but keeps the ISO file in a local cache keyed by
+    the digest of the rendered seed files. If the seed files are identical to
+    an earlier run, the cached ISO is returned without building it again.
+
+    The returned ISO file is owned by the cache, and must not be removed. The
+    cache keeps the MAX_CACHED_SEED_ISOS most recently used ISOs.
+
+    Parameters
+    ----------
+    context: dict
+        Dict-like object to use as context for generating the user-data and
+        meta-data files.
+
+    Returns
+    -------
+    Tuple containing (filename, digest).
+    """
+    seed_data = render_seed_data([context])[0]
+    digest = seed_data_digest(seed_data)
+    output_file = os.path.join(get_cache_dir("seed-isos"),
+                               "{0}.iso".format(digest))
+
+    if os.path.exists(output_file):
+        logger.info("Using cached cloud-init seed ISO at {0}"
+                    .format(output_file))
+        os.utime(output_file, None)
+        return (output_file, digest)
+
+    # Build next to the final location, and move it into place once complete.
+    # This way, a failed build never ends up in the cache.
+    temp_file = tempfile.mkstemp(prefix="cloudinit-seed-iso-", suffix=".iso",
+                                 dir=os.path.dirname(output_file))[1]
+    try:
+        _build_seed_iso(seed_data, temp_file)
+        os.rename(temp_file, output_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    _prune_seed_isos(os.path.dirname(output_file))
+    return (output_file, digest)
+
+
+def _prune_seed_isos(directory):
+    """
+    Removes the least recently used seed ISOs from the local cache, beyond
+    MAX_CACHED_SEED_ISOS.
+    """
+    isos = []
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        # Skip ISOs that are still being built.
+        if filename.endswith(".iso") and \
+                not filename.startswith("cloudinit-seed-iso-"):
+            try:
+                isos.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+    isos.sort()
+    for _, path in isos[:max(0, len(isos) - MAX_CACHED_SEED_ISOS)]:
+        try:
+            os.remove(path)
+        except OSError:
+            # Removed by another process in the meantime.
+            pass
@@ -18,12 +18,15 @@
 from proxmoxdeploy.questions import QuestionGroup, OptionalQuestionGroup, \
     SpecificAnswerOptionalQuestionGroup, Question, BooleanQuestion, \
     EnumQuestion, NoAskQuestion, IntegerQuestion, MultipleAnswerQuestion, \
-    FileQuestion
-from jinja2 import Environment, PackageLoader, Template
+    FileQuestion, EnumOrURLQuestion, preseed_answers
+from proxmoxdeploy.cache import get_cache_dir
+from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache
 from subprocess import Popen, PIPE
+import hashlib
 import locale
 import os
 import pytz
+import threading
 
 VALID_LOCALES = sorted(set(locale.locale_alias.values()))
 VALID_KEYBOARD_LAYOUTS = [
@@ -40,6 +43,13 @@ VALID_TIMEZONES = sorted(pytz.common_timezones)
 VALID_IMAGE_FORMATS = [".iso", ".img", ".qcow2", ".raw"]
 VALID_COMPRESSION_FORMATS = [".xz", ".gz", ".bz2"]
 
+USER_DATA_TEMPLATE = "user-data.j2"
+META_DATA_TEMPLATE = "meta-data.j2"
+
+_environment = None
+_custom_templates = {}
+_template_lock = threading.Lock()
+
 DEFAULT_SSH_KEYS = None
 try:
     agent = Popen(["ssh-add", "-L"], stdout=PIPE)
@@ -124,27 +134,139 @@ QUESTIONS = QuestionGroup([
 ])
 
 
-def ask_cloudinit_questions(cloud_images_dir):
+def ask_cloudinit_questions(cloud_images_dir, ip_pools=None,
+                            image_chosen=None, preseed=None, defaults=False):
+    """
+    Asks all cloud-init questions.
+
+    Parameters
+    ----------
+    cloud_images_dir: str
+        Directory containing Cloud images.
+    ip_pools: list of str
+        Names of IP pools, offered as network types besides "static" and
+        "dhcp". If a pool is chosen, its name is in the answers as "ip_pool",
+        and the static network questions are not asked.
+    image_chosen: callable
+        Called with the chosen image, before the other questions are asked.
+    preseed: dict
+        Answers to questions that are not asked, see preseed_answers. The
+        image may be preseeded by its filename.
+    defaults: bool
+        Whether questions without a preseeded answer are answered with their
+        default, if they have one.
+    """
     global QUESTIONS
     images = list_images(cloud_images_dir)
-    if len(images) < 1:
-        raise RuntimeError("Cloud images directory contains no valid images.")
-    QUESTIONS['_basic']['image'] = EnumQuestion("What Cloud image to upload",
-                                                valid_answers=images,
-                                                default=images[0])
-    QUESTIONS.ask_all()
-    return QUESTIONS.flatten_answers()
+    QUESTIONS['_basic']['image'] = EnumOrURLQuestion(
+        "What Cloud image to upload", valid_answers=images,
+        default=images[0] if images else None)
+    ip_pools = list(ip_pools or [])
+    network_type = QUESTIONS['_network']['_static_network'].optional_question
+    network_type.valid_answers = ["static", "dhcp"] + ip_pools
+    preseed = dict(preseed or {})
+    for image in images:
+        if preseed.get("image") == os.path.basename(image):
+            preseed['image'] = image
+    preseed_answers(QUESTIONS, preseed, defaults)
+    QUESTIONS['_basic'].ask_all()
+    if image_chosen is not None:
+        image_chosen(QUESTIONS['_basic']['image'].answer)
+    for key, questions in QUESTIONS.iteritems():
+        if key != "_basic":
+            questions.ask_all()
+    answers = QUESTIONS.flatten_answers()
+    if answers.get("configure_network") and network_type.answer in ip_pools:
+        answers['ip_pool'] = network_type.answer
+    return answers
 
 
-def _generate_data(output_file, context, template_file, default_template):
+def get_environment():
+    """
+    Get the Jinja2 environment shared by all renders. It is built on first use.
+    Parsed templates are kept in the environment, and their compiled bytecode
+    is cached on disk for later runs.
+    """
+    global _environment
+    with _template_lock:
+        if _environment is None:
+            _environment = Environment(
+                loader=PackageLoader("proxmoxdeploy.cloudinit"),
+                bytecode_cache=FileSystemBytecodeCache(
+                    get_cache_dir("jinja2")),
+                auto_reload=False)
+        return _environment
+
+
+def get_template(template_file=None, default_template=None):
+    """
+    Get a compiled template. Custom templates are memoised by their contents.
+
+    Parameters
+    ----------
+    template_file: file or str
+        File to read the Jinja2 template from, or the template source itself.
+        If not set, default_template is loaded from the package.
+    default_template: str
+        Name of the packaged template to load.
+    """
+    env = get_environment()
     if not template_file:
-        env = Environment(loader=PackageLoader("proxmoxdeploy.cloudinit"))
-        template = env.get_template(default_template)
+        return env.get_template(default_template)
+
+    if hasattr(template_file, "read"):
+        source = template_file.read()
     else:
-        template = Template(template_file.read())
+        source = template_file
+    if isinstance(source, unicode):
+        key = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    else:
+        key = hashlib.sha1(source).hexdigest()
+
+    with _template_lock:
+        template = _custom_templates.get(key)
+        if template is None:
+            template = env.from_string(source)
+            _custom_templates[key] = template
+        return template
+
+
+def _render(template, context):
+    return template.render(context=context).encode("utf-8")
+
+
+def render_seed_data(contexts, user_data_template=None,
+                     meta_data_template=None):
+    """
+    Renders the user-data and meta-data files for many contexts, in memory.
+    Every template is parsed only once.
+
+    Parameters
+    ----------
+    contexts: iterable of dicts
+        Dict(-like) objects where the required template variables can be
+        looked up.
+    user_data_template: file or str
+        Custom user-data template, see get_template.
+    meta_data_template: file or str
+        Custom meta-data template, see get_template.
 
-    with open(output_file, "w") as output:
-        output.write(template.render(context=context))
+    Returns
+    -------
+    List of dicts, containing the rendered "user-data" and "meta-data" as
+    bytes, in the order of contexts.
+    """
+    user_data = get_template(user_data_template, USER_DATA_TEMPLATE)
+    meta_data = get_template(meta_data_template, META_DATA_TEMPLATE)
+    return [{"user-data": _render(user_data, context),
+             "meta-data": _render(meta_data, context)}
+            for context in contexts]
+
+
+def _generate_data(output_file, context, template_file, default_template):
+    template = get_template(template_file, default_template)
+    with open(output_file, "wb") as output:
+        output.write(_render(template, context))
 
 
 def list_images(_dir):
@@ -152,6 +274,8 @@ def list_images(_dir):
     Walks the given directory recursively and list all usable images.
     """
     images = []
+    if not _dir:
+        return images
     for root, subdirs, files in os.walk(_dir):
         if subdirs:
             for subdir in subdirs:
@@ -178,7 +302,7 @@ def generate_user_data(output_file, context, template_file=None):
         File to read the Jinja2 template to populate from. If not set, will
         load the default template. The file will be read to the end.
     """
-    _generate_data(output_file, context, template_file, "user-data.j2")
+    _generate_data(output_file, context, template_file, USER_DATA_TEMPLATE)
 
 
 def generate_meta_data(output_file, context, template_file=None):
@@ -196,4 +320,4 @@ def generate_meta_data(output_file, context, template_file=None):
         File to read the Jinja2 template to populate from. If not set, will
         load the default template. The file will be read to the end.
     """
-    _generate_data(output_file, context, template_file, "meta-data.j2")
+    _generate_data(output_file, context, template_file, META_DATA_TEMPLATE)
@@ -0,0 +1,277 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Captures the serial console of a VM during its first boot, and derives a boot
+profile from it: how long the firmware, the kernel, the stages of cloud-init
+and the work done in them took.
+"""
+
+from .cache import get_cache_dir
+from collections import OrderedDict
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+# Unix socket QEMU serves the first serial port of a VM on.
+SERIAL_SOCKET = "/var/run/qemu-server/{0}.serial0"
+# Seconds the console is still read after the VM was found ready by other
+# means, for the last lines of cloud-init.
+CONSOLE_GRACE = 5.0
+# Events of the boot, and the first console line that marks each of them.
+# Events that can appear repeatedly are marked by their first and last line.
+KERNEL_PATTERN = re.compile(r"^\[\s*(\d+\.\d+)\]")
+BOOT_EVENTS = OrderedDict([
+    ("kernel", re.compile(r"^\[\s*0\.0+\]|Linux version")),
+    ("init", re.compile(r"Run /sbin/init|Freeing unused kernel memory|"
+                        r"systemd\[1\]: systemd")),
+    ("cloud_init_local",
+     re.compile(r"Cloud-init v\. \S+ running 'init-local'")),
+    ("cloud_init_init", re.compile(r"Cloud-init v\. \S+ running 'init'")),
+    ("cloud_init_config",
+     re.compile(r"Cloud-init v\. \S+ running 'modules:config'")),
+    ("cloud_init_final",
+     re.compile(r"Cloud-init v\. \S+ running 'modules:final'")),
+    ("cloud_init_finished", re.compile(r"Cloud-init v\. \S+ finished")),
+])
+ACTIVITY_PATTERNS = OrderedDict([
+    ("packages", re.compile(r"Reading package lists|^(Get|Hit|Ign):\d+ |"
+                            r"Unpacking |Setting up ")),
+    ("chef", re.compile(r"Chef Client|chef-client|Chef Run")),
+])
+# Stages of the boot profile, between two events.
+BOOT_STAGES = (
+    ("firmware", "start", "kernel"),
+    ("kernel", "kernel", "init"),
+    ("userspace", "init", "cloud_init_local"),
+    ("cloud_init_local", "cloud_init_local", "cloud_init_init"),
+    ("cloud_init_init", "cloud_init_init", "cloud_init_config"),
+    ("cloud_init_config", "cloud_init_config", "cloud_init_final"),
+    ("cloud_init_final", "cloud_init_final", "cloud_init_finished"),
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_boot_profile(lines):
+    """
+    Derives a boot profile from console lines.
+
+    Parameters
+    ----------
+    lines: list of tuples
+        Lines of the console, as (seconds since the start of the VM, text).
+
+    Returns
+    -------
+    OrderedDict mapping stages to seconds, for the stages of BOOT_STAGES of
+    which both events were seen, and for the activities of
+    ACTIVITY_PATTERNS from their first to their last line.
+    """
+    events = {"start": 0.0}
+    kernel_times = {}
+    activities = OrderedDict()
+    for elapsed, text in lines:
+        for event, pattern in BOOT_EVENTS.iteritems():
+            if event not in events and pattern.search(text):
+                events[event] = elapsed
+                match = KERNEL_PATTERN.match(text)
+                if match:
+                    kernel_times[event] = float(match.group(1))
+        for activity, pattern in ACTIVITY_PATTERNS.iteritems():
+            if pattern.search(text):
+                first, last = activities.get(activity, (elapsed, elapsed))
+                activities[activity] = (first, elapsed)
+
+    # Not every image runs init-local, then init marks the start of cloud-init.
+    if "cloud_init_local" not in events and "cloud_init_init" in events:
+        events['cloud_init_local'] = events['cloud_init_init']
+
+    profile = OrderedDict()
+    for stage, start, end in BOOT_STAGES:
+        if start in events and end in events and events[end] > events[start]:
+            profile[stage] = events[end] - events[start]
+    if "kernel" in kernel_times and "init" in kernel_times:
+        # Timestamps of the kernel are more precise than the time the lines
+        # were read.
+        profile['kernel'] = kernel_times['init'] - kernel_times['kernel']
+    for activity, (first, last) in activities.iteritems():
+        profile[activity] = last - first
+    return profile
+
+
+class CommandStream(object):
+    """
+    Output of a command running on a node, line by line.
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def readline(self):
+        return self.pipe.stdout.readline()
+
+    def close(self):
+        if self.pipe.poll() is None:
+            self.pipe.kill()
+        self.pipe.wait()
+
+
+def open_command_stream(session, command):
+    """
+    Starts a command on a node, of which the output is read while it runs.
+    Sessions with an ``open_stream`` method are used directly, for others a
+    new ssh process is started.
+
+    Parameters
+    ----------
+    session: ProxmoxOpenSSHSession
+        Session of the node, usually ProxmoxClient._get_ssh_session().
+    command: str
+        Command to run.
+
+    Returns
+    -------
+    Stream with readline() and close() methods.
+    """
+    if hasattr(session, "open_stream"):
+        return session.open_stream(command)
+    ssh_client = session.ssh_client
+    with open(os.devnull, "w") as devnull:
+        pipe = subprocess.Popen(ssh_client.ssh_command(command, False),
+                                stdout=subprocess.PIPE, stderr=devnull,
+                                env=ssh_client.get_env())
+    return CommandStream(pipe)
+
+
+class SerialConsoleReader(object):
+    """
+    Reads the serial console of a VM in a background thread, until cloud-init
+    finished or the timeout expired, and writes it to a log. Every line is
+    logged with the seconds since the start of the VM.
+    """
+    def __init__(self, api, node, vmid, started_at=None, timeout=900,
+                 log_file=None):
+        """
+        Parameters
+        ----------
+        api: ProxmoxClient
+            Client to open the console with.
+        node: str
+            Node the VM resides on.
+        vmid: int
+            ID of the VM.
+        started_at: float
+            Time the VM was started. Defaults to now.
+        timeout: int
+            Seconds after the start of the VM to stop reading.
+        log_file: str
+            File to write the console to. By default, a file in the
+            consoles cache directory.
+        """
+        self.api = api
+        self.node = node
+        self.vmid = vmid
+        self.started_at = started_at or time.time()
+        self.timeout = timeout
+        self.log_file = log_file or os.path.join(
+            get_cache_dir("consoles"), "{0}-{1}-{2}.log".format(
+                node, vmid, int(self.started_at)))
+        self.lines = []
+        self.finished_at = None
+        self.error = None
+        self._stream = None
+        self._closed = False
+        self._timer = None
+        self._stop_at = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def running(self):
+        return not self._done.is_set()
+
+    @property
+    def profile(self):
+        return parse_boot_profile(self.lines)
+
+    def start(self):
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self, delay=0):
+        """
+        Stops reading, after delay seconds. An earlier scheduled stop is kept.
+        """
+        stop_at = time.time() + delay
+        with self._lock:
+            if self._stop_at is not None and self._stop_at <= stop_at:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            self._stop_at = stop_at
+            self._timer = threading.Timer(delay, self._close)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return not self.running
+
+    def _close(self):
+        with self._lock:
+            self._closed = True
+            if self._stream is not None:
+                self._stream.close()
+
+    def _read(self):
+        try:
+            stream = self.api.open_serial_console(self.node, self.vmid)
+            with self._lock:
+                self._stream = stream
+                if self._closed:
+                    stream.close()
+            self.stop(max(0, self.started_at + self.timeout - time.time()))
+            with open(self.log_file, "w") as log:
+                self._copy(stream, log)
+        except Exception as e:
+            logger.warning("Reading the console of VM {0} failed: {1}".format(
+                self.vmid, e))
+            self.error = str(e)
+        finally:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+            self._close()
+            self._done.set()
+
+    def _copy(self, stream, log):
+        finished = BOOT_EVENTS['cloud_init_finished']
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            elapsed = time.time() - self.started_at
+            text = line.rstrip("\r\n")
+            self.lines.append((elapsed, text))
+            log.write("[{0:9.3f}] {1}\n".format(elapsed, text))
+            log.flush()
+            if finished.search(text):
+                self.finished_at = time.time()
+                return
@@ -0,0 +1,323 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Conversion of images into virtual disks with qemu-img, with settings tuned
+per storage.
+"""
+
+from configobj import ConfigObj
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_MODES = ("none", "writeback", "writethrough", "directsync", "unsafe")
+# Settings, and the qemu-img convert option that is needed for them.
+SETTING_OPTIONS = {"coroutines": "-m", "unordered_writes": "-W",
+                   "target_cache": "-t", "source_cache": "-T"}
+# Values tried for every setting by ConversionEngine.tune, in this order.
+TUNING_CANDIDATES = [
+    ("coroutines", [1, 4, 8, 16]),
+    ("unordered_writes", [False, True]),
+    ("target_cache", [None, "none", "writeback"]),
+]
+
+
+class ConversionSettings(object):
+    """
+    Settings of qemu-img convert. Settings that are None are left to the
+    default of qemu-img.
+    """
+    def __init__(self, coroutines=None, unordered_writes=False,
+                 target_cache=None, source_cache=None):
+        """
+        Parameters
+        ----------
+        coroutines: int
+            Amount of parallel coroutines, 1 to 16.
+        unordered_writes: bool
+            Allow writes to the target out of order.
+        target_cache: str
+            Cache mode of the target, one of CACHE_MODES.
+        source_cache: str
+            Cache mode of the source, one of CACHE_MODES.
+        """
+        if coroutines is not None and not 1 <= coroutines <= 16:
+            raise ValueError("Amount of coroutines must be between 1 and 16")
+        for cache in (target_cache, source_cache):
+            if cache is not None and cache not in CACHE_MODES:
+                raise ValueError("Unknown cache mode: {0}".format(cache))
+        self.coroutines = coroutines
+        self.unordered_writes = unordered_writes
+        self.target_cache = target_cache
+        self.source_cache = source_cache
+
+    def __eq__(self, other):
+        return self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return ", ".join("{0}={1}".format(key, value) for key, value
+                         in sorted(self.as_dict().items()))
+
+    def as_dict(self):
+        return {"coroutines": self.coroutines,
+                "unordered_writes": self.unordered_writes,
+                "target_cache": self.target_cache,
+                "source_cache": self.source_cache}
+
+    def replace(self, **settings):
+        """
+        Get a copy of the settings, with some settings replaced.
+        """
+        values = self.as_dict()
+        values.update(settings)
+        return ConversionSettings(**values)
+
+    def update(self, section):
+        """
+        Get a copy of the settings, with the settings of a config section
+        applied. Keys are written with dashes, and "default" resets a setting
+        to the default of qemu-img.
+
+        Parameters
+        ----------
+        section: dict
+            Config section with string values.
+        """
+        values = {}
+        for key, value in section.items():
+            key = key.replace("-", "_")
+            if key not in SETTING_OPTIONS:
+                logger.warning("Ignoring unknown conversion setting {0}"
+                               .format(key))
+                continue
+            if value in (None, "default"):
+                value = None
+            elif key == "coroutines":
+                value = int(value)
+            elif key == "unordered_writes":
+                value = str(value).lower() in ("1", "true", "yes", "on")
+            values[key] = value
+        return self.replace(**values)
+
+    def as_config(self):
+        """
+        Get the settings as a config section, see update.
+        """
+        return dict((key.replace("_", "-"),
+                     "default" if value is None else str(value))
+                    for key, value in self.as_dict().items())
+
+    def get_options(self):
+        """
+        Get the qemu-img convert options for these settings.
+        """
+        options = []
+        if self.coroutines is not None:
+            options += ["-m", str(self.coroutines)]
+        if self.unordered_writes:
+            options.append("-W")
+        if self.target_cache is not None:
+            options += ["-t", self.target_cache]
+        if self.source_cache is not None:
+            options += ["-T", self.source_cache]
+        return options
+
+
+# Block devices are written with parallel, unordered writes, bypassing the
+# page cache of the node. Files are written in order, so qcow2 images don't
+# get fragmented.
+STORAGE_TYPE_DEFAULTS = {
+    "dir": ConversionSettings(coroutines=8),
+    "nfs": ConversionSettings(coroutines=16),
+    "lvm": ConversionSettings(coroutines=16, unordered_writes=True,
+                              target_cache="none"),
+    "lvmthin": ConversionSettings(coroutines=16, unordered_writes=True,
+                                  target_cache="none"),
+    "zfspool": ConversionSettings(coroutines=16, unordered_writes=True),
+}
+
+
+class ConversionEngine(object):
+    """
+    Builds the qemu-img convert commands of a node. Settings are looked up in
+    the config for the node and storage, the storage, and the type of the
+    storage, in that order, and fall back to STORAGE_TYPE_DEFAULTS. Settings
+    the qemu-img of the node doesn't support are left out.
+    """
+    def __init__(self, config=None, overrides=None):
+        """
+        Parameters
+        ----------
+        config: dict
+            Maps "<node>/<storage>", storage names and storage types to
+            config sections with settings, see ConversionSettings.update.
+        overrides: dict
+            Settings that override the config, for all storages.
+        """
+        self.config = config or {}
+        self.overrides = overrides or {}
+        self._help = None
+
+    def supports(self, ssh, option):
+        """
+        Tests if the qemu-img of the node supports an option of convert, by
+        looking for it in the usage of qemu-img.
+        """
+        if self._help is None:
+            stdout, stderr = ssh._exec("qemu-img --help")
+            self._help = stdout + stderr
+        for line in self._help.split("\n"):
+            if line.strip().startswith("convert ") and (
+                    "[{0} ".format(option) in line or
+                    "[{0}]".format(option) in line):
+                return True
+        return False
+
+    def get_settings(self, node, storage, storage_type):
+        """
+        Get the settings for conversions into a storage.
+        """
+        settings = STORAGE_TYPE_DEFAULTS.get(storage_type,
+                                             ConversionSettings())
+        for key in (storage_type, storage, "{0}/{1}".format(node, storage)):
+            if key in self.config:
+                settings = settings.update(self.config[key])
+        return settings.replace(**self.overrides)
+
+    def get_supported(self, ssh, settings):
+        """
+        Get a copy of the settings, without the settings the qemu-img of the
+        node doesn't support.
+        """
+        unsupported = {}
+        for key, value in settings.as_dict().items():
+            if value not in (None, False) and \
+                    not self.supports(ssh, SETTING_OPTIONS[key]):
+                logger.debug("qemu-img of the node doesn't support {0}"
+                             .format(SETTING_OPTIONS[key]))
+                unsupported[key] = None if key != "unordered_writes" \
+                    else False
+        return settings.replace(**unsupported)
+
+    def get_command(self, ssh, settings, disk_format, source, target,
+                    rate=None, target_is_zero=False):
+        """
+        Get the qemu-img convert command. The target is always allocated
+        beforehand, so it is converted into as it is, instead of recreated.
+
+        Parameters
+        ----------
+        ssh: ProxmoxBaseSSHSession subclass
+            Session to probe qemu-img with.
+        settings: ConversionSettings
+            Settings of the conversion.
+        disk_format: raw or qcow2
+            Format of the target.
+        source: str
+            Path of the image on the node.
+        target: str
+            Path of the virtual disk on the node.
+        rate: int
+            Maximum bandwidth of the conversion, in bytes per second.
+        target_is_zero: bool
+            If the target is known to read as zeroes, so zeroes in the source
+            don't have to be written.
+        """
+        options = self.get_supported(ssh, settings or ConversionSettings()) \
+            .get_options()
+        if rate and self.supports(ssh, "-r"):
+            options += ["-r", str(rate)]
+        elif rate:
+            logger.warning("qemu-img of the node can't limit the bandwidth of "
+                           "conversions")
+        options.insert(0, "-n")
+        if target_is_zero and self.supports(ssh, "--target-is-zero"):
+            options.insert(1, "--target-is-zero")
+        return "qemu-img convert {0}-O {1} '{2}' {3}".format(
+            "".join(option + " " for option in options), disk_format, source,
+            target)
+
+    def tune(self, ssh, settings, convert, rounds=1):
+        """
+        Finds the fastest settings for conversions into a storage. Starting
+        from the given settings, the values of every setting in
+        TUNING_CANDIDATES are tried in turn, keeping the fastest value.
+
+        Parameters
+        ----------
+        ssh: ProxmoxBaseSSHSession subclass
+            Session to probe qemu-img with.
+        settings: ConversionSettings
+            Settings to start from.
+        convert: callable
+            Converts a test image with the given settings.
+        rounds: int
+            Amount of conversions per settings, of which the fastest counts.
+
+        Returns
+        -------
+        Tuple of the fastest settings, and a list of (settings, seconds) of
+        all settings tried.
+        """
+        def measure(candidate):
+            durations = []
+            for _ in range(rounds):
+                start = time.time()
+                convert(candidate)
+                durations.append(time.time() - start)
+            logger.info("{0:>7.2f}s  {1}".format(min(durations), candidate))
+            results.append((candidate, min(durations)))
+            return min(durations)
+
+        results = []
+        best = self.get_supported(ssh, settings)
+        best_duration = measure(best)
+        for key, values in TUNING_CANDIDATES:
+            if not self.supports(ssh, SETTING_OPTIONS[key]):
+                continue
+            for value in values:
+                candidate = best.replace(**{key: value})
+                if candidate == best:
+                    continue
+                duration = measure(candidate)
+                if duration < best_duration:
+                    best, best_duration = candidate, duration
+        return (best, results)
+
+
+def save_settings(filename, key, settings):
+    """
+    Stores tuned settings in the conversion section of a config file.
+
+    Parameters
+    ----------
+    filename: str
+        Config file to update.
+    key: str
+        Key of the settings, see ConversionEngine.
+    settings: ConversionSettings
+        Settings to store.
+    """
+    config = ConfigObj(filename)
+    if "conversion" not in config:
+        config["conversion"] = {}
+    config["conversion"][key] = settings.as_config()
+    config.write()
@@ -0,0 +1,141 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .cloudinit import generate_cached_seed_iso
+from .ippool import DESCRIPTION
+from .metrics import PhaseTimer
+from collections import OrderedDict
+import logging
+
+# Answers that decide which costly features are in the user-data, reported
+# with the boot profile to relate boot times to them.
+USER_DATA_FEATURES = ("apt_update", "apt_upgrade", "packages",
+                      "configure_chef", "resize_rootfs", "reboot")
+
+logger = logging.getLogger(__name__)
+
+
+def deploy(api, journal, timer=None):
+    """
+    Provisions a VM from the answers in the journal. Every completed step is
+    recorded in the journal, and steps completed earlier are skipped. The
+    phases of deployments that are not resumed are recorded in the history
+    of the client.
+
+    Parameters
+    ----------
+    api: ProxmoxClient
+        Client to provision the VM with.
+    journal: DeployJournal
+        Journal containing the answers to all questions. With "agent" in
+        the Proxmox answers, the QEMU guest agent of the VM is enabled.
+    timer: PhaseTimer
+        Records the time spent in each phase. If not set, a new one is used.
+
+    Returns
+    -------
+    The PhaseTimer with the time spent in each phase.
+    """
+    if timer is None:
+        timer = PhaseTimer()
+    resumed = bool(journal.steps)
+    proxmox = journal.proxmox
+    cloudinit = journal.cloudinit
+    context = dict(proxmox, **cloudinit)
+    description = None
+    if cloudinit.get("ip_address"):
+        description = DESCRIPTION.format(cloudinit['ip_address'])
+
+    with timer.phase("create_vm"):
+        journal.run("create_vm", api.create_vm, node=proxmox['node'],
+                    vmid=proxmox['vmid'], name=cloudinit['name'],
+                    cpu=proxmox['cpu'], cpu_family=proxmox['cpu_family'],
+                    memory=proxmox['memory'], vlan_id=cloudinit['vlan_id'],
+                    description=description,
+                    agent=proxmox.get("agent", False))
+
+    if not journal.is_done("seed_iso"):
+        with timer.phase("generate_seed_iso"):
+            cloudinit_iso, seed_digest = generate_cached_seed_iso(
+                context=context)
+            logger.debug("File generated at: {0}".format(cloudinit_iso))
+
+        logger.info("Uploading cloud-init seed ISO to Proxmox")
+        with timer.phase("attach_seed_iso"):
+            journal.run("seed_iso", api.attach_seed_iso,
+                        node=proxmox['node'], storage=proxmox["storage"],
+                        vmid=proxmox['vmid'], iso_file=cloudinit_iso,
+                        digest=seed_digest)
+
+    logger.info("Uploading cloud image to Proxmox")
+    disk_size = proxmox['disk'] * 1024 ** 2
+    with timer.phase("attach_base_disk"):
+        api.attach_base_disk(node=proxmox['node'], storage=proxmox["storage"],
+                             vmid=proxmox['vmid'],
+                             img_file=cloudinit['image'],
+                             disk_size=disk_size, journal=journal)
+    logger.info("Adding serial console to VM")
+    with timer.phase("attach_serial_console"):
+        journal.run("serial_console", api.attach_serial_console,
+                    node=proxmox['node'], vmid=proxmox['vmid'])
+
+    if cloudinit['start_vm']:
+        logger.info("Starting VM")
+        with timer.phase("start_vm"):
+            journal.run("start_vm", api.start_vm, node=proxmox['node'],
+                        vmid=proxmox['vmid'])
+    if not resumed:
+        api.history.record_deployment(proxmox['node'], timer)
+    return timer
+
+
+def build_report(journal, timer, guest=None):
+    """
+    Builds the report of a deployment.
+
+    Parameters
+    ----------
+    journal: DeployJournal
+        Journal of the deployment.
+    timer: PhaseTimer
+        Time spent in each phase of the deployment.
+    guest: GuestState
+        Readiness of the deployed VM, if it was waited for.
+
+    Returns
+    -------
+    Dict with the VM, the time spent in each phase, the readiness of the VM
+    and, if its console was captured, its boot profile together with the
+    features of the user-data that affect it.
+    """
+    boot_profile = None
+    if guest is not None and guest.console is not None:
+        boot_profile = guest.console.profile
+    return OrderedDict([
+        ("name", journal.cloudinit.get("name")),
+        ("vmid", journal.proxmox.get("vmid")),
+        ("node", journal.proxmox.get("node")),
+        ("storage", journal.proxmox.get("storage")),
+        ("image", journal.cloudinit.get("image")),
+        ("phases", timer.as_dict()),
+        ("deploy_seconds", timer.total),
+        ("readiness", guest.as_dict() if guest is not None else None),
+        ("boot_profile", boot_profile),
+        ("user_data_features", OrderedDict(
+            (feature, bool(journal.cloudinit.get(feature)))
+            for feature in USER_DATA_FEATURES)),
+    ])
@@ -0,0 +1,168 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Discovery of the cluster in the background, while the user answers the
+questions.
+"""
+
+from .exceptions import UploadCancelledException
+from .imagecache import is_image_url
+from .snapshot import ClusterSnapshot
+import logging
+import threading
+
+# Seconds to wait for a cancelled upload to stop.
+CANCEL_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterDiscovery(object):
+    """
+    Discovers the nodes, storages, capacity and next VM id of the cluster,
+    and the state of an image in the image cache of the node, in background
+    threads. It has the methods of ProxmoxClient that ask_proxmox_questions
+    uses, which wait for the discovery instead of calling the API.
+
+    Once the user chose an image, it can be uploaded into the image cache of
+    the node speculatively, while the other questions are answered. The
+    deployment then finds it there.
+    """
+    def __init__(self, api, image=None):
+        """
+        Parameters
+        ----------
+        api: ProxmoxClient
+            Client to discover the cluster with.
+        image: str
+            Image to discover the state of in the image cache, usually the
+            default answer to the image question.
+        """
+        self.api = api
+        self.image = image
+        self.snapshot = ClusterSnapshot(api, ttl=float("inf"))
+        self.next_vmid = None
+        self.image_cache_status = None
+        self.upload_status = None
+        self._error = None
+        self._discovered = threading.Event()
+        self._cancel = threading.Event()
+        self._threads = []
+        self._upload = None
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def start(self):
+        self._start(self._discover_cluster)
+        if self.image and not is_image_url(self.image):
+            self._start(self._discover_image)
+        return self
+
+    def _discover_cluster(self):
+        try:
+            self.snapshot.get()
+            self.next_vmid = self.api.get_next_vmid()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._discovered.set()
+
+    def _discover_image(self):
+        try:
+            self.image_cache_status = self.api.get_image_cache_status(
+                self.image)
+        except Exception as e:
+            logger.debug("Failed to get the state of {0} in the image cache: "
+                         "{1}".format(self.image, e))
+
+    def _get_nodes(self):
+        self._discovered.wait()
+        if self._error is not None:
+            raise self._error
+        return self.snapshot.get()
+
+    def get_nodes(self):
+        return list(self._get_nodes())
+
+    def get_storage(self, node):
+        return list(self._get_nodes()[node]['storage'])
+
+    def get_max_cpu(self, node):
+        return self._get_nodes()[node]['cpu']
+
+    def get_max_memory(self, node):
+        return self._get_nodes()[node]['memory']
+
+    def get_max_disk_size(self, node, storage):
+        return self._get_nodes()[node]['storage'][storage]
+
+    def get_next_vmid(self):
+        self._get_nodes()
+        return self.next_vmid
+
+    def upload(self, image):
+        """
+        Starts uploading an image into the image cache of the node. Only local
+        images are uploaded, the node downloads URLs when deploying.
+        """
+        if is_image_url(image) or self._upload is not None:
+            return
+        if image == self.image and self.image_cache_status == "warm":
+            self.upload_status = "warm"
+            return
+        self._upload = self._start(self._prefetch, image)
+
+    @property
+    def uploading(self):
+        return self._upload is not None and self._upload.is_alive()
+
+    def _prefetch(self, image):
+        try:
+            self.upload_status = self.api.prefetch_image(image,
+                                                         cancel=self._cancel)
+        except UploadCancelledException:
+            self.upload_status = "cancelled"
+        except Exception as e:
+            logger.debug("Failed to upload {0} ahead of time: {1}".format(
+                image, e))
+            self.upload_status = "failed"
+
+    def wait_for_upload(self):
+        """
+        Waits for the upload of the image to finish.
+
+        Returns
+        -------
+        How the image was cached, see NodeImageCache.prefetch, "failed" if
+        the upload failed, or None if no image was uploaded.
+        """
+        if self._upload is not None:
+            self._upload.join()
+        return self.upload_status
+
+    def cancel(self):
+        """
+        Aborts the upload of the image, for example when the user aborted.
+        """
+        self._cancel.set()
+        if self._upload is not None:
+            self._upload.join(CANCEL_TIMEOUT)
@@ -26,3 +26,7 @@ class CommandInvocationException(RuntimeError):
 
 class SSHCommandInvocationException(CommandInvocationException):
     pass
+
+
+class UploadCancelledException(RuntimeError):
+    pass
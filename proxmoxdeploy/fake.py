@@ -0,0 +1,1111 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+"""
+Local stand-in for a Proxmox node. It implements the parts of the Proxmox API
+and the commands over SSH that proxmox-deploy uses, with configurable latency
+and bandwidth. Only the contents of small files are stored, of larger files
+only their sizes, so large images can be simulated cheaply.
+"""
+
+from . import blocksync
+from .httpsapi import API_PATH
+from .readiness import PROBE_SCRIPT, get_mac_address
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from proxmoxer.core import ProxmoxResource
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+import Cookie
+import hashlib
+import json
+import os
+import re
+import shlex
+import struct
+import threading
+import time
+import urllib2
+import urlparse
+import uuid
+
+QCOW2_MAGIC = "QFI\xfb"
+COMPRESSION_COMMANDS = {"unxz": ".xz", "gunzip": ".gz", "bunzip2": ".bz2"}
+# Assumed ratio between the decompressed and compressed size of an image.
+DECOMPRESSION_RATIO = 3
+# Serial console of a booting VM, as (stage, fraction, line). Lines of the boot
+# stage appear at the fraction of the boot time, lines of the cloud-init stage
+# at the fraction of the time between the boot and cloud-init being done.
+FAKE_CONSOLE = [
+    ("boot", 0.0, "SeaBIOS (version 1.10.2)"),
+    ("boot", 0.1, "[    0.000000] Linux version 4.4.0-21-generic"),
+    ("boot", 0.5, "[    1.842117] Run /sbin/init as init process"),
+    ("boot", 0.6, "[    2.104592] systemd[1]: systemd 229 running in system "
+                  "mode."),
+    ("boot", 0.8, "Cloud-init v. 0.7.7 running 'init-local' at Mon, 11 Apr "
+                  "2016 12:00:00 +0000. Up 3.21 seconds."),
+    ("boot", 1.0, "Cloud-init v. 0.7.7 running 'init' at Mon, 11 Apr 2016 "
+                  "12:00:01 +0000. Up 4.43 seconds."),
+    ("cloud_init", 0.2, "Cloud-init v. 0.7.7 running 'modules:config' at "
+                        "Mon, 11 Apr 2016 12:00:05 +0000. Up 8.01 seconds."),
+    ("cloud_init", 0.4, "Cloud-init v. 0.7.7 running 'modules:final' at "
+                        "Mon, 11 Apr 2016 12:00:07 +0000. Up 10.12 seconds."),
+    ("cloud_init", 0.5, "Reading package lists..."),
+    ("cloud_init", 0.9, "Setting up qemu-guest-agent (2.5+dfsg-5ubuntu10)"),
+    ("cloud_init", 1.0, "Cloud-init v. 0.7.7 finished at Mon, 11 Apr 2016 "
+                        "12:00:30 +0000. Datasource DataSourceNoCloud. Up "
+                        "33.50 seconds"),
+]
+# Usage of the commands of qemu-img that are used, as printed by qemu-img 2.x.
+QEMU_IMG_HELP = """\
+qemu-img version 2.12.0
+usage: qemu-img [standard options] command [command options]
+
+Command syntax:
+  convert [--object objectdef] [--image-opts] [-c] [-p] [-q] [-n] \
+[-f fmt] [-t cache] [-T src_cache] [-O output_fmt] [-o options] \
+[-s snapshot_id_or_name] [-l snapshot_param] [-S sparse_size] \
+[-r rate_limit] [-m num_coroutines] [-W] filename [filename2 [...]] \
+output_filename
+  info [--object objectdef] [--image-opts] [-f fmt] [--output=ofmt] \
+[--backing-chain] [-U] filename
+"""
+
+
+class FakeResponse(object):
+    """
+    Response object, like the one returned by proxmoxer SSH sessions.
+    """
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        if status_code >= 400:
+            self.content = data
+        else:
+            self.content = json.dumps(data)
+        self.text = self.content
+        self.headers = {"content-type": "application/json"}
+
+
+class _JsonSerializer(object):
+    def loads(self, response):
+        return json.loads(response.content)
+
+
+class FakeFile(object):
+    """
+    A file on the fake node. Only its size, the virtual disk size of the image
+    it contains and its SHA256 digest are tracked. The contents of small text
+    files, such as dumped headers, are kept as well.
+    """
+    def __init__(self, size, virtual_size=None, digest=None, content=None,
+                 image_format=None, backing_file=None):
+        self.size = size
+        self.virtual_size = virtual_size if virtual_size else size
+        self.digest = digest
+        self.content = content
+        self.backing_file = backing_file
+        # Images of which the virtual size differs from the file size are
+        # assumed to be qcow2.
+        self.image_format = image_format or (
+            "raw" if self.virtual_size == size else "qcow2")
+
+
+class FakeProxmoxNode(object):
+    """
+    State of a fake Proxmox node: VMs, storages, volumes and files.
+    """
+    def __init__(self, name="pve", cpus=8, memory=32 * 1024 ** 3,
+                 api_latency=0.0, command_latency=0.0, bandwidth=None,
+                 disk_bandwidth=None, storages=None, version="4.1-1",
+                 max_content_size=64 * 1024 ** 2, iowait=0.0, boot_time=0.0,
+                 cloud_init_time=0.0):
+        """
+        Parameters
+        ----------
+        name: str
+            Name of the node.
+        cpus: int
+            Amount of cpus of the node.
+        memory: int
+            Memory of the node in bytes.
+        api_latency: float
+            Seconds every API call takes.
+        command_latency: float
+            Seconds every command over SSH takes, excluding data transfer.
+        bandwidth: int
+            Upload bandwidth in bytes per second. Unlimited if None.
+        disk_bandwidth: int
+            Bandwidth of conversions on the node, in bytes per second.
+            Unlimited if None.
+        storages: list of dicts
+            Storages of the node, with keys "storage", "type", "content",
+            "path" and "avail", and optionally other keys of the storage
+            config, like "blocksize". Defaults to the storages of a fresh
+            install.
+        version: str
+            Proxmox version reported by the API.
+        max_content_size: int
+            Contents of uploaded files up to this size are kept, so commands
+            can work with them.
+        iowait: float
+            I/O wait of the node reported by the API, as a fraction of cpu
+            time.
+        boot_time: float
+            Seconds after their start before VMs answer pings and show an
+            SSH banner.
+        cloud_init_time: float
+            Seconds after their start before cloud-init finished in VMs.
+        """
+        self.name = name
+        self.cpus = cpus
+        self.memory = memory
+        self.api_latency = api_latency
+        self.command_latency = command_latency
+        self.bandwidth = bandwidth
+        self.disk_bandwidth = disk_bandwidth
+        self.version = version
+        self.max_content_size = max_content_size
+        self.iowait = iowait
+        self.boot_time = boot_time
+        self.cloud_init_time = cloud_init_time
+        if storages is None:
+            storages = [
+                {"storage": "local", "type": "dir", "path": "/var/lib/vz",
+                 "content": "iso,vztmpl,backup", "avail": 100 * 1024 ** 3},
+                {"storage": "local-lvm", "type": "lvmthin", "vgname": "pve",
+                 "thinpool": "data", "content": "images,rootdir",
+                 "avail": 500 * 1024 ** 3},
+            ]
+        self.storages = dict((storage['storage'], dict(storage, active=1))
+                             for storage in storages)
+        self.vms = {}
+        self.guests = {}
+        self.volumes = {}
+        self.files = {}
+        self.tasks = {}
+        self.flocks = []
+        self.next_vmid = 100
+        self.api_calls = 0
+        self.commands = 0
+        self.bytes_uploaded = 0
+        self.lock = threading.RLock()
+
+    def reset_counters(self):
+        with self.lock:
+            self.api_calls = 0
+            self.commands = 0
+            self.bytes_uploaded = 0
+
+    def get_guest(self, address):
+        """
+        Get the running VM with the given address, or None. VMs get the
+        address 10.0.X.Y when they are started, where X.Y is their vmid.
+        """
+        for guest in self.guests.values():
+            if guest['address'] == address:
+                return guest
+        return None
+
+    def volume_path(self, volid):
+        storage, name = volid.split(":", 1)
+        _storage = self.storages[storage]
+        if _storage['type'] in ("dir", "nfs"):
+            content, _, filename = name.partition("/")
+            if content == "iso":
+                return os.path.join(_storage['path'], "template", "iso",
+                                    filename)
+            if content == "snippets":
+                return os.path.join(_storage['path'], "snippets", filename)
+            return os.path.join(_storage['path'], "images", name)
+        return os.path.join("/dev", storage, name)
+
+
+class FakeSession(object):
+    """
+    Stand-in for the proxmoxer SSH session. API requests are dispatched to
+    handlers, and commands are interpreted against the fake node.
+    """
+    def __init__(self, node, user="root@pam"):
+        """
+        Parameters
+        ----------
+        node: FakeProxmoxNode
+            Node to serve.
+        user: str
+            User the API calls are made as, with the name of its API token if
+            one is used. Only root@pam may import disks.
+        """
+        self.node = node
+        self.user = user
+        self.routes = [
+            ("GET", r"^/version$", self._get_version),
+            ("GET", r"^/cluster/nextid$", self._get_nextid),
+            ("GET", r"^/cluster/resources$", self._get_resources),
+            ("GET", r"^/nodes$", self._get_nodes),
+            ("GET", r"^/nodes/([^/]+)/status$", self._get_node_status),
+            ("GET", r"^/nodes/([^/]+)/storage$", self._get_storages),
+            ("GET", r"^/nodes/([^/]+)/storage/([^/]+)/status$",
+             self._get_storage_status),
+            ("GET", r"^/nodes/([^/]+)/storage/([^/]+)/content$",
+             self._get_storage_content),
+            ("GET", r"^/storage/([^/]+)$", self._get_storage_config),
+            ("GET", r"^/nodes/([^/]+)/qemu$", self._get_vms),
+            ("POST", r"^/nodes/([^/]+)/qemu$", self._create_vm),
+            ("GET", r"^/nodes/([^/]+)/qemu/(\d+)/config$", self._get_config),
+            ("PUT", r"^/nodes/([^/]+)/qemu/(\d+)/config$", self._set_config),
+            ("POST", r"^/nodes/([^/]+)/qemu/(\d+)/config$",
+             self._set_config_async),
+            ("PUT", r"^/nodes/([^/]+)/qemu/(\d+)/resize$", self._resize),
+            ("POST", r"^/nodes/([^/]+)/qemu/(\d+)/status/start$",
+             self._start_vm),
+            ("POST", r"^/nodes/([^/]+)/qemu/(\d+)/agent/ping$",
+             self._ping_agent),
+            ("GET", r"^/nodes/([^/]+)/tasks/([^/]+)/status$",
+             self._get_task_status),
+        ]
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        time.sleep(self.node.api_latency)
+        args = dict(data or {}, **(params or {}))
+        with self.node.lock:
+            self.node.api_calls += 1
+            for _method, pattern, handler in self.routes:
+                match = re.match(pattern, url.strip())
+                if match and _method == method.upper():
+                    try:
+                        return FakeResponse(handler(*match.groups(), **args))
+                    except (KeyError, ValueError) as e:
+                        return FakeResponse("400 Bad Request: {0}".format(e),
+                                            400)
+        return FakeResponse("501 Not Implemented: {0} {1}".format(method, url),
+                            501)
+
+    def _check_node(self, node):
+        if node != self.node.name:
+            raise KeyError("no such node '{0}'".format(node))
+
+    def _get_vm(self, node, vmid):
+        self._check_node(node)
+        return self.node.vms[int(vmid)]
+
+    def _get_version(self):
+        return {"version": self.node.version, "release": "fake"}
+
+    def _get_nextid(self, vmid=None):
+        if vmid is not None:
+            if int(vmid) in self.node.vms:
+                raise ValueError("VM {0} already exists".format(vmid))
+            return str(vmid)
+        vmid = self.node.next_vmid
+        while vmid in self.node.vms:
+            vmid += 1
+        return str(vmid)
+
+    def _get_resources(self, type=None):
+        resources = [{"type": "qemu", "id": "qemu/{0}".format(vmid),
+                      "vmid": vmid, "node": self.node.name,
+                      "status": vm['status']}
+                     for vmid, vm in sorted(self.node.vms.items())]
+        if type in (None, "vm"):
+            return resources
+        return []
+
+    def _get_nodes(self):
+        disk = sum(storage['avail']
+                   for storage in self.node.storages.values())
+        return [{"node": self.node.name, "status": "online",
+                 "maxcpu": self.node.cpus, "maxmem": self.node.memory,
+                 "maxdisk": disk}]
+
+    def _get_node_status(self, node):
+        self._check_node(node)
+        return {"cpuinfo": {"cpus": self.node.cpus, "sockets": 1},
+                "memory": {"total": self.node.memory},
+                "wait": self.node.iowait}
+
+    def _get_storages(self, node, storage=None, **kwargs):
+        self._check_node(node)
+        return [dict(_storage) for name, _storage
+                in sorted(self.node.storages.items())
+                if storage is None or name == storage]
+
+    def _get_storage_status(self, node, storage):
+        self._check_node(node)
+        return dict(self.node.storages[storage])
+
+    def _get_storage_config(self, storage):
+        return dict((key, value) for key, value
+                    in self.node.storages[storage].items()
+                    if key not in ("avail", "active"))
+
+    def _get_storage_content(self, node, storage, content=None):
+        self._check_node(node)
+        volumes = []
+        for volid, volume in sorted(self.node.volumes.items()):
+            if volid.split(":")[0] != storage:
+                continue
+            if content and volume['content'] != content:
+                continue
+            volumes.append({"volid": volid, "format": volume['format'],
+                            "size": volume['file'].size,
+                            "content": volume['content']})
+
+        # ISO images and snippets are plain files in the storage directory.
+        _storage = self.node.storages[storage]
+        for _content, subdir in (("iso", "template/iso"),
+                                 ("snippets", "snippets")):
+            if content not in (None, _content) or \
+                    _storage['type'] not in ("dir", "nfs"):
+                continue
+            directory = os.path.join(_storage['path'], subdir)
+            for path, _file in sorted(self.node.files.items()):
+                if os.path.dirname(path) == directory:
+                    volumes.append({
+                        "volid": "{0}:{1}/{2}".format(
+                            storage, _content, os.path.basename(path)),
+                        "format": _content, "size": _file.size,
+                        "content": _content})
+        return volumes
+
+    def _get_vms(self, node):
+        self._check_node(node)
+        return [{"vmid": vmid, "name": vm.get("name"), "status": vm['status']}
+                for vmid, vm in sorted(self.node.vms.items())]
+
+    def _create_vm(self, node, vmid, **config):
+        self._check_node(node)
+        vmid = int(vmid)
+        if vmid in self.node.vms:
+            raise ValueError("VM {0} already exists".format(vmid))
+        net0 = config.get("net0")
+        if net0 and get_mac_address(net0) is None:
+            model, _, options = net0.partition(",")
+            config['net0'] = "{0}=DE:AD:BE:{1:02X}:{2:02X}:{3:02X},{4}".format(
+                model, vmid >> 16 & 255, vmid >> 8 & 255, vmid & 255, options)
+        self.node.vms[vmid] = dict(config, status="stopped")
+        return "UPID:{0}:qmcreate:{1}:".format(node, vmid)
+
+    def _get_config(self, node, vmid):
+        vm = self._get_vm(node, vmid)
+        return dict((key, value) for key, value in vm.iteritems()
+                    if key != "status")
+
+    def _check_import(self, config):
+        if self.user != "root@pam" and \
+                any("import-from=" in value for value in config.values()):
+            raise ValueError("only root can set 'import-from' to a path")
+
+    def _set_config(self, node, vmid, **config):
+        self._check_import(config)
+        vm = self._get_vm(node, vmid)
+        for key, value in config.items():
+            if "import-from=" in value:
+                config[key] = self._import_disk(int(vmid), key, value)
+        vm.update(config)
+
+    def _set_config_async(self, node, vmid, **config):
+        """
+        Sets the config of a VM in a task, like Proxmox does for POST
+        requests. Drives with import-from are imported at the disk bandwidth
+        of the node, and the task fails if the image is removed meanwhile.
+        """
+        self._check_import(config)
+        self._get_vm(node, vmid)
+        upid = "UPID:{0}:qmconfig:{1}:{2}:".format(node, vmid, len(
+            self.node.tasks))
+        self.node.tasks[upid] = {"status": "running"}
+        thread = threading.Thread(target=self._run_config_task,
+                                  args=(upid, node, vmid, config))
+        thread.daemon = True
+        thread.start()
+        return upid
+
+    def _run_config_task(self, upid, node, vmid, config):
+        sources = [dict(option.split("=", 1) for option
+                        in value.split(",")[1:])['import-from']
+                   for value in config.values() if "import-from=" in value]
+        with self.node.lock:
+            size = 0
+            for source in sources:
+                _file = self.node.files.get(source)
+                if _file is not None and _file.backing_file:
+                    _file = self.node.files.get(_file.backing_file)
+                size += _file.virtual_size if _file is not None else 0
+        if self.node.disk_bandwidth:
+            time.sleep(float(size) / self.node.disk_bandwidth)
+        with self.node.lock:
+            missing = [source for source in sources
+                       if source not in self.node.files or
+                       self.node.files[source].backing_file not in
+                       (None,) + tuple(self.node.files)]
+            if missing:
+                exitstatus = "import failed: {0} is gone".format(missing[0])
+            else:
+                try:
+                    self._set_config(node, vmid, **config)
+                    exitstatus = "OK"
+                except (KeyError, ValueError) as e:
+                    exitstatus = str(e)
+            self.node.tasks[upid] = {"status": "stopped",
+                                     "exitstatus": exitstatus}
+
+    def _import_disk(self, vmid, key, value):
+        """
+        Allocates a volume for a drive with import-from, like Proxmox does.
+        The volume gets the virtual size of the imported image.
+        """
+        options = dict(option.split("=", 1)
+                       for option in value.split(",")[1:])
+        storage = value.split(":")[0]
+        source = self.node.files[options['import-from']]
+        disk_format = options.get("format", "raw")
+        index = 0
+        while True:
+            name = "vm-{0}-disk-{1}".format(vmid, index)
+            if self.node.storages[storage]['type'] in ("dir", "nfs"):
+                volid = "{0}:{1}/{2}.{3}".format(storage, vmid, name,
+                                                 disk_format)
+            else:
+                volid = "{0}:{1}".format(storage, name)
+            if volid not in self.node.volumes:
+                break
+            index += 1
+        _file = FakeFile(source.virtual_size, image_format=disk_format)
+        self.node.volumes[volid] = {"format": disk_format,
+                                    "content": "images", "file": _file}
+        self.node.files[self.node.volume_path(volid)] = _file
+        return volid
+
+    def _resize(self, node, vmid, disk, size):
+        vm = self._get_vm(node, vmid)
+        volid = vm[disk].split(",")[0]
+        self.node.volumes[volid]['file'].size = int(size)
+
+    def _start_vm(self, node, vmid):
+        vm = self._get_vm(node, vmid)
+        vm['status'] = "running"
+        vmid = int(vmid)
+        self.node.guests[vmid] = {
+            "started_at": time.time(),
+            "address": "10.0.{0}.{1}".format(vmid >> 8 & 255, vmid & 255),
+            "mac": get_mac_address(vm.get("net0", "")),
+        }
+        return "UPID:{0}:qmstart:{1}:".format(node, vmid)
+
+    def _get_task_status(self, node, upid):
+        self._check_node(node)
+        task = self.node.tasks.get(upid, {"status": "stopped",
+                                          "exitstatus": "OK"})
+        return dict(task, upid=upid)
+
+    def _ping_agent(self, node, vmid):
+        vm = self._get_vm(node, vmid)
+        guest = self.node.guests.get(int(vmid))
+        if not str(vm.get("agent", "0")).startswith(("1", "enabled=1")) or \
+                guest is None or \
+                time.time() - guest['started_at'] < self.node.boot_time:
+            raise ValueError("QEMU guest agent is not running")
+        return {}
+
+    def _exec(self, cmd):
+        if isinstance(cmd, (list, tuple)):
+            argv = list(cmd)
+        else:
+            argv = shlex.split(cmd)
+        time.sleep(self.node.command_latency)
+        with self.node.lock:
+            self.node.commands += 1
+        return self._dispatch(argv)
+
+    def _dispatch(self, argv):
+        handler = getattr(self, "_cmd_{0}".format(
+            argv[0].replace("-", "_")), None)
+        if handler is None and argv[0] in COMPRESSION_COMMANDS:
+            handler = self._cmd_decompress
+        if handler is None:
+            return ("", "bash: {0}: command not found".format(argv[0]))
+        return handler(argv)
+
+    def _cmd_bash(self, argv):
+        """
+        Runs the guest probes sent to the node, against the VMs started on
+        it. The completion marker is only checked for its existence.
+        """
+        if argv[1:3] != ["-c", PROBE_SCRIPT]:
+            return ("", "bash: only guest probes are supported")
+        now = time.time()
+        lines = []
+        for guest in self.node.guests.values():
+            if now - guest['started_at'] >= self.node.boot_time:
+                lines.append("neigh {0} dev vmbr0 lladdr {1} REACHABLE"
+                             .format(guest['address'], guest['mac']))
+        for arg in argv[5:]:
+            address = arg.lstrip("+")
+            guest = self.node.get_guest(address)
+            signals = [address]
+            if guest is not None:
+                elapsed = now - guest['started_at']
+                if elapsed >= self.node.boot_time:
+                    signals += ["ping", "ssh"]
+                    if arg.startswith("+") and \
+                            elapsed >= self.node.cloud_init_time:
+                        signals.append("cloud-init")
+            lines.append(" ".join(signals))
+        return ("\n".join(lines) + "\n", "")
+
+    def _cmd_flock(self, argv):
+        """
+        Runs the commands of a shell command line joined by "&&". The lock
+        is not taken, only recorded in the flocks of the node, as its mode,
+        the lock file and the first command run with it.
+        """
+        mode, path, command = argv[1], argv[2], argv[-1]
+        if argv[3] != "-c":
+            return ("", "flock: only -c is supported")
+        commands = [[]]
+        for arg in shlex.split(command):
+            if arg == "&&":
+                commands.append([])
+            else:
+                commands[-1].append(arg)
+        with self.node.lock:
+            self.node.flocks.append((mode, path, commands[0][0]))
+        stdout = ""
+        for _argv in commands:
+            _stdout, stderr = self._dispatch(_argv)
+            stdout += _stdout
+            if stderr:
+                return (stdout, stderr)
+        return (stdout, "")
+
+    def _cmd_hostname(self, argv):
+        return ("{0}\n".format(self.node.name), "")
+
+    def _cmd_ionice(self, argv):
+        # Skip the options, all of which take a value.
+        index = 1
+        while index < len(argv) and argv[index].startswith("-"):
+            index += 2
+        return self._dispatch(argv[index:])
+
+    _cmd_nice = _cmd_ionice
+
+    def _cmd_pvesm(self, argv):
+        with self.node.lock:
+            if argv[1] == "path":
+                return (self.node.volume_path(argv[2]) + "\n", "")
+            if argv[1] == "alloc":
+                storage, vmid, name, size = argv[2:6]
+                disk_format = argv[argv.index("-format") + 1] \
+                    if "-format" in argv else "raw"
+                _storage = self.node.storages[storage]
+                if _storage['type'] in ("dir", "nfs"):
+                    volid = "{0}:{1}/{2}".format(storage, vmid, name)
+                else:
+                    volid = "{0}:{1}".format(storage, name)
+                if volid in self.node.volumes:
+                    return ("", "volume '{0}' already exists".format(volid))
+                _file = FakeFile(int(size) * 1024)
+                self.node.volumes[volid] = {"format": disk_format,
+                                            "content": "images",
+                                            "file": _file}
+                self.node.files[self.node.volume_path(volid)] = _file
+                return ("successfully created '{0}'\n".format(volid), "")
+            if argv[1] == "free":
+                volume = self.node.volumes.pop(argv[2], None)
+                if volume is None:
+                    return ("", "no such volume '{0}'".format(argv[2]))
+                self.node.files.pop(self.node.volume_path(argv[2]), None)
+                return ("", "")
+        return ("", "pvesm: unknown command '{0}'".format(argv[1]))
+
+    def _cmd_qemu_img(self, argv):
+        if argv[1] == "--help":
+            return (QEMU_IMG_HELP, "")
+        if argv[1] == "info":
+            with self.node.lock:
+                _file = self.node.files.get(argv[-1])
+            if _file is None:
+                return ("", "qemu-img: Could not open '{0}'".format(argv[-1]))
+            return ("image: {0}\nfile format: {1}\n"
+                    "virtual size: {2}M ({3} bytes)\n"
+                    "disk size: {4}M\n".format(
+                        argv[-1], _file.image_format,
+                        _file.virtual_size / 1024 ** 2, _file.virtual_size,
+                        _file.size / 1024 ** 2), "")
+        if argv[1] == "create":
+            path, size = argv[-2], argv[-1]
+            options = {}
+            index = 2
+            while index < len(argv) - 2:
+                if argv[index] in ("-f", "-F", "-b", "-o"):
+                    options[argv[index]] = argv[index + 1]
+                    index += 1
+                index += 1
+            virtual_size = int(size.rstrip("K")) * 1024
+            with self.node.lock:
+                if "-b" in options and options['-b'] not in self.node.files:
+                    return ("", "qemu-img: Could not open '{0}'".format(
+                        options['-b']))
+                self.node.files[path] = FakeFile(
+                    0, virtual_size, image_format=options.get("-f", "raw"),
+                    backing_file=options.get("-b"))
+            return ("", "")
+        if argv[1] == "convert":
+            source, target = argv[-2], argv[-1]
+            with self.node.lock:
+                _source = self.node.files.get(source)
+                _target = self.node.files.get(target)
+            if _source is None:
+                return ("", "qemu-img: Could not open '{0}'".format(source))
+            rate = self.node.disk_bandwidth
+            if rate:
+                # Modelled after a device that needs parallel requests to
+                # reach its bandwidth, qemu-img uses 8 coroutines by default.
+                coroutines = int(argv[argv.index("-m") + 1]) \
+                    if "-m" in argv else 8
+                rate = rate * min(coroutines, 8) / 8.0
+            if "-r" in argv:
+                rate = min(rate or float("inf"),
+                           int(argv[argv.index("-r") + 1]))
+            if rate:
+                time.sleep(float(_source.virtual_size) / rate)
+            with self.node.lock:
+                if _target is None:
+                    _target = self.node.files[target] = FakeFile(0)
+                if "-n" not in argv and not target.startswith("/dev/"):
+                    _target.size = _source.virtual_size
+            return ("", "")
+        return ("", "qemu-img: unknown command '{0}'".format(argv[1]))
+
+    def _cmd_rm(self, argv):
+        with self.node.lock:
+            for path in argv[1:]:
+                if not path.startswith("-"):
+                    self.node.files.pop(path, None)
+        return ("", "")
+
+    def _cmd_stat(self, argv):
+        with self.node.lock:
+            _file = self.node.files.get(argv[-1])
+        if _file is None:
+            return ("", "stat: cannot stat '{0}'".format(argv[-1]))
+        return ("{0}\n".format(_file.size), "")
+
+    def _cmd_vgs(self, argv):
+        # Volume groups of the fake node use the default extent size.
+        return ("  4096.00\n", "")
+
+    def _cmd_dd(self, argv):
+        options = dict(arg.split("=", 1) for arg in argv[1:] if "=" in arg)
+        size = int(options.get("bs", 512)) * int(options.get("count", 0))
+        with self.node.lock:
+            self.node.files[options['of']] = FakeFile(size)
+        return ("", "")
+
+    def _cmd_decompress(self, argv):
+        path = argv[-1]
+        ext = COMPRESSION_COMMANDS[argv[0]]
+        with self.node.lock:
+            _file = self.node.files.pop(path, None)
+            if _file is None or not path.endswith(ext):
+                return ("", "{0}: {1}: No such file".format(argv[0], path))
+            size = _file.size * DECOMPRESSION_RATIO
+            self.node.files[path[:-len(ext)]] = FakeFile(size)
+        return ("", "")
+
+    def _cmd_mkdir(self, argv):
+        return ("", "")
+
+    def _cmd_mktemp(self, argv):
+        template = argv[-1]
+        stem = template.rstrip("X")
+        path = stem + uuid.uuid4().hex[:len(template) - len(stem)]
+        with self.node.lock:
+            self.node.files[path] = FakeFile(0)
+        return ("{0}\n".format(path), "")
+
+    def _cmd_mv(self, argv):
+        source, target = argv[-2], argv[-1]
+        with self.node.lock:
+            _file = self.node.files.pop(source, None)
+            if _file is None:
+                return ("", "mv: cannot stat '{0}'".format(source))
+            self.node.files[target] = _file
+        return ("", "")
+
+    def _cmd_cat(self, argv):
+        with self.node.lock:
+            _file = self.node.files.get(argv[-1])
+        if _file is None or _file.content is None:
+            return ("", "cat: {0}: No such file or directory".format(
+                argv[-1]))
+        return (_file.content, "")
+
+    def _cmd_sha256sum(self, argv):
+        with self.node.lock:
+            _file = self.node.files.get(argv[-1])
+        if _file is None or _file.digest is None:
+            return ("", "sha256sum: {0}: No such file or directory".format(
+                argv[-1]))
+        return ("{0}  {1}\n".format(_file.digest, argv[-1]), "")
+
+    def _cmd_curl(self, argv):
+        """
+        Downloads with urllib2 from the local process, so the fake node can
+        fetch images from a local HTTP server.
+        """
+        options = {}
+        headers = {}
+        url = None
+        args = iter(argv[1:])
+        for arg in args:
+            if arg in ("-o", "-D", "-w", "--limit-rate"):
+                options[arg] = next(args)
+            elif arg == "-H":
+                name, value = next(args).split(":", 1)
+                headers[name.strip()] = value.strip()
+            elif arg.startswith("-"):
+                options[arg] = True
+            else:
+                url = arg
+        fail = any("f" in arg for arg in options if not arg.startswith("--"))
+
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers=headers))
+            code = response.getcode()
+        except urllib2.HTTPError as e:
+            response = e
+            code = e.code
+        except urllib2.URLError as e:
+            return ("", "curl: (7) Failed to connect: {0}".format(e.reason))
+        if fail and code >= 400:
+            return ("", "curl: (22) The requested URL returned error: {0}"
+                    .format(code))
+
+        digest = hashlib.sha256()
+        size = 0
+        virtual_size = None
+        body = []
+        while True:
+            data = response.read(64 * 1024)
+            if not data:
+                break
+            if size == 0 and data[:4] == QCOW2_MAGIC and len(data) >= 32:
+                virtual_size = struct.unpack(">Q", data[24:32])[0]
+            digest.update(data)
+            size += len(data)
+            if "-o" not in options:
+                body.append(data)
+
+        stdout = "".join(body)
+        with self.node.lock:
+            if "-o" in options:
+                self.node.files[options['-o']] = FakeFile(
+                    size, virtual_size, digest=digest.hexdigest())
+            if "-D" in options:
+                dumped = "HTTP/1.1 {0} {1}\r\n{2}\r\n".format(
+                    code, getattr(response, "msg", ""),
+                    "".join(response.info().headers))
+                self.node.files[options['-D']] = FakeFile(
+                    len(dumped), content=dumped)
+        if "-w" in options:
+            stdout += options['-w'].replace("%{http_code}", str(code))
+        return (stdout, "")
+
+    def _store(self, path, content):
+        virtual_size = None
+        if content[:4] == QCOW2_MAGIC and len(content) >= 32:
+            virtual_size = struct.unpack(">Q", content[24:32])[0]
+        digest = hashlib.sha256(content).hexdigest()
+        with self.node.lock:
+            self.node.files[path] = FakeFile(len(content), virtual_size,
+                                             digest=digest, content=content)
+
+    def _open(self, path):
+        with self.node.lock:
+            _file = self.node.files.get(path)
+        if _file is None or _file.content is None:
+            raise IOError("No such file or directory: '{0}'".format(path))
+        return StringIO(_file.content)
+
+    def _cmd_python3(self, argv):
+        """
+        Runs the blocksync commands sent to the node, on the contents of the
+        fake files. Only files smaller than max_content_size have contents.
+        """
+        if argv[1:] == ["-c", "pass"]:
+            return ("", "")
+        if argv[1:2] != ["-c"] or "def apply_delta" not in argv[2]:
+            return ("", "python3: only blocksync is supported")
+        command = argv[3:]
+        try:
+            if command[0] == "signatures":
+                output = StringIO()
+                blocksync.write_signatures(self._open(command[1]),
+                                           int(command[2]), output)
+                return (output.getvalue(), "")
+            if command[0] == "apply":
+                new = StringIO()
+                digest = blocksync.apply_delta(
+                    self._open(command[1]), self._open(command[2]), new,
+                    int(command[4]))
+                self._store(command[3], new.getvalue())
+                path = command[3]
+            else:
+                digest = blocksync.hash_file(self._open(command[1]))
+                path = command[1]
+        except IOError as e:
+            return ("", "python3: {0}".format(e))
+        self._store(path + ".sha256", digest + "\n")
+        return (digest + "\n", "")
+
+    def open_stream(self, cmd):
+        """
+        Starts reading the serial console of a VM, the only command of which
+        the output is streamed.
+        """
+        match = re.match(r"^socat -u UNIX-CONNECT:/var/run/qemu-server/"
+                         r"(\d+)\.serial0 STDOUT$", cmd)
+        if not match or int(match.group(1)) not in self.node.guests:
+            raise IOError("socat: connection refused")
+        return FakeConsoleStream(self.node, int(match.group(1)))
+
+    def upload_file_obj(self, file_obj, remote_path):
+        start = time.time()
+        size = 0
+        virtual_size = None
+        digest = hashlib.sha256()
+        content = []
+        while True:
+            data = file_obj.read(64 * 1024)
+            if not data:
+                break
+            if size == 0 and data[:4] == QCOW2_MAGIC and len(data) >= 32:
+                virtual_size = struct.unpack(">Q", data[24:32])[0]
+            digest.update(data)
+            size += len(data)
+            if self.node.bandwidth:
+                delay = float(size) / self.node.bandwidth - \
+                    (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if size <= self.node.max_content_size:
+                content.append(data)
+        with self.node.lock:
+            self.node.bytes_uploaded += size
+            self.node.files[remote_path] = FakeFile(
+                size, virtual_size, digest=digest.hexdigest(),
+                content="".join(content)
+                if size <= self.node.max_content_size else None)
+
+
+class FakeHTTPSession(FakeSession):
+    """
+    Stand-in for the HTTPS session, which sends API calls to a FakeAPIServer
+    over a transport, and runs commands against the fake node directly.
+    """
+    def __init__(self, node, transport):
+        super(FakeHTTPSession, self).__init__(node)
+        self.transport = transport
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        return self.transport.request(method, url, data=data, params=params,
+                                      headers=headers)
+
+
+class _APIRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests.
+    protocol_version = "HTTP/1.1"
+    # Buffer responses, and send them without waiting for ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, data=None, reason=None, errors=None):
+        body = {"data": data}
+        if errors:
+            body['errors'] = errors
+        content = json.dumps(body)
+        self.send_response(status, reason)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _get_ticket(self):
+        cookie = Cookie.SimpleCookie(self.headers.get("Cookie", ""))
+        if "PVEAuthCookie" not in cookie:
+            return None
+        return urllib2.unquote(cookie['PVEAuthCookie'].value)
+
+    def _is_authorized(self, method):
+        server = self.server
+        authorization = self.headers.get("Authorization", "")
+        if server.token and authorization == "PVEAPIToken={0}!{1}".format(
+                server.user, server.token):
+            return True
+        ticket = self._get_ticket()
+        if ticket is None or ticket not in server.tickets:
+            return False
+        return method == "GET" or self.headers.get(
+            "CSRFPreventionToken") == server.tickets[ticket]
+
+    def _handle(self):
+        method = self.command
+        url = urlparse.urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        data = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        params = dict(urlparse.parse_qsl(url.query))
+        if not url.path.startswith(API_PATH):
+            return self._send(404, reason="Not Found")
+        path = url.path[len(API_PATH):]
+
+        if method == "POST" and path == "/access/ticket":
+            if (data.get("username") != self.server.user or
+                    data.get("password") != self.server.password):
+                return self._send(401, reason="authentication failure")
+            ticket = "PVE:{0}:{1}".format(self.server.user, uuid.uuid4())
+            csrf_token = str(uuid.uuid4())
+            with self.server.lock:
+                self.server.tickets[ticket] = csrf_token
+            return self._send(200, {"username": self.server.user,
+                                    "ticket": ticket,
+                                    "CSRFPreventionToken": csrf_token})
+        if not self._is_authorized(method):
+            return self._send(401, reason="No ticket")
+
+        response = self.server.session.request(method, path, data=data,
+                                               params=params)
+        if response.status_code >= 400:
+            return self._send(response.status_code,
+                              reason=response.content.split(": ", 1)[-1])
+        return self._send(200, json.loads(response.content))
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class FakeAPIServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the API of a fake node over HTTP, like the API daemon of Proxmox,
+    with keep-alive connections and authentication by ticket or API token.
+    The benchmarks use it as a stand-in to measure the HTTPS backend.
+    """
+    daemon_threads = True
+
+    def __init__(self, node, user="root@pam", token=None, password=None,
+                 address=("127.0.0.1", 0)):
+        """
+        Parameters
+        ----------
+        node: FakeProxmoxNode
+            Node to serve.
+        user: str
+            User that may authenticate.
+        token: str
+            API token of the user, as "NAME=SECRET".
+        password: str
+            Password of the user, to request tickets with.
+        address: tuple
+            Address to listen on. By default, a free port on localhost.
+        """
+        HTTPServer.__init__(self, address, _APIRequestHandler)
+        self.session = FakeSession(node, user="{0}!{1}".format(
+            user, token.split("=", 1)[0]) if token else user)
+        self.user = user
+        self.token = token
+        self.password = password
+        self.tickets = {}
+        self.connections = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeConsoleStream(object):
+    """
+    Serial console of a VM on the fake node, which prints FAKE_CONSOLE over
+    the boot time and cloud-init time of the node.
+    """
+    def __init__(self, node, vmid):
+        self.node = node
+        self.guest = node.guests[vmid]
+        self.lines = list(FAKE_CONSOLE)
+        self.closed = threading.Event()
+
+    def readline(self):
+        if not self.lines or self.closed.is_set():
+            return ""
+        stage, fraction, line = self.lines.pop(0)
+        boot_time = self.node.boot_time
+        if stage == "boot":
+            delay = fraction * boot_time
+        else:
+            delay = boot_time + fraction * max(
+                0, self.node.cloud_init_time - boot_time)
+        delay -= time.time() - self.guest['started_at']
+        if delay > 0 and self.closed.wait(delay):
+            return ""
+        return line + "\n"
+
+    def close(self):
+        self.closed.set()
+
+
+class _FakeBackend(object):
+    def __init__(self, session):
+        self.session = session
+
+
+class FakeProxmoxAPI(ProxmoxResource):
+    """
+    Drop-in replacement for ProxmoxAPI, backed by a fake node.
+    """
+    def __init__(self, node=None, session=None):
+        """
+        Parameters
+        ----------
+        node: FakeProxmoxNode
+            Node to serve. A default node is created if not given.
+        session: FakeSession
+            Session to serve requests with. By default, a FakeSession for the
+            node is used.
+        """
+        self.node = node if node else FakeProxmoxNode()
+        if session is None:
+            session = FakeSession(self.node)
+        self._backend = _FakeBackend(session)
+        super(FakeProxmoxAPI, self).__init__(
+            base_url="", session=session, serializer=_JsonSerializer())
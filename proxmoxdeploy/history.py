@@ -0,0 +1,188 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+History of the throughput and phase durations measured by deployments, per
+node and per storage, to estimate later deployments with.
+"""
+
+from .cache import get_cache_dir
+import json
+import logging
+import os
+import tempfile
+import threading
+
+# Weight of a new measurement in the moving averages of the history.
+SMOOTHING = 0.3
+# Steps of base disk uploads whose throughput is measured, in bytes of the
+# local image per second. Uploads are measured per node, the conversion and
+# import into a disk per storage.
+RATE_PHASES = {"upload_image": "node", "copy_image": "storage",
+               "import_image": "storage"}
+# Steps of base disk uploads whose duration is measured per storage.
+STORAGE_PHASES = ("cache_image", "allocate_disk", "attach_disk")
+# Phases of deploy that are measured as a whole, per node. The base disk is
+# measured by its steps instead.
+DEPLOY_PHASES = ("create_vm", "generate_seed_iso", "attach_seed_iso",
+                 "attach_serial_console", "start_vm")
+
+logger = logging.getLogger(__name__)
+
+
+class ThroughputHistory(object):
+    """
+    Moving averages of the throughput of uploads and conversions, and of the
+    duration of the other phases of deployments. Measurements are kept per
+    node and per storage, under keys like "upload_image:<node>" and
+    "copy_image:<node>/<storage>".
+
+    A history without a filename is kept in memory only. Processes that share
+    a history file don't merge their measurements, the last one to save it
+    wins.
+    """
+    def __init__(self, filename=None, entries=None):
+        """
+        Parameters
+        ----------
+        filename: str
+            File to persist the history to. If None, nothing is persisted.
+        entries: dict
+            Measurements, mapping keys to dicts with the "average" and the
+            amount of "samples".
+        """
+        self.filename = filename
+        self.entries = entries or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, filename=None):
+        """
+        Opens a persistent history, by default the one in the cache directory.
+        A missing or unreadable file gives an empty history.
+        """
+        if filename is None:
+            filename = os.path.join(get_cache_dir("history"),
+                                    "throughput.json")
+        entries = None
+        if os.path.exists(filename):
+            try:
+                with open(filename) as _file:
+                    entries = json.load(_file)
+            except ValueError:
+                logger.warning("Ignoring unreadable history {0}".format(
+                    filename))
+        return cls(filename, entries)
+
+    def save(self):
+        """
+        Writes the history to disk, replacing the file atomically.
+        """
+        if self.filename is None:
+            return
+        fd, temp_file = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename), suffix=".tmp")
+        with os.fdopen(fd, "w") as _file:
+            json.dump(self.entries, _file, indent=2, sort_keys=True)
+        os.rename(temp_file, self.filename)
+
+    def _add(self, key, value):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = {"average": value, "samples": 1}
+        else:
+            entry['average'] += SMOOTHING * (value - entry['average'])
+            entry['samples'] += 1
+
+    def record(self, measurements):
+        """
+        Adds measurements to the moving averages, and saves the history.
+
+        Parameters
+        ----------
+        measurements: list of tuples
+            Tuples of (key, value).
+        """
+        if not measurements:
+            return
+        with self._lock:
+            for key, value in measurements:
+                self._add(key, value)
+            self.save()
+
+    def record_upload(self, node, storage, image_size, timer):
+        """
+        Records the steps of a base disk upload.
+
+        Parameters
+        ----------
+        node: str
+            Node the disk was uploaded to.
+        storage: str
+            Storage the disk was allocated on.
+        image_size: int
+            Size of the local image in bytes, or None if it is unknown. The
+            throughput is only measured for images of a known size.
+        timer: PhaseTimer
+            Time spent in the steps that ran, see RATE_PHASES and
+            STORAGE_PHASES.
+        """
+        keys = {"node": node, "storage": "{0}/{1}".format(node, storage)}
+        measurements = []
+        for phase, elapsed in timer.as_dict().iteritems():
+            if phase in RATE_PHASES and image_size and elapsed > 0:
+                measurements.append((
+                    "{0}:{1}".format(phase, keys[RATE_PHASES[phase]]),
+                    image_size / elapsed))
+            elif phase in STORAGE_PHASES:
+                measurements.append((
+                    "{0}:{1}".format(phase, keys['storage']), elapsed))
+        self.record(measurements)
+
+    def record_deployment(self, node, timer):
+        """
+        Records the phases of a deployment, see DEPLOY_PHASES.
+        """
+        self.record([("{0}:{1}".format(phase, node), elapsed)
+                     for phase, elapsed in timer.as_dict().iteritems()
+                     if phase in DEPLOY_PHASES])
+
+    def estimate(self, phase, node, storage):
+        """
+        Get the average measurement of a phase on a node, or on the storage
+        of the node for phases that are measured per storage. Without
+        measurements there, the average of all nodes or storages is used.
+
+        Returns
+        -------
+        Tuple of the average, and its source: "node" or "storage" if it was
+        measured there, "cluster" if it was measured elsewhere, or None if
+        the phase was never measured.
+        """
+        scope = "node"
+        if phase in STORAGE_PHASES or RATE_PHASES.get(phase) == "storage":
+            scope = "storage"
+        key = node if scope == "node" else "{0}/{1}".format(node, storage)
+        prefix = "{0}:".format(phase)
+        with self._lock:
+            entry = self.entries.get(prefix + key)
+            if entry is not None:
+                return (entry['average'], scope)
+            others = [other['average'] for _key, other
+                      in self.entries.iteritems() if _key.startswith(prefix)]
+        if others:
+            return (sum(others) / len(others), "cluster")
+        return (None, None)
@@ -0,0 +1,387 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Proxmox API over HTTPS, with a pool of keep-alive connections. Only API
+calls are sent over HTTPS. Commands and uploads still go over SSH, as the API
+offers no way to run them.
+"""
+
+from proxmoxer import ProxmoxResource
+from proxmoxer.backends.command_base import JsonSimpleSerializer
+from proxmoxer.backends.openssh import OpenSSHSession
+import httplib
+import json
+import logging
+import socket
+import ssl
+import threading
+import time
+import urllib
+
+# Default port of the Proxmox API.
+API_PORT = 8006
+# Path of the JSON API, prepended to every request.
+API_PATH = "/api2/json"
+# Tickets are valid for two hours. They are renewed well before that.
+TICKET_LIFETIME = 3600
+# Methods of which requests can be sent again when their response was lost.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+logger = logging.getLogger(__name__)
+
+
+class Response(object):
+    """
+    Response to an API call, in the same form as the responses of the SSH
+    sessions of proxmoxer, so the two can be used interchangeably.
+    """
+    def __init__(self, content, status_code):
+        self.status_code = status_code
+        self.content = content
+        self.text = content
+        self.headers = {"content-type": "application/json"}
+
+
+def _encode(values):
+    encoded = []
+    for key, value in sorted((values or {}).iteritems()):
+        if value is None:
+            continue
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        if isinstance(value, bool):
+            value = int(value)
+        encoded.append((key, value))
+    return urllib.urlencode(encoded)
+
+
+class ConnectionPool(object):
+    """
+    Pool of keep-alive connections to a single host. Connections are created
+    on demand, up to the size of the pool, and reused afterwards. A request
+    that finds all connections busy waits for one to be released.
+    """
+    def __init__(self, host, port, size=8, scheme="https", timeout=600,
+                 verify_ssl=True, ca_file=None):
+        """
+        Parameters
+        ----------
+        host: str
+            Host to connect to.
+        port: int
+            Port to connect to.
+        size: int
+            Maximum amount of open connections.
+        scheme: str
+            Either "https", or "http" for servers without TLS, such as the
+            stand-in API of the benchmarks.
+        timeout: int
+            Socket timeout of the connections, in seconds.
+        verify_ssl: bool
+            Whether to verify the certificate of the host.
+        ca_file: str
+            CA bundle to verify the certificate with, for self-signed
+            certificates. By default, the system CA bundle is used.
+        """
+        if scheme not in ("http", "https"):
+            raise ValueError("Unsupported scheme {0}".format(scheme))
+        self.host = host
+        self.port = port
+        self.size = size
+        self.scheme = scheme
+        self.timeout = timeout
+        self.context = None
+        if scheme == "https":
+            if verify_ssl:
+                self.context = ssl.create_default_context(cafile=ca_file)
+            else:
+                self.context = ssl._create_unverified_context()
+        self.connections_made = 0
+        self._idle = []
+        self._open = 0
+        self._condition = threading.Condition()
+
+    def _connect(self):
+        if self.scheme == "https":
+            connection = httplib.HTTPSConnection(self.host, self.port,
+                                                 timeout=self.timeout,
+                                                 context=self.context)
+        else:
+            connection = httplib.HTTPConnection(self.host, self.port,
+                                                timeout=self.timeout)
+        connection.connect()
+        # httplib sends the headers and body of a request separately. With
+        # Nagle's algorithm, the body waits for the delayed ACK of the
+        # headers, adding tens of milliseconds to every call.
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def acquire(self):
+        """
+        Takes a connection from the pool, creating one if there is none idle
+        and the pool is not full.
+
+        Returns
+        -------
+        Tuple of the connection, and whether it was used before.
+        """
+        with self._condition:
+            while not self._idle and self._open >= self.size:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop(), True
+            self._open += 1
+            self.connections_made += 1
+        try:
+            return self._connect(), False
+        except:
+            # Free the slot, so the pool doesn't shrink with every failure.
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection, reuse=True):
+        """
+        Returns a connection to the pool. Connections that are not reusable,
+        for example after an error, are closed instead.
+        """
+        with self._condition:
+            if reuse:
+                self._idle.append(connection)
+            else:
+                connection.close()
+                self._open -= 1
+            self._condition.notify()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Sends a request over a pooled connection. A connection that was
+        closed by the server while it was idle is replaced, and the request
+        sent again. Requests that are not idempotent are only sent again if
+        sending them failed, as the server may have processed a request of
+        which the response was lost.
+
+        Returns
+        -------
+        Tuple of the status code, reason and body of the response.
+        """
+        while True:
+            connection, reused = self.acquire()
+            sent = False
+            try:
+                connection.request(method, path, body, headers or {})
+                sent = True
+                response = connection.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                self.release(connection, reuse=False)
+                if reused and (not sent or
+                               method.upper() in IDEMPOTENT_METHODS):
+                    logger.debug("Reconnecting after {0}".format(e))
+                    continue
+                raise
+            self.release(connection, reuse=not response.will_close)
+            return response.status, response.reason, content
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self._condition:
+            for connection in self._idle:
+                connection.close()
+            self._open -= len(self._idle)
+            self._idle = []
+
+
+class HTTPSTransport(object):
+    """
+    Sends API calls to the Proxmox API over a connection pool, authenticated
+    with either an API token or a ticket.
+
+    Requests are the same as those of the SSH sessions of proxmoxer: a method
+    and an API path, such as "/nodes". Responses contain the data of the API
+    call only, like the output of pvesh.
+    """
+    def __init__(self, host, port=API_PORT, user="root@pam", token=None,
+                 password=None, connections=8, scheme="https", timeout=600,
+                 verify_ssl=True, ca_file=None):
+        """
+        Parameters
+        ----------
+        host: str
+            Proxmox host.
+        port: int
+            Port of the Proxmox API.
+        user: str
+            User to authenticate as, including the realm.
+        token: str
+            API token of the user, as "NAME=SECRET".
+        password: str
+            Password of the user, to request tickets with if no token is
+            given.
+        connections: int
+            Maximum amount of connections to the API.
+        scheme, timeout, verify_ssl, ca_file:
+            See ConnectionPool.
+        """
+        if not token and password is None:
+            raise ValueError("Either an API token or a password is required")
+        if "@" not in user:
+            user = "{0}@pam".format(user)
+        self.user = user
+        self.token = token
+        self.password = password
+        self.pool = ConnectionPool(host, port, size=connections,
+                                   scheme=scheme, timeout=timeout,
+                                   verify_ssl=verify_ssl, ca_file=ca_file)
+        self._ticket = None
+        self._csrf_token = None
+        self._ticket_time = 0
+        self._ticket_lock = threading.Lock()
+
+    def _login(self):
+        body = _encode({"username": self.user, "password": self.password})
+        status, reason, content = self.pool.request(
+            "POST", API_PATH + "/access/ticket", body,
+            {"Content-Type": "application/x-www-form-urlencoded"})
+        if status != 200:
+            raise RuntimeError("Authentication as {0} failed: {1} {2}"
+                               .format(self.user, status, reason))
+        data = json.loads(content)['data']
+        self._ticket = data['ticket']
+        self._csrf_token = data['CSRFPreventionToken']
+        self._ticket_time = time.time()
+        logger.debug("Obtained ticket for {0}".format(self.user))
+
+    def _get_auth_headers(self, method, renew=False):
+        if self.token:
+            return {"Authorization": "PVEAPIToken={0}!{1}".format(
+                self.user, self.token)}
+        with self._ticket_lock:
+            if renew or time.time() - self._ticket_time > TICKET_LIFETIME:
+                self._login()
+            headers = {"Cookie": "PVEAuthCookie={0}".format(
+                urllib.quote(self._ticket))}
+        if method != "GET":
+            headers['CSRFPreventionToken'] = self._csrf_token
+        return headers
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        method = method.upper()
+        path = API_PATH + url
+        query = _encode(params)
+        if query:
+            path = "{0}?{1}".format(path, query)
+        body = None
+        request_headers = dict(headers or {})
+        if method in ("POST", "PUT"):
+            body = _encode(data)
+            request_headers['Content-Type'] = \
+                "application/x-www-form-urlencoded"
+
+        renew = False
+        while True:
+            request_headers.update(self._get_auth_headers(method, renew))
+            status, reason, content = self.pool.request(
+                method, path, body, request_headers)
+            if status == 401 and not self.token and not renew:
+                # The ticket expired early, for example after a restart of
+                # the API daemon.
+                renew = True
+                continue
+            break
+
+        if status >= 400:
+            try:
+                errors = json.loads(content).get("errors")
+            except ValueError:
+                errors = None
+            message = "{0} {1}".format(status, reason)
+            if errors:
+                message += ": {0}".format(json.dumps(errors, sort_keys=True))
+            return Response(message, status)
+        return Response(json.dumps(json.loads(content).get("data")), status)
+
+    def close(self):
+        self.pool.close()
+
+
+class HTTPSSession(OpenSSHSession):
+    """
+    OpenSSH session of proxmoxer that sends API calls over HTTPS. Commands
+    and uploads still use SSH.
+    """
+    def __init__(self, host, user, transport, **kwargs):
+        """
+        Parameters
+        ----------
+        host, user:
+            SSH host and user.
+        transport: HTTPSTransport
+            Transport to send API calls with.
+        kwargs:
+            Other arguments of OpenSSHSession.
+        """
+        super(HTTPSSession, self).__init__(host, user, **kwargs)
+        self.transport = transport
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        return self.transport.request(method, url, data=data, params=params,
+                                      headers=headers)
+
+
+class _Backend(object):
+    def __init__(self, session):
+        self.session = session
+
+
+class HTTPSProxmoxAPI(ProxmoxResource):
+    """
+    Drop-in replacement for ProxmoxAPI with the openssh backend, which sends
+    API calls over HTTPS instead of running pvesh over SSH for every call.
+    """
+    def __init__(self, host, user="root", port=22, api_port=API_PORT,
+                 token=None, password=None, connections=8, verify_ssl=True,
+                 ca_file=None, timeout=600):
+        """
+        Parameters
+        ----------
+        host: str
+            Proxmox host.
+        user: str
+            User for both SSH and the API. For the API, the realm defaults
+            to pam.
+        port: int
+            SSH port.
+        api_port: int
+            Port of the Proxmox API.
+        token, password, connections, verify_ssl, ca_file:
+            See HTTPSTransport.
+        timeout: int
+            Timeout of API calls and commands, in seconds.
+        """
+        transport = HTTPSTransport(host, api_port, user=user, token=token,
+                                   password=password, connections=connections,
+                                   timeout=timeout, verify_ssl=verify_ssl,
+                                   ca_file=ca_file)
+        session = HTTPSSession(host, user.split("@")[0], transport,
+                               port=port, timeout=timeout)
+        self._backend = _Backend(session)
+        super(HTTPSProxmoxAPI, self).__init__(
+            base_url="", session=session, serializer=JsonSimpleSerializer())
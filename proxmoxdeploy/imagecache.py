@@ -0,0 +1,591 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+"""
+Cache of cloud images on the Proxmox node. Images given as an HTTP(S) URL are
+downloaded by the node itself, verified against their published checksum, and
+decompressed into the cache. Later deployments of the same URL send a
+conditional request, and reuse the cached image if it did not change.
+
+Local images can be cached as well. When a new version of a cached local image
+is deployed, only the blocks that changed are sent, see blocksync.
+
+Every entry has a lock file, taken with flock. Deployments hold it shared
+while they read a cached image, and a new version of the image is only moved
+into place while the lock is held exclusively, so images don't change while
+they are read, also by other processes.
+"""
+
+from . import blocksync
+from .cloudinit.templates import VALID_COMPRESSION_FORMATS
+from .exceptions import SSHCommandInvocationException
+from .metrics import format_bytes
+from .throttle import NodeThrottle
+from collections import defaultdict
+import hashlib
+import inspect
+import logging
+import os
+import pipes
+import posixpath
+import re
+import tempfile
+import threading
+import urllib
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+NODE_CACHE_DIR = "/var/cache/proxmox-deploy/images"
+# Files in which distributions publish the checksums of their images, next to
+# the images themselves.
+CHECKSUM_FILES = ("SHA256SUMS", "CHECKSUM")
+DECOMPRESSION_COMMANDS = {".xz": "unxz", ".gz": "gunzip", ".bz2": "bunzip2"}
+_BLOCKSYNC_SOURCE = inspect.getsource(blocksync)
+
+
+def is_image_url(image):
+    """
+    Tests if an image is given as an HTTP(S) URL, instead of a local file.
+    """
+    return image.startswith(("http://", "https://"))
+
+
+def get_image_name(url):
+    """
+    Get the filename of the image an URL points to.
+    """
+    return urllib.unquote(posixpath.basename(urlparse.urlparse(url).path))
+
+
+def parse_checksums(text, name):
+    """
+    Finds the SHA256 checksum of a file in a checksum file. Both the format
+    of sha256sum ("<hash>  <name>") and the BSD format used by Fedora
+    ("SHA256 (<name>) = <hash>") are supported.
+
+    Returns
+    -------
+    The checksum, or None if the file is not listed.
+    """
+    for line in text.splitlines():
+        line = line.strip()
+        match = re.match(r"^([0-9a-fA-F]{64}) [ *](.+)$", line)
+        if match:
+            checksum, _name = match.groups()
+        else:
+            match = re.match(r"^SHA256 \((.+)\) = ([0-9a-fA-F]{64})$", line)
+            if not match:
+                continue
+            _name, checksum = match.groups()
+        if posixpath.basename(_name) == name:
+            return checksum.lower()
+    return None
+
+
+def parse_headers(text):
+    """
+    Parses the headers dumped by curl. When redirects are followed, only the
+    headers of the final response are returned.
+
+    Returns
+    -------
+    Dict mapping lowercase header names to their values.
+    """
+    headers = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("HTTP/"):
+            headers = {}
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+class NodeImageCache(object):
+    """
+    Downloads images on the Proxmox node into a cache directory. Every URL is
+    cached in its own directory, holding the decompressed image and the
+    headers of the response it was downloaded with.
+    """
+    def __init__(self, cache_dir=NODE_CACHE_DIR, sync_local_images=False,
+                 block_size=blocksync.DEFAULT_BLOCK_SIZE, python="python3",
+                 limit_rate=None, throttle=None):
+        """
+        Parameters
+        ----------
+        cache_dir: str
+            Directory on the node to cache images in.
+        sync_local_images: bool
+            Whether deployments cache local images on the node, refreshing
+            uncompressed images with block level deltas. Cached images are
+            used by deployments either way.
+        block_size: int
+            Size of the blocks compared by delta refreshes.
+        python: str
+            Python interpreter on the node, used to compute and apply deltas.
+        limit_rate: int
+            Maximum rate of downloads by the node, in bytes per second.
+        throttle: NodeThrottle
+            Priorities to decompress and rebuild images with.
+        """
+        self.cache_dir = cache_dir
+        self.sync_local_images = sync_local_images
+        self.block_size = block_size
+        self.python = python
+        self.limit_rate = limit_rate
+        self.throttle = throttle or NodeThrottle()
+        self._local_digests = {}
+        self._python_sessions = set()
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def get_entry_dir(self, url):
+        """
+        Get the directory on the node the image of an URL is cached in.
+        """
+        return posixpath.join(self.cache_dir,
+                              hashlib.sha1(url).hexdigest()[:16])
+
+    def get_image_path(self, url):
+        """
+        Get the path of the decompressed image of an URL on the node.
+        """
+        name = get_image_name(url)
+        base, ext = os.path.splitext(name)
+        if ext in VALID_COMPRESSION_FORMATS:
+            name = base
+        return posixpath.join(self.get_entry_dir(url), name)
+
+    def get_lock_path(self, image_path):
+        """
+        Get the path of the lock file of the entry an image is cached in.
+        """
+        return posixpath.join(posixpath.dirname(image_path), "lock")
+
+    def wrap_shared(self, image_path, command):
+        """
+        Wraps a command that reads an image, so it holds the shared lock of
+        the image while it runs, if the image is in the cache.
+        """
+        if not image_path.startswith(self.cache_dir.rstrip("/") + "/"):
+            return command
+        return "flock -s {0} -c {1}".format(
+            pipes.quote(self.get_lock_path(image_path)), pipes.quote(command))
+
+    def _run(self, ssh, message, *argv):
+        return self._exec(ssh, message, " ".join(pipes.quote(str(arg))
+                                                 for arg in argv))
+
+    def _run_heavy(self, ssh, message, *argv):
+        """
+        Like _run, but with the priorities of the throttle of heavy work.
+        """
+        return self._exec(ssh, message, self.throttle.wrap(
+            " ".join(pipes.quote(str(arg)) for arg in argv)))
+
+    def _exec(self, ssh, message, command):
+        stdout, stderr = ssh._exec(command)
+        if message and len(stderr) > 0:
+            raise SSHCommandInvocationException(message, stdout=stdout,
+                                                stderr=stderr)
+        return stdout
+
+    def _stage(self, ssh, part, name):
+        """
+        Moves a downloaded or uploaded image next to the cached image, and
+        decompresses it there, without taking the lock of the entry.
+
+        Returns
+        -------
+        Path of the decompressed image.
+        """
+        staged = posixpath.join(posixpath.dirname(part), "new-" + name)
+        self._run(ssh, "Failed to store image", "mv", part, staged)
+        base, ext = os.path.splitext(staged)
+        if ext in DECOMPRESSION_COMMANDS:
+            logger.info("Decompressing image")
+            self._run(ssh, None, "rm", "-f", base)
+            try:
+                self._run_heavy(ssh, "Failed to decompress image",
+                                DECOMPRESSION_COMMANDS[ext], staged)
+            except:
+                self._run(ssh, None, "rm", "-f", staged, base)
+                raise
+            staged = base
+        return staged
+
+    def _replace(self, ssh, image_path, staged, meta_file, meta_part):
+        """
+        Moves a staged image and the new file describing it into place, while
+        holding the lock of the entry exclusively. The old description is
+        removed first, so an interrupted replacement is never taken for a
+        cached image.
+        """
+        commands = [["rm", "-f", meta_file],
+                    ["mv", staged, image_path],
+                    ["mv", meta_part, meta_file]]
+        self._run(ssh, "Failed to store image", "flock", "-x",
+                  self.get_lock_path(image_path), "-c", " && ".join(
+                      " ".join(pipes.quote(arg) for arg in argv)
+                      for argv in commands))
+
+    def _get_file_size(self, ssh, path):
+        stdout, _ = ssh._exec("stat -c %s {0}".format(pipes.quote(path)))
+        try:
+            return int(stdout.strip())
+        except ValueError:
+            return None
+
+    def get_expected_checksum(self, ssh, url):
+        """
+        Get the published SHA256 checksum of the image. The checksum is taken
+        from a "#sha256=<checksum>" fragment of the URL, or looked up in the
+        checksum files published next to the image.
+
+        Returns
+        -------
+        The checksum, or None if no checksum is published.
+        """
+        fragment = urlparse.urlparse(url).fragment
+        if fragment.startswith("sha256="):
+            return fragment[len("sha256="):].lower()
+
+        name = get_image_name(url)
+        for checksum_file in CHECKSUM_FILES:
+            checksum_url = urlparse.urljoin(url.split("#")[0], checksum_file)
+            stdout, stderr = ssh._exec(
+                "curl -sSfL {0}".format(pipes.quote(checksum_url)))
+            if stderr:
+                continue
+            checksum = parse_checksums(stdout, name)
+            if checksum:
+                return checksum
+        return None
+
+    def is_cached(self, ssh, url):
+        """
+        Tests if the image of an URL is in the cache, without checking if it
+        is still up to date.
+        """
+        headers = posixpath.join(self.get_entry_dir(url), "headers")
+        return self._get_file_size(ssh, headers) is not None and \
+            self._get_file_size(ssh, self.get_image_path(url)) is not None
+
+    def fetch(self, ssh, url):
+        """
+        Makes sure the current version of the image of an URL is cached on
+        the node.
+
+        Parameters
+        ----------
+        ssh: ProxmoxBaseSSHSession subclass
+            Session to run commands on the node with.
+        url: str
+            HTTP(S) URL of the image.
+
+        Returns
+        -------
+        Path of the decompressed image on the node.
+        """
+        return self._fetch(ssh, url)[0]
+
+    def _get_lock(self, key):
+        with self._lock:
+            return self._locks[key]
+
+    def _fetch(self, ssh, url):
+        with self._get_lock(url):
+            return self._fetch_locked(ssh, url)
+
+    def _fetch_locked(self, ssh, url):
+        entry_dir = self.get_entry_dir(url)
+        image_path = self.get_image_path(url)
+        headers_file = posixpath.join(entry_dir, "headers")
+        download = posixpath.join(entry_dir, get_image_name(url))
+        self._run(ssh, "Failed to create image cache directory",
+                  "mkdir", "-p", entry_dir)
+
+        argv = ["curl", "-sSL", "-o", download + ".part",
+                "-D", headers_file + ".part", "-w", "%{http_code}"]
+        if self.limit_rate:
+            argv += ["--limit-rate", int(self.limit_rate)]
+        if self.is_cached(ssh, url):
+            cached = parse_headers(self._run(ssh, None, "cat", headers_file))
+            if "etag" in cached:
+                argv += ["-H", "If-None-Match: {0}".format(cached['etag'])]
+            if "last-modified" in cached:
+                argv += ["-H", "If-Modified-Since: {0}".format(
+                    cached['last-modified'])]
+
+        logger.info("Downloading {0} on the node".format(url))
+        try:
+            stdout = self._run(ssh, "Failed to download image",
+                               *(argv + [url.split("#")[0]]))
+        except SSHCommandInvocationException:
+            self._run(ssh, None, "rm", "-f", download + ".part",
+                      headers_file + ".part")
+            raise
+        status = stdout.strip()[-3:]
+        if status == "304":
+            logger.info("Image did not change, using cached image")
+            self._run(ssh, None, "rm", "-f", download + ".part",
+                      headers_file + ".part")
+            return (image_path, "warm")
+        if status != "200":
+            self._run(ssh, None, "rm", "-f", download + ".part",
+                      headers_file + ".part")
+            raise SSHCommandInvocationException(
+                "Failed to download image, server responded with {0}"
+                .format(status), stdout=stdout)
+
+        checksum = self.get_expected_checksum(ssh, url)
+        if checksum:
+            stdout = self._run(ssh, "Failed to checksum image", "sha256sum",
+                               download + ".part")
+            if stdout.split()[0].lower() != checksum:
+                self._run(ssh, None, "rm", "-f", download + ".part",
+                          headers_file + ".part")
+                raise RuntimeError("Checksum of {0} does not match the "
+                                   "published checksum".format(url))
+            logger.info("Verified checksum of image")
+        else:
+            logger.warning("No checksum published for {0}, the image is not "
+                           "verified".format(url))
+
+        try:
+            staged = self._stage(ssh, download + ".part",
+                                 get_image_name(url))
+        except:
+            self._run(ssh, None, "rm", "-f", headers_file + ".part")
+            raise
+        self._replace(ssh, image_path, staged, headers_file,
+                      headers_file + ".part")
+        return (image_path, "downloaded")
+
+    def get_local_image_path(self, filename):
+        """
+        Get the path on the node a local image is cached at. Images are cached
+        by their filename, so a new version of an image replaces the previous
+        version, and is synced against it.
+        """
+        name = os.path.basename(filename)
+        return posixpath.join(
+            self.cache_dir, hashlib.sha1("file:" + name).hexdigest()[:16],
+            name)
+
+    def _get_decompressed_path(self, path):
+        base, ext = os.path.splitext(path)
+        return base if ext in VALID_COMPRESSION_FORMATS else path
+
+    def _hash_local_image(self, filename):
+        """
+        Hashes a local image. Hashes are remembered until the image changes.
+        """
+        stat = os.stat(filename)
+        key = (filename, stat.st_size, stat.st_mtime)
+        if key not in self._local_digests:
+            with open(filename, "rb") as _file:
+                self._local_digests[key] = blocksync.hash_file(_file)
+        return self._local_digests[key]
+
+    def _run_blocksync(self, ssh, message, *argv):
+        return self._run_heavy(ssh, message, self.python, "-c",
+                               _BLOCKSYNC_SOURCE, *argv)
+
+    def _get_cached_digest(self, ssh, path):
+        stdout, stderr = ssh._exec("cat {0}".format(
+            pipes.quote(path + ".sha256")))
+        if stderr:
+            return None
+        return stdout.strip() or None
+
+    def get_cached(self, ssh, filename):
+        """
+        Get the cached copy of a local image on the node, if it is the same
+        version as the local image.
+
+        Returns
+        -------
+        Path of the image on the node, or None if it is not cached.
+        """
+        path = self.get_local_image_path(filename)
+        cached_digest = self._get_cached_digest(ssh, path)
+        if cached_digest is None or \
+                cached_digest != self._hash_local_image(filename):
+            return None
+        return self._get_decompressed_path(path)
+
+    def sync(self, ssh, filename, upload):
+        """
+        Makes sure the current version of a local image is cached on the
+        node. If a previous version of an uncompressed image is cached, only
+        the blocks that changed are sent. Compressed images are uploaded
+        whole and decompressed on the node, because a small change of an
+        image changes nearly all of the compressed file.
+
+        Parameters
+        ----------
+        ssh: ProxmoxBaseSSHSession subclass
+            Session to run commands on the node with.
+        filename: str
+            Local filename of the image.
+        upload: callable
+            Called with a local filename and a remote path, to upload a file
+            to the node.
+
+        Returns
+        -------
+        Path of the decompressed image on the node.
+        """
+        return self._sync(ssh, filename, upload)[0]
+
+    def prefetch(self, ssh, image, upload):
+        """
+        Makes sure the current version of an image is cached on the node.
+
+        Parameters
+        ----------
+        ssh: ProxmoxBaseSSHSession subclass
+            Session to run commands on the node with.
+        image: str
+            Local filename or HTTP(S) URL of the image.
+        upload: callable
+            Called with a local filename and a remote path, to upload a file
+            to the node.
+
+        Returns
+        -------
+        How the image was cached: "warm" if it already was, "downloaded",
+        "uploaded" or "synced".
+        """
+        if is_image_url(image):
+            return self._fetch(ssh, image)[1]
+        return self._sync(ssh, image, upload)[1]
+
+    def get_status(self, ssh, image):
+        """
+        Get the state of an image in the cache, without transferring it.
+
+        Returns
+        -------
+        "warm" if the current version of a local image is cached, "cached" if
+        the image of an URL is cached (whether it is current is only checked
+        when it is used), or "cold" if the image is not cached.
+        """
+        if is_image_url(image):
+            return "cached" if self.is_cached(ssh, image) else "cold"
+        return "warm" if self.get_cached(ssh, image) else "cold"
+
+    def _check_python(self, ssh):
+        """
+        Makes sure the Python interpreter that hashes and rebuilds images runs
+        on the node, before anything is uploaded. It is checked once per
+        session.
+        """
+        if ssh in self._python_sessions:
+            return
+        stdout, stderr = ssh._exec("{0} -c pass".format(
+            pipes.quote(self.python)))
+        if len(stderr) > 0:
+            raise SSHCommandInvocationException(
+                "{0} is not available on the node".format(self.python),
+                stdout=stdout, stderr=stderr)
+        self._python_sessions.add(ssh)
+
+    def _sync(self, ssh, filename, upload):
+        self._check_python(ssh)
+        path = self.get_local_image_path(filename)
+        with self._get_lock(path):
+            return self._sync_locked(ssh, filename, upload, path)
+
+    def _sync_locked(self, ssh, filename, upload, path):
+        digest = self._hash_local_image(filename)
+        cached_digest = self._get_cached_digest(ssh, path)
+        image_path = self._get_decompressed_path(path)
+        if cached_digest == digest:
+            logger.info("Image is already cached on the node")
+            return (image_path, "warm")
+
+        self._run(ssh, "Failed to create image cache directory",
+                  "mkdir", "-p", posixpath.dirname(path))
+        compressed = image_path != path
+        try:
+            if not compressed and cached_digest and \
+                    self._get_file_size(ssh, path) is not None:
+                logger.info("Sending changes to the cached image")
+                remote_digest = self._send_delta(ssh, filename, upload, path)
+                status = "synced"
+            else:
+                upload(filename, path + ".part")
+                remote_digest = self._run_blocksync(
+                    ssh, "Failed to hash image", "hash", path + ".part")
+                status = "uploaded"
+        except:
+            # Don't leave a partial copy of the image on the node.
+            self._run(ssh, None, "rm", "-f", path + ".part",
+                      path + ".part.sha256")
+            raise
+
+        if remote_digest.strip() != digest:
+            self._run(ssh, None, "rm", "-f", path + ".part",
+                      path + ".part.sha256")
+            raise RuntimeError("Image {0} was corrupted on its way to the "
+                               "node".format(filename))
+        # The digest is that of the local image, compressed or not.
+        try:
+            staged = self._stage(ssh, path + ".part",
+                                 posixpath.basename(path))
+        except:
+            self._run(ssh, None, "rm", "-f", path + ".part.sha256")
+            raise
+        self._replace(ssh, image_path, staged, path + ".sha256",
+                      path + ".part.sha256")
+        return (image_path, status)
+
+    def _send_delta(self, ssh, filename, upload, path):
+        """
+        Sends the blocks of a local image that differ from the cached image,
+        and rebuilds the new version next to the cached image.
+
+        Returns
+        -------
+        The SHA256 digest of the rebuilt image.
+        """
+        signatures = blocksync.read_signatures(self._run_blocksync(
+            ssh, "Failed to compute block signatures", "signatures", path,
+            self.block_size))
+        fd, delta_file = tempfile.mkstemp(prefix="proxmox-deploy-",
+                                          suffix=".delta")
+        try:
+            with os.fdopen(fd, "wb") as output:
+                with open(filename, "rb") as _file:
+                    _, copied, literal = blocksync.compute_delta(
+                        _file, signatures, self.block_size, output)
+            logger.info("{0} changed, {1} unchanged".format(
+                format_bytes(literal), format_bytes(copied)))
+            upload(delta_file, path + ".delta")
+        finally:
+            os.remove(delta_file)
+
+        try:
+            return self._run_blocksync(
+                ssh, "Failed to apply delta", "apply", path, path + ".delta",
+                path + ".part", self.block_size)
+        finally:
+            self._run(ssh, None, "rm", "-f", path + ".delta")
@@ -0,0 +1,415 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Pools of static IPv4 addresses for deployments. Every pool is a subnet from
+the config file, of which the free addresses are tracked in a bitmap. Leases
+are persisted, and shared with other processes through a file lock.
+"""
+
+from .cache import get_cache_dir
+from collections import OrderedDict
+import base64
+import fcntl
+import json
+import logging
+import os
+import re
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+# Leases of VMs that do not exist are kept this long, as the VM may still be
+# about to be created, in seconds.
+LEASE_GRACE = 3600
+# Description of VMs with an address from a pool, used to find the addresses
+# in use when reconciling.
+DESCRIPTION = "Deployed by proxmox-deploy, IP address {0}"
+ADDRESS_PATTERNS = (
+    re.compile(r"IP address (\d+\.\d+\.\d+\.\d+)"),
+    re.compile(r"\bip=(\d+\.\d+\.\d+\.\d+)"),
+)
+
+logger = logging.getLogger(__name__)
+
+
+def ip_to_int(address):
+    try:
+        return struct.unpack("!I", socket.inet_aton(address))[0]
+    except socket.error:
+        raise ValueError("Invalid IPv4 address: {0}".format(address))
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack("!I", value))
+
+
+def parse_subnet(subnet):
+    """
+    Parses a subnet in CIDR notation, such as "10.0.0.0/24".
+
+    Returns
+    -------
+    Tuple of the network address, netmask and broadcast address, as integers.
+    """
+    try:
+        address, prefix = subnet.split("/")
+        prefix = int(prefix)
+    except ValueError:
+        raise ValueError("Invalid subnet: {0}".format(subnet))
+    if not 0 < prefix <= 30:
+        raise ValueError("Subnet {0} has no room for hosts".format(subnet))
+    netmask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    network = ip_to_int(address) & netmask
+    return network, netmask, network | (~netmask & 0xffffffff)
+
+
+class AddressBitmap(object):
+    """
+    Bitmap of used addresses, one bit per address. Free addresses are found
+    next-fit from the last allocation, skipping fully used bytes, so handing
+    out addresses takes constant time on average.
+    """
+    def __init__(self, size, data=None, cursor=0):
+        self.size = size
+        self.bits = bytearray(data or (size + 7) // 8)
+        self.used = sum(bin(byte).count("1") for byte in self.bits)
+        self.cursor = cursor
+
+    def is_set(self, index):
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def set(self, index):
+        if not self.is_set(index):
+            self.bits[index >> 3] |= 1 << (index & 7)
+            self.used += 1
+
+    def clear(self, index):
+        if self.is_set(index):
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xff
+            self.used -= 1
+
+    def allocate(self):
+        """
+        Marks the next free address as used.
+
+        Returns
+        -------
+        Index of the address, or None if all addresses are used.
+        """
+        if self.used >= self.size:
+            return None
+        count = len(self.bits)
+        start = self.cursor >> 3
+        for offset in xrange(count):
+            byte_index = (start + offset) % count
+            byte = self.bits[byte_index]
+            if byte == 0xff:
+                continue
+            for bit in xrange(8):
+                index = (byte_index << 3) | bit
+                if index < self.size and not byte & (1 << bit):
+                    self.set(index)
+                    self.cursor = (index + 1) % self.size
+                    return index
+        return None
+
+
+class IPPool(object):
+    """
+    Subnet of which addresses are handed out to VMs. The network and broadcast
+    addresses and the gateway are never handed out.
+    """
+    def __init__(self, name, subnet, gateway=None, first=None, last=None,
+                 dns_servers=None, state_dir=None):
+        """
+        Parameters
+        ----------
+        name: str
+            Name of the pool.
+        subnet: str
+            Subnet in CIDR notation, such as "10.0.0.0/24".
+        gateway: str
+            Gateway of the subnet. Defaults to the first address.
+        first, last: str
+            First and last address to hand out. By default, all addresses of
+            the subnet are handed out.
+        dns_servers: str
+            Space separated DNS servers. Defaults to the gateway.
+        state_dir: str
+            Directory to persist the leases of the pool in. Defaults to the
+            ip-pools cache directory.
+        """
+        self.name = name
+        self.subnet = subnet
+        self.network, self.netmask, self.broadcast = parse_subnet(subnet)
+        self.gateway = ip_to_int(gateway) if gateway else self.network + 1
+        self.first = ip_to_int(first) if first else self.network + 1
+        self.last = ip_to_int(last) if last else self.broadcast - 1
+        if not self.network < self.first <= self.last < self.broadcast:
+            raise ValueError("Range of pool {0} is not within {1}".format(
+                name, subnet))
+        self.dns_servers = dns_servers or int_to_ip(self.gateway)
+        state_dir = state_dir or get_cache_dir("ip-pools")
+        self.state_file = os.path.join(state_dir, "{0}.json".format(name))
+        self.lock_file = os.path.join(state_dir, "{0}.lock".format(name))
+        self._lock = threading.Lock()
+        self._state = None
+
+    @classmethod
+    def from_config(cls, name, config, state_dir=None):
+        """
+        Creates a pool from its section in the config file, with the keys
+        "subnet", and optionally "gateway", "range" as "FIRST-LAST" and
+        "dns-servers".
+        """
+        if "subnet" not in config:
+            raise ValueError("Pool {0} has no subnet".format(name))
+        first = last = None
+        if config.get("range"):
+            first, last = config['range'].split("-")
+        return cls(name, config['subnet'], gateway=config.get("gateway"),
+                   first=first, last=last,
+                   dns_servers=config.get("dns-servers"), state_dir=state_dir)
+
+    @property
+    def size(self):
+        return self.last - self.first + 1
+
+    def __contains__(self, address):
+        return self.first <= ip_to_int(address) <= self.last
+
+    def get_answers(self, address):
+        """
+        Get the answers to the static network questions for an address.
+        """
+        return {
+            "ip_address": address,
+            "subnet_mask": int_to_ip(self.netmask),
+            "network_address": int_to_ip(self.network),
+            "broadcast_address": int_to_ip(self.broadcast),
+            "gateway_address": int_to_ip(self.gateway),
+            "dns_servers": self.dns_servers,
+        }
+
+    def _get_version(self):
+        try:
+            stat = os.stat(self.state_file)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def _load(self):
+        """
+        Get the bitmap and leases of the pool. They are kept in memory until
+        another process changes the state file.
+        """
+        version = self._get_version()
+        if self._state is not None and self._state[0] == version:
+            return self._state[1], self._state[2]
+        bitmap = AddressBitmap(self.size)
+        leases = {}
+        if version is not None:
+            with open(self.state_file) as _file:
+                state = json.load(_file)
+            leases = state['leases']
+            if (state['first'], state['last']) == (self.first, self.last):
+                bitmap = AddressBitmap(self.size,
+                                       base64.b64decode(state['bitmap']),
+                                       state['cursor'])
+            else:
+                # The range changed, rebuild the bitmap from the leases.
+                for address in leases.keys():
+                    if address in self:
+                        bitmap.set(ip_to_int(address) - self.first)
+                    else:
+                        del leases[address]
+        if self.first <= self.gateway <= self.last:
+            bitmap.set(self.gateway - self.first)
+        self._state = (version, bitmap, leases)
+        return bitmap, leases
+
+    def _save(self, bitmap, leases):
+        state = {"subnet": self.subnet, "first": self.first,
+                 "last": self.last, "leases": leases,
+                 "bitmap": base64.b64encode(bytes(bitmap.bits)),
+                 "cursor": bitmap.cursor}
+        fd, temp_file = tempfile.mkstemp(
+            dir=os.path.dirname(self.state_file), suffix=".tmp")
+        with os.fdopen(fd, "w") as _file:
+            json.dump(state, _file, indent=2, sort_keys=True)
+        os.rename(temp_file, self.state_file)
+        self._state = (self._get_version(), bitmap, leases)
+
+    def _update(self, func):
+        """
+        Calls func with the bitmap and leases, while holding the pool locked
+        for both other threads and other processes, and saves them afterwards.
+        """
+        with self._lock:
+            with open(self.lock_file, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    bitmap, leases = self._load()
+                    result = func(bitmap, leases)
+                    self._save(bitmap, leases)
+                    return result
+                except:
+                    # The state in memory may be partially changed.
+                    self._state = None
+                    raise
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def allocate(self, vmid, name=None):
+        """
+        Hands out a free address.
+
+        Parameters
+        ----------
+        vmid: int
+            ID of the VM the address is for.
+        name: str
+            Name of the VM.
+
+        Returns
+        -------
+        The address.
+        """
+        def allocate(bitmap, leases):
+            index = bitmap.allocate()
+            if index is None:
+                raise ValueError("IP pool {0} is exhausted".format(self.name))
+            address = int_to_ip(self.first + index)
+            leases[address] = {"vmid": vmid, "name": name,
+                               "since": time.time()}
+            return address
+        address = self._update(allocate)
+        logger.info("Allocated {0} from IP pool {1}".format(address,
+                                                             self.name))
+        return address
+
+    def release(self, address):
+        if address not in self:
+            raise ValueError("{0} is not in IP pool {1}".format(address,
+                                                                self.name))
+
+        def release(bitmap, leases):
+            bitmap.clear(ip_to_int(address) - self.first)
+            leases.pop(address, None)
+        self._update(release)
+
+    def reconcile(self, used):
+        """
+        Brings the leases in line with the addresses in use by VMs. Addresses
+        in use are marked as used, and leases of VMs that do not exist are
+        released once they are older than LEASE_GRACE.
+
+        Parameters
+        ----------
+        used: dict
+            Mapping of addresses to the vmid of the VM using them.
+        """
+        vmids = set(used.values())
+
+        def reconcile(bitmap, leases):
+            for address, vmid in used.iteritems():
+                if address in self:
+                    bitmap.set(ip_to_int(address) - self.first)
+                    lease = leases.setdefault(address, {
+                        "vmid": vmid, "name": None, "since": time.time()})
+                    lease['vmid'] = vmid
+            for address, lease in leases.items():
+                if address not in used and lease['vmid'] not in vmids and \
+                        time.time() - lease['since'] > LEASE_GRACE:
+                    logger.info("Releasing {0} of VM {1}, which does not "
+                                "exist".format(address, lease['vmid']))
+                    bitmap.clear(ip_to_int(address) - self.first)
+                    del leases[address]
+        self._update(reconcile)
+
+    def status(self):
+        with self._lock:
+            bitmap, leases = self._load()
+        return OrderedDict([("subnet", self.subnet), ("size", self.size),
+                            ("used", bitmap.used),
+                            ("free", self.size - bitmap.used)])
+
+
+def get_vm_addresses(config):
+    """
+    Get the IPv4 addresses a VM uses according to its config: from its
+    description, as set for VMs with an address from a pool, and from the
+    ipconfig options of the cloud-init support of Proxmox.
+    """
+    addresses = set()
+    for key, value in config.iteritems():
+        if key == "description" or re.match(r"^ipconfig\d+$", key):
+            for pattern in ADDRESS_PATTERNS:
+                addresses.update(pattern.findall(str(value)))
+    return addresses
+
+
+class IPPoolManager(OrderedDict):
+    """
+    All IP pools of the config file, by name.
+    """
+    def __init__(self, config=None, state_dir=None):
+        """
+        Parameters
+        ----------
+        config: dict
+            The [ip-pools] section of the config file, with a subsection per
+            pool.
+        state_dir: str
+            Directory to persist the leases in.
+        """
+        super(IPPoolManager, self).__init__()
+        for name, pool_config in (config or {}).iteritems():
+            self[name] = IPPool.from_config(name, pool_config,
+                                            state_dir=state_dir)
+
+    def allocate(self, pool, vmid, name=None):
+        """
+        Hands out an address from a pool.
+
+        Returns
+        -------
+        Dict with the answers to the static network questions.
+        """
+        if pool not in self:
+            raise ValueError("Unknown IP pool: {0}".format(pool))
+        return self[pool].get_answers(self[pool].allocate(vmid, name))
+
+    def reconcile(self, api):
+        """
+        Reconciles all pools against the addresses in use by the VMs of the
+        cluster.
+        """
+        used = {}
+        for node in api.get_nodes():
+            for vmid in api.get_vms(node):
+                for address in get_vm_addresses(
+                        api.get_vm_config(node, vmid)):
+                    used[address] = int(vmid)
+        for pool in self.values():
+            pool.reconcile(used)
+
+    def status(self):
+        return OrderedDict((name, pool.status())
+                           for name, pool in self.iteritems())
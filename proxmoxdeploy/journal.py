@@ -0,0 +1,172 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .cache import get_cache_dir
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DeployJournal(object):
+    """
+    Records the completed steps of a deployment, so a failed deployment can be
+    resumed from the first incomplete step. Every recorded step is written to
+    disk immediately.
+
+    A journal without a filename is kept in memory only. This allows code to
+    always use a journal, whether or not the deployment is resumable.
+    """
+    def __init__(self, filename=None, host=None, proxmox=None, cloudinit=None,
+                 steps=None):
+        """
+        Parameters
+        ----------
+        filename: str
+            File to persist the journal to. If None, nothing is persisted.
+        host: str
+            Proxmox host the deployment is performed on.
+        proxmox: dict
+            Answers to the Proxmox questions.
+        cloudinit: dict
+            Answers to the cloud-init questions.
+        steps: dict
+            Completed steps, mapping step names to their recorded data.
+        """
+        self.filename = filename
+        self.host = host
+        self.proxmox = proxmox or {}
+        self.cloudinit = cloudinit or {}
+        self.steps = steps or {}
+        self._lock = threading.Lock()
+
+    @property
+    def persistent(self):
+        return self.filename is not None
+
+    @classmethod
+    def create(cls, host, proxmox, cloudinit):
+        """
+        Creates a new persistent journal for a deployment.
+
+        Parameters
+        ----------
+        host: str
+            Proxmox host the deployment is performed on.
+        proxmox: dict
+            Answers to the Proxmox questions.
+        cloudinit: dict
+            Answers to the cloud-init questions.
+        """
+        filename = os.path.join(
+            get_cache_dir("journals"),
+            "{0}-{1}.json".format(host, proxmox['vmid']))
+        journal = cls(filename, host=host, proxmox=proxmox,
+                      cloudinit=cloudinit)
+        journal.save()
+        return journal
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a persisted journal.
+        """
+        with open(filename) as _file:
+            data = json.load(_file)
+        return cls(filename, host=data['host'], proxmox=data['proxmox'],
+                   cloudinit=data['cloudinit'], steps=data['steps'])
+
+    @classmethod
+    def find_latest(cls, host):
+        """
+        Finds the most recently updated journal for the given host.
+
+        Returns
+        -------
+        Filename of the journal, or None if there are no journals.
+        """
+        journals = glob.glob(os.path.join(get_cache_dir("journals"),
+                                          "{0}-*.json".format(host)))
+        if not journals:
+            return None
+        return max(journals, key=os.path.getmtime)
+
+    def save(self):
+        """
+        Writes the journal to disk. The file is replaced atomically, so a crash
+        never leaves a partially written journal behind.
+        """
+        if not self.persistent:
+            return
+        data = {"host": self.host, "proxmox": self.proxmox,
+                "cloudinit": self.cloudinit, "steps": self.steps}
+        fd, temp_file = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename), suffix=".tmp")
+        with os.fdopen(fd, "w") as _file:
+            json.dump(data, _file, indent=2, sort_keys=True)
+        os.rename(temp_file, self.filename)
+
+    def is_done(self, step):
+        return step in self.steps
+
+    def get(self, step):
+        """
+        Get the data recorded for a step, or None if it was not completed.
+        """
+        return self.steps.get(step)
+
+    def record(self, step, **data):
+        """
+        Marks a step as completed, and records data about it.
+        """
+        with self._lock:
+            data['completed_at'] = time.time()
+            self.steps[step] = data
+            self.save()
+
+    def forget(self, step):
+        """
+        Marks a step as not completed, for example when an artefact recorded
+        with it turns out to be gone.
+        """
+        with self._lock:
+            if self.steps.pop(step, None) is not None:
+                self.save()
+
+    def run(self, step, func, *args, **kwargs):
+        """
+        Calls func, unless the step was already completed. The return value of
+        func is recorded with the step, and returned on later calls.
+        """
+        if self.is_done(step):
+            logger.info("Skipping {0}, already completed".format(step))
+            return self.steps[step].get("result")
+        result = func(*args, **kwargs)
+        self.record(step, result=result)
+        return result
+
+    def remove(self):
+        """
+        Removes the persisted journal, usually when the deployment completed.
+        """
+        if self.persistent and os.path.exists(self.filename):
+            os.remove(self.filename)
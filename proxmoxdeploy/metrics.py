@@ -0,0 +1,283 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+"""
+Metrics of deployments: the time spent in each phase, and the progress and
+throughput of transfers, which are reported to listeners such as the log or
+an event stream file.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+
+class PhaseTimer(object):
+    """
+    Records how long each phase of a deployment takes.
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager that adds the time spent in its body to the phase with
+        the given name.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, elapsed):
+        """
+        Adds elapsed seconds to the phase with the given name.
+        """
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def as_dict(self):
+        """
+        Returns a dict of phase names to seconds spent.
+        """
+        with self._lock:
+            return OrderedDict(self.phases)
+
+
+def format_bytes(size):
+    """
+    Formats a size in bytes as a human readable string.
+    """
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return "{0:.1f} {1}".format(size, unit)
+        size /= 1024.0
+    return "{0:.1f} TiB".format(size)
+
+
+class TransferProgress(object):
+    """
+    Progress of a single transfer. Created by TransferMonitor.start().
+    """
+    def __init__(self, monitor, name, total=None):
+        self.monitor = monitor
+        self.name = name
+        self.total = total
+        self.bytes_sent = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self.throughput = 0.0
+        self._sample = (self.started_at, 0)
+
+    def update(self, size):
+        """
+        Adds size bytes to the amount sent.
+        """
+        self.bytes_sent += size
+        self.monitor._updated(self)
+
+    def finish(self):
+        self.finished_at = time.time()
+        self.monitor._finished(self)
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def average_throughput(self):
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes_sent / elapsed
+
+    @property
+    def eta(self):
+        """
+        Seconds until the transfer is expected to finish, or None if unknown.
+        """
+        throughput = self.throughput or self.average_throughput
+        if self.total is None or throughput <= 0:
+            return None
+        return max(0, self.total - self.bytes_sent) / throughput
+
+    def _take_sample(self):
+        now = time.time()
+        sample_time, sample_bytes = self._sample
+        if now > sample_time:
+            self.throughput = (self.bytes_sent - sample_bytes) / \
+                (now - sample_time)
+        self._sample = (now, self.bytes_sent)
+
+    def as_dict(self):
+        return OrderedDict([
+            ("name", self.name),
+            ("bytes_sent", self.bytes_sent),
+            ("total", self.total),
+            ("throughput", self.throughput),
+            ("average_throughput", self.average_throughput),
+            ("eta", self.eta),
+            ("elapsed", self.elapsed),
+        ])
+
+
+class TransferMonitor(object):
+    """
+    Tracks the progress of concurrent transfers, and emits events about them
+    to listeners. Progress events are emitted at most once per interval for
+    each transfer.
+
+    Listeners are called with a dict containing the "event" (one of
+    "transfer_started", "transfer_progress" or "transfer_finished"), the
+    transfer (see TransferProgress.as_dict), and the aggregate "throughput"
+    and "active" transfers.
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.bytes_sent = 0
+        self._listeners = []
+        self._active = []
+        self._emitted_at = {}
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def start(self, name, total=None):
+        """
+        Starts tracking a new transfer.
+
+        Parameters
+        ----------
+        name: str
+            Name of the transfer, usually the destination.
+        total: int
+            Total amount of bytes to send, if known.
+
+        Returns
+        -------
+        TransferProgress to report progress to.
+        """
+        progress = TransferProgress(self, name, total)
+        with self._lock:
+            self._active.append(progress)
+            self._emitted_at[progress] = progress.started_at
+        self._emit("transfer_started", progress)
+        return progress
+
+    def _updated(self, progress):
+        with self._lock:
+            now = time.time()
+            if now - self._emitted_at[progress] < self.interval:
+                return
+            self._emitted_at[progress] = now
+            progress._take_sample()
+        self._emit("transfer_progress", progress)
+
+    def _finished(self, progress):
+        with self._lock:
+            progress._take_sample()
+            self._active.remove(progress)
+            del self._emitted_at[progress]
+            self.bytes_sent += progress.bytes_sent
+        self._emit("transfer_finished", progress)
+
+    def snapshot(self):
+        """
+        Returns the aggregate state of all active transfers.
+        """
+        with self._lock:
+            active = list(self._active)
+        return OrderedDict([
+            ("active", len(active)),
+            ("throughput", sum(progress.throughput for progress in active)),
+            ("bytes_in_flight", sum(progress.bytes_sent
+                                    for progress in active)),
+            ("bytes_sent", self.bytes_sent),
+            ("transfers", [progress.as_dict() for progress in active]),
+        ])
+
+    def _emit(self, event, progress):
+        if not self._listeners:
+            return
+        snapshot = self.snapshot()
+        data = OrderedDict([
+            ("event", event),
+            ("time", time.time()),
+            ("transfer", progress.as_dict()),
+            ("throughput", snapshot['throughput']),
+            ("active", snapshot['active']),
+        ])
+        for listener in self._listeners:
+            listener(data)
+
+
+class ProgressLogger(object):
+    """
+    Transfer listener that logs the progress of transfers.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+
+    def __call__(self, event):
+        transfer = event['transfer']
+        if event['event'] == "transfer_started":
+            return
+        if event['event'] == "transfer_finished":
+            self.logger.info("  {0}: {1} in {2:.1f}s, {3}/s".format(
+                transfer['name'], format_bytes(transfer['bytes_sent']),
+                transfer['elapsed'],
+                format_bytes(transfer['average_throughput'])))
+            return
+
+        message = "  {0}: {1}".format(transfer['name'],
+                                      format_bytes(transfer['bytes_sent']))
+        if transfer['total']:
+            message += " of {0} ({1:.0%})".format(
+                format_bytes(transfer['total']),
+                float(transfer['bytes_sent']) / transfer['total'])
+        message += ", {0}/s".format(format_bytes(transfer['throughput']))
+        if transfer['eta'] is not None:
+            message += ", ETA {0:.0f}s".format(transfer['eta'])
+        if event['active'] > 1:
+            message += " ({0} transfers, {1}/s total)".format(
+                event['active'], format_bytes(event['throughput']))
+        self.logger.info(message)
+
+
+class EventStreamWriter(object):
+    """
+    Transfer listener that writes every event as a line of JSON to a file.
+    """
+    def __init__(self, filename):
+        self._file = open(filename, "a")
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
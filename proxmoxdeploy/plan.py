@@ -0,0 +1,350 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Dry runs of deployments, with estimates of how long they take and what they
+transfer.
+"""
+
+from .imagecache import is_image_url
+from .metrics import format_bytes
+from collections import OrderedDict
+import logging
+import os
+
+# Estimates of phases that were never measured, in seconds.
+DEFAULT_DURATIONS = {
+    "create_vm": 2.0,
+    "generate_seed_iso": 0.5,
+    "attach_seed_iso": 2.0,
+    "cache_image": 1.0,
+    "allocate_disk": 1.0,
+    "attach_disk": 1.0,
+    "attach_serial_console": 1.0,
+    "start_vm": 3.0,
+}
+# Estimates of the throughput of steps that were never measured, in bytes of
+# the local image per second.
+DEFAULT_RATES = {
+    "upload_image": 50 * 1024 ** 2,
+    "copy_image": 200 * 1024 ** 2,
+    "import_image": 200 * 1024 ** 2,
+}
+
+logger = logging.getLogger(__name__)
+
+
+class DeployPlan(object):
+    """
+    Resolves deployments without side effects: where they are placed, which
+    VM ids they get, whether their image is in the image cache, how many
+    bytes they transfer, which disks they allocate, and how long each phase
+    is expected to take.
+
+    Phases follow deploy, with the base disk split into the steps of
+    ProxmoxClient._upload_to_storage, or of a native import. Their durations
+    are estimated from the ThroughputHistory of the client, and the size of
+    the local image. Deployments are planned in order, so a later deployment
+    of an image that an earlier one caches on the node is a cache hit.
+    """
+    def __init__(self, api, history=None, ip_pools=None, workers=1):
+        """
+        Parameters
+        ----------
+        api: ProxmoxClient
+            Client to query the cluster with. Only read-only methods are used.
+        history: ThroughputHistory
+            Measurements to estimate with. Defaults to the history of the
+            client.
+        ip_pools: IPPoolManager
+            IP pools deployments can take their address from.
+        workers: int
+            Amount of deployments that run concurrently, to estimate the
+            duration of the whole plan with.
+        """
+        self.api = api
+        self.history = history or api.history
+        self.ip_pools = ip_pools or {}
+        self.workers = workers
+        self.deployments = []
+        self._vmids = set()
+        self._cache_status = {}
+        self._available = {}
+        self._native_import = None
+
+    def get_vmid(self, reserved=()):
+        """
+        Get the VM id the next deployment without one would get.
+
+        Parameters
+        ----------
+        reserved: iterable of int
+            VM ids that are taken by running deployments.
+        """
+        return self.api.get_free_vmid(self._vmids.union(reserved))
+
+    def _get_cache_status(self, node, image):
+        key = (node, image)
+        if key not in self._cache_status:
+            try:
+                self._cache_status[key] = \
+                    self.api.get_image_cache_status(image)
+            except Exception as e:
+                logger.warning("Failed to check the image cache of {0}: {1}"
+                               .format(node, e))
+                self._cache_status[key] = "cold"
+        return self._cache_status[key]
+
+    def _get_available(self, node, storage):
+        key = (node, storage)
+        if key not in self._available:
+            self._available[key] = \
+                self.api.get_max_disk_size(node, storage) * 1024 ** 3
+        return self._available[key]
+
+    def _estimate(self, phase, node, storage=None, size=None):
+        """
+        Estimates a phase, from its average duration or, for phases in
+        DEFAULT_RATES, from its throughput and the size of the image.
+
+        Returns
+        -------
+        Tuple of the seconds, or None if they can't be estimated, and the
+        source of the estimate: "node", "storage", "cluster", "default" or
+        None.
+        """
+        value, source = self.history.estimate(phase, node, storage)
+        if phase in DEFAULT_RATES:
+            if value is None:
+                value, source = (DEFAULT_RATES[phase], "default")
+            if size is None:
+                return (None, None)
+            return (float(size) / value, source)
+        if value is None:
+            value, source = (DEFAULT_DURATIONS[phase], "default")
+        return (value, source)
+
+    def _get_image_phases(self, image, cache):
+        phases = []
+        if cache == "hit":
+            phases.append("cache_image")
+        elif is_image_url(image):
+            # The node downloads the image, at a speed we don't know.
+            phases.append("download_image")
+        else:
+            phases.append("upload_image")
+        if self._native_import is None:
+            self._native_import = self.api._use_native_import()
+        if self._native_import:
+            phases.append("import_image")
+        else:
+            phases.extend(["allocate_disk", "copy_image", "attach_disk"])
+        return phases
+
+    def add(self, proxmox, cloudinit, reserved=()):
+        """
+        Plans a deployment.
+
+        Parameters
+        ----------
+        proxmox: dict
+            Answers to the Proxmox questions. If there is no "vmid", the
+            deployment gets the next free one.
+        cloudinit: dict
+            Answers to the cloud-init questions.
+        reserved: iterable of int
+            VM ids that are taken by running deployments.
+
+        Returns
+        -------
+        Dict describing the deployment, with the "problems" that would stop
+        it from succeeding.
+        """
+        problems = []
+        node, storage = proxmox['node'], proxmox['storage']
+        vmid = proxmox.get("vmid")
+        if not vmid:
+            vmid = self.get_vmid(reserved)
+        elif int(vmid) in self._vmids or int(vmid) in reserved:
+            problems.append("VM id {0} is already taken".format(vmid))
+        vmid = int(vmid)
+        self._vmids.add(vmid)
+
+        for key, limit in (("cpu", self.api.get_max_cpu(node)),
+                           ("memory", self.api.get_max_memory(node))):
+            if int(proxmox[key]) > limit:
+                problems.append("{0} exceeds the {1} available on {2}"
+                                .format(key, limit, node))
+
+        image = cloudinit['image']
+        image_size = None
+        if not is_image_url(image):
+            image_size = os.path.getsize(image)
+        status = self._get_cache_status(node, image)
+        cache = "miss" if status == "cold" else "hit"
+        if cache == "miss" and (is_image_url(image) or
+                                self.api.image_cache.sync_local_images):
+            # Later deployments find the image in the image cache.
+            self._cache_status[(node, image)] = "warm"
+        transfer_bytes = image_size if cache == "miss" else 0
+
+        disk_bytes = int(proxmox['disk']) * 1024 ** 3
+        available = self._get_available(node, storage)
+        if disk_bytes > available:
+            problems.append("{0} on {1} has {2} left for a disk of {3}"
+                            .format(storage, node,
+                                    format_bytes(max(0, available)),
+                                    format_bytes(disk_bytes)))
+        self._available[(node, storage)] = available - disk_bytes
+
+        pool = cloudinit.get("ip_pool")
+        if pool:
+            planned = len([deployment for deployment in self.deployments
+                           if deployment['ip_pool'] == pool])
+            if pool not in self.ip_pools:
+                problems.append("Unknown IP pool: {0}".format(pool))
+            elif planned >= self.ip_pools[pool].status()['free']:
+                problems.append("IP pool {0} has no free addresses left"
+                                .format(pool))
+
+        phases = ["create_vm", "generate_seed_iso", "attach_seed_iso"]
+        phases.extend(self._get_image_phases(image, cache))
+        phases.append("attach_serial_console")
+        if cloudinit.get("start_vm"):
+            phases.append("start_vm")
+        estimates = OrderedDict()
+        sources = OrderedDict()
+        for phase in phases:
+            if phase == "download_image":
+                estimates[phase], sources[phase] = (None, None)
+            else:
+                estimates[phase], sources[phase] = self._estimate(
+                    phase, node, storage, image_size)
+
+        deployment = OrderedDict([
+            ("name", cloudinit.get("name")),
+            ("vmid", vmid),
+            ("node", node),
+            ("storage", storage),
+            ("image", image),
+            ("image_size", image_size),
+            ("cache", cache),
+            ("transfer_bytes", transfer_bytes),
+            ("disk_bytes", disk_bytes),
+            ("ip_pool", pool),
+            ("phases", estimates),
+            ("sources", sources),
+            ("deploy_seconds", sum(seconds for seconds in estimates.values()
+                                   if seconds is not None)),
+            ("complete", None not in estimates.values()),
+            ("problems", problems),
+        ])
+        self.deployments.append(deployment)
+        return deployment
+
+    def summary(self):
+        """
+        Returns the totals of the plan, per node and per storage. The
+        duration of the plan assumes deployments are spread evenly over the
+        workers.
+        """
+        nodes = OrderedDict()
+        storages = OrderedDict()
+        for deployment in self.deployments:
+            node = nodes.setdefault(deployment['node'], OrderedDict([
+                ("vmids", []), ("cache_hits", 0), ("cache_misses", 0),
+                ("transfer_bytes", 0)]))
+            node['vmids'].append(deployment['vmid'])
+            node["cache_hits" if deployment['cache'] == "hit"
+                 else "cache_misses"] += 1
+            node['transfer_bytes'] += deployment['transfer_bytes'] or 0
+
+            key = "{0}/{1}".format(deployment['node'], deployment['storage'])
+            storage = storages.setdefault(key, OrderedDict([
+                ("disks", 0), ("disk_bytes", 0)]))
+            storage['disks'] += 1
+            storage['disk_bytes'] += deployment['disk_bytes']
+        for key, storage in storages.iteritems():
+            node, _, name = key.partition("/")
+            storage['available_bytes'] = \
+                self._available[(node, name)] + storage['disk_bytes']
+
+        seconds = [deployment['deploy_seconds']
+                   for deployment in self.deployments]
+        return OrderedDict([
+            ("deployments", len(self.deployments)),
+            ("transfer_bytes", sum(node['transfer_bytes']
+                                   for node in nodes.values())),
+            ("disk_bytes", sum(storage['disk_bytes']
+                               for storage in storages.values())),
+            ("nodes", nodes),
+            ("storages", storages),
+            ("sequential_seconds", sum(seconds)),
+            ("estimated_seconds", max(seconds + [sum(seconds) /
+                                                 max(1, self.workers)])
+             if seconds else 0.0),
+            ("complete", all(deployment['complete']
+                             for deployment in self.deployments)),
+            ("problems", sum(len(deployment['problems'])
+                             for deployment in self.deployments)),
+        ])
+
+    def as_dict(self):
+        return OrderedDict([("deployments", self.deployments),
+                            ("summary", self.summary())])
+
+    def log(self, logger):
+        """
+        Logs the plan in human readable form.
+        """
+        for deployment in self.deployments:
+            logger.info("{0} (VM {1}) on {2}/{3}".format(
+                deployment['name'], deployment['vmid'], deployment['node'],
+                deployment['storage']))
+            logger.info("  image {0}, {1}, cache {2}".format(
+                os.path.basename(deployment['image']),
+                format_bytes(deployment['image_size'])
+                if deployment['image_size'] is not None else "size unknown",
+                deployment['cache']))
+            logger.info("  transfer {0}, disk {1}".format(
+                format_bytes(deployment['transfer_bytes'] or 0),
+                format_bytes(deployment['disk_bytes'])))
+            for phase, seconds in deployment['phases'].iteritems():
+                if seconds is None:
+                    logger.info("  {0:<25} {1:>10}".format(phase, "unknown"))
+                    continue
+                logger.info("  {0:<25} {1:>9.1f}s  {2}".format(
+                    phase, seconds, deployment['sources'][phase]))
+            for problem in deployment['problems']:
+                logger.warning("  {0}".format(problem))
+
+        summary = self.summary()
+        logger.info("")
+        for name, node in summary['nodes'].iteritems():
+            logger.info("{0:<20} {1:>4} hits {2:>4} misses {3:>12} to "
+                        "transfer".format(name, node['cache_hits'],
+                                          node['cache_misses'],
+                                          format_bytes(
+                                              node['transfer_bytes'])))
+        for name, storage in summary['storages'].iteritems():
+            logger.info("{0:<20} {1:>4} disks {2:>12} of {3} available"
+                        .format(name, storage['disks'],
+                                format_bytes(storage['disk_bytes']),
+                                format_bytes(storage['available_bytes'])))
+        logger.info("{0} deployments, estimated {1:.0f}s{2}".format(
+            summary['deployments'], summary['estimated_seconds'],
+            "" if summary['complete'] else
+            ", excluding phases that can't be estimated"))
@@ -0,0 +1,107 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Preseed files, which answer questions ahead of time. A preseed file is an INI
+file in the format of the config file. Answers outside of a section apply to
+every profile. Every section is a profile, which may inherit the answers of
+other profiles with "inherit":
+
+    cpu_family = host
+    timezone = Europe/Amsterdam
+
+    [small]
+    cpu = 1
+    memory = 1024
+
+    [web]
+    inherit = small
+    packages = nginx
+"""
+
+from configobj import ConfigObj, Section
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def _get_profile(config, profile, seen):
+    if profile in seen:
+        raise ValueError("Profile {0} inherits from itself".format(profile))
+    if not isinstance(config.get(profile), Section):
+        raise ValueError("Unknown profile: {0}".format(profile))
+    section = config[profile]
+    inherit = section.get("inherit", [])
+    if not isinstance(inherit, list):
+        inherit = [inherit]
+    answers = {}
+    for parent in inherit:
+        answers.update(_get_profile(config, parent, seen + [profile]))
+    answers.update((key, value) for key, value in section.iteritems()
+                   if key != "inherit")
+    return answers
+
+
+def load_preseed(filename, profile=None):
+    """
+    Loads the answers of a profile from a preseed file.
+
+    Parameters
+    ----------
+    filename: str
+        Preseed file to load.
+    profile: str
+        Profile to load. The answers of the profiles it inherits are
+        overridden by its own answers. Without a profile, only the answers
+        outside of a section are loaded.
+
+    Returns
+    -------
+    Dict of answers, by question key.
+    """
+    if not os.path.exists(filename):
+        raise ValueError("Preseed file {0} does not exist".format(filename))
+    config = ConfigObj(filename)
+    answers = dict((key, config[key]) for key in config.scalars)
+    if profile:
+        answers.update(_get_profile(config, profile, []))
+    return answers
+
+
+def save_preseed(filename, answers, profile=None):
+    """
+    Saves answers to a preseed file. Other profiles in the file are kept.
+
+    Parameters
+    ----------
+    filename: str
+        Preseed file to save to.
+    answers: dict
+        Answers to save, by question key.
+    profile: str
+        Profile to save the answers as, replacing the profile if it exists.
+        Without a profile, the answers are saved outside of a section.
+    """
+    config = ConfigObj(filename)
+    if profile:
+        config[profile] = answers
+    else:
+        for key in list(config.scalars):
+            del config[key]
+        config.update(answers)
+    config.write()
+    logger.info("Recorded answers to {0}".format(filename))
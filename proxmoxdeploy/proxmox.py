@@ -16,13 +16,28 @@
 # this program. If not, see http://www.gnu.org/licenses/.
 
 from .cloudinit.templates import VALID_IMAGE_FORMATS, VALID_COMPRESSION_FORMATS
-from .exceptions import SSHCommandInvocationException
+from .console import SERIAL_SOCKET, open_command_stream
+from .conversion import ConversionEngine, STORAGE_TYPE_DEFAULTS
+from .exceptions import SSHCommandInvocationException, \
+    UploadCancelledException
+from .history import ThroughputHistory
+from .imagecache import NodeImageCache, is_image_url
+from .journal import DeployJournal
+from .metrics import PhaseTimer, TransferMonitor, format_bytes
 from .questions import QuestionGroup, IntegerQuestion, EnumQuestion, \
-    NoAskQuestion
-from openssh_wrapper import SSHError
+    NoAskQuestion, preseed_answers
+from .readiness import PROBE_SCRIPT, parse_probe_output
+from .storage import BLOCK_STORAGE_TYPES, FILE_STORAGE_TYPES, \
+    get_storage_profile
+from .throttle import NodeThrottle
+from proxmoxer import ResourceException
+import hashlib
 import logging
 import math
 import os.path
+import pipes
+import re
+import time
 
 CPU_FAMILIES = [
     "486", "athlon", "pentium", "pentium2", "pentium3", "coreduo", "core2duo",
@@ -31,36 +46,116 @@ CPU_FAMILIES = [
     "Opteron_G1", "Opteron_G2", "Opteron_G3", "Opteron_G4", "Opteron_G5",
     "host"
 ]
+# Keys of the answers to the Proxmox questions.
+PROXMOX_ANSWER_KEYS = ("node", "storage", "cpu", "cpu_family", "memory",
+                       "disk", "vmid")
+# Content types a seed ISO can be stored as a plain file in, in order of
+# preference. Storages with either content type have a path on the node.
+SEED_ISO_CONTENT_TYPES = ("iso", "snippets")
+# Seed ISOs in iso or snippets storages, named after the VM they belong to.
+SEED_ISO_PATTERN = re.compile(r"^vm-(\d+)-cloudinit-seed(-[0-9a-f]+)?\.iso$")
+IMPORT_MODES = ("auto", "native", "convert")
+# First version of Proxmox that can import disks while attaching them.
+NATIVE_IMPORT_VERSION = (7, 2)
+# Seconds between polls of the status of a task.
+TASK_POLL_INTERVAL = 1.0
 
 logger = logging.getLogger(__name__)
 
 
-def ask_proxmox_questions(proxmox):
+class _HashingFile(object):
+    """
+    Wraps a file object, and feeds everything read from it into a hash object.
+    """
+    def __init__(self, _file, digest):
+        self._file = _file
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.digest.update(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class _ProgressFile(object):
+    """
+    Wraps a file object, and reports everything read from it to a
+    TransferProgress. If a limiter is given, reads are slowed down to its
+    rate. If a cancel event is given, reads fail once it is set.
+    """
+    def __init__(self, _file, progress, limiter=None, cancel=None):
+        self._file = _file
+        self.progress = progress
+        self.limiter = limiter
+        self.cancel = cancel
+
+    def read(self, size=-1):
+        if self.cancel is not None and self.cancel.is_set():
+            raise UploadCancelledException("Upload was cancelled")
+        data = self._file.read(size)
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        self.progress.update(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _hash_file(filename, block_size=1024 ** 2):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as _file:
+        for block in iter(lambda: _file.read(block_size), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _preseed_question(question, preseed, key, defaults):
+    if key not in preseed:
+        question.preseeded = defaults
+    else:
+        try:
+            question.preseed(preseed[key])
+        except ValueError as e:
+            raise ValueError("{0}: {1}".format(key, e))
+
+
+def ask_proxmox_questions(proxmox, preseed=None, defaults=False):
     """
     Asks the user questions about the Proxmox VM to provision.
 
     Parameters
     ----------
     proxmox: ProxmoxClient
+    preseed: dict
+        Answers to questions that are not asked, by the keys in
+        PROXMOX_ANSWER_KEYS. See preseed_answers.
+    defaults: bool
+        Whether questions without a preseeded answer are answered with their
+        default, if they have one.
 
     Returns
     -------
     dict of key-value pairs of answered questions.
     """
+    preseed = preseed or {}
     available_nodes = proxmox.get_nodes()
-    if len(available_nodes) == 1:
-        chosen_node = available_nodes[0]
-    else:
-        node_q = EnumQuestion("Proxmox Node to create VM on",
-                              valid_answers=available_nodes,
-                              default=available_nodes[0])
+    node_q = EnumQuestion("Proxmox Node to create VM on",
+                          valid_answers=available_nodes,
+                          default=available_nodes[0])
+    _preseed_question(node_q, preseed, "node", defaults)
+    if len(available_nodes) > 1:
         node_q.ask()
-        chosen_node = node_q.answer
+    chosen_node = node_q.answer
 
     available_storage = proxmox.get_storage(chosen_node)
     storage_q = EnumQuestion("Storage to create disk on",
                              valid_answers=available_storage,
                              default=available_storage[0])
+    _preseed_question(storage_q, preseed, "storage", defaults)
     storage_q.ask()
     chosen_storage = storage_q.answer
 
@@ -83,6 +178,7 @@ def ask_proxmox_questions(proxmox):
                                  default=proxmox.get_next_vmid()))
     ])
 
+    preseed_answers(proxmox_questions, preseed, defaults)
     proxmox_questions.ask_all()
     return proxmox_questions.flatten_answers()
 
@@ -91,14 +187,105 @@ class ProxmoxClient(object):
     """
     Wrapper around Proxmoxer, to encapsulate retrieval logic in one place.
     """
-    def __init__(self, client):
+    def __init__(self, client, monitor=None, image_cache=None, limiter=None,
+                 throttle=None, converter=None, storage_overrides=None,
+                 import_mode="auto", history=None):
         """
         Parameters
         ----------
         client: ProxmoxAPI
             ProxmoxAPI intance
+        monitor: TransferMonitor
+            Monitor to report the progress of uploads to. Clients shared
+            between concurrent deployments report to the same monitor.
+        image_cache: NodeImageCache
+            Cache of images on the node.
+        limiter: TokenBucket
+            Limits the rate of uploads, in bytes per second.
+        throttle: NodeThrottle
+            Throttles the heavy work on the node.
+        converter: ConversionEngine
+            Builds the commands to convert images into virtual disks with.
+        storage_overrides: dict
+            Maps storage names to config sections that override their learned
+            profile, see get_storage_profile.
+        import_mode: str
+            How base disks are imported, one of IMPORT_MODES. "native" lets
+            Proxmox import the disk when attaching it, which needs Proxmox
+            7.2 or later. "convert" allocates and converts the disk over SSH.
+            "auto" uses native imports where available, unless heavy work is
+            throttled, which native imports don't support.
+        history: ThroughputHistory
+            History to record the throughput of base disk uploads in. If not
+            set, measurements are kept in memory only.
         """
         self.client = client
+        self.monitor = monitor or TransferMonitor()
+        self.throttle = throttle or NodeThrottle()
+        self.image_cache = image_cache or NodeImageCache(
+            throttle=self.throttle)
+        self.limiter = limiter
+        self.converter = converter or ConversionEngine()
+        self.storage_overrides = storage_overrides or {}
+        if import_mode not in IMPORT_MODES:
+            raise ValueError("Unknown import mode: {0}".format(import_mode))
+        self.import_mode = import_mode
+        self.history = history or ThroughputHistory()
+        self._version = None
+        self._storage_profiles = {}
+        self._local_node = None
+
+    def _get_ssh_session(self):
+        """
+        Get the SSH session used by proxmoxer. This is an internal class of
+        proxmoxer, we're using its ssh transfer methods for various operations.
+        """
+        return self.client._backend.session
+
+    def _get_local_node(self):
+        """
+        Get the name of the node the SSH session is connected to.
+        """
+        if self._local_node is None:
+            stdout, _ = self._get_ssh_session()._exec("hostname")
+            self._local_node = stdout.strip().split(".")[0]
+        return self._local_node
+
+    def _get_node_command(self, node, command):
+        """
+        Get a command that runs a command on a node of the cluster. Commands
+        for other nodes than the one the SSH session is connected to are
+        passed on with ssh as root, which the nodes of a cluster allow
+        between each other.
+        """
+        if node == self._get_local_node():
+            return command
+        return "ssh -o BatchMode=yes root@{0} {1}".format(
+            pipes.quote(node), pipes.quote(command))
+
+    def get_version(self):
+        """
+        Get the version of Proxmox, as a tuple of the major and minor version.
+        """
+        if self._version is None:
+            version = self.client.version.get()['version']
+            self._version = tuple(int(part) for part
+                                  in re.split(r"[.-]", version)[:2])
+        return self._version
+
+    def get_api_user(self):
+        """
+        Get the user API calls are made as, with its realm, and the name of
+        its API token if one is used. API calls over SSH run pvesh as
+        root@pam.
+        """
+        transport = getattr(self._get_ssh_session(), "transport", None)
+        if transport is None:
+            return "root@pam"
+        if transport.token:
+            return "{0}!{1}".format(transport.user,
+                                    transport.token.split("=", 1)[0])
+        return transport.user
 
     def get_next_vmid(self):
         """
@@ -110,6 +297,36 @@ class ProxmoxClient(object):
         """
         return self.client.cluster.nextid.get()
 
+    def get_free_vmid(self, exclude=()):
+        """
+        Retrieve the first available vmid that is not excluded.
+
+        Candidates past the next available vmid are checked one by one with
+        the cluster, as any of them may belong to an existing VM.
+
+        Parameters
+        ----------
+        exclude: iterable of int
+            VM ids that must not be returned, such as the ids of deployments
+            that have not created their VM yet.
+
+        Returns
+        -------
+        The first available vmid that is not in exclude.
+        """
+        exclude = set(exclude)
+        vmid = int(self.get_next_vmid())
+        while vmid in exclude:
+            vmid += 1
+            if vmid in exclude:
+                continue
+            try:
+                self.client.cluster.nextid.get(vmid=vmid)
+            except ResourceException:
+                # Taken by an existing VM, move on to the next candidate.
+                exclude.add(vmid)
+        return vmid
+
     def get_nodes(self):
         """
         Retrieve a list of available nodes.
@@ -185,6 +402,77 @@ class ProxmoxClient(object):
                 storages.append(storage['storage'])
         return storages
 
+    def get_seed_storage(self, node):
+        """
+        Get a storage that can hold a seed ISO as a plain file.
+
+        Parameters
+        ----------
+        node: str
+            Name of the node to look for a storage on.
+
+        Returns
+        -------
+        Tuple of (storage, content type), or (None, None) if no active storage
+        with one of SEED_ISO_CONTENT_TYPES is available.
+        """
+        storages = self.client.nodes(node).storage.get()
+        for content in SEED_ISO_CONTENT_TYPES:
+            for storage in storages:
+                if (content in storage['content'].split(",")
+                        and storage.get('active', 1)):
+                    return (storage['storage'], content)
+        return (None, None)
+
+    def _get_extent_size(self, vgname):
+        stdout, stderr = self._get_ssh_session()._exec(
+            "vgs --noheadings --nosuffix --units k -o vg_extent_size "
+            "'{0}'".format(vgname))
+        try:
+            return int(float(stdout.strip()))
+        except ValueError:
+            logger.warning("Failed to get the extent size of volume group "
+                           "{0}".format(vgname))
+            return None
+
+    def get_storage_profile(self, node, storage, storage_type=None):
+        """
+        Get the profile of a storage, which decides the format, creation
+        options and size multiple of disks on it. The profile is learned from
+        the status and config of the storage once.
+
+        Parameters
+        ----------
+        node: str
+            Name of the node of the storage.
+        storage: str
+            Name of the storage.
+        storage_type: str
+            Type of the storage, if already known.
+
+        Returns
+        -------
+        StorageProfile
+        """
+        key = (node, storage)
+        if key not in self._storage_profiles:
+            if storage_type is None:
+                storage_type = self.client.nodes(node).storage(storage) \
+                    .status.get()['type']
+            try:
+                config = self.client.storage(storage).get()
+            except ResourceException:
+                config = {}
+            extent_size = None
+            if storage_type in ("lvm", "lvmthin") and config.get("vgname"):
+                extent_size = self._get_extent_size(config['vgname'])
+            profile = get_storage_profile(
+                storage_type, config, extent_size,
+                self.storage_overrides.get(storage))
+            logger.info("Disks on {0} are {1}".format(storage, profile))
+            self._storage_profiles[key] = profile
+        return self._storage_profiles[key]
+
     def get_max_disk_size(self, node=None, storage=None):
         """
         Get the maximum amount of disk space available.
@@ -214,7 +502,7 @@ class ProxmoxClient(object):
                         for _node in self.client.nodes.get()])
 
     def create_vm(self, node, vmid, name, cpu, cpu_family, memory,
-                  vlan_id=None):
+                  vlan_id=None, description=None, agent=False):
         """
         Creates a VM.
 
@@ -234,25 +522,60 @@ class ProxmoxClient(object):
             Megabytes of memory.
         vlan_id: int
             VLAN ID of the network device.
+        description: str
+            Description of the VM, shown as its notes.
+        agent: bool
+            Whether to enable the QEMU guest agent, so its answers show that
+            the VM booted.
         """
         node = self.client.nodes(node)
         net0 = "virtio,bridge=vmbr0"
         if vlan_id:
             net0 += ",tag={0}".format(vlan_id)
 
+        options = {}
+        if description:
+            options['description'] = description
+        if agent:
+            options['agent'] = 1
+
         logger.info("Creating Virtual Machine")
         node.qemu.create(
             vmid=vmid, name=name, sockets=1, cores=cpu, cpu=cpu_family,
-            memory=memory, net0=net0
+            memory=memory, net0=net0, **options
         )
 
-    def _upload(self, ssh, filename):
+    def _upload(self, ssh, filename, tmpfile=None, digest=None, cancel=None):
         logger.info("Transferring image to Proxmox")
-        tmpfile = os.path.join("/tmp", os.path.basename(filename))
-        with open(filename) as _file:
-            ssh.upload_file_obj(_file, tmpfile)
+        if not tmpfile:
+            tmpfile = os.path.join("/tmp", os.path.basename(filename))
+        progress = self.monitor.start(os.path.basename(tmpfile),
+                                      os.path.getsize(filename))
+        try:
+            with open(filename, "rb") as _file:
+                if hasattr(ssh, "upload_stream"):
+                    ssh.upload_stream(_file, tmpfile, progress=progress,
+                                      digest=digest, cancel=cancel,
+                                      limiter=self.limiter)
+                    return tmpfile
+                if digest:
+                    _file = _HashingFile(_file, digest)
+                ssh.upload_file_obj(
+                    _ProgressFile(_file, progress, self.limiter, cancel),
+                    tmpfile)
+        finally:
+            progress.finish()
         return tmpfile
 
+    def _get_upload_function(self, ssh, cancel=None):
+        """
+        Get a function that uploads a local file to a path on the node. If a
+        cancel event is given, uploads are aborted once it is set.
+        """
+        return lambda filename, tmpfile: self._upload(ssh, filename,
+                                                      tmpfile=tmpfile,
+                                                      cancel=cancel)
+
     def _decompress_image(self, ssh, tmpfile):
         _, ext = os.path.splitext(tmpfile)
         if ext in VALID_COMPRESSION_FORMATS:
@@ -263,8 +586,8 @@ class ProxmoxClient(object):
                 command = "gunzip"
             else:
                 command = "bunzip2"
-            stdout, stderr = ssh._exec("{0} '{1}'".format(command,
-                                                          tmpfile))
+            stdout, stderr = ssh._exec(self.throttle.wrap(
+                "{0} '{1}'".format(command, tmpfile)))
             if len(stdout) > 0 or len(stderr) > 0:
                 raise SSHCommandInvocationException(
                     "Failed to decompress image", stdout=stdout, stderr=stderr)
@@ -277,7 +600,10 @@ class ProxmoxClient(object):
 
         return tmpfile
 
-    def _get_virtual_disk_size(self, ssh, tmpfile):
+    def _get_image_info(self, ssh, tmpfile):
+        """
+        Get the format and virtual disk size in kilobytes of an image.
+        """
         stdout, stderr = ssh._exec("qemu-img info '{0}'".format(tmpfile))
 
         if len(stdout) == 0 or len(stderr) > 0:
@@ -285,16 +611,21 @@ class ProxmoxClient(object):
                 "Failed to get virtual disk size", stdout=stdout,
                 stderr=stderr)
 
+        image_format = None
         virtual_size = 0
         try:
             for line in stdout.split("\n"):
+                if line.startswith("file format:"):
+                    image_format = line.split(":", 1)[1].strip()
                 if "virtual size" in line:
                     virtual_size = line.split("(")[1].split()[0]
                     virtual_size = int(math.ceil(int(virtual_size) / 1024))
-                    break
         except:
             pass
-        return virtual_size
+        return (image_format, virtual_size)
+
+    def _get_virtual_disk_size(self, ssh, tmpfile):
+        return self._get_image_info(ssh, tmpfile)[1]
 
     def _allocate_disk(self, ssh, storage, vmid, diskname, disk_size,
                        storagename, disk_format):
@@ -320,29 +651,172 @@ class ProxmoxClient(object):
 
         return stdout.strip()
 
-    def _copy_image_into_disk(self, ssh, disk_format, tmpfile, devicepath):
+    def _create_disk_file(self, ssh, disk_format, devicepath, disk_size,
+                          create_options):
+        """
+        Recreates the file of a disk on a file storage with the options of
+        the storage profile, at its final size.
+        """
+        stdout, stderr = ssh._exec(self.throttle.wrap(
+            "qemu-img create -q -f {0} -o {1} '{2}' {3}K".format(
+                disk_format, ",".join(create_options), devicepath,
+                disk_size)))
+        if len(stderr) > 0:
+            raise SSHCommandInvocationException(
+                "Failed to create disk", stdout=stdout, stderr=stderr)
+
+    def _copy_image_into_disk(self, ssh, disk_format, tmpfile, devicepath,
+                              storage=None, conversion=None, profile=None,
+                              disk_size=None, node=None):
         logger.info("Copying image into virtual disk")
-        stdout, stderr = ssh._exec(
-            "qemu-img convert -O {0} '{1}' {2}".format(disk_format, tmpfile,
-                                                       devicepath)
-        )
+        # The disk is converted into as allocated, at its final size, so it
+        # doesn't need to be resized afterwards. Files are created empty, so
+        # qemu-img can skip writing zeroes to them.
+        target_is_zero = False
+        if profile and profile.storage_type in FILE_STORAGE_TYPES:
+            create_options = profile.get_create_options(disk_format)
+            if create_options:
+                self._create_disk_file(ssh, disk_format, devicepath,
+                                       disk_size, create_options)
+            target_is_zero = True
+        with self.throttle.converting(node, storage) as rate:
+            if rate:
+                logger.info("Limiting conversion to {0}/s".format(
+                    format_bytes(rate)))
+            # Images in the image cache are not replaced while they are
+            # converted.
+            command = self.converter.get_command(
+                ssh, conversion, disk_format, tmpfile, devicepath, rate,
+                target_is_zero)
+            stdout, stderr = ssh._exec(self.throttle.wrap(
+                self.image_cache.wrap_shared(tmpfile, command)))
 
         if len(stderr) > 0:
             raise SSHCommandInvocationException(
                 "Failed to copy file into disk", stdout=stdout, stderr=stderr)
 
+    def _get_remote_file_size(self, ssh, remote_file):
+        stdout, _ = ssh._exec("stat -c %s '{0}'".format(remote_file))
+        try:
+            return int(stdout.strip())
+        except ValueError:
+            return None
+
+    def _stage_image(self, ssh, filename, journal, step):
+        """
+        Uploads and decompresses an image into a temporary file on the node.
+        If the journal shows that the same image was staged before, and the
+        staged file is still complete, it is reused instead.
+
+        Returns
+        -------
+        Filename of the staged image on the node.
+        """
+        stat = os.stat(filename)
+        staged = journal.get(step)
+        if staged:
+            same_source = (
+                (staged['source_size'], staged['source_mtime']) ==
+                (stat.st_size, stat.st_mtime) or
+                staged['source_hash'] == _hash_file(filename))
+            if same_source and staged['size'] is not None and \
+                    self._get_remote_file_size(ssh, staged['path']) == \
+                    staged['size']:
+                logger.info("Reusing image staged at {0}"
+                            .format(staged['path']))
+                return staged['path']
+            journal.forget(step)
+
+        # Prefix the temporary file with the step, so concurrent deployments
+        # of the same image don't overwrite each other's files.
+        tmpfile = os.path.join("/tmp", "{0}-{1}".format(
+            step.replace(":", "-"), os.path.basename(filename)))
+        digest = hashlib.sha256()
+        tmpfile = self._upload(ssh, filename, tmpfile=tmpfile, digest=digest)
+        tmpfile = self._decompress_image(ssh, tmpfile)
+        if journal.persistent:
+            journal.record(step, path=tmpfile, source=filename,
+                           source_size=stat.st_size,
+                           source_mtime=stat.st_mtime,
+                           source_hash=digest.hexdigest(),
+                           size=self._get_remote_file_size(ssh, tmpfile))
+        return tmpfile
+
+    def _get_node_image(self, ssh, filename, journal, step):
+        """
+        Get an image onto the node. Images are taken from the image cache of
+        the node, which downloads URLs and syncs local images if enabled.
+        Other images are staged in a temporary file.
+
+        Returns
+        -------
+        Tuple of the path of the image on the node, and the path of the
+        temporary file, or None if the image is kept in the cache.
+        """
+        # Cached images are kept on the node for later deployments.
+        if is_image_url(filename):
+            return (self.image_cache.fetch(ssh, filename), None)
+        if self.image_cache.sync_local_images:
+            return (self.image_cache.sync(ssh, filename,
+                                          self._get_upload_function(ssh)),
+                    None)
+        image = self.image_cache.get_cached(ssh, filename)
+        if image:
+            logger.info("Using image cached on the node")
+            return (image, None)
+        tmpfile = self._stage_image(ssh, filename, journal, step)
+        return (tmpfile, tmpfile)
+
+    def _get_timed_node_image(self, ssh, filename, journal, step, timer):
+        """
+        Get an image onto the node, see _get_node_image. The time spent is
+        added to the "upload_image" phase of the timer if the image was
+        uploaded, or to "cache_image" if it was taken from the image cache.
+        Reused staged images are not timed.
+        """
+        resumed = journal.is_done(step)
+        start = time.time()
+        image, tmpfile = self._get_node_image(ssh, filename, journal, step)
+        if tmpfile is None:
+            timer.add("cache_image", time.time() - start)
+        elif not resumed:
+            timer.add("upload_image", time.time() - start)
+        return (image, tmpfile)
+
+    def _run_timed_step(self, journal, timer, phase, step, func, *args,
+                        **kwargs):
+        """
+        Runs a step with the journal. Its time is added to a phase of the
+        timer, unless it was completed before.
+        """
+        if journal.is_done(step):
+            return journal.run(step, func, *args, **kwargs)
+        with timer.phase(phase):
+            return journal.run(step, func, *args, **kwargs)
+
     def _upload_to_storage(self, ssh_session, storage, vmid, filename,
                            diskname, storagename, disk_format="raw",
-                           disk_size=None, disk_multiple=None):
+                           disk_size=None, disk_multiple=None, journal=None,
+                           conversion=None, profile=None, timer=None,
+                           node=None):
         """
         Upload a file into a datastore. The steps executed are:
-          1. The file is uploaded via SFTP to /tmp.
+          1. The file is uploaded via SFTP to /tmp, unless it is in the
+          image cache of the node. If it is an URL, it is downloaded into the
+          image cache instead, or if delta sync is enabled, synced into it.
           2. A new disk is allocated using `pvesm`.
           3. The path of this disk is retrieved using `pvesm`.
           4. The file is converted and transfered into the disk
-          using `qemu-img`.
+          using `qemu-img`. The disk is not recreated, so it keeps the size it
+          was allocated with.
           5. The temporary file is removed.
 
+        Steps 1, 2 and 4 are recorded in the journal. If the journal is
+        persistent and a step fails, the temporary file is kept, so a resumed
+        deployment can reuse it. The time spent in them is recorded in the
+        timer, as "upload_image" or "cache_image", "allocate_disk" and
+        "copy_image".
+
         Parameters
         ----------
         ssh_session: ProxmoxBaseSSHSession subclass
@@ -354,7 +828,7 @@ class ProxmoxClient(object):
             ID of the VM to associate the file with. This is enforced by
             Proxmox.
         filename: str
-            Local filename of the file.
+            Local filename or HTTP(S) URL of the file.
         diskname: str
             Name of the disk to allocate.
         storagename: str
@@ -367,12 +841,29 @@ class ProxmoxClient(object):
             from the file. In kilobytes.
         disk_multiple: int
             Increase size of disk to be a multiple of this size. In kilobytes.
+        journal: DeployJournal
+            Journal to record completed steps in.
+        conversion: ConversionSettings
+            Settings to convert the image into the disk with.
+        profile: StorageProfile
+            Profile of the storage, see get_storage_profile.
+        timer: PhaseTimer
+            Records the time spent in the steps.
+        node: str
+            Name of the node, to throttle the conversion with.
         """
+        if journal is None:
+            journal = DeployJournal()
+        if timer is None:
+            timer = PhaseTimer()
+
         tmpfile = None
+        completed = False
         try:
-            tmpfile = self._upload(ssh_session, filename)
-            tmpfile = self._decompress_image(ssh_session, tmpfile)
-            image_size = self._get_virtual_disk_size(ssh_session, tmpfile)
+            image, tmpfile = self._get_timed_node_image(
+                ssh_session, filename, journal,
+                "{0}:staged".format(diskname), timer)
+            image_size = self._get_virtual_disk_size(ssh_session, image)
 
             if not disk_size:
                 logger.warning("Setting disk size to {0}K".format(image_size))
@@ -384,25 +875,36 @@ class ProxmoxClient(object):
 
             if disk_multiple and disk_size % disk_multiple != 0:
                 disk_size += disk_multiple - (disk_size % disk_multiple)
-                logger.warning("Disk size is not a multiple of {0}, "
-                               "increasing to {0}K".format(disk_multiple,
-                                                           disk_size))
+                logger.info("Disk size is not a multiple of {0}K, "
+                            "increasing to {1}K".format(disk_multiple,
+                                                        disk_size))
 
-            self._allocate_disk(ssh_session, storage, vmid, diskname,
-                                disk_size, storagename, disk_format)
+            self._run_timed_step(
+                journal, timer, "allocate_disk",
+                "{0}:allocated".format(diskname), self._allocate_disk,
+                ssh_session, storage, vmid, diskname, disk_size, storagename,
+                disk_format)
 
             devicepath = self._get_device_path(ssh_session, storagename)
 
-            self._copy_image_into_disk(ssh_session, disk_format, tmpfile,
-                                       devicepath)
+            self._run_timed_step(
+                journal, timer, "copy_image", "{0}:copied".format(diskname),
+                self._copy_image_into_disk, ssh_session, disk_format, image,
+                devicepath, storage, conversion, profile, disk_size, node)
+            completed = True
         finally:
-            if tmpfile:
+            if tmpfile and (completed or not journal.persistent):
                 logger.info("Removing temporary disk file")
                 ssh_session._exec("rm '{0}'".format(tmpfile))
+            elif tmpfile:
+                logger.info("Keeping temporary disk file {0} to resume from"
+                            .format(tmpfile))
 
     def _upload_to_flat_storage(self, storage, vmid, filename, disk_format,
                                 disk_label, disk_size=None,
-                                disk_multiple=None):
+                                disk_multiple=None, journal=None,
+                                conversion=None, profile=None, timer=None,
+                                node=None):
         """
         Generates appropriate names for uploading a file to a 'dir' datastore.
         Actual work is done by _upload_to_storage.
@@ -415,7 +917,7 @@ class ProxmoxClient(object):
             ID of the VM to associate the file with. This is enforced by
             Proxmox.
         filename: str
-            Local filename of the file.
+            Local filename or HTTP(S) URL of the file.
         disk_format: raw or qcow2
             Format of the file. The source type doesn't matter, as we will call
             `qemu-img` to both transfer and convert the file into the disk.
@@ -426,12 +928,22 @@ class ProxmoxClient(object):
             from the file. In kilobytes.
         disk_multiple: int
             Increase size of disk to be a multiple of this size. In kilobytes.
+        journal: DeployJournal
+            Journal to record completed steps in.
+        conversion: ConversionSettings
+            Settings to convert the image into the disk with.
+        profile: StorageProfile
+            Profile of the storage, see get_storage_profile.
+        timer: PhaseTimer
+            Records the time spent in the steps of the upload.
+        node: str
+            Name of the node, to throttle the conversion with.
 
         Returns
         -------
         Full canonical name of the disk.
         """
-        ssh_session = self.client._backend.session
+        ssh_session = self._get_ssh_session()
         diskname = "vm-{0}-{1}.{2}".format(vmid, disk_label, disk_format)
         storagename = "{0}:{1}/{2}".format(storage, vmid, diskname)
 
@@ -439,13 +951,17 @@ class ProxmoxClient(object):
         self._upload_to_storage(ssh_session, storage, vmid, filename,
                                 diskname, storagename, disk_format=disk_format,
                                 disk_size=disk_size,
-                                disk_multiple=disk_multiple)
+                                disk_multiple=disk_multiple, journal=journal,
+                                conversion=conversion, profile=profile,
+                                timer=timer, node=node)
 
         return storagename
 
     def _upload_to_blob_storage(self, storage, vmid, filename, disk_format,
                                 disk_label, disk_size=None,
-                                disk_multiple=None):
+                                disk_multiple=None, journal=None,
+                                conversion=None, profile=None, timer=None,
+                                node=None):
         """
         Generates appropriate names for uploading a file to a blob datastore.
         Actual work is done by _upload_to_storage.
@@ -458,10 +974,9 @@ class ProxmoxClient(object):
             ID of the VM to associate the file with. This is enforced by
             Proxmox.
         filename: str
-            Local filename of the file.
-        disk_format: raw or qcow2
-            Format of the file. Will be overridden into 'raw', because blob
-            storage only supports RAW disks.
+            Local filename or HTTP(S) URL of the file.
+        disk_format: raw
+            Format of the disk. Blob storage only supports raw disks.
         disk_label: str
             Label to incorporate in the resulting disk name.
         disk_size: int
@@ -469,26 +984,37 @@ class ProxmoxClient(object):
             from the file. In kilobytes.
         disk_multiple: int
             Increase size of disk to be a multiple of this size. In kilobytes.
+        journal: DeployJournal
+            Journal to record completed steps in.
+        conversion: ConversionSettings
+            Settings to convert the image into the disk with.
+        profile: StorageProfile
+            Profile of the storage, see get_storage_profile.
+        timer: PhaseTimer
+            Records the time spent in the steps of the upload.
+        node: str
+            Name of the node, to throttle the conversion with.
 
         Returns
         -------
         Full canonical name of the disk.
         """
-        ssh_session = self.client._backend.session
+        ssh_session = self._get_ssh_session()
         diskname = "vm-{0}-{1}".format(vmid, disk_label)
         storagename = "{0}:{1}".format(storage, diskname)
 
         logger.info("Uploading to blob storage")
-        # LVM only supports raw disks, overwrite the disk_format here.
         self._upload_to_storage(ssh_session, storage, vmid, filename,
-                                diskname, storagename, disk_format="raw",
+                                diskname, storagename, disk_format=disk_format,
                                 disk_size=disk_size,
-                                disk_multiple=disk_multiple)
+                                disk_multiple=disk_multiple, journal=journal,
+                                conversion=conversion, profile=profile,
+                                timer=timer, node=node)
 
         return storagename
 
     def upload(self, node, storage, vmid, filename, disk_format, disk_label,
-               disk_size=None):
+               disk_size=None, journal=None, timer=None):
         """
         Upload a file into a datastore.
 
@@ -505,61 +1031,296 @@ class ProxmoxClient(object):
             ID of the VM to associate the file with. This is enforced by
             Proxmox.
         filename: str
-            Local filename of the file.
+            Local filename or HTTP(S) URL of the file.
         disk_format: raw or qcow2
-            Format of the file.
+            Format of the disk. If None, the format of the storage profile is
+            used, see get_storage_profile.
         disk_label: str
             Label to incorporate in the resulting disk name.
         disk_size: int
             Override the disk size. If not specified, the size is calculated
             from the file. In kilobytes.
+        journal: DeployJournal
+            Journal to record completed steps in.
+        timer: PhaseTimer
+            Records the time spent in the steps of the upload, see
+            _upload_to_storage.
         """
         _node = self.client.nodes(node)
+        self.throttle.wait_for_node(node, lambda: _node.status.get()['wait'])
         _storage = _node.storage(storage)
         _type = _storage.status.get()['type']
-        if _type in ("dir", "nfs"):
+        if _type not in FILE_STORAGE_TYPES + BLOCK_STORAGE_TYPES:
+            raise ValueError(
+                "Only dir, lvm, lvmthin, nfs and zfspool storage are "
+                "supported at this time")
+        profile = self.get_storage_profile(node, storage, _type)
+        disk_format = profile.get_disk_format(disk_format)
+        conversion = self.converter.get_settings(node, storage, _type)
+        if _type in FILE_STORAGE_TYPES:
             diskname = self._upload_to_flat_storage(
                 storage=storage, vmid=vmid, filename=filename,
                 disk_label=disk_label, disk_format=disk_format,
-                disk_size=disk_size)
-        elif _type in ("lvm", "lvmthin"):
-            diskname = self._upload_to_blob_storage(
-                storage=storage, vmid=vmid, filename=filename,
-                disk_label=disk_label, disk_format=disk_format,
-                disk_size=disk_size)
-        elif _type == "zfspool":
+                disk_size=disk_size, disk_multiple=profile.size_multiple,
+                journal=journal, conversion=conversion, profile=profile,
+                timer=timer, node=node)
+        else:
             diskname = self._upload_to_blob_storage(
                 storage=storage, vmid=vmid, filename=filename,
                 disk_label=disk_label, disk_format=disk_format,
-                disk_size=disk_size, disk_multiple=1024)
-        else:
-            raise ValueError(
-                "Only dir, lvm, lvmthin and zfspool storage are supported at "
-                "this time")
+                disk_size=disk_size, disk_multiple=profile.size_multiple,
+                journal=journal, conversion=conversion, profile=profile,
+                timer=timer, node=node)
         return diskname
 
-    def attach_seed_iso(self, node, storage, vmid, iso_file):
+    def prefetch_image(self, image, cancel=None):
+        """
+        Copies an image into the image cache of the node, so deployments of
+        the image don't have to transfer it.
+
+        Parameters
+        ----------
+        image: str
+            Local filename or HTTP(S) URL of the image.
+        cancel: threading.Event
+            Aborts the upload of a local image when set, with an
+            UploadCancelledException.
+
+        Returns
+        -------
+        How the image was cached, see NodeImageCache.prefetch.
+        """
+        ssh_session = self._get_ssh_session()
+        return self.image_cache.prefetch(
+            ssh_session, image, self._get_upload_function(ssh_session, cancel))
+
+    def get_image_cache_status(self, image):
+        """
+        Get the state of an image in the image cache of the node, see
+        NodeImageCache.get_status.
+        """
+        return self.image_cache.get_status(self._get_ssh_session(), image)
+
+    def tune_conversion(self, node, storage, size, rounds=1):
+        """
+        Finds the fastest conversion settings for a storage, by converting a
+        test image into a test disk on the storage with different settings.
+        The test image and disk are removed afterwards.
+
+        Parameters
+        ----------
+        node: str
+            Name of the node to tune conversions for.
+        storage: str
+            Name of the storage to tune conversions into.
+        size: int
+            Size of the test image, in kilobytes.
+        rounds: int
+            Amount of conversions per settings, see ConversionEngine.tune.
+
+        Returns
+        -------
+        See ConversionEngine.tune.
+        """
+        ssh = self._get_ssh_session()
+        _type = self.client.nodes(node).storage(storage).status.get()['type']
+        if _type not in STORAGE_TYPE_DEFAULTS:
+            raise ValueError("Only dir, lvm, lvmthin, nfs and zfspool storage "
+                             "are supported at this time")
+        vmid = self.get_next_vmid()
+        if _type in ("dir", "nfs"):
+            diskname = "vm-{0}-convert-test.raw".format(vmid)
+            storagename = "{0}:{1}/{2}".format(storage, vmid, diskname)
+        else:
+            diskname = "vm-{0}-convert-test".format(vmid)
+            storagename = "{0}:{1}".format(storage, diskname)
+        stdout, stderr = ssh._exec(
+            "mktemp /tmp/proxmox-deploy-convert-test.XXXXXXXXXX")
+        if len(stderr) > 0:
+            raise SSHCommandInvocationException(
+                "Failed to create test image", stdout=stdout, stderr=stderr)
+        tmpfile = stdout.strip()
+
+        try:
+            logger.info("Creating test image of {0}".format(
+                format_bytes(size * 1024)))
+            # Random data, so the conversion can't skip any blocks.
+            stdout, stderr = ssh._exec(
+                "dd if=/dev/urandom of={0} bs=1024 count={1} status=none"
+                .format(pipes.quote(tmpfile), size))
+            if len(stderr) > 0:
+                raise SSHCommandInvocationException(
+                    "Failed to create test image", stdout=stdout,
+                    stderr=stderr)
+            self._allocate_disk(ssh, storage, vmid, diskname, size,
+                                storagename, "raw")
+            try:
+                devicepath = self._get_device_path(ssh, storagename)
+
+                def convert(settings):
+                    stdout, stderr = ssh._exec(self.converter.get_command(
+                        ssh, settings, "raw", tmpfile, devicepath))
+                    if len(stderr) > 0:
+                        raise SSHCommandInvocationException(
+                            "Failed to convert test image", stdout=stdout,
+                            stderr=stderr)
+
+                return self.converter.tune(
+                    ssh, self.converter.get_settings(node, storage, _type),
+                    convert, rounds=rounds)
+            finally:
+                logger.info("Removing test disk")
+                ssh._exec("pvesm free '{0}'".format(storagename))
+        finally:
+            ssh._exec("rm -f {0}".format(pipes.quote(tmpfile)))
+
+    def _upload_seed_iso_as_file(self, node, storage, content, vmid, iso_file,
+                                 digest=None):
+        """
+        Upload a seed ISO straight into the directory of a file based storage.
+        Unlike _upload_to_storage, no disk is allocated and no conversion is
+        done, the ISO is written once to its final location.
+
+        Proxmox does not remove files in these storages when a VM is
+        destroyed, so the ISO is named after its VM, and seed ISOs that are
+        no longer needed are removed afterwards, see _remove_stale_seed_isos.
+
+        Parameters
+        ----------
+        node: str
+            Name of the node the storage is on.
+        storage: str
+            Name of storage to upload the file into.
+        content: iso or snippets
+            Content type of the storage to store the ISO as.
+        vmid: int
+            ID of the VM the ISO belongs to.
+        iso_file: str
+            Local filename of the ISO file.
+        digest: str
+            Digest of the seed files in the ISO. If given, it is part of the
+            name of the ISO, and the ISO is only uploaded if the storage does
+            not contain it yet, as when a deployment is resumed. ISOs are
+            uploaded to a temporary file, and moved to that name once
+            complete.
+
+        Returns
+        -------
+        Drive specification to attach the ISO as cdrom.
+        """
+        ssh_session = self._get_ssh_session()
+        name = "vm-{0}-cloudinit-seed{1}.iso".format(
+            vmid, "-{0}".format(digest) if digest else "")
+        volume = "{0}:{1}/{2}".format(storage, content, name)
+        existing = [_volume['volid'] for _volume in
+                    self.client.nodes(node).storage(storage).content.get(
+                        content=content)]
+
+        path = self._get_device_path(ssh_session, volume)
+        if digest and volume in existing:
+            logger.info("Seed ISO is already present in {0} storage"
+                        .format(content))
+        else:
+            logger.info("Uploading to {0} storage".format(content))
+            # The ISO only gets its final name once it is complete, so an
+            # interrupted upload is never taken for a present ISO.
+            partfile = "{0}.part".format(path)
+            try:
+                self._upload(ssh_session, iso_file, tmpfile=partfile)
+                stdout, stderr = ssh_session._exec("mv -f {0} {1}".format(
+                    pipes.quote(partfile), pipes.quote(path)))
+                if len(stderr) > 0:
+                    raise SSHCommandInvocationException(
+                        "Failed to move seed ISO into place", stdout=stdout,
+                        stderr=stderr)
+            except:
+                ssh_session._exec("rm -f {0}".format(pipes.quote(partfile)))
+                raise
+        self._remove_stale_seed_isos(ssh_session, os.path.dirname(path),
+                                     int(vmid), name, existing)
+
+        if content == "iso":
+            return "{0},media=cdrom".format(volume)
+        # Only iso volumes can be referenced as cdrom, so refer to snippets by
+        # their absolute path. This is allowed for root@pam only.
+        return "{0},media=cdrom".format(path)
+
+    def _remove_stale_seed_isos(self, ssh_session, directory, vmid, name,
+                                volumes):
+        """
+        Removes the seed ISOs of VMs that no longer exist in the cluster, and
+        earlier seed ISOs of the VM, from the directory of a storage.
+
+        Parameters
+        ----------
+        directory: str
+            Directory of the storage on the node.
+        vmid: int
+            ID of the VM the current seed ISO belongs to.
+        name: str
+            Filename of the current seed ISO, which is kept.
+        volumes: list of str
+            Volume IDs in the storage.
+        """
+        vmids = set(int(vm['vmid']) for vm in
+                    self.client.cluster.resources.get(type="vm"))
+        stale = []
+        for volume in volumes:
+            filename = volume.split("/", 1)[-1]
+            match = SEED_ISO_PATTERN.match(filename)
+            if not match or filename == name:
+                continue
+            owner = int(match.group(1))
+            if owner == vmid or owner not in vmids:
+                stale.append(os.path.join(directory, filename))
+        if stale:
+            logger.info("Removing {0} seed ISOs that are no longer used"
+                        .format(len(stale)))
+            ssh_session._exec("rm -f {0}".format(
+                " ".join(pipes.quote(path) for path in stale)))
+
+    def attach_seed_iso(self, node, storage, vmid, iso_file, digest=None):
         """
         Upload a cloud-init seed ISO file, and attach it to a VM.
 
+        If the node has a storage for ISO images or snippets, the ISO is
+        written directly into that storage and attached as cdrom. Otherwise,
+        the ISO is uploaded as a disk into the given storage.
+
         Parameters
         ----------
         node: str
             Name of the node to upload to. See the note above.
         storage: str
-            Name of storage to upload the file into.
+            Name of storage to upload the file into, if no storage for ISO
+            images or snippets is available.
         vmid: int
             ID of the VM to associate the file with. This is enforced by
             Proxmox.
         iso_file: str
             Local filename of the ISO file.
+        digest: str
+            Digest of the seed files in the ISO, see generate_cached_seed_iso.
+            Seed ISOs with a digest are not uploaded again if the VM already
+            has them.
         """
         _node = self.client.nodes(node)
+        seed_storage, content = self.get_seed_storage(node)
+        if seed_storage:
+            drive = self._upload_seed_iso_as_file(node, seed_storage, content,
+                                                  vmid, iso_file,
+                                                  digest=digest)
+            _node.qemu(vmid).config.set(ide2=drive)
+            return
+
+        logger.info("No storage for ISO images available, uploading seed ISO "
+                    "as disk")
         diskname = self.upload(node, storage, vmid, iso_file,
                                disk_label="cloudinit-seed", disk_format="raw")
         _node.qemu(vmid).config.set(virtio1=diskname)
 
-    def attach_base_disk(self, node, storage, vmid, img_file, disk_size):
+    def attach_base_disk(self, node, storage, vmid, img_file, disk_size,
+                         journal=None):
         """
         Upload a Cloud base image, and attach it to a VM.
 
@@ -573,23 +1334,118 @@ class ProxmoxClient(object):
             ID of the VM to associate the file with. This is enforced by
             Proxmox.
         img_file: str
-            Local filename of the ISO file.
+            Local filename or HTTP(S) URL of the image.
         disk_size: int
             Size of the disk to allocate, in kilobytes.
+        journal: DeployJournal
+            Journal to record completed steps in. Steps that were already
+            completed are skipped.
+
+        The throughput of the steps that ran is recorded in the history.
         """
+        if journal is None:
+            journal = DeployJournal()
+        timer = PhaseTimer()
+        image_size = None
+        if not is_image_url(img_file):
+            image_size = os.path.getsize(img_file)
+
+        if self._use_native_import():
+            journal.run("base-disk:imported", self._import_base_disk, node,
+                        storage, vmid, img_file, disk_size, journal, timer)
+            self.history.record_upload(node, storage, image_size, timer)
+            return
+
+        # The disk is allocated at its final size, so it is attached as it
+        # is, without resizing it afterwards.
         _node = self.client.nodes(node)
-        diskname = self.upload(node, storage, vmid, img_file,
-                               disk_label="base-disk", disk_format="qcow2",
-                               disk_size=disk_size)
-        _node.qemu(vmid).config.set(virtio0=diskname, bootdisk="virtio0")
+        diskname = journal.run(
+            "base-disk:uploaded", self.upload, node, storage, vmid, img_file,
+            disk_label="base-disk", disk_format=None, disk_size=disk_size,
+            journal=journal, timer=timer)
+        self._run_timed_step(journal, timer, "attach_disk",
+                             "base-disk:attached", _node.qemu(vmid).config.set,
+                             virtio0=diskname, bootdisk="virtio0")
+        self.history.record_upload(node, storage, image_size, timer)
+
+    def _use_native_import(self):
+        if self.import_mode == "convert":
+            return False
+        supported = self.get_version() >= NATIVE_IMPORT_VERSION
+        if self.import_mode == "native" and not supported:
+            logger.warning("Proxmox {0}.{1} can't import disks, converting "
+                           "the image instead".format(*self.get_version()))
+        # Proxmox only lets root@pam import from a path on the node, not even
+        # its API tokens.
+        user = self.get_api_user()
+        if supported and user != "root@pam":
+            log = logger.warning if self.import_mode == "native" \
+                else logger.debug
+            log("Only root@pam can import disks, not {0}, converting the "
+                "image instead".format(user))
+            return False
+        if self.import_mode == "native":
+            return supported
+        return supported and not self.throttle.active
+
+    def _import_base_disk(self, node, storage, vmid, img_file, disk_size,
+                          journal, timer=None):
+        """
+        Imports an image as base disk, with the import of Proxmox. The disk
+        is allocated, filled and attached by a single API call.
+
+        The image is imported through a qcow2 overlay of the final size of the
+        disk, so the disk is created at that size. The overlay also keeps
+        images in the image cache from being changed. The import runs in a
+        task, so it can't hold the lock of a cached image, but cached images
+        are replaced by renaming them, and the task keeps reading the version
+        it opened.
+
+        The time spent is recorded in the timer, as "upload_image" or
+        "cache_image", and "import_image".
+        """
+        if timer is None:
+            timer = PhaseTimer()
+        ssh = self._get_ssh_session()
+        profile = self.get_storage_profile(node, storage)
+        image, tmpfile = self._get_timed_node_image(
+            ssh, img_file, journal, "vm-{0}-base-disk:staged".format(vmid),
+            timer)
+        overlay = "/tmp/vm-{0}-base-disk-import.qcow2".format(vmid)
+        completed = False
         try:
-            logger.info("Resizing virtual disk")
-            _node.qemu(vmid).resize.set(disk="virtio0", size=disk_size * 1024)
-        except SSHError as se:
-            if "disk size" not in str(se):
-                raise se
-            logger.error("Failed to set disk size, disk will probably be "
-                         "bigger than expected")
+            image_format, image_size = self._get_image_info(ssh, image)
+            if image_size > disk_size:
+                logger.warning("Provided disk size was too small, "
+                               "increasing to {0}K".format(image_size))
+            disk_size = profile.round_size(max(disk_size, image_size))
+            stdout, stderr = ssh._exec(
+                "qemu-img create -q -f qcow2 -F {0} -b '{1}' '{2}' {3}K"
+                .format(image_format, image, overlay, disk_size))
+            if len(stderr) > 0:
+                raise SSHCommandInvocationException(
+                    "Failed to create image overlay", stdout=stdout,
+                    stderr=stderr)
+
+            logger.info("Importing image into virtual disk")
+            drive = "{0}:0,import-from={1}".format(storage, overlay)
+            if profile.storage_type in FILE_STORAGE_TYPES:
+                drive += ",format={0}".format(profile.disk_format)
+            # The import runs in a task, which reads the overlay and the
+            # image until it is finished.
+            with timer.phase("import_image"):
+                upid = self.client.nodes(node).qemu(vmid).config.create(
+                    virtio0=drive, bootdisk="virtio0")
+                self.wait_for_task(node, upid)
+            completed = True
+        finally:
+            ssh._exec("rm -f '{0}'".format(overlay))
+            if tmpfile and (completed or not journal.persistent):
+                logger.info("Removing temporary disk file")
+                ssh._exec("rm '{0}'".format(tmpfile))
+            elif tmpfile:
+                logger.info("Keeping temporary disk file {0} to resume from"
+                            .format(tmpfile))
 
     def start_vm(self, node, vmid):
         """
@@ -601,9 +1457,107 @@ class ProxmoxClient(object):
             Node the VM resides on.
         vmid: int
             ID of VM to start.
+
+        Returns
+        -------
+        ID of the start task.
         """
         _node = self.client.nodes(node)
-        _node.qemu(vmid).status.start.create()
+        return _node.qemu(vmid).status.start.create()
+
+    def get_task_status(self, node, upid):
+        """
+        Get the status of a task, with its "status", which is "stopped" once
+        the task finished, and its "exitstatus", which is "OK" if it succeeded.
+        """
+        return self.client.nodes(node).tasks(upid).status.get()
+
+    def wait_for_task(self, node, upid, interval=TASK_POLL_INTERVAL):
+        """
+        Waits for a task to finish.
+
+        Raises
+        ------
+        RuntimeError
+            If the task failed.
+        """
+        while True:
+            status = self.get_task_status(node, upid)
+            if status['status'] == "stopped":
+                break
+            time.sleep(interval)
+        if status.get("exitstatus") != "OK":
+            raise RuntimeError("Task {0} failed: {1}".format(
+                upid, status.get("exitstatus")))
+
+    def get_vms(self, node):
+        """
+        Get the IDs of all VMs on a node.
+        """
+        return [int(vm['vmid'])
+                for vm in self.client.nodes(node).qemu.get()]
+
+    def get_vm_config(self, node, vmid):
+        return self.client.nodes(node).qemu(vmid).config.get()
+
+    def ping_guest_agent(self, node, vmid):
+        """
+        Checks whether the guest agent of a VM answers.
+        """
+        try:
+            self.client.nodes(node).qemu(vmid).agent.ping.create()
+        except ResourceException:
+            return False
+        return True
+
+    def probe_guests(self, node, addresses, marker):
+        """
+        Probes guests from their node, with a single command.
+
+        Parameters
+        ----------
+        node: str
+            Node the guests reside on.
+        addresses: list of str
+            Addresses of the guests. Addresses prefixed with a + are checked
+            for the marker file as well.
+        marker: str
+            File of which the existence is checked on the guests.
+
+        Returns
+        -------
+        Tuple of a dict mapping addresses to the set of signals seen, and a
+        dict mapping MAC addresses to addresses from the neighbour table of
+        the node.
+        """
+        ssh = self._get_ssh_session()
+        stdout, stderr = ssh._exec(self._get_node_command(
+            node, "bash -c {0} probe {1} {2}".format(
+                pipes.quote(PROBE_SCRIPT), pipes.quote(marker),
+                " ".join(pipes.quote(address) for address in addresses))))
+        return parse_probe_output(stdout)
+
+    def open_serial_console(self, node, vmid):
+        """
+        Starts reading the serial console of a running VM, on the node that
+        runs it.
+
+        Parameters
+        ----------
+        node: str
+            Node the VM resides on.
+        vmid: int
+            ID of the VM.
+
+        Returns
+        -------
+        Stream with a readline() method returning the next line of the
+        console, and a close() method.
+        """
+        return open_command_stream(
+            self._get_ssh_session(), self._get_node_command(
+                node, "socat -u UNIX-CONNECT:{0} STDOUT".format(
+                    SERIAL_SOCKET.format(vmid))))
 
     def attach_serial_console(self, node, vmid):
         """
@@ -17,7 +17,18 @@
 
 from collections import OrderedDict
 from contextlib import contextmanager
+from StringIO import StringIO
+import bisect
+import difflib
 import sys
+import threading
+try:
+    import readline
+except ImportError:
+    readline = None
+
+# Amount of suggestions for an invalid answer.
+MAX_SUGGESTIONS = 5
 
 
 class QuestionGroup(OrderedDict):
@@ -91,7 +102,8 @@ class OptionalQuestionGroup(QuestionGroup):
         if self.evaluate_answer():
             return super(OptionalQuestionGroup, self).flatten_answers()
         elif self.negative_questions:
-            return self.negative_questions
+            return dict((key, question.answer) for key, question
+                        in self.negative_questions.iteritems())
         else:
             return {}
 
@@ -108,6 +120,220 @@ class SpecificAnswerOptionalQuestionGroup(OptionalQuestionGroup):
         return self.specific_answer == self.optional_question.answer
 
 
+def validate_answers(questions, answers):
+    """
+    Validates answers without asking any questions, for example answers of a
+    deployment request. Only answers with a question in the group are
+    validated, against the same indexes the questions use.
+
+    Parameters
+    ----------
+    questions: QuestionGroup
+        Questions to validate the answers against. Nested groups are
+        included.
+    answers: dict
+        Answers to validate, by question key.
+
+    Raises
+    ------
+    ValueError
+        If any answer is invalid. The message explains all invalid answers.
+    """
+    errors = []
+    for key, question in questions.iteritems():
+        if isinstance(question, QuestionGroup):
+            try:
+                validate_answers(question, answers)
+            except ValueError as e:
+                errors.append(str(e))
+        elif key in answers:
+            error = question.check(answers[key])
+            if error:
+                errors.append("{0}: {1}".format(key, error))
+    if errors:
+        raise ValueError("\n".join(errors))
+
+
+def _get_preseed_key(key):
+    """
+    Get the key the optional question of an optional group is preseeded with,
+    which is the key of the group without its leading underscore.
+    """
+    return key.lstrip("_")
+
+
+def preseed_answers(questions, answers, defaults=False):
+    """
+    Answers questions from a preseed, so they are not asked. The answers are
+    validated like interactive answers. Questions are answered by their
+    flatten_answers key, the optional question of an optional group by the
+    key of the group without its leading underscore.
+
+    Parameters
+    ----------
+    questions: QuestionGroup
+        Questions to answer. Nested groups are included.
+    answers: dict
+        Answers to preseed, by key.
+    defaults: bool
+        Whether questions without a preseeded answer are answered with their
+        default, if they have one.
+
+    Returns
+    -------
+    Set of the keys that were used.
+
+    Raises
+    ------
+    ValueError
+        If any answer is invalid. The message explains all invalid answers.
+    """
+    used = set()
+    errors = []
+
+    def preseed(key, question):
+        if key not in answers:
+            if defaults and question.answer is not None:
+                question.preseeded = True
+            return
+        used.add(key)
+        try:
+            question.preseed(answers[key])
+        except ValueError as e:
+            errors.append("{0}: {1}".format(key, e))
+
+    for key, question in questions.iteritems():
+        if isinstance(question, OptionalQuestionGroup):
+            preseed(_get_preseed_key(key), question.optional_question)
+        if isinstance(question, QuestionGroup):
+            try:
+                used.update(preseed_answers(question, answers, defaults))
+            except ValueError as e:
+                errors.append(str(e))
+        elif not isinstance(question, NoAskQuestion):
+            preseed(key, question)
+    if errors:
+        raise ValueError("\n".join(errors))
+    return used
+
+
+def get_preseed_keys(questions):
+    """
+    Get all keys that questions can be preseeded with, see preseed_answers.
+    """
+    keys = set()
+    for key, question in questions.iteritems():
+        if isinstance(question, OptionalQuestionGroup):
+            keys.add(_get_preseed_key(key))
+        if isinstance(question, QuestionGroup):
+            keys.update(get_preseed_keys(question))
+        elif not isinstance(question, NoAskQuestion):
+            keys.add(key)
+    return keys
+
+
+def record_answers(questions):
+    """
+    Get the answers to the questions that were asked, formatted for a
+    preseed. Questions of optional groups that were declined are left out.
+    """
+    answers = OrderedDict()
+    for key, question in questions.iteritems():
+        if isinstance(question, OptionalQuestionGroup):
+            answers[_get_preseed_key(key)] = \
+                question.optional_question.format_preseed()
+            if not question.evaluate_answer():
+                continue
+        if isinstance(question, QuestionGroup):
+            answers.update(record_answers(question))
+        elif not isinstance(question, NoAskQuestion):
+            answers[key] = question.format_preseed()
+    return answers
+
+
+class AnswerIndex(object):
+    """
+    Index of valid answers. Answers are looked up in constant time, and
+    completed from a sorted list, in logarithmic time. Indexes are shared by
+    all users of the same answers, see get().
+    """
+    _indexes = {}
+    _lock = threading.Lock()
+
+    def __init__(self, answers):
+        self.answers = frozenset(answers)
+        self.sorted = sorted(self.answers)
+        self._folded = {}
+        for answer in self.sorted:
+            self._folded.setdefault(answer.lower(), answer)
+        self._folded_sorted = sorted(self._folded)
+
+    @classmethod
+    def get(cls, answers):
+        """
+        Get the index of answers, which is built on first use.
+        """
+        key = tuple(answers)
+        with cls._lock:
+            index = cls._indexes.get(key)
+            if index is None:
+                index = cls._indexes[key] = cls(key)
+            return index
+
+    def __contains__(self, answer):
+        return answer in self.answers
+
+    def __len__(self):
+        return len(self.answers)
+
+    def _prefixed(self, answers, prefix):
+        start = bisect.bisect_left(answers, prefix)
+        end = start
+        while end < len(answers) and answers[end].startswith(prefix):
+            end += 1
+        return answers[start:end]
+
+    def complete(self, prefix):
+        """
+        Get the answers starting with prefix, in sorted order. If there are
+        none, answers starting with prefix in a different case are returned.
+        """
+        matches = self._prefixed(self.sorted, prefix)
+        if not matches:
+            matches = [self._folded[answer] for answer in
+                       self._prefixed(self._folded_sorted, prefix.lower())]
+        return matches
+
+    def suggest(self, answer, limit=MAX_SUGGESTIONS):
+        """
+        Get the valid answers closest to an invalid answer: first the answer in
+        a different case, then answers it is a prefix of, then similar answers.
+        """
+        if not isinstance(answer, basestring):
+            answer = str(answer)
+        folded = answer.lower()
+        suggestions = []
+        if folded in self._folded:
+            suggestions.append(self._folded[folded])
+        suggestions.extend(self.complete(answer)[:limit])
+        suggestions.extend(
+            self._folded[match] for match in difflib.get_close_matches(
+                folded, self._folded_sorted, n=limit))
+        return list(OrderedDict.fromkeys(suggestions))[:limit]
+
+    def check(self, answer):
+        """
+        Get an explanation why answer is invalid, or None if it is valid.
+        """
+        if answer in self.answers:
+            return None
+        suggestions = self.suggest(answer)
+        if suggestions:
+            return "invalid answer {0!r}, did you mean: {1}?".format(
+                answer, ", ".join(suggestions))
+        return "invalid answer {0!r}".format(answer)
+
+
 class Question(object):
     """
     Base Question class, which accepts all answers and stores them as string.
@@ -142,6 +368,8 @@ class Question(object):
         """
         self.question = question
         self.answer = default
+        self.raw_answer = None
+        self.preseeded = False
         self.allow_empty = allow_empty
         self.empty_value = empty_value
         self.input = _input
@@ -194,7 +422,11 @@ class Question(object):
 
         format_default, format_answer and validate are implemented in the base
         class, but should probably be overridden in subclasses.
+
+        Preseeded questions are not asked.
         """
+        if self.preseeded:
+            return
         with self._override_files(_output, _input):
             valid = False
             while not valid:
@@ -204,6 +436,48 @@ class Question(object):
                     return
                 valid = self.validate(answer)
             self.answer = self.format_answer(answer)
+            self.raw_answer = answer
+
+    def preseed(self, answer):
+        """
+        Answers the question without asking it. The answer is validated and
+        formatted like an interactive answer, and an empty answer keeps the
+        default.
+
+        Raises
+        ------
+        ValueError
+            If the answer is invalid, with the message validate wrote.
+        """
+        if isinstance(answer, list):
+            raise ValueError("expected a single value")
+        self.preseeded = True
+        if answer == "" and self.answer is not None:
+            # Like an empty interactive answer, this keeps the default.
+            return
+        self.preseeded = False
+        output = StringIO()
+        with self._override_files(output, None):
+            valid = self.validate(answer)
+        if not valid:
+            raise ValueError(self.check(answer) or
+                             " ".join(output.getvalue().split()) or
+                             "invalid answer {0!r}".format(answer))
+        self.answer = self.format_answer(answer)
+        self.raw_answer = answer
+        self.preseeded = True
+
+    def format_preseed(self):
+        """
+        Formats the answer for a preseed, so that preseeding it gives the same
+        answer. In the base class, this is the answer that was entered, or
+        the default as string.
+        """
+        if self.raw_answer is not None:
+            return self.raw_answer
+        if self.answer is None:
+            return self.empty_answers[-1]
+        return str(self.answer)
 
     def format_default(self):
         """
@@ -240,6 +514,17 @@ class Question(object):
             return self._validate(answer)
         return answer != ""
 
+    def check(self, answer):
+        """
+        Checks an answer that was not entered interactively, such as the
+        answers of a deployment request. In the base class, all answers are
+        accepted.
+
+        Should return an explanation why the answer is invalid, or None if it
+        is valid.
+        """
+        return None
+
 
 class BooleanQuestion(Question):
     """
@@ -281,6 +566,9 @@ class BooleanQuestion(Question):
         else:
             return False
 
+    def format_preseed(self):
+        return "yes" if self.answer else "no"
+
 
 class IntegerQuestion(Question):
     """
@@ -352,23 +640,118 @@ class EnumQuestion(Question):
     def __init__(self, question, valid_answers, default=None, **kwargs):
         super(EnumQuestion, self).__init__(question, default, **kwargs)
         assert len(valid_answers) > 0
-        if default:
-            assert default in valid_answers
         self.valid_answers = valid_answers
+        if default:
+            assert default in self.index
+
+    @property
+    def valid_answers(self):
+        return self._valid_answers
+
+    @valid_answers.setter
+    def valid_answers(self, valid_answers):
+        self._valid_answers = valid_answers
+        self.index = AnswerIndex.get(valid_answers)
 
     def _validate(self, answer):
         """
-        Validates the given answer by checking it's presence in the
-        provided list.
+        Validates the given answer by looking it up in the index of the
+        provided list. An answer ending in "?" lists the options starting with
+        the rest of the answer. Invalid answers get suggestions.
         """
-        if answer == "?" or answer not in self.valid_answers:
-            sorted_answers = sorted(self.valid_answers)
+        if answer in self.index:
+            return True
+        if answer.endswith("?"):
+            options = self.index.complete(answer[:-1])
             self.output.write(
                 "Please enter one of: \n\t{0}\n"
-                .format("\n\t".join(sorted_answers))
+                .format("\n\t".join(options))
             )
             return False
-        return True
+        suggestions = self.index.suggest(answer)
+        if suggestions:
+            self.output.write("Did you mean: \n\t{0}\n"
+                              .format("\n\t".join(suggestions)))
+        else:
+            self.output.write("Please enter one of the options, enter ? for "
+                              "a list of them.\n")
+        return False
+
+    def check(self, answer):
+        return self.index.check(answer)
+
+    def _complete(self, text, state):
+        if state == 0:
+            self._completions = self.index.complete(text)
+        if state < len(self._completions):
+            return self._completions[state]
+        return None
+
+    @contextmanager
+    def _completion(self):
+        """
+        Completes answers with tab, if the answer is read from a terminal.
+        Yields whether completion is enabled.
+        """
+        if readline is None or self.input is not sys.stdin or \
+                not self.input.isatty():
+            yield False
+            return
+        completer = readline.get_completer()
+        delims = readline.get_completer_delims()
+        readline.set_completer(self._complete)
+        readline.set_completer_delims("")
+        readline.parse_and_bind("tab: complete")
+        try:
+            yield True
+        finally:
+            readline.set_completer(completer)
+            readline.set_completer_delims(delims)
+
+    def _read_answer(self):
+        with self._completion() as completing:
+            if not completing:
+                return super(EnumQuestion, self)._read_answer()
+            try:
+                return raw_input().strip()
+            except EOFError:
+                return ""
+
+
+class EnumOrURLQuestion(EnumQuestion):
+    """
+    Question class which accepts an answer from a given list, or an HTTP(S)
+    URL. The list may be empty, in which case only URLs are accepted.
+    """
+    question_without_default = "{0} (Enter ? for a list of options, or an " \
+        "URL): "
+    question_with_default = "{0} (Enter ? for a list of options, or an " \
+        "URL) [{1}]: "
+    url_schemes = ("http://", "https://")
+
+    def __init__(self, question, valid_answers, default=None, **kwargs):
+        Question.__init__(self, question, default, **kwargs)
+        self.valid_answers = valid_answers
+        if default and not default.startswith(self.url_schemes):
+            assert default in self.index
+
+    def _validate(self, answer):
+        """
+        Validates the given answer by checking it's presence in the provided
+        list, or if it is an HTTP(S) URL.
+        """
+        if self._is_url(answer):
+            return True
+        return super(EnumOrURLQuestion, self)._validate(answer)
+
+    def _is_url(self, answer):
+        return answer.startswith(self.url_schemes) and \
+            len(answer) > len(answer.split("//")[0]) + 2
+
+    def check(self, answer):
+        if isinstance(answer, basestring) and self._is_url(answer):
+            return None
+        return super(EnumOrURLQuestion, self).check(answer)
 
 
 class FileQuestion(Question):
@@ -407,6 +790,8 @@ class MultipleAnswerQuestion(Question):
         once, the user is prompted to enter more values until an empty value is
         provided.
         """
+        if self.preseeded:
+            return
         with self._override_files(_output, _input):
             answers = []
             defaults = self.answer
@@ -434,6 +819,20 @@ class MultipleAnswerQuestion(Question):
                     if valid:
                         answers.append(answer)
 
+    def preseed(self, answer):
+        """
+        Answers the question without asking it, with a single value or a list
+        of values.
+        """
+        answers = answer if isinstance(answer, list) else [answer]
+        for answer in answers:
+            Question.preseed(self, answer)
+        self.answer = answers
+        self.preseeded = True
+
+    def format_preseed(self):
+        return list(self.answer or [])
+
     def format_default(self):
         """
         Formats the default value for output to user. Only the count of
@@ -0,0 +1,487 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Waits for deployed VMs to become ready, and measures how long they take to
+boot and to finish cloud-init.
+
+A VM is booted once its start task finished and it shows any sign of life:
+an answer of its guest agent, an entry in the neighbour (ARP) table of its
+node, an answer to a ping, or an SSH banner. It is
+ready once cloud-init wrote its completion marker. Guests are probed from
+their node, which usually shares their network, with a single command per
+node per round for all of its guests. Optionally, the serial console of every
+guest is captured as well, which also shows when cloud-init finished.
+"""
+
+from .console import CONSOLE_GRACE, SerialConsoleReader
+from collections import OrderedDict, deque
+import logging
+import threading
+import time
+
+# File cloud-init writes when its final stage finished.
+CLOUD_INIT_MARKER = "/var/lib/cloud/instance/boot-finished"
+# Seconds between the first probes of a guest. When a probe shows no progress,
+# the interval grows by BACKOFF_FACTOR, up to the maximum interval.
+PROBE_INTERVAL = 1.0
+MAX_PROBE_INTERVAL = 5.0
+BACKOFF_FACTOR = 1.5
+# Finished guests of which the timings are used to predict when the next
+# guests are booted and ready. Dense probing starts at this fraction of the
+# average time, as measured times are late by up to a probe interval.
+HISTORY_SIZE = 20
+EXPECTED_TIME_FRACTION = 0.75
+# Failed logins before the completion marker is no longer checked.
+MAX_MARKER_FAILURES = 3
+# Signals that a guest booted.
+BOOT_SIGNALS = ("agent", "arp", "ping", "ssh")
+# Probes all guests given as arguments in parallel. Arguments prefixed with a +
+# are checked for the completion marker as well, once they have an SSH banner,
+# by logging in with the keys of the node. Prints one line per guest with the
+# address and the signals seen, and the neighbour table of the node to find
+# guests by MAC.
+PROBE_SCRIPT = """\
+marker=$1
+shift
+ip neigh show | sed 's/^/neigh /'
+for arg in "$@"; do
+  (
+    addr=${arg#+}
+    result=$addr
+    ping -c 1 -W 1 "$addr" >/dev/null 2>&1 && result="$result ping"
+    banner=$(timeout 2 bash -c 'exec 3<>"/dev/tcp/$0/22" && head -c 4 <&3' \
+      "$addr" 2>/dev/null)
+    [ "$banner" = "SSH-" ] && result="$result ssh"
+    if [ "$arg" != "$addr" ] && [ "$banner" = "SSH-" ]; then
+      ssh -n -o BatchMode=yes -o ConnectTimeout=2 -o LogLevel=ERROR \
+        -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null \
+        "root@$addr" test -e "$marker"
+      case $? in
+        0) result="$result cloud-init" ;;
+        255) result="$result denied" ;;
+      esac
+    fi
+    echo "$result"
+  ) &
+done
+wait
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def parse_probe_output(output):
+    """
+    Parses the output of PROBE_SCRIPT.
+
+    Returns
+    -------
+    Tuple of a dict mapping addresses to the set of signals seen, and a dict
+    mapping lowercase MAC addresses to addresses from the neighbour table.
+    """
+    signals = {}
+    neighbours = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == "neigh":
+            if "lladdr" in fields[:-1]:
+                mac = fields[fields.index("lladdr") + 1].lower()
+                neighbours[mac] = fields[1]
+        else:
+            signals[fields[0]] = set(fields[1:])
+    return signals, neighbours
+
+
+def get_mac_address(net):
+    """
+    Get the MAC address from the config of a network device, such as
+    "virtio=DE:AD:BE:EF:00:01,bridge=vmbr0", or None if it has none.
+    """
+    model = net.split(",")[0]
+    if "=" not in model:
+        return None
+    return model.split("=", 1)[1].lower()
+
+
+class GuestState(object):
+    """
+    Readiness of a single VM, and the time it took to get there.
+
+    The state is one of "starting" until its start task finished, "booting",
+    "booted", "ready" once cloud-init finished, or "failed" and "timeout".
+    """
+    def __init__(self, node, vmid, upid=None, address=None, started_at=None,
+                 callback=None, console=None):
+        self.node = node
+        self.vmid = vmid
+        self.upid = upid
+        self.address = address or None
+        self.started_at = started_at or time.time()
+        self.callback = callback
+        self.console = console
+        self.state = "starting"
+        self.error = None
+        self.booted_at = None
+        self.boot_signal = None
+        self.ready_at = None
+        self.mac = None
+        self.agent = False
+        self.configured = False
+        self.marker_failures = 0
+        self.probes = 0
+        self.progress = False
+        self.interval = PROBE_INTERVAL
+        self.next_probe_at = time.time()
+
+    @property
+    def done(self):
+        """
+        Whether the guest is ready, or will not get any further.
+        """
+        return self.state in ("ready", "failed", "timeout") or \
+            (self.state == "booted" and
+             self.marker_failures >= MAX_MARKER_FAILURES)
+
+    @property
+    def finished(self):
+        """
+        Whether the guest is done, and its console is no longer read.
+        """
+        return self.done and (self.console is None or
+                              not self.console.running)
+
+    @property
+    def time_to_boot(self):
+        if self.booted_at is None:
+            return None
+        return self.booted_at - self.started_at
+
+    @property
+    def time_to_cloud_init(self):
+        if self.ready_at is None:
+            return None
+        return self.ready_at - self.started_at
+
+    def as_dict(self):
+        return OrderedDict([
+            ("state", self.state),
+            ("error", self.error),
+            ("address", self.address),
+            ("boot_signal", self.boot_signal),
+            ("time_to_boot", self.time_to_boot),
+            ("time_to_cloud_init", self.time_to_cloud_init),
+            ("probes", self.probes),
+            ("console_log", self.console.log_file if self.console else None),
+        ])
+
+
+class ReadinessWaiter(object):
+    """
+    Waits for many VMs at once. Guests are probed from a background thread,
+    each at its own interval: the interval grows while a guest shows no
+    progress, and is reset whenever it does. Once earlier guests finished, a
+    guest is also probed shortly before the time it is expected to boot and
+    be ready, and densely after that. Guests on the same node are probed
+    together with a single command.
+    """
+    def __init__(self, api, timeout=900, check_cloud_init=True,
+                 capture_console=False):
+        """
+        Parameters
+        ----------
+        api: ProxmoxClient
+            Client to probe the guests with.
+        timeout: int
+            Seconds after the start of a VM before it is given up on.
+        check_cloud_init: bool
+            Whether to wait for cloud-init to finish. If not, a VM is ready
+            once it booted.
+        capture_console: bool
+            Whether to capture the serial console of every VM during its
+            boot, for its boot profile.
+        """
+        self.api = api
+        self.timeout = timeout
+        self.check_cloud_init = check_cloud_init
+        self.capture_console = capture_console
+        self._guests = []
+        self._history = {"time_to_boot": deque(maxlen=HISTORY_SIZE),
+                         "time_to_cloud_init": deque(maxlen=HISTORY_SIZE)}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, node, vmid, upid=None, address=None, started_at=None,
+            callback=None):
+        """
+        Starts waiting for a VM.
+
+        Parameters
+        ----------
+        node: str
+            Node the VM resides on.
+        vmid: int
+            ID of the VM.
+        upid: str
+            ID of the start task of the VM, to check whether it succeeded.
+        address: str
+            Static IP address of the VM. Without one, the address is looked
+            up by MAC address in the neighbour table of the node.
+        started_at: float
+            Time the VM was started. Defaults to now.
+        callback: callable
+            Called with the GuestState once the VM is ready, or waiting for
+            it failed.
+
+        Returns
+        -------
+        The GuestState of the VM.
+        """
+        console = None
+        if self.capture_console:
+            console = SerialConsoleReader(self.api, node, vmid,
+                                          started_at=started_at,
+                                          timeout=self.timeout)
+            console.start()
+        guest = GuestState(node, vmid, upid=upid, address=address,
+                           started_at=started_at, callback=callback,
+                           console=console)
+        with self._condition:
+            self._guests.append(guest)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+        return guest
+
+    def add_deployment(self, journal, callback=None):
+        """
+        Starts waiting for the VM of a deployment, of which the start_vm step
+        is completed.
+        """
+        start = journal.get("start_vm")
+        return self.add(journal.proxmox['node'], journal.proxmox['vmid'],
+                        upid=start.get("result"),
+                        address=journal.cloudinit.get("ip_address"),
+                        started_at=start.get("completed_at"),
+                        callback=callback)
+
+    def wait(self, guests=None, timeout=None):
+        """
+        Blocks until the given guests, or all guests, are finished.
+
+        Returns
+        -------
+        True if all of them finished, False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while True:
+                pending = [guest for guest in (guests or self._guests)
+                           if not guest.finished]
+                if not pending:
+                    return True
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                else:
+                    # Wait with a timeout, so KeyboardInterrupt is handled.
+                    self._condition.wait(1.0)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                pending = [guest for guest in self._guests
+                           if not guest.finished]
+                self._guests = pending
+                if not pending:
+                    self._condition.wait()
+                    continue
+                delay = min(guest.next_probe_at for guest in pending) - \
+                    time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                due = [guest for guest in pending
+                       if guest.next_probe_at <= time.time()]
+            try:
+                self.poll(due)
+            except Exception as e:
+                logger.warning("Probing guests failed: {0}".format(e))
+                for guest in due:
+                    self._reschedule(guest, progress=False)
+            finished = [guest for guest in due if guest.finished]
+            with self._condition:
+                self._condition.notify_all()
+            for guest in finished:
+                for key, times in self._history.iteritems():
+                    if getattr(guest, key) is not None:
+                        times.append(getattr(guest, key))
+                self._log_result(guest)
+                if guest.callback is not None:
+                    guest.callback(guest)
+
+    def _log_result(self, guest):
+        if guest.state == "failed":
+            logger.error("VM {0} failed to start: {1}".format(
+                guest.vmid, guest.error))
+        elif guest.state == "timeout":
+            logger.error("VM {0} not ready after {1}s".format(
+                guest.vmid, self.timeout))
+        elif guest.time_to_cloud_init is None:
+            logger.info("VM {0} booted in {1:.1f}s ({2}), cloud-init not "
+                        "checked".format(guest.vmid, guest.time_to_boot,
+                                         guest.boot_signal))
+        else:
+            logger.info("VM {0} booted in {1:.1f}s ({2}), cloud-init done "
+                        "after {3:.1f}s".format(
+                            guest.vmid, guest.time_to_boot,
+                            guest.boot_signal, guest.time_to_cloud_init))
+
+    def _get_expected_time(self, guest):
+        if guest.state in ("starting", "booting"):
+            times = self._history['time_to_boot']
+        else:
+            times = self._history['time_to_cloud_init']
+        if not times:
+            return None
+        return guest.started_at + \
+            EXPECTED_TIME_FRACTION * sum(times) / len(times)
+
+    def _reschedule(self, guest, progress):
+        if progress:
+            guest.interval = PROBE_INTERVAL
+        else:
+            guest.interval = min(guest.interval * BACKOFF_FACTOR,
+                                 MAX_PROBE_INTERVAL)
+        now = time.time()
+        guest.next_probe_at = now + guest.interval
+        expected = self._get_expected_time(guest)
+        if expected is not None and now < expected < guest.next_probe_at:
+            guest.next_probe_at = expected
+            guest.interval = PROBE_INTERVAL
+
+    def poll(self, guests):
+        """
+        Probes the given guests once, and updates their states.
+        """
+        nodes = OrderedDict()
+        for guest in guests:
+            guest.probes += 1
+            state = guest.state
+            if guest.state == "starting":
+                self._check_task(guest)
+            if guest.state in ("booting", "booted") and \
+                    guest.console is not None and \
+                    guest.console.finished_at is not None:
+                if guest.booted_at is None:
+                    guest.booted_at = guest.console.finished_at
+                    guest.boot_signal = "console"
+                guest.ready_at = guest.console.finished_at
+                guest.state = "ready"
+            if guest.state in ("booting", "booted"):
+                nodes.setdefault(guest.node, []).append(guest)
+            if guest.state == "booting" and guest.agent and \
+                    self.api.ping_guest_agent(guest.node, guest.vmid):
+                self._booted(guest, "agent")
+            guest.progress = guest.state != state
+
+        for node, node_guests in nodes.iteritems():
+            self._probe_node(node, node_guests)
+
+        now = time.time()
+        for guest in guests:
+            if not guest.done and now - guest.started_at > self.timeout:
+                guest.state = "timeout"
+            if guest.done and guest.console is not None:
+                # Give the console some time for the last lines of
+                # cloud-init, unless the guest failed.
+                guest.console.stop(CONSOLE_GRACE if guest.state in
+                                   ("ready", "booted") else 0)
+            self._reschedule(guest, guest.progress)
+
+    def _check_task(self, guest):
+        if not guest.configured:
+            config = self.api.get_vm_config(guest.node, guest.vmid)
+            guest.mac = get_mac_address(config.get("net0", ""))
+            guest.agent = str(config.get("agent", "0")).split(",")[0] \
+                in ("1", "enabled=1")
+            guest.configured = True
+        if guest.upid:
+            status = self.api.get_task_status(guest.node, guest.upid)
+            if status.get("status") != "stopped":
+                return
+            if status.get("exitstatus") != "OK":
+                guest.state = "failed"
+                guest.error = status.get("exitstatus")
+                return
+        guest.state = "booting"
+
+    def _booted(self, guest, signal):
+        if guest.booted_at is None:
+            guest.booted_at = time.time()
+            guest.boot_signal = signal
+        guest.state = "booted"
+        if not self.check_cloud_init:
+            guest.ready_at = guest.booted_at
+            guest.state = "ready"
+
+    def _probe_node(self, node, guests):
+        addresses = []
+        for guest in guests:
+            if guest.address is None:
+                continue
+            if guest.state == "booted" and self.check_cloud_init:
+                addresses.append("+" + guest.address)
+            else:
+                addresses.append(guest.address)
+        signals, neighbours = self.api.probe_guests(node, addresses,
+                                                    CLOUD_INIT_MARKER)
+        for guest in guests:
+            seen = signals.get(guest.address, set())
+            if guest.mac in neighbours:
+                # The guest answered ARP, or sent traffic to the node.
+                guest.address = guest.address or neighbours[guest.mac]
+                seen.add("arp")
+            if guest.state == "booting":
+                for signal in BOOT_SIGNALS:
+                    if signal in seen:
+                        self._booted(guest, signal)
+                        guest.progress = True
+                        break
+            elif "cloud-init" in seen:
+                guest.ready_at = time.time()
+                guest.state = "ready"
+                guest.progress = True
+            elif "denied" in seen:
+                guest.marker_failures += 1
+                if guest.marker_failures == MAX_MARKER_FAILURES:
+                    logger.warning(
+                        "Cannot log in to VM {0} from {1} to check whether "
+                        "cloud-init finished".format(guest.vmid, node))
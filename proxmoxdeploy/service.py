@@ -0,0 +1,558 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .asyncclient import AsyncProxmoxClient
+from .cloudinit.templates import QUESTIONS, USER_DATA_TEMPLATE, \
+    META_DATA_TEMPLATE, get_template, list_images
+from .deploy import deploy
+from .imagecache import is_image_url
+from .ippool import IPPoolManager
+from .journal import DeployJournal
+from .metrics import PhaseTimer
+from .plan import DeployPlan
+from .proxmox import CPU_FAMILIES
+from .questions import AnswerIndex, validate_answers
+from .readiness import ReadinessWaiter
+from .snapshot import ClusterSnapshot
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn, UnixStreamServer
+import functools
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+PROXMOX_DEFAULTS = {
+    "cpu": 1,
+    "cpu_family": "host",
+    "memory": 1024,
+    "disk": 10,
+}
+# Finished jobs to keep around for status requests.
+MAX_FINISHED_JOBS = 1000
+# States of deployment jobs. Jobs are booting while waiting for their VM to
+# become ready.
+JOB_STATES = ("queued", "running", "booting", "completed", "failed")
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCatalog(object):
+    """
+    Cached list of the images in the cloud images directory.
+    """
+    def __init__(self, cloud_images_dir, ttl=300):
+        self.cloud_images_dir = cloud_images_dir
+        self.ttl = ttl
+        self.refreshed_at = None
+        self._images = []
+        self._lock = threading.Lock()
+
+    def get(self, refresh=False):
+        with self._lock:
+            if refresh or self.refreshed_at is None or \
+                    time.time() - self.refreshed_at > self.ttl:
+                self._images = list_images(self.cloud_images_dir)
+                self.refreshed_at = time.time()
+            return self._images
+
+    def resolve(self, image):
+        """
+        Resolves an image by its path or its filename. HTTP(S) URLs are
+        resolved to themselves, they are downloaded by the node.
+
+        Returns
+        -------
+        Path of the image, or None if it is not in the catalog.
+        """
+        if is_image_url(image):
+            return image
+        for refresh in (False, True):
+            for _image in self.get(refresh=refresh):
+                if image in (_image, os.path.basename(_image)):
+                    return _image
+        return None
+
+
+def summarize_times(times):
+    """
+    Summarizes durations as their average, 95th percentile and maximum, or
+    None if there are none.
+    """
+    if not times:
+        return None
+    times = sorted(times)
+    return OrderedDict([
+        ("average", sum(times) / len(times)),
+        ("p95", times[min(len(times) - 1, int(len(times) * 0.95))]),
+        ("max", times[-1]),
+    ])
+
+
+class DeployJob(object):
+    """
+    A queued deployment, and its progress.
+    """
+    def __init__(self, job_id, journal):
+        self.id = job_id
+        self.journal = journal
+        self.status = "queued"
+        self.error = None
+        self.timer = PhaseTimer()
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.guest = None
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "vmid": self.journal.proxmox['vmid'],
+            "node": self.journal.proxmox['node'],
+            "name": self.journal.cloudinit['name'],
+            "journal": self.journal.filename,
+            "queued_at": self.queued_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "phases": self.timer.as_dict(),
+            "readiness": self.guest.as_dict() if self.guest else None,
+            "boot_profile": self.guest.console.profile
+            if self.guest and self.guest.console else None,
+        }
+
+
+class DeployService(object):
+    """
+    Long running deployment service. Keeps the Proxmox client, a snapshot of
+    the cluster capacity, the image catalog and the compiled templates warm,
+    and runs queued deployments concurrently with an AsyncProxmoxClient.
+    """
+    def __init__(self, api, host, cloud_images_dir, workers=2,
+                 snapshot_ttl=60, catalog_ttl=300, max_api_calls=8,
+                 max_commands=8, max_uploads=2, wait_ready=False,
+                 ready_timeout=900, check_cloud_init=True,
+                 capture_console=False, ip_pools=None):
+        """
+        Parameters
+        ----------
+        api: ProxmoxClient
+            Client to deploy with. Shared by all workers.
+        host: str
+            Proxmox host, used to name the deployment journals.
+        cloud_images_dir: str
+            Directory containing Cloud images.
+        workers: int
+            Amount of deployments to run concurrently.
+        snapshot_ttl: int
+            Seconds before the cluster snapshot is refreshed.
+        catalog_ttl: int
+            Seconds before the image catalog is refreshed.
+        max_api_calls: int
+            Amount of API calls all deployments together make at the same
+            time.
+        max_commands: int
+            Amount of commands all deployments together run at the same time.
+        max_uploads: int
+            Amount of uploads all deployments together run at the same time.
+        wait_ready: bool
+            Whether to wait for started VMs to become ready before a
+            deployment is completed. All VMs are waited for together,
+            without occupying a worker.
+        ready_timeout: int
+            Seconds to wait for a VM to become ready.
+        check_cloud_init: bool
+            Whether a VM is only ready once cloud-init finished.
+        capture_console: bool
+            Whether to capture the serial console of started VMs, for their
+            boot profile. Implies wait_ready.
+        ip_pools: IPPoolManager
+            IP pools that requests can take their address from, with the
+            "ip_pool" field.
+        """
+        self.api = api
+        self.host = host
+        self.workers = workers
+        self.snapshot = ClusterSnapshot(api, ttl=snapshot_ttl)
+        self.catalog = ImageCatalog(cloud_images_dir, ttl=catalog_ttl)
+        self.started_at = None
+        self.executor = None
+        self.waiter = None
+        self.ip_pools = ip_pools or IPPoolManager()
+        self._waiter_options = {"timeout": ready_timeout,
+                                "check_cloud_init": check_cloud_init,
+                                "capture_console": capture_console}
+        self._wait_ready = wait_ready or capture_console
+        self._limits = {"max_api_calls": max_api_calls,
+                        "max_commands": max_commands,
+                        "max_uploads": max_uploads}
+        self._jobs = OrderedDict()
+        self._job_ids = itertools.count(1)
+        self._reserved_vmids = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Warms up the caches, and starts running deployments.
+        """
+        get_template(default_template=USER_DATA_TEMPLATE)
+        get_template(default_template=META_DATA_TEMPLATE)
+        self.catalog.get()
+        self.snapshot.get()
+        if self.ip_pools:
+            self.ip_pools.reconcile(self.api)
+
+        self.started_at = time.time()
+        self.executor = AsyncProxmoxClient(self.api, workers=self.workers,
+                                           **self._limits)
+        if self._wait_ready:
+            self.waiter = ReadinessWaiter(self.api, **self._waiter_options)
+
+    def _allocate_vmid(self):
+        return self.api.get_free_vmid(self._reserved_vmids)
+
+    def build_answers(self, request):
+        """
+        Fills in defaults for a deployment request, and validates it against
+        the cluster snapshot and the image catalog.
+
+        Parameters
+        ----------
+        request: dict
+            Answers to any of the Proxmox and cloud-init questions. At least
+            "name" and "image" are required. With "ip_pool", the VM gets an
+            address from that IP pool when it is queued.
+
+        Returns
+        -------
+        Tuple containing (proxmox answers, cloud-init answers).
+        """
+        for key in ("name", "image"):
+            if not request.get(key):
+                raise ValueError("Missing required field: {0}".format(key))
+
+        cloudinit = QUESTIONS.flatten_answers()
+        cloudinit.update((key, value) for key, value in request.iteritems()
+                         if key not in PROXMOX_DEFAULTS and
+                         key not in ("node", "storage", "vmid"))
+        validate_answers(QUESTIONS, dict(
+            (key, value) for key, value in cloudinit.iteritems()
+            if key in request and key != "image"))
+        cloudinit['image'] = self.catalog.resolve(request['image'])
+        if not cloudinit['image']:
+            raise ValueError("Unknown image: {0}".format(request['image']))
+        if cloudinit.get("ip_pool") and \
+                cloudinit['ip_pool'] not in self.ip_pools:
+            raise ValueError("Unknown IP pool: {0}".format(
+                cloudinit['ip_pool']))
+
+        nodes = self.snapshot.get()
+        proxmox = dict(PROXMOX_DEFAULTS)
+        proxmox.update((key, request[key]) for key in PROXMOX_DEFAULTS
+                       if key in request)
+        proxmox['node'] = request.get("node", nodes.keys()[0])
+        if proxmox['node'] not in nodes:
+            raise ValueError("Unknown node: {0}".format(proxmox['node']))
+        node = nodes[proxmox['node']]
+        if not node['storage']:
+            raise ValueError("Node {0} has no usable storage"
+                             .format(proxmox['node']))
+        proxmox['storage'] = request.get("storage", node['storage'].keys()[0])
+        if proxmox['storage'] not in node['storage']:
+            raise ValueError("Unknown storage: {0}"
+                             .format(proxmox['storage']))
+
+        error = AnswerIndex.get(CPU_FAMILIES).check(proxmox['cpu_family'])
+        if error:
+            raise ValueError("cpu_family: {0}".format(error))
+        limits = (("cpu", node['cpu']), ("memory", node['memory']),
+                  ("disk", node['storage'][proxmox['storage']]))
+        for key, limit in limits:
+            if not 0 < int(proxmox[key]) <= limit:
+                raise ValueError("{0} must be between 1 and {1}"
+                                 .format(key, limit))
+            proxmox[key] = int(proxmox[key])
+
+        if request.get("vmid"):
+            proxmox['vmid'] = int(request['vmid'])
+        return (proxmox, cloudinit)
+
+    def submit(self, request):
+        """
+        Validates a deployment request, and queues it.
+
+        Returns
+        -------
+        The queued DeployJob.
+        """
+        proxmox, cloudinit = self.build_answers(request)
+        with self._lock:
+            if not proxmox.get("vmid"):
+                proxmox['vmid'] = self._allocate_vmid()
+            elif proxmox['vmid'] in self._reserved_vmids:
+                raise ValueError("VM id {0} is already being deployed"
+                                 .format(proxmox['vmid']))
+            if cloudinit.get("ip_pool"):
+                cloudinit.update(self.ip_pools.allocate(
+                    cloudinit['ip_pool'], proxmox['vmid'], cloudinit['name']))
+            self._reserved_vmids.add(proxmox['vmid'])
+            proxmox['agent'] = self._wait_ready
+            journal = DeployJournal.create(self.host, proxmox, cloudinit)
+            job = DeployJob(next(self._job_ids), journal)
+            self._jobs[job.id] = job
+            self._prune_jobs()
+        logger.info("Queued deployment {0} of {1}".format(
+            job.id, cloudinit['name']))
+        self.executor.submit(self._run, job)
+        return job
+
+    def plan(self, requests):
+        """
+        Plans deployment requests without queueing them, see DeployPlan. VM
+        ids of queued deployments are not handed out, and requests without
+        an id get the ids they would get if they were submitted in order.
+
+        Returns
+        -------
+        The DeployPlan.
+        """
+        plan = DeployPlan(self.api, ip_pools=self.ip_pools,
+                          workers=self.workers)
+        answers = [self.build_answers(request) for request in requests]
+        with self._lock:
+            reserved = set(self._reserved_vmids)
+        for proxmox, cloudinit in answers:
+            plan.add(proxmox, cloudinit, reserved)
+        return plan
+
+    def _prune_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.iteritems()
+                    if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def _run(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        logger.info("Starting deployment {0}".format(job.id))
+        try:
+            deploy(self.api, job.journal, timer=job.timer)
+        except Exception as e:
+            logger.error("Deployment {0} failed: {1}".format(job.id, e))
+            logger.debug(traceback.format_exc())
+            job.status = "failed"
+            job.error = str(e)
+            self._release_address(job.journal)
+        else:
+            job.journal.remove()
+            if self.waiter is not None and job.journal.is_done("start_vm"):
+                job.status = "booting"
+                job.guest = self.waiter.add_deployment(
+                    job.journal, callback=functools.partial(self._ready, job))
+            else:
+                job.status = "completed"
+        finally:
+            if job.status != "booting":
+                job.finished_at = time.time()
+            with self._lock:
+                self._reserved_vmids.discard(job.journal.proxmox['vmid'])
+
+    def _release_address(self, journal):
+        """
+        Returns the address of a failed deployment to its IP pool, unless the
+        VM was created with it.
+        """
+        pool = journal.cloudinit.get("ip_pool")
+        if pool and not journal.is_done("create_vm"):
+            self.ip_pools[pool].release(journal.cloudinit['ip_address'])
+
+    def _ready(self, job, guest):
+        if guest.state in ("ready", "booted"):
+            job.status = "completed"
+        else:
+            job.status = "failed"
+            job.error = guest.error or "VM not ready after {0}s".format(
+                self.waiter.timeout)
+        job.finished_at = time.time()
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def wait(self):
+        """
+        Blocks until all queued deployments are finished.
+        """
+        self.executor.join()
+        if self.waiter is not None:
+            self.waiter.wait()
+
+    def status(self):
+        """
+        Returns the state of the service, including the amount of jobs in each
+        state and the average time spent in each deployment phase.
+        """
+        jobs = self.list_jobs()
+        states = dict((state, 0) for state in JOB_STATES)
+        phases = OrderedDict()
+        readiness = OrderedDict((key, []) for key in
+                                ("time_to_boot", "time_to_cloud_init"))
+        boot_profiles = OrderedDict()
+        for job in jobs:
+            states[job.status] += 1
+            if job.status != "completed":
+                continue
+            for phase, elapsed in job.timer.as_dict().iteritems():
+                phases.setdefault(phase, []).append(elapsed)
+            if job.guest is not None:
+                for key, times in readiness.iteritems():
+                    if getattr(job.guest, key) is not None:
+                        times.append(getattr(job.guest, key))
+            if job.guest is not None and job.guest.console is not None:
+                for stage, elapsed in job.guest.console.profile.iteritems():
+                    boot_profiles.setdefault(stage, []).append(elapsed)
+        return {
+            "uptime": time.time() - self.started_at,
+            "workers": self.workers,
+            "jobs": states,
+            "average_phases": OrderedDict(
+                (phase, sum(times) / len(times))
+                for phase, times in phases.iteritems()),
+            "readiness": OrderedDict(
+                (key, summarize_times(times))
+                for key, times in readiness.iteritems()),
+            "average_boot_profile": OrderedDict(
+                (stage, sum(times) / len(times))
+                for stage, times in boot_profiles.iteritems()),
+            "ip_pools": self.ip_pools.status(),
+            "snapshot_age": self.snapshot.age,
+            "images": len(self.catalog.get()),
+            "transfers": self.api.monitor.snapshot(),
+        }
+
+
+class DeployRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of the deployment service:
+
+      POST /deploys        Queue a deployment, the body is a JSON object of
+                           answers. Returns the job.
+      POST /plan           Plan deployments without queueing them, the body
+                           is a JSON object of answers, or a list of them.
+                           Returns the plan.
+      GET  /deploys        List all jobs.
+      GET  /deploys/<id>   Get a single job, including its phase timings.
+      GET  /status         Get the state of the service.
+      GET  /transfers      Get the progress of all running uploads.
+    """
+    def _send_json(self, code, data):
+        body = json.dumps(data, indent=2)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self.path.strip("/").split("/")
+        if parts == ["status"]:
+            return self._send_json(200, service.status())
+        if parts == ["transfers"]:
+            return self._send_json(200, service.api.monitor.snapshot())
+        if parts == ["deploys"]:
+            return self._send_json(
+                200, [job.as_dict() for job in service.list_jobs()])
+        if len(parts) == 2 and parts[0] == "deploys" and parts[1].isdigit():
+            job = service.get_job(int(parts[1]))
+            if job:
+                return self._send_json(200, job.as_dict())
+        self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        path = self.path.strip("/")
+        if path not in ("deploys", "plan"):
+            return self._send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.getheader("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if path == "plan":
+                requests = request if isinstance(request, list) \
+                    else [request]
+                if not all(isinstance(item, dict) for item in requests):
+                    raise ValueError("Requests must be JSON objects")
+                plan = self.server.service.plan(requests)
+                return self._send_json(200, plan.as_dict())
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            job = self.server.service.submit(request)
+        except ValueError as ve:
+            return self._send_json(400, {"error": str(ve)})
+        except Exception as e:
+            logger.error("Failed to handle POST /{0}: {1}".format(path, e))
+            logger.debug(traceback.format_exc())
+            return self._send_json(500, {"error": str(e)})
+        self._send_json(202, job.as_dict())
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPRequestHandler.address_string(self)
+        return "unix"
+
+    def log_message(self, format, *args):
+        logger.debug("{0} - {1}".format(self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, listen=None, socket_path=None):
+    """
+    Creates an HTTP server for the deployment service, listening either on a
+    TCP address or a Unix socket.
+
+    Parameters
+    ----------
+    service: DeployService
+        Service to handle requests with.
+    listen: tuple
+        (host, port) to listen on.
+    socket_path: str
+        Path of the Unix socket to listen on. Takes precedence over listen.
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, DeployRequestHandler)
+    else:
+        server = ThreadingHTTPServer(listen, DeployRequestHandler)
+    server.service = service
+    return server
@@ -0,0 +1,80 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Cached view of the capacity of the cluster, shared by the deploy service and
+the discovery of the cluster during the questions.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class ClusterSnapshot(object):
+    """
+    Cached view of the nodes, storages and capacity of the cluster. The view
+    is refreshed when it is older than the given ttl.
+    """
+    def __init__(self, api, ttl=60):
+        """
+        Parameters
+        ----------
+        api: ProxmoxClient
+            Client to query the cluster with.
+        ttl: int
+            Seconds before the view is refreshed.
+        """
+        self.api = api
+        self.ttl = ttl
+        self.refreshed_at = None
+        self._nodes = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        nodes = OrderedDict()
+        for node in self.api.get_nodes():
+            storages = OrderedDict()
+            for storage in self.api.get_storage(node):
+                storages[storage] = self.api.get_max_disk_size(node, storage)
+            nodes[node] = {
+                "cpu": self.api.get_max_cpu(node),
+                "memory": self.api.get_max_memory(node),
+                "storage": storages,
+            }
+        self._nodes = nodes
+        self.refreshed_at = time.time()
+
+    def get(self):
+        """
+        Get the cached view, refreshing it first if it is stale.
+
+        Returns
+        -------
+        Dict mapping node names to dicts with their maximum "cpu" and "memory",
+        and "storage" mapping storage names to their maximum disk size.
+        """
+        with self._lock:
+            if self.refreshed_at is None or \
+                    time.time() - self.refreshed_at > self.ttl:
+                self.refresh()
+            return self._nodes
+
+    @property
+    def age(self):
+        if self.refreshed_at is None:
+            return None
+        return time.time() - self.refreshed_at
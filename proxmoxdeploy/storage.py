@@ -0,0 +1,189 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+"""
+Profiles of Proxmox storages, which decide how virtual disks are allocated
+on them.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+FILE_STORAGE_TYPES = ("dir", "nfs")
+BLOCK_STORAGE_TYPES = ("lvm", "lvmthin", "zfspool")
+# Preallocation modes qemu-img supports, per disk format.
+PREALLOCATION_MODES = {"qcow2": ("off", "metadata", "falloc", "full"),
+                       "raw": ("off", "falloc", "full")}
+# Defaults of Proxmox for storages that don't configure these.
+DEFAULT_LVM_EXTENT_SIZE = 4096
+DEFAULT_ZFS_BLOCKSIZE = 8
+
+
+def parse_size(size):
+    """
+    Parses a size as used in the storage config, like "8k" or "1M".
+
+    Returns
+    -------
+    Size in kilobytes.
+    """
+    size = str(size).strip().upper()
+    units = {"K": 1, "M": 1024, "G": 1024 ** 2}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size) // 1024
+
+
+class StorageProfile(object):
+    """
+    How virtual disks are allocated on a storage: the disk format, the
+    options to create the disk with, and the multiple its size is rounded
+    up to.
+    """
+    def __init__(self, storage_type, disk_format, cluster_size=None,
+                 preallocation=None, size_multiple=None):
+        """
+        Parameters
+        ----------
+        storage_type: str
+            Type of the storage.
+        disk_format: raw or qcow2
+            Format of disks on the storage.
+        cluster_size: int
+            Cluster size of qcow2 disks in kilobytes, or None for the default
+            of qemu-img.
+        preallocation: str
+            Preallocation mode of disks, one of PREALLOCATION_MODES, or None
+            for the default of qemu-img.
+        size_multiple: int
+            Multiple the size of disks is rounded up to, in kilobytes.
+        """
+        if storage_type in BLOCK_STORAGE_TYPES and disk_format != "raw":
+            raise ValueError("{0} storage only supports raw disks".format(
+                storage_type))
+        if preallocation is not None and \
+                preallocation not in PREALLOCATION_MODES[disk_format]:
+            raise ValueError("Unknown preallocation mode for {0}: {1}".format(
+                disk_format, preallocation))
+        self.storage_type = storage_type
+        self.disk_format = disk_format
+        self.cluster_size = cluster_size
+        self.preallocation = preallocation
+        self.size_multiple = size_multiple
+
+    def __str__(self):
+        details = [self.disk_format]
+        if self.cluster_size:
+            details.append("cluster size {0}K".format(self.cluster_size))
+        if self.preallocation:
+            details.append("preallocation {0}".format(self.preallocation))
+        if self.size_multiple:
+            details.append("multiple of {0}K".format(self.size_multiple))
+        return ", ".join(details)
+
+    def get_disk_format(self, disk_format=None):
+        """
+        Get the format to create a disk with, given the requested format.
+        Block storages only support raw disks.
+        """
+        if disk_format is None:
+            return self.disk_format
+        if self.storage_type in BLOCK_STORAGE_TYPES and disk_format != "raw":
+            logger.info("{0} storage only supports raw disks, using raw "
+                        "instead of {1}".format(self.storage_type,
+                                                disk_format))
+            return "raw"
+        return disk_format
+
+    def get_create_options(self, disk_format):
+        """
+        Get the qemu-img options to create a disk in the given format with.
+        Disks on block storages are created by Proxmox, so they have none.
+        """
+        if self.storage_type not in FILE_STORAGE_TYPES:
+            return []
+        options = []
+        if self.cluster_size and disk_format == "qcow2":
+            options.append("cluster_size={0}".format(
+                self.cluster_size * 1024))
+        if self.preallocation and \
+                self.preallocation in PREALLOCATION_MODES[disk_format]:
+            options.append("preallocation={0}".format(self.preallocation))
+        return options
+
+    def round_size(self, disk_size):
+        """
+        Rounds a disk size in kilobytes up to the multiple of the storage.
+        """
+        if self.size_multiple and disk_size % self.size_multiple != 0:
+            disk_size += self.size_multiple - disk_size % self.size_multiple
+        return disk_size
+
+
+def get_storage_profile(storage_type, storage_config=None,
+                        extent_size=None, overrides=None):
+    """
+    Learns the profile of a storage from its config.
+
+    File storages get qcow2 disks, or the format configured as default for
+    the storage, with metadata preallocation, so the first writes of a guest
+    don't have to allocate qcow2 metadata. LVM volumes are rounded up to the
+    extent size of the volume group, and ZFS volumes to their volblocksize.
+
+    Parameters
+    ----------
+    storage_type: str
+        Type of the storage, from its status.
+    storage_config: dict
+        Config of the storage, as returned by the storage API.
+    extent_size: int
+        Extent size of the volume group of LVM storages, in kilobytes.
+    overrides: dict
+        Config section with "format", "cluster-size" and "preallocation"
+        keys, which override the learned profile.
+    """
+    storage_config = storage_config or {}
+    overrides = overrides or {}
+    cluster_size = None
+    preallocation = None
+    size_multiple = None
+    if storage_type in FILE_STORAGE_TYPES:
+        disk_format = storage_config.get("format", "qcow2")
+        if disk_format not in PREALLOCATION_MODES:
+            disk_format = "qcow2"
+        preallocation = storage_config.get(
+            "preallocation", "metadata" if disk_format == "qcow2" else None)
+    else:
+        disk_format = "raw"
+        if storage_type in ("lvm", "lvmthin"):
+            size_multiple = extent_size or DEFAULT_LVM_EXTENT_SIZE
+        elif storage_type == "zfspool":
+            size_multiple = parse_size(storage_config.get(
+                "blocksize", "{0}k".format(DEFAULT_ZFS_BLOCKSIZE)))
+
+    if "format" in overrides:
+        disk_format = overrides['format']
+    if "cluster-size" in overrides:
+        cluster_size = parse_size(overrides['cluster-size'])
+    if "preallocation" in overrides:
+        preallocation = overrides['preallocation']
+    if preallocation == "metadata" and disk_format != "qcow2":
+        preallocation = None
+    return StorageProfile(storage_type, disk_format,
+                          cluster_size=cluster_size,
+                          preallocation=preallocation,
+                          size_multiple=size_multiple)
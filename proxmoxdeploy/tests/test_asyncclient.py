@@ -0,0 +1,122 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..asyncclient import AsyncProxmoxClient
+import threading
+import time
+import unittest
+
+
+class CountingSession(object):
+    """
+    Session that records how many calls of each kind run at the same time.
+    """
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.running = {"request": 0, "exec": 0, "upload": 0}
+        self.peak = dict(self.running)
+        self._lock = threading.Lock()
+
+    def _call(self, kind):
+        with self._lock:
+            self.running[kind] += 1
+            self.peak[kind] = max(self.peak[kind], self.running[kind])
+        time.sleep(self.delay)
+        with self._lock:
+            self.running[kind] -= 1
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        self._call("request")
+
+    def _exec(self, cmd):
+        self._call("exec")
+        return ("", "")
+
+    def upload_file_obj(self, file_obj, remote_path):
+        self._call("upload")
+
+
+class StubClient(object):
+    def __init__(self):
+        self.session = CountingSession()
+
+    def _get_ssh_session(self):
+        return self.session
+
+    def get_version(self):
+        return (7, 4)
+
+
+class AsyncProxmoxClientTest(unittest.TestCase):
+    def setUp(self):
+        self.client = StubClient()
+        self.session = self.client.session
+        self.executor = AsyncProxmoxClient(self.client, workers=8,
+                                           max_api_calls=3, max_commands=2,
+                                           max_uploads=1)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_limits(self):
+        calls = [lambda: self.session.request("GET", "/version"),
+                 lambda: self.session._exec("true"),
+                 lambda: self.session.upload_file_obj(None, "/tmp/x")]
+        for _ in range(4):
+            for call in calls:
+                self.executor.submit(call)
+        self.executor.join()
+        self.assertEqual(self.session.peak,
+                         {"request": 3, "exec": 2, "upload": 1})
+
+    def test_operations(self):
+        self.assertEqual(self.executor.get_version().get(), (7, 4))
+        self.assertRaises(AttributeError, getattr, self.executor,
+                          "destroy_everything")
+
+    def test_join(self):
+        finished = []
+
+        def second():
+            time.sleep(0.05)
+            finished.append("second")
+
+        def first():
+            time.sleep(0.05)
+            self.executor.submit(second)
+            finished.append("first")
+
+        self.executor.submit(first)
+        self.executor.join()
+        # The operation submitted by the first one is waited for as well.
+        self.assertEqual(finished, ["first", "second"])
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_exception(self):
+        def fail():
+            raise ValueError("No storage left")
+        result = self.executor.submit(fail)
+        self.assertRaises(ValueError, result.get)
+        self.executor.join()
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_map(self):
+        def square(value):
+            time.sleep(0.01 * (5 - value))
+            return value * value
+        self.assertEqual(self.executor.map(square, range(5)),
+                         [0, 1, 4, 9, 16])
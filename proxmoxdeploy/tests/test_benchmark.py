@@ -0,0 +1,69 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..benchmark import compare_configurations, compare_results
+from collections import OrderedDict
+import unittest
+
+
+def get_results(seconds=10.0, vms_per_minute=60.0, failed=0, api_calls=100,
+                vms=10):
+    return OrderedDict([
+        ("single", OrderedDict([
+            ("seconds", seconds),
+            ("phases", OrderedDict([("create_vm", seconds / 2),
+                                    ("start_vm", 0.1)])),
+            ("api_calls", api_calls),
+        ])),
+        ("batch", OrderedDict([
+            ("vms", vms),
+            ("workers", 4),
+            ("failed", failed),
+            ("seconds", seconds),
+            ("vms_per_minute", vms_per_minute),
+        ])),
+    ])
+
+
+class CompareResultsTest(unittest.TestCase):
+    def test_no_regressions(self):
+        self.assertEqual(compare_results(get_results(11.0, 50.0),
+                                         get_results()), [])
+
+    def test_regressions(self):
+        self.assertEqual(
+            compare_results(get_results(13.0, 40.0), get_results()),
+            [("single.seconds", 10.0, 13.0),
+             ("single.phases.create_vm", 5.0, 6.5),
+             ("batch.seconds", 10.0, 13.0),
+             ("batch.vms_per_minute", 60.0, 40.0)])
+
+    def test_short_timings(self):
+        baseline = get_results()
+        baseline['single']['phases']['start_vm'] = 0.01
+        self.assertEqual(compare_results(get_results(), baseline), [])
+
+    def test_counts_not_compared(self):
+        self.assertEqual(compare_results(get_results(failed=1, api_calls=200),
+                                         get_results()), [])
+
+    def test_configurations(self):
+        self.assertEqual(compare_configurations(get_results(),
+                                                get_results()), [])
+        self.assertEqual(compare_configurations(get_results(vms=20),
+                                                get_results()),
+                         [("batch.vms", 10, 20)])
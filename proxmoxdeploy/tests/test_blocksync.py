@@ -0,0 +1,72 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..blocksync import apply_delta, compute_delta, read_signatures, \
+    write_signatures
+from StringIO import StringIO
+import hashlib
+import os
+import unittest
+
+BLOCK_SIZE = 4096
+
+
+class BlockSyncTest(unittest.TestCase):
+    def round_trip(self, old, new):
+        signatures = StringIO()
+        write_signatures(StringIO(old), BLOCK_SIZE, signatures)
+        delta = StringIO()
+        digest, copied, literal = compute_delta(
+            StringIO(new), read_signatures(signatures.getvalue()),
+            BLOCK_SIZE, delta)
+        delta.seek(0)
+        rebuilt = StringIO()
+        self.assertEqual(apply_delta(StringIO(old), delta, rebuilt,
+                                     BLOCK_SIZE), digest)
+        self.assertEqual(rebuilt.getvalue(), new)
+        self.assertEqual(digest, hashlib.sha256(new).hexdigest())
+        return copied, literal
+
+    def test_identical(self):
+        data = os.urandom(BLOCK_SIZE * 8)
+        self.assertEqual(self.round_trip(data, data), (len(data), 0))
+
+    def test_changed_block(self):
+        old = os.urandom(BLOCK_SIZE * 8)
+        new = old[:BLOCK_SIZE * 3] + os.urandom(BLOCK_SIZE) + \
+            old[BLOCK_SIZE * 4:]
+        self.assertEqual(self.round_trip(old, new),
+                         (BLOCK_SIZE * 7, BLOCK_SIZE))
+
+    def test_shifted_data(self):
+        old = os.urandom(BLOCK_SIZE * 8)
+        new = os.urandom(512) + old
+        self.assertEqual(self.round_trip(old, new), (len(old), 512))
+
+    def test_partial_tail(self):
+        old = os.urandom(BLOCK_SIZE * 4)
+        new = old + os.urandom(1000)
+        self.assertEqual(self.round_trip(old, new), (len(old), 1000))
+
+    def test_empty(self):
+        self.assertEqual(self.round_trip(b"", os.urandom(100)), (0, 100))
+        self.assertEqual(self.round_trip(os.urandom(BLOCK_SIZE), b""),
+                         (0, 0))
+
+    def test_corrupt_delta(self):
+        self.assertRaises(ValueError, apply_delta, StringIO(), StringIO("X"),
+                          StringIO(), BLOCK_SIZE)
@@ -0,0 +1,58 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .. import cache, cloudinit
+from ..cloudinit.templates import QUESTIONS
+from shutil import rmtree
+import os
+import tempfile
+import time
+import unittest
+
+
+class SeedIsoCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = tempfile.mkdtemp()
+        self.max_cached = cloudinit.MAX_CACHED_SEED_ISOS
+        cloudinit.MAX_CACHED_SEED_ISOS = 2
+
+    def tearDown(self):
+        rmtree(cache.CACHE_DIR)
+        cache.CACHE_DIR = self.cache_dir
+        cloudinit.MAX_CACHED_SEED_ISOS = self.max_cached
+
+    def generate(self, name):
+        context = QUESTIONS.flatten_answers()
+        context.update(name=name, ssh_root_keys=[], vmid=100)
+        return cloudinit.generate_cached_seed_iso(context)[0]
+
+    def test_cached(self):
+        first = self.generate("a")
+        self.assertEqual(self.generate("a"), first)
+        self.assertNotEqual(self.generate("b"), first)
+
+    def test_bounded(self):
+        first = self.generate("a")
+        second = self.generate("b")
+        # Make sure the use of the first ISO is the most recent one.
+        os.utime(second, (time.time() - 60, time.time() - 60))
+        self.generate("a")
+        third = self.generate("c")
+        self.assertEqual(sorted(os.listdir(os.path.dirname(first))),
+                         sorted(os.path.basename(path)
+                                for path in (first, third)))
@@ -0,0 +1,50 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..console import parse_boot_profile
+import unittest
+
+CONSOLE = [
+    (1.5, "[    0.000000] Linux version 5.15.0-generic"),
+    (3.0, "[    2.250000] Run /sbin/init as init process"),
+    (4.0, "Cloud-init v. 23.1 running 'init' at Mon, 01 Jan 2024"),
+    (6.0, "Reading package lists..."),
+    (7.5, "Setting up nginx (1.18.0)"),
+    (8.0, "Cloud-init v. 23.1 running 'modules:config' at Mon"),
+    (9.0, "Cloud-init v. 23.1 running 'modules:final' at Mon"),
+    (12.0, "Cloud-init v. 23.1 finished at Mon, 01 Jan 2024"),
+]
+
+
+class BootProfileTest(unittest.TestCase):
+    def test_profile(self):
+        profile = parse_boot_profile(CONSOLE)
+        self.assertEqual(profile.items(), [
+            ("firmware", 1.5),
+            # Kernel timestamps are preferred over the time lines were read.
+            ("kernel", 2.25),
+            ("userspace", 1.0),
+            ("cloud_init_init", 4.0),
+            ("cloud_init_config", 1.0),
+            ("cloud_init_final", 3.0),
+            ("packages", 1.5),
+        ])
+
+    def test_partial(self):
+        profile = parse_boot_profile(CONSOLE[:2] + [(5.0, "login: ")])
+        self.assertEqual(profile.keys(), ["firmware", "kernel"])
+        self.assertEqual(parse_boot_profile([]).items(), [])
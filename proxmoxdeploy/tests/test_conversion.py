@@ -0,0 +1,178 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..conversion import ConversionEngine, ConversionSettings, \
+    STORAGE_TYPE_DEFAULTS, save_settings
+from configobj import ConfigObj
+from shutil import rmtree
+import os
+import tempfile
+import time
+import unittest
+
+# Usage of a qemu-img without -W, -r and --target-is-zero.
+OLD_HELP = """\
+qemu-img version 2.5.0
+Command syntax:
+  check [-q] [-f fmt] [--output=ofmt] [-r [leaks | all]] filename
+  convert [-c] [-p] [-q] [-n] [-f fmt] [-t cache] [-T src_cache] \
+[-O output_fmt] [-o options] [-s snapshot_name] [-S sparse_size] \
+[-m num_coroutines] filename [filename2 [...]] output_filename
+"""
+NEW_HELP = """\
+qemu-img version 5.2.0
+Command syntax:
+  convert [--object objectdef] [--image-opts] [--target-image-opts] \
+[--target-is-zero] [-U] [-C] [-c] [-p] [-q] [-n] [-f fmt] [-t cache] \
+[-T src_cache] [-O output_fmt] [-B backing_file] [-o options] [-l snapshot] \
+[-S sparse_size] [-r rate_limit] [-m num_coroutines] [-W] filename \
+[filename2 [...]] output_filename
+"""
+
+
+class HelpSession(object):
+    """
+    Session of which qemu-img prints the given usage.
+    """
+    def __init__(self, usage):
+        self.usage = usage
+        self.commands = []
+
+    def _exec(self, cmd):
+        self.commands.append(cmd)
+        return (self.usage, "")
+
+
+class ConversionSettingsTest(unittest.TestCase):
+    def test_validation(self):
+        self.assertRaises(ValueError, ConversionSettings, coroutines=17)
+        self.assertRaises(ValueError, ConversionSettings,
+                          target_cache="fast")
+
+    def test_update(self):
+        settings = ConversionSettings(coroutines=8, target_cache="none")
+        settings = settings.update({"coroutines": "4",
+                                    "unordered-writes": "yes",
+                                    "target-cache": "default",
+                                    "compression": "on"})
+        self.assertEqual(settings, ConversionSettings(
+            coroutines=4, unordered_writes=True))
+        self.assertEqual(ConversionSettings().update(settings.as_config()),
+                         settings)
+
+
+class ConversionEngineTest(unittest.TestCase):
+    def test_settings_precedence(self):
+        engine = ConversionEngine(config={
+            "lvmthin": {"coroutines": "4"},
+            "local-lvm": {"coroutines": "2", "target-cache": "writeback"},
+            "pve/local-lvm": {"target-cache": "default"},
+        }, overrides={"unordered_writes": False})
+        # The defaults of the type, then the type, storage and node/storage
+        # sections, and the overrides.
+        self.assertEqual(engine.get_settings("pve", "local-lvm", "lvmthin"),
+                         ConversionSettings(coroutines=2))
+        self.assertEqual(engine.get_settings("pve2", "local-lvm", "lvmthin"),
+                         ConversionSettings(coroutines=2,
+                                            target_cache="writeback"))
+        self.assertEqual(engine.get_settings("pve", "data", "lvmthin"),
+                         ConversionSettings(coroutines=4,
+                                            target_cache="none"))
+        self.assertEqual(engine.get_settings("pve", "local", "dir"),
+                         STORAGE_TYPE_DEFAULTS['dir'])
+        self.assertEqual(ConversionEngine().get_settings("pve", "rbd", "rbd"),
+                         ConversionSettings())
+
+    def test_supports(self):
+        engine = ConversionEngine()
+        ssh = HelpSession(OLD_HELP)
+        self.assertTrue(engine.supports(ssh, "-m"))
+        self.assertTrue(engine.supports(ssh, "-n"))
+        self.assertFalse(engine.supports(ssh, "-W"))
+        # Options of other commands don't count.
+        self.assertFalse(engine.supports(ssh, "-r"))
+        # The usage is only asked for once.
+        self.assertEqual(ssh.commands, ["qemu-img --help"])
+        engine = ConversionEngine()
+        ssh = HelpSession(NEW_HELP)
+        for option in ("-W", "-r", "--target-is-zero"):
+            self.assertTrue(engine.supports(ssh, option), option)
+
+    def test_get_supported(self):
+        settings = ConversionSettings(coroutines=16, unordered_writes=True,
+                                      target_cache="none")
+        self.assertEqual(
+            ConversionEngine().get_supported(HelpSession(OLD_HELP),
+                                             settings),
+            ConversionSettings(coroutines=16, target_cache="none"))
+        self.assertEqual(
+            ConversionEngine().get_supported(HelpSession(NEW_HELP),
+                                             settings), settings)
+
+    def test_get_command(self):
+        settings = ConversionSettings(coroutines=16, unordered_writes=True,
+                                      target_cache="none")
+        command = ConversionEngine().get_command(
+            HelpSession(NEW_HELP), settings, "raw", "/tmp/disk.img",
+            "/dev/pve/vm-100-disk-1", rate=1048576, target_is_zero=True)
+        self.assertEqual(
+            command, "qemu-img convert -n --target-is-zero -m 16 -W -t none "
+            "-r 1048576 -O raw '/tmp/disk.img' /dev/pve/vm-100-disk-1")
+
+    def test_get_command_unsupported(self):
+        settings = ConversionSettings(coroutines=16, unordered_writes=True)
+        command = ConversionEngine().get_command(
+            HelpSession(OLD_HELP), settings, "qcow2", "/tmp/disk.img",
+            "/var/lib/vz/images/100/vm-100-disk-1.qcow2", rate=1048576,
+            target_is_zero=True)
+        self.assertEqual(
+            command, "qemu-img convert -n -m 16 -O qcow2 '/tmp/disk.img' "
+            "/var/lib/vz/images/100/vm-100-disk-1.qcow2")
+
+    def test_tune(self):
+        def convert(settings):
+            # 8 coroutines and the writeback cache are fastest.
+            delay = 0.04 if settings.coroutines != 8 else 0.01
+            if settings.target_cache != "writeback":
+                delay += 0.03
+            time.sleep(delay)
+
+        best, results = ConversionEngine().tune(
+            HelpSession(OLD_HELP), ConversionSettings(coroutines=16,
+                                                      unordered_writes=True),
+            convert)
+        self.assertEqual(best, ConversionSettings(coroutines=8,
+                                                  target_cache="writeback"))
+        # The start, 1, 4, 8 and again 16 coroutines, and two cache modes.
+        # -W is not supported, so it is not tried.
+        self.assertEqual(len(results), 7)
+        self.assertFalse(any(settings.unordered_writes
+                             for settings, _ in results))
+
+
+class SaveSettingsTest(unittest.TestCase):
+    def test_save(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "proxmox-deploy.cfg")
+            settings = ConversionSettings(coroutines=4, target_cache="none")
+            save_settings(filename, "pve/local-lvm", settings)
+            config = ConfigObj(filename)
+            self.assertEqual(ConversionSettings().update(
+                config['conversion']['pve/local-lvm']), settings)
+        finally:
+            rmtree(directory)
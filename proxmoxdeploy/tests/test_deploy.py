@@ -0,0 +1,75 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .. import cache
+from ..cloudinit.templates import QUESTIONS
+from ..deploy import deploy
+from ..fake import FakeProxmoxAPI, FakeProxmoxNode
+from ..journal import DeployJournal
+from ..proxmox import ProxmoxClient
+from shutil import rmtree
+import os
+import tempfile
+import unittest
+
+PHASES = ["create_vm", "generate_seed_iso", "attach_seed_iso",
+          "attach_base_disk", "attach_serial_console", "start_vm"]
+
+
+class DeployTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = os.path.join(self.directory, "cache")
+        self.image = os.path.join(self.directory, "disk1.img")
+        with open(self.image, "wb") as image:
+            image.truncate(1024 ** 2)
+        self.node = FakeProxmoxNode()
+        self.api = ProxmoxClient(FakeProxmoxAPI(self.node))
+
+    def tearDown(self):
+        cache.CACHE_DIR = self.cache_dir
+        rmtree(self.directory)
+
+    def create_journal(self):
+        proxmox = {"node": self.node.name,
+                   "storage": self.api.get_storage(self.node.name)[0],
+                   "cpu": 1, "cpu_family": "host", "memory": 512,
+                   "disk": 1, "vmid": int(self.api.get_next_vmid())}
+        cloudinit = QUESTIONS.flatten_answers()
+        cloudinit.update(name="test", image=self.image, ssh_root_keys=[],
+                         start_vm=True)
+        return DeployJournal(proxmox=proxmox, cloudinit=cloudinit)
+
+    def test_deploy(self):
+        journal = self.create_journal()
+        timer = deploy(self.api, journal)
+        self.assertEqual(timer.as_dict().keys(), PHASES)
+        for step in ("create_vm", "seed_iso", "base-disk:attached",
+                     "serial_console", "start_vm"):
+            self.assertTrue(journal.is_done(step), step)
+        vm = self.node.vms[journal.proxmox['vmid']]
+        self.assertEqual(vm['status'], "running")
+        self.assertIn("virtio0", vm)
+
+    def test_resume(self):
+        journal = self.create_journal()
+        deploy(self.api, journal)
+        calls = self.node.api_calls
+        # Completed steps are skipped when the deployment is resumed.
+        deploy(self.api, journal)
+        self.assertLess(self.node.api_calls - calls, calls)
@@ -0,0 +1,133 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..discovery import ClusterDiscovery
+from ..exceptions import UploadCancelledException
+import threading
+import unittest
+
+
+class StubClient(object):
+    """
+    Client with a single node, of which the upload of an image blocks until
+    it is released or cancelled.
+    """
+    def __init__(self, error=None, cache_status="cold"):
+        self.error = error
+        self.cache_status = cache_status
+        self.calls = []
+        self.uploaded = []
+        self.release = threading.Event()
+
+    def get_nodes(self):
+        self.calls.append("get_nodes")
+        if self.error is not None:
+            raise self.error
+        return ["pve"]
+
+    def get_storage(self, node):
+        return ["local-lvm"]
+
+    def get_max_cpu(self, node):
+        return 8
+
+    def get_max_memory(self, node):
+        return 16384
+
+    def get_max_disk_size(self, node, storage):
+        return 100
+
+    def get_next_vmid(self):
+        self.calls.append("get_next_vmid")
+        return 105
+
+    def get_image_cache_status(self, image):
+        return self.cache_status
+
+    def prefetch_image(self, image, cancel=None):
+        while not self.release.wait(0.01):
+            if cancel is not None and cancel.is_set():
+                raise UploadCancelledException("Upload cancelled")
+        if image == "broken.img":
+            raise IOError("Connection lost")
+        self.uploaded.append(image)
+        return "uploaded"
+
+
+class ClusterDiscoveryTest(unittest.TestCase):
+    def test_discovery(self):
+        client = StubClient()
+        discovery = ClusterDiscovery(client).start()
+        self.assertEqual(discovery.get_nodes(), ["pve"])
+        self.assertEqual(discovery.get_storage("pve"), ["local-lvm"])
+        self.assertEqual(discovery.get_max_cpu("pve"), 8)
+        self.assertEqual(discovery.get_max_memory("pve"), 16384)
+        self.assertEqual(discovery.get_max_disk_size("pve", "local-lvm"),
+                         100)
+        self.assertEqual(discovery.get_next_vmid(), 105)
+        # The cluster is discovered once, the questions use the snapshot.
+        self.assertEqual(client.calls, ["get_nodes", "get_next_vmid"])
+
+    def test_error(self):
+        error = RuntimeError("Connection refused")
+        discovery = ClusterDiscovery(StubClient(error=error)).start()
+        for method in (discovery.get_nodes, discovery.get_next_vmid):
+            with self.assertRaises(RuntimeError) as cm:
+                method()
+            self.assertIs(cm.exception, error)
+        with self.assertRaises(RuntimeError):
+            discovery.get_max_cpu("pve")
+
+    def test_upload(self):
+        client = StubClient()
+        discovery = ClusterDiscovery(client, image="default.img").start()
+        discovery.upload("ubuntu.img")
+        self.assertTrue(discovery.uploading)
+        # Only the first chosen image is uploaded.
+        discovery.upload("debian.img")
+        client.release.set()
+        self.assertEqual(discovery.wait_for_upload(), "uploaded")
+        self.assertFalse(discovery.uploading)
+        self.assertEqual(client.uploaded, ["ubuntu.img"])
+
+    def test_upload_skipped(self):
+        client = StubClient(cache_status="warm")
+        discovery = ClusterDiscovery(client, image="ubuntu.img").start()
+        self.assertIsNone(discovery.wait_for_upload())
+        for thread in discovery._threads:
+            thread.join()
+        discovery.upload("http://example.com/ubuntu.img")
+        self.assertIsNone(discovery.wait_for_upload())
+        discovery.upload("ubuntu.img")
+        self.assertEqual(discovery.wait_for_upload(), "warm")
+        self.assertEqual(client.uploaded, [])
+
+    def test_upload_failed(self):
+        client = StubClient()
+        client.release.set()
+        discovery = ClusterDiscovery(client).start()
+        discovery.upload("broken.img")
+        self.assertEqual(discovery.wait_for_upload(), "failed")
+
+    def test_cancel(self):
+        client = StubClient()
+        discovery = ClusterDiscovery(client).start()
+        discovery.upload("ubuntu.img")
+        discovery.cancel()
+        self.assertFalse(discovery.uploading)
+        self.assertEqual(discovery.wait_for_upload(), "cancelled")
+        self.assertEqual(client.uploaded, [])
@@ -0,0 +1,112 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..history import ThroughputHistory
+from ..metrics import PhaseTimer
+from shutil import rmtree
+import json
+import os
+import tempfile
+import unittest
+
+MB = 1024 ** 2
+
+
+class ThroughputHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "throughput.json")
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_moving_average(self):
+        history = ThroughputHistory()
+        history.record([("create_vm:pve", 10.0)])
+        history.record([("create_vm:pve", 20.0)])
+        self.assertEqual(history.entries['create_vm:pve'],
+                         {"average": 13.0, "samples": 2})
+        self.assertEqual(history.estimate("create_vm", "pve", "local-lvm"),
+                         (13.0, "node"))
+
+    def test_record_upload(self):
+        timer = PhaseTimer()
+        timer.add("upload_image", 2.0)
+        timer.add("copy_image", 0.5)
+        timer.add("allocate_disk", 1.5)
+        timer.add("cache_image", 0.0)
+        history = ThroughputHistory()
+        history.record_upload("pve", "local-lvm", 10 * MB, timer)
+        self.assertEqual(sorted(history.entries), [
+            "allocate_disk:pve/local-lvm", "cache_image:pve/local-lvm",
+            "copy_image:pve/local-lvm", "upload_image:pve"])
+        self.assertEqual(history.estimate("upload_image", "pve", "other"),
+                         (5.0 * MB, "node"))
+        self.assertEqual(history.estimate("copy_image", "pve", "local-lvm"),
+                         (20.0 * MB, "storage"))
+        self.assertEqual(history.estimate("allocate_disk", "pve",
+                                          "local-lvm"), (1.5, "storage"))
+
+    def test_record_unknown_size(self):
+        timer = PhaseTimer()
+        timer.add("upload_image", 2.0)
+        timer.add("attach_disk", 1.0)
+        history = ThroughputHistory()
+        history.record_upload("pve", "local-lvm", None, timer)
+        self.assertEqual(list(history.entries), ["attach_disk:pve/local-lvm"])
+
+    def test_record_deployment(self):
+        timer = PhaseTimer()
+        timer.add("create_vm", 2.0)
+        timer.add("base_disk", 30.0)
+        timer.add("start_vm", 1.0)
+        history = ThroughputHistory()
+        history.record_deployment("pve", timer)
+        self.assertEqual(sorted(history.entries),
+                         ["create_vm:pve", "start_vm:pve"])
+
+    def test_cluster_fallback(self):
+        history = ThroughputHistory()
+        history.record([("create_vm:pve1", 2.0), ("create_vm:pve2", 4.0),
+                        ("copy_image:pve1/local-lvm", 10.0 * MB),
+                        ("copy_image:pve1/ceph", 30.0 * MB)])
+        self.assertEqual(history.estimate("create_vm", "pve3", None),
+                         (3.0, "cluster"))
+        # Storage phases fall back to all storages, also of the same node.
+        self.assertEqual(history.estimate("copy_image", "pve1", "nfs"),
+                         (20.0 * MB, "cluster"))
+        self.assertEqual(history.estimate("start_vm", "pve1", None),
+                         (None, None))
+
+    def test_persisted(self):
+        history = ThroughputHistory.open(self.filename)
+        self.assertEqual(history.entries, {})
+        history.record([("create_vm:pve", 2.0)])
+        other = ThroughputHistory.open(self.filename)
+        self.assertEqual(other.estimate("create_vm", "pve", None),
+                         (2.0, "node"))
+        with open(self.filename) as _file:
+            self.assertEqual(json.load(_file)['create_vm:pve']['samples'], 1)
+
+    def test_unreadable(self):
+        with open(self.filename, "w") as _file:
+            _file.write("{")
+        history = ThroughputHistory.open(self.filename)
+        self.assertEqual(history.entries, {})
+        history.record([("create_vm:pve", 2.0)])
+        self.assertEqual(ThroughputHistory.open(self.filename).entries,
+                         {"create_vm:pve": {"average": 2.0, "samples": 1}})
@@ -0,0 +1,92 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..httpsapi import ConnectionPool
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import httplib
+import socket
+import threading
+import unittest
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Answers the first request of every connection, and drops the connection
+    without a response on the second one, after processing it.
+    """
+    protocol_version = "HTTP/1.1"
+
+    requests = 0
+
+    def respond(self):
+        self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        self.server.received.append(self.command)
+        self.requests += 1
+        if self.requests > 1:
+            self.close_connection = 1
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("ok")
+
+    do_GET = do_POST = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), FlakyHandler)
+        self.server.received = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.pool = ConnectionPool("127.0.0.1", self.server.server_port,
+                                   size=1, scheme="http", timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_failed_connect(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        port = server.getsockname()[1]
+        server.close()
+        pool = ConnectionPool("127.0.0.1", port, size=1, scheme="http",
+                              timeout=5)
+        # Failed connections don't keep their slot in the pool.
+        for _ in range(3):
+            self.assertRaises(socket.error, pool.acquire)
+        self.assertEqual(pool.connections_made, 3)
+
+    def test_retry_idempotent(self):
+        self.assertEqual(self.pool.request("GET", "/")[0], 200)
+        # The response to the second request is lost, so it is sent again
+        # over a new connection.
+        self.assertEqual(self.pool.request("GET", "/")[2], "ok")
+        self.assertEqual(self.server.received, ["GET", "GET", "GET"])
+        self.assertEqual(self.pool.connections_made, 2)
+
+    def test_no_retry_post(self):
+        self.assertEqual(self.pool.request("POST", "/", "a=1")[0], 200)
+        self.assertRaises(httplib.HTTPException, self.pool.request, "POST",
+                          "/", "a=1")
+        self.assertEqual(self.server.received, ["POST", "POST"])
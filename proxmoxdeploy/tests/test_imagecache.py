@@ -0,0 +1,112 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..exceptions import SSHCommandInvocationException
+from ..fake import FakeFile, FakeProxmoxAPI, FakeProxmoxNode, \
+    FakeSession
+from ..imagecache import NodeImageCache, parse_checksums
+from ..proxmox import ProxmoxClient
+import os
+import tempfile
+import unittest
+
+CHECKSUM = "a" * 64
+OTHER = "B" * 64
+
+
+class ChecksumTest(unittest.TestCase):
+    def test_sha256sum(self):
+        text = "{0}  other.img\n{1} *images/disk.img\n".format(OTHER,
+                                                              CHECKSUM)
+        self.assertEqual(parse_checksums(text, "disk.img"), CHECKSUM)
+        self.assertEqual(parse_checksums(text, "other.img"), OTHER.lower())
+
+    def test_bsd(self):
+        text = "# comment\nSHA256 (disk.img) = {0}\n".format(CHECKSUM)
+        self.assertEqual(parse_checksums(text, "disk.img"), CHECKSUM)
+
+    def test_missing(self):
+        text = "{0}  other.img\nMD5 (disk.img) = {1}\n".format(
+            CHECKSUM, "c" * 32)
+        self.assertIsNone(parse_checksums(text, "disk.img"))
+        self.assertIsNone(parse_checksums("", "disk.img"))
+
+
+class ImageSyncTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.image = tempfile.mkstemp(suffix=".img")
+        with os.fdopen(fd, "wb") as image:
+            image.write(os.urandom(64 * 1024))
+        self.node = FakeProxmoxNode()
+
+    def tearDown(self):
+        os.remove(self.image)
+
+    def test_missing_python(self):
+        api = ProxmoxClient(FakeProxmoxAPI(self.node),
+                            image_cache=NodeImageCache(python="python9"))
+        self.assertRaises(SSHCommandInvocationException, api.prefetch_image,
+                          self.image)
+        self.assertEqual(self.node.bytes_uploaded, 0)
+
+    def test_failed_upload(self):
+        api = ProxmoxClient(FakeProxmoxAPI(self.node))
+
+        def upload(filename, path):
+            self.node.files[path] = None
+            raise IOError("Connection lost")
+        self.assertRaises(IOError, api.image_cache.prefetch,
+                          api._get_ssh_session(), self.image, upload)
+        self.assertEqual([path for path in self.node.files
+                          if path.endswith(".part")], [])
+        self.assertEqual(api.prefetch_image(self.image), "uploaded")
+        self.assertEqual(api.prefetch_image(self.image), "warm")
+
+    def test_lock(self):
+        api = ProxmoxClient(FakeProxmoxAPI(self.node),
+                            image_cache=NodeImageCache(sync_local_images=True))
+        api.upload("pve", "local-lvm", 100, self.image, "raw", "base-disk")
+        lock = api.image_cache.get_lock_path(
+            api.image_cache.get_local_image_path(self.image))
+        # The image is moved into place under the exclusive lock, and
+        # converted under the shared lock.
+        self.assertEqual(self.node.flocks, [("-x", lock, "rm"),
+                                            ("-s", lock, "qemu-img")])
+
+
+class BrokenDownloadSession(FakeSession):
+    """
+    Session of a fake node of which downloads fail halfway.
+    """
+    def _cmd_curl(self, argv):
+        with self.node.lock:
+            self.node.files[argv[argv.index("-o") + 1]] = FakeFile(1024)
+            self.node.files[argv[argv.index("-D") + 1]] = FakeFile(16)
+        return ("", "curl: (18) transfer closed with outstanding read data "
+                    "remaining")
+
+
+class ImageFetchTest(unittest.TestCase):
+    def test_failed_download(self):
+        node = FakeProxmoxNode()
+        api = ProxmoxClient(FakeProxmoxAPI(
+            session=BrokenDownloadSession(node)))
+        self.assertRaises(SSHCommandInvocationException,
+                          api.image_cache.fetch, api._get_ssh_session(),
+                          "http://images.example.com/disk.img")
+        self.assertEqual([path for path in node.files
+                          if path.endswith(".part")], [])
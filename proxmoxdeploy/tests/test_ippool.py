@@ -0,0 +1,129 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..ippool import AddressBitmap, IPPool
+from shutil import rmtree
+import tempfile
+import unittest
+
+
+class AddressBitmapTest(unittest.TestCase):
+    def test_allocate_all(self):
+        bitmap = AddressBitmap(10)
+        self.assertEqual([bitmap.allocate() for _ in range(10)], range(10))
+        self.assertEqual(bitmap.used, 10)
+        self.assertIsNone(bitmap.allocate())
+
+    def test_next_fit(self):
+        bitmap = AddressBitmap(32)
+        for _ in range(12):
+            bitmap.allocate()
+        bitmap.clear(1)
+        # The cursor moves on from the last allocation before wrapping.
+        self.assertEqual(bitmap.allocate(), 12)
+        for _ in range(19):
+            bitmap.allocate()
+        self.assertEqual(bitmap.allocate(), 1)
+        self.assertIsNone(bitmap.allocate())
+
+    def test_set_and_clear(self):
+        bitmap = AddressBitmap(16)
+        bitmap.set(3)
+        bitmap.set(3)
+        self.assertTrue(bitmap.is_set(3))
+        self.assertEqual(bitmap.used, 1)
+        bitmap.clear(3)
+        bitmap.clear(3)
+        self.assertFalse(bitmap.is_set(3))
+        self.assertEqual(bitmap.used, 0)
+
+    def test_restore(self):
+        bitmap = AddressBitmap(12)
+        bitmap.set(0)
+        bitmap.set(9)
+        restored = AddressBitmap(12, bytes(bitmap.bits), cursor=1)
+        self.assertEqual(restored.used, 2)
+        self.assertEqual(restored.allocate(), 1)
+
+
+class IPPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.state_dir)
+
+    def create_pool(self, **kwargs):
+        return IPPool("test", "10.0.0.0/29", state_dir=self.state_dir,
+                      **kwargs)
+
+    def test_allocate(self):
+        pool = self.create_pool()
+        self.assertEqual(pool.size, 6)
+        # The gateway is never handed out.
+        addresses = [pool.allocate(100 + index) for index in range(5)]
+        self.assertEqual(addresses, ["10.0.0.{0}".format(index)
+                                     for index in range(2, 7)])
+        self.assertRaises(ValueError, pool.allocate, 200)
+
+    def test_answers(self):
+        pool = self.create_pool(dns_servers="10.0.0.53")
+        answers = pool.get_answers(pool.allocate(100))
+        self.assertEqual(answers['ip_address'], "10.0.0.2")
+        self.assertEqual(answers['subnet_mask'], "255.255.255.248")
+        self.assertEqual(answers['broadcast_address'], "10.0.0.7")
+        self.assertEqual(answers['gateway_address'], "10.0.0.1")
+        self.assertEqual(answers['dns_servers'], "10.0.0.53")
+
+    def test_release(self):
+        pool = self.create_pool()
+        address = pool.allocate(100)
+        pool.release(address)
+        self.assertEqual(pool.status()['used'], 1)
+        self.assertRaises(ValueError, pool.release, "10.0.1.2")
+
+    def test_persisted(self):
+        pool = self.create_pool()
+        pool.allocate(100)
+        other = self.create_pool()
+        self.assertEqual(other.allocate(101), "10.0.0.3")
+        self.assertEqual(pool.allocate(102), "10.0.0.4")
+
+    def test_range_changed(self):
+        self.create_pool().allocate(100)
+        pool = self.create_pool(first="10.0.0.2", last="10.0.0.4")
+        self.assertEqual(pool.status()['used'], 1)
+        self.assertEqual(pool.allocate(101), "10.0.0.3")
+
+    def test_reconcile(self):
+        pool = self.create_pool()
+        stale = pool.allocate(100)
+        recent = pool.allocate(101)
+
+        def age_lease(bitmap, leases):
+            leases[stale]['since'] = 0
+        pool._update(age_lease)
+
+        pool.reconcile({"10.0.0.5": 102})
+        self.assertEqual(pool.status()['used'], 3)
+        self.assertEqual(pool.allocate(103), stale)
+        self.assertNotEqual(pool.allocate(104), recent)
+
+    def test_invalid_range(self):
+        self.assertRaises(ValueError, self.create_pool, first="10.0.0.9")
+        self.assertRaises(ValueError, IPPool, "test", "10.0.0.0/31",
+                          state_dir=self.state_dir)
@@ -0,0 +1,135 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..metrics import PhaseTimer, ProgressLogger, TransferMonitor, \
+    format_bytes
+import unittest
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+
+class PhaseTimerTest(unittest.TestCase):
+    def test_add(self):
+        timer = PhaseTimer()
+        timer.add("upload_image", 1.5)
+        timer.add("create_vm", 0.5)
+        timer.add("upload_image", 1.0)
+        self.assertEqual(timer.as_dict().items(),
+                         [("upload_image", 2.5), ("create_vm", 0.5)])
+        self.assertEqual(timer.total, 3.0)
+
+    def test_phase(self):
+        timer = PhaseTimer()
+        with timer.phase("create_vm"):
+            pass
+        try:
+            with timer.phase("start_vm"):
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        # Failed phases are timed as well.
+        self.assertEqual(timer.as_dict().keys(), ["create_vm", "start_vm"])
+        self.assertGreaterEqual(timer.as_dict()['start_vm'], 0.0)
+
+
+class FormatBytesTest(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(format_bytes(512), "512.0 B")
+        self.assertEqual(format_bytes(1536), "1.5 KiB")
+        self.assertEqual(format_bytes(10 * 1024 ** 3), "10.0 GiB")
+        self.assertEqual(format_bytes(2 * 1024 ** 4), "2.0 TiB")
+
+
+class TransferMonitorTest(unittest.TestCase):
+    def test_events(self):
+        monitor = TransferMonitor(interval=3600)
+        events = []
+        monitor.add_listener(events.append)
+        progress = monitor.start("disk.img", total=1000)
+        for _ in range(10):
+            progress.update(100)
+        progress.finish()
+        # Progress events are only emitted once per interval.
+        self.assertEqual([event['event'] for event in events],
+                         ["transfer_started", "transfer_finished"])
+        self.assertEqual(events[-1]['transfer']['bytes_sent'], 1000)
+        self.assertEqual(events[-1]['active'], 0)
+        self.assertEqual(monitor.bytes_sent, 1000)
+
+    def test_progress(self):
+        monitor = TransferMonitor(interval=0)
+        events = []
+        monitor.add_listener(events.append)
+        first = monitor.start("disk1.img")
+        second = monitor.start("disk2.img", total=200)
+        first.update(100)
+        second.update(50)
+        self.assertEqual([event['event'] for event in events],
+                         ["transfer_started"] * 2 +
+                         ["transfer_progress"] * 2)
+        self.assertEqual(events[-1]['active'], 2)
+        self.assertEqual(events[-1]['transfer']['bytes_sent'], 50)
+        snapshot = monitor.snapshot()
+        self.assertEqual(snapshot['bytes_in_flight'], 150)
+        self.assertEqual([transfer['name'] for transfer in
+                          snapshot['transfers']], ["disk1.img", "disk2.img"])
+        first.finish()
+        second.finish()
+        self.assertEqual(monitor.snapshot()['active'], 0)
+        self.assertEqual(monitor.bytes_sent, 150)
+
+
+class ProgressLoggerTest(unittest.TestCase):
+    def get_event(self, event, **transfer):
+        data = {"name": "disk.img", "bytes_sent": 512 * 1024,
+                "total": 1024 ** 2, "throughput": 256 * 1024,
+                "average_throughput": 128 * 1024, "eta": 2.0,
+                "elapsed": 4.0}
+        data.update(transfer)
+        return {"event": event, "transfer": data, "active": 1,
+                "throughput": 256 * 1024}
+
+    def test_progress(self):
+        logger = ListLogger()
+        progress = ProgressLogger(logger)
+        progress(self.get_event("transfer_started"))
+        progress(self.get_event("transfer_progress"))
+        progress(self.get_event("transfer_progress", total=None, eta=None))
+        self.assertEqual(logger.messages, [
+            "  disk.img: 512.0 KiB of 1.0 MiB (50%), 256.0 KiB/s, ETA 2s",
+            "  disk.img: 512.0 KiB, 256.0 KiB/s"])
+
+    def test_concurrent(self):
+        logger = ListLogger()
+        event = self.get_event("transfer_progress")
+        event.update(active=3, throughput=768 * 1024)
+        ProgressLogger(logger)(event)
+        self.assertTrue(logger.messages[0].endswith(
+            " (3 transfers, 768.0 KiB/s total)"))
+
+    def test_finished(self):
+        logger = ListLogger()
+        ProgressLogger(logger)(self.get_event("transfer_finished",
+                                              bytes_sent=1024 ** 2))
+        self.assertEqual(logger.messages,
+                         ["  disk.img: 1.0 MiB in 4.0s, 128.0 KiB/s"])
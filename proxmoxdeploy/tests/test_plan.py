@@ -0,0 +1,172 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..history import ThroughputHistory
+from ..ippool import IPPool
+from ..plan import DeployPlan, DEFAULT_DURATIONS, DEFAULT_RATES
+from shutil import rmtree
+import os
+import tempfile
+import unittest
+
+MB = 1024 ** 2
+
+
+class StubImageCache(object):
+    sync_local_images = True
+
+
+class StubClient(object):
+    """
+    Client of a node with 8 cpus, 16 GB of memory and 100 GB of disk space
+    on every storage.
+    """
+    def __init__(self, cache_status="cold", native_import=False):
+        self.cache_status = cache_status
+        self.native_import = native_import
+        self.history = ThroughputHistory()
+        self.image_cache = StubImageCache()
+
+    def get_free_vmid(self, reserved):
+        vmid = 100
+        while vmid in reserved:
+            vmid += 1
+        return vmid
+
+    def get_max_cpu(self, node):
+        return 8
+
+    def get_max_memory(self, node):
+        return 16384
+
+    def get_max_disk_size(self, node, storage):
+        return 100
+
+    def get_image_cache_status(self, image):
+        return self.cache_status
+
+    def _use_native_import(self):
+        return self.native_import
+
+
+class DeployPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tempdir, "ubuntu.img")
+        with open(self.image, "wb") as image:
+            image.truncate(10 * MB)
+        self.api = StubClient()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def add(self, plan, image=None, **answers):
+        proxmox = {"node": "pve", "storage": "local-lvm", "cpu": 2,
+                   "memory": 2048, "disk": 10}
+        proxmox.update(answers)
+        cloudinit = {"name": "test", "image": image or self.image,
+                     "start_vm": True,
+                     "ip_pool": proxmox.pop("ip_pool", None)}
+        return plan.add(proxmox, cloudinit)
+
+    def test_estimates(self):
+        self.api.history.record([
+            ("create_vm:pve", 4.0),
+            ("upload_image:pve", 5.0 * MB),
+            ("copy_image:pve/ceph", 10.0 * MB),
+        ])
+        plan = DeployPlan(self.api)
+        deployment = self.add(plan)
+        self.assertEqual(list(deployment['phases']), [
+            "create_vm", "generate_seed_iso", "attach_seed_iso",
+            "upload_image", "allocate_disk", "copy_image", "attach_disk",
+            "attach_serial_console", "start_vm"])
+        self.assertEqual(deployment['phases']['create_vm'], 4.0)
+        self.assertEqual(deployment['sources']['create_vm'], "node")
+        self.assertEqual(deployment['phases']['upload_image'], 2.0)
+        self.assertEqual(deployment['sources']['upload_image'], "node")
+        # Measured on another storage only.
+        self.assertEqual(deployment['phases']['copy_image'], 1.0)
+        self.assertEqual(deployment['sources']['copy_image'], "cluster")
+        self.assertEqual(deployment['phases']['start_vm'],
+                         DEFAULT_DURATIONS['start_vm'])
+        self.assertEqual(deployment['sources']['start_vm'], "default")
+        self.assertEqual(deployment['deploy_seconds'],
+                         sum(deployment['phases'].values()))
+        self.assertTrue(deployment['complete'])
+        self.assertEqual(deployment['transfer_bytes'], 10 * MB)
+        self.assertEqual(deployment['problems'], [])
+
+    def test_defaults(self):
+        self.api.native_import = True
+        deployment = self.add(DeployPlan(self.api))
+        self.assertEqual(set(deployment['sources'].values()), set(["default"]))
+        self.assertIn("import_image", deployment['phases'])
+        self.assertNotIn("copy_image", deployment['phases'])
+        self.assertEqual(deployment['phases']['import_image'],
+                         10.0 * MB / DEFAULT_RATES['import_image'])
+
+    def test_cache(self):
+        plan = DeployPlan(self.api)
+        first = self.add(plan)
+        second = self.add(plan)
+        self.assertEqual((first['cache'], second['cache']), ("miss", "hit"))
+        self.assertEqual(second['transfer_bytes'], 0)
+        self.assertIn("cache_image", second['phases'])
+        self.assertNotIn("upload_image", second['phases'])
+        self.assertEqual((first['vmid'], second['vmid']), (100, 101))
+
+    def test_download(self):
+        deployment = self.add(DeployPlan(self.api),
+                              image="http://example.com/ubuntu.img")
+        self.assertIsNone(deployment['image_size'])
+        self.assertIsNone(deployment['phases']['download_image'])
+        self.assertIsNone(deployment['phases']['copy_image'])
+        self.assertFalse(deployment['complete'])
+
+    def test_problems(self):
+        pool = IPPool("office", "10.0.0.0/29", first="10.0.0.2",
+                      last="10.0.0.2", state_dir=self.tempdir)
+        plan = DeployPlan(self.api, ip_pools={"office": pool})
+        self.assertEqual(self.add(plan, vmid=100, ip_pool="office")
+                         ['problems'], [])
+        problems = self.add(plan, vmid=100, cpu=16, disk=95,
+                            ip_pool="office")['problems']
+        self.assertEqual(len(problems), 4)
+        self.assertEqual(problems[0], "VM id 100 is already taken")
+        self.assertIn("cpu exceeds", problems[1])
+        self.assertIn("local-lvm on pve has", problems[2])
+        self.assertEqual(problems[3], "IP pool office has no free addresses "
+                         "left")
+        deployment = self.add(plan, storage="ceph", ip_pool="lab")
+        self.assertEqual(deployment['problems'], ["Unknown IP pool: lab"])
+
+    def test_summary(self):
+        plan = DeployPlan(self.api, workers=2)
+        for _ in range(4):
+            self.add(plan)
+        summary = plan.summary()
+        self.assertEqual(summary['deployments'], 4)
+        self.assertEqual(summary['transfer_bytes'], 10 * MB)
+        self.assertEqual(summary['nodes']['pve']['cache_hits'], 3)
+        self.assertEqual(summary['storages']['pve/local-lvm']['disks'], 4)
+        self.assertEqual(summary['storages']['pve/local-lvm']
+                         ['available_bytes'], 100 * 1024 ** 3)
+        seconds = [deployment['deploy_seconds']
+                   for deployment in plan.deployments]
+        self.assertEqual(summary['sequential_seconds'], sum(seconds))
+        self.assertEqual(summary['estimated_seconds'], sum(seconds) / 2)
@@ -0,0 +1,75 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..preseed import load_preseed, save_preseed
+from shutil import rmtree
+import os
+import tempfile
+import unittest
+
+PRESEED = """
+node = pve
+cpu = 2
+
+[small]
+cpu = 1
+memory = 1024
+
+[tools]
+packages = vim, htop
+
+[web]
+inherit = small, tools
+packages = nginx,
+
+[loop]
+inherit = loop
+"""
+
+
+class PreseedTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "preseed.ini")
+        with open(self.filename, "w") as _file:
+            _file.write(PRESEED)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_global(self):
+        self.assertEqual(load_preseed(self.filename),
+                         {"node": "pve", "cpu": "2"})
+
+    def test_inherit(self):
+        self.assertEqual(load_preseed(self.filename, "web"), {
+            "node": "pve", "cpu": "1", "memory": "1024",
+            "packages": ["nginx"]})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, load_preseed, self.filename, "missing")
+        self.assertRaises(ValueError, load_preseed, self.filename, "loop")
+        self.assertRaises(ValueError, load_preseed,
+                          os.path.join(self.directory, "missing.ini"))
+
+    def test_save(self):
+        save_preseed(self.filename, {"cpu": "4"}, profile="large")
+        save_preseed(self.filename, {"node": "pve2"})
+        self.assertEqual(load_preseed(self.filename, "large"),
+                         {"node": "pve2", "cpu": "4"})
+        self.assertEqual(load_preseed(self.filename, "small")['memory'],
+                         "1024")
@@ -0,0 +1,169 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .. import cache
+from ..fake import FakeAPIServer, FakeHTTPSession, FakeProxmoxAPI, \
+    FakeProxmoxNode, FakeSession
+from ..httpsapi import HTTPSTransport
+from ..proxmox import ProxmoxClient
+from proxmoxer.core import ResourceException
+from shutil import rmtree
+import os
+import tempfile
+import unittest
+
+ISO_DIR = "/var/lib/vz/template/iso"
+
+
+class SeedIsoTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.iso = tempfile.mkstemp(suffix=".iso")
+        with os.fdopen(fd, "wb") as iso:
+            iso.write(b"seed")
+        self.node = FakeProxmoxNode()
+        self.api = ProxmoxClient(FakeProxmoxAPI(self.node))
+
+    def tearDown(self):
+        os.remove(self.iso)
+
+    def attach(self, vmid, digest):
+        self.api.create_vm(self.node.name, vmid, "test", 1, "host", 512, 1)
+        self.api.attach_seed_iso(self.node.name, "local-lvm", vmid,
+                                 self.iso, digest=digest)
+
+    def get_isos(self):
+        return sorted(os.path.basename(path) for path in self.node.files
+                      if os.path.dirname(path) == ISO_DIR)
+
+    def test_named_after_vm(self):
+        self.attach(100, "aa")
+        self.assertEqual(self.node.vms[100]['ide2'],
+                         "local:iso/vm-100-cloudinit-seed-aa.iso,media=cdrom")
+        self.assertEqual(self.get_isos(), ["vm-100-cloudinit-seed-aa.iso"])
+
+    def test_removed_with_vm(self):
+        self.attach(100, "aa")
+        self.attach(101, "bb")
+        # The ISO of a destroyed VM is removed once another one is written.
+        del self.node.vms[100]
+        self.attach(102, "cc")
+        self.assertEqual(self.get_isos(), ["vm-101-cloudinit-seed-bb.iso",
+                                           "vm-102-cloudinit-seed-cc.iso"])
+
+    def test_replaced(self):
+        self.attach(100, "aa")
+        del self.node.vms[100]
+        self.attach(100, "bb")
+        self.assertEqual(self.get_isos(), ["vm-100-cloudinit-seed-bb.iso"])
+
+
+class NodeCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.node = FakeProxmoxNode()
+        self.api = ProxmoxClient(FakeProxmoxAPI(self.node))
+        self.commands = []
+        session = self.api._get_ssh_session()
+        _exec = session._exec
+
+        def record(command):
+            self.commands.append(command)
+            return _exec(command)
+        session._exec = record
+
+    def test_probe_local_node(self):
+        self.api.probe_guests("pve", ["10.0.0.2"], "/tmp/marker")
+        self.assertEqual(self.commands[0], "hostname")
+        self.assertTrue(self.commands[1].startswith("bash -c "))
+
+    def test_probe_other_node(self):
+        self.api.probe_guests("pve2", ["10.0.0.2"], "/tmp/marker")
+        self.assertTrue(self.commands[1].startswith(
+            "ssh -o BatchMode=yes root@pve2 'bash -c "))
+        self.assertIn("10.0.0.2", self.commands[1])
+
+    def test_console_other_node(self):
+        session = self.api._get_ssh_session()
+        session.open_stream = self.commands.append
+        self.api.open_serial_console("pve2", 100)
+        self.assertEqual(self.commands[1], "ssh -o BatchMode=yes root@pve2 "
+                         "'socat -u UNIX-CONNECT:/var/run/qemu-server/"
+                         "100.serial0 STDOUT'")
+
+
+class NativeImportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = os.path.join(self.directory, "cache")
+        self.image = os.path.join(self.directory, "disk1.img")
+        with open(self.image, "wb") as image:
+            image.truncate(1024 ** 2)
+        self.node = FakeProxmoxNode(version="7.4-3")
+
+    def tearDown(self):
+        cache.CACHE_DIR = self.cache_dir
+        rmtree(self.directory)
+
+    def attach(self, user="root@pam", token=None, import_mode="auto"):
+        """
+        Attaches the image as base disk of a new VM, with API calls over
+        HTTP as the given user.
+
+        Returns
+        -------
+        The volume of the base disk.
+        """
+        password = None if token else "secret"
+        server = FakeAPIServer(self.node, user=user, token=token,
+                               password=password)
+        server.start()
+        transport = HTTPSTransport("127.0.0.1", server.port, user=user,
+                                   token=token, password=password,
+                                   scheme="http")
+        try:
+            api = ProxmoxClient(FakeProxmoxAPI(
+                self.node, FakeHTTPSession(self.node, transport)),
+                import_mode=import_mode)
+            vmid = int(api.get_next_vmid())
+            api.create_vm(self.node.name, vmid, "test", 1, "host", 512, 1)
+            api.attach_base_disk(self.node.name, "local-lvm", vmid,
+                                 self.image, 1024)
+        finally:
+            transport.close()
+            server.stop()
+        return self.node.vms[vmid]['virtio0']
+
+    def test_root(self):
+        self.assertEqual(self.attach(), "local-lvm:vm-100-disk-0")
+
+    def test_other_user(self):
+        self.assertEqual(self.attach("deploy@pve"),
+                         "local-lvm:vm-100-base-disk")
+        self.assertEqual(self.attach("deploy@pve", import_mode="native"),
+                         "local-lvm:vm-101-base-disk")
+
+    def test_root_token(self):
+        self.assertEqual(self.attach(token="deploy=secret"),
+                         "local-lvm:vm-100-base-disk")
+
+    def test_fake_node(self):
+        api = FakeProxmoxAPI(self.node,
+                             FakeSession(self.node, user="deploy@pve"))
+        api.nodes("pve").qemu.create(vmid=100, name="test")
+        self.assertRaises(ResourceException,
+                          api.nodes("pve").qemu(100).config.set,
+                          virtio0="local-lvm:0,import-from=/tmp/disk1.img")
@@ -0,0 +1,56 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..questions import AnswerIndex
+import unittest
+
+ANSWERS = ["local", "local-lvm", "Local-ZFS", "nfs-backup", "ceph"]
+
+
+class AnswerIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = AnswerIndex(ANSWERS)
+
+    def test_contains(self):
+        self.assertIn("local-lvm", self.index)
+        self.assertNotIn("local-zfs", self.index)
+        self.assertEqual(len(self.index), 5)
+
+    def test_complete(self):
+        self.assertEqual(self.index.complete("local"),
+                         ["local", "local-lvm"])
+        self.assertEqual(self.index.complete("c"), ["ceph"])
+        self.assertEqual(self.index.complete("x"), [])
+
+    def test_complete_folded(self):
+        # Without exact matches, matches in a different case are returned.
+        self.assertEqual(self.index.complete("local-z"), ["Local-ZFS"])
+        self.assertEqual(self.index.complete("CEPH"), ["ceph"])
+
+    def test_suggest(self):
+        self.assertEqual(self.index.suggest("local-zfs")[0], "Local-ZFS")
+        self.assertIn("nfs-backup", self.index.suggest("nfs-backp"))
+        self.assertEqual(self.index.suggest("local", limit=1), ["local"])
+        self.assertEqual(self.index.suggest(42), [])
+
+    def test_check(self):
+        self.assertIsNone(self.index.check("ceph"))
+        self.assertIn("Local-ZFS", self.index.check("local-zfs"))
+        self.assertEqual(self.index.check("zzz"), "invalid answer 'zzz'")
+
+    def test_shared(self):
+        self.assertIs(AnswerIndex.get(ANSWERS), AnswerIndex.get(ANSWERS))
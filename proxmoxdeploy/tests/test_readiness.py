@@ -0,0 +1,214 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .. import readiness
+from ..readiness import GuestState, ReadinessWaiter, get_mac_address, \
+    parse_probe_output
+import time
+import unittest
+
+NEIGHBOURS = """\
+neigh 10.0.0.1 dev vmbr0 lladdr AA:BB:CC:DD:EE:01 REACHABLE
+neigh 10.0.0.7 dev vmbr0 lladdr de:ad:be:ef:00:07 STALE
+neigh 10.0.0.9 dev vmbr0 FAILED
+"""
+
+
+class StubClient(object):
+    """
+    Client of which the probes of the guests are scripted: every call of
+    probe_guests answers with the next line of signals per address.
+    """
+    def __init__(self, probes=None, neighbours="", exitstatus="OK",
+                 agent=False):
+        self.probes = probes or {}
+        self.neighbours = neighbours
+        self.exitstatus = exitstatus
+        self.agent = agent
+        self.task_polls = 0
+        self.probed = []
+
+    def get_vm_config(self, node, vmid):
+        return {"net0": "virtio=DE:AD:BE:EF:00:07,bridge=vmbr0",
+                "agent": "1" if self.agent else "0"}
+
+    def get_task_status(self, node, upid):
+        self.task_polls += 1
+        if self.task_polls < 2:
+            return {"status": "running"}
+        return {"status": "stopped", "exitstatus": self.exitstatus}
+
+    def ping_guest_agent(self, node, vmid):
+        return self.agent
+
+    def probe_guests(self, node, addresses, marker):
+        self.probed.append(list(addresses))
+        lines = [self.neighbours]
+        for address in addresses:
+            address = address.lstrip("+")
+            signals = self.probes.get(address, [])
+            lines.append(" ".join([address] +
+                                  (signals.pop(0) if signals else [])))
+        return parse_probe_output("\n".join(lines))
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse_probe_output(self):
+        signals, neighbours = parse_probe_output(
+            NEIGHBOURS + "\n10.0.0.7 ping ssh\n10.0.0.8\n10.0.0.9 denied\n")
+        self.assertEqual(signals, {"10.0.0.7": set(["ping", "ssh"]),
+                                   "10.0.0.8": set(),
+                                   "10.0.0.9": set(["denied"])})
+        self.assertEqual(neighbours, {"aa:bb:cc:dd:ee:01": "10.0.0.1",
+                                      "de:ad:be:ef:00:07": "10.0.0.7"})
+
+    def test_get_mac_address(self):
+        self.assertEqual(
+            get_mac_address("virtio=DE:AD:BE:EF:00:01,bridge=vmbr0"),
+            "de:ad:be:ef:00:01")
+        self.assertEqual(get_mac_address("e1000=AA:BB:CC:DD:EE:FF"),
+                         "aa:bb:cc:dd:ee:ff")
+        self.assertIsNone(get_mac_address("virtio,bridge=vmbr0"))
+        self.assertIsNone(get_mac_address(""))
+
+
+class ReadinessWaiterTest(unittest.TestCase):
+    def poll(self, waiter, guest, times=1):
+        for _ in range(times):
+            waiter.poll([guest])
+
+    def test_states(self):
+        client = StubClient(probes={"10.0.0.7": [[], ["ping"], [],
+                                                 ["cloud-init"]]})
+        waiter = ReadinessWaiter(client)
+        guest = GuestState("pve", 100, upid="UPID:1", address="10.0.0.7")
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "starting")
+        self.assertEqual(guest.mac, "de:ad:be:ef:00:07")
+        self.assertEqual(client.probed, [])
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "booting")
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "booted")
+        self.assertEqual(guest.boot_signal, "ping")
+        self.assertIsNotNone(guest.time_to_boot)
+        self.poll(waiter, guest, 2)
+        self.assertEqual(guest.state, "ready")
+        self.assertTrue(guest.done)
+        self.assertIsNotNone(guest.time_to_cloud_init)
+        # Once booted, the marker is checked as well.
+        self.assertEqual(client.probed, [["10.0.0.7"], ["10.0.0.7"],
+                                         ["+10.0.0.7"], ["+10.0.0.7"]])
+        self.assertEqual(guest.probes, 5)
+
+    def test_failed_task(self):
+        waiter = ReadinessWaiter(StubClient(exitstatus="start failed"))
+        guest = GuestState("pve", 100, upid="UPID:1", address="10.0.0.7")
+        self.poll(waiter, guest, 2)
+        self.assertEqual(guest.state, "failed")
+        self.assertEqual(guest.error, "start failed")
+        self.assertTrue(guest.done)
+
+    def test_neighbour_lookup(self):
+        client = StubClient(neighbours=NEIGHBOURS)
+        waiter = ReadinessWaiter(client, check_cloud_init=False)
+        guest = GuestState("pve", 100)
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "ready")
+        self.assertEqual(guest.boot_signal, "arp")
+        self.assertEqual(guest.address, "10.0.0.7")
+        self.assertEqual(guest.time_to_cloud_init, guest.time_to_boot)
+
+    def test_guest_agent(self):
+        client = StubClient(agent=True)
+        waiter = ReadinessWaiter(client, check_cloud_init=False)
+        guest = GuestState("pve", 100, address="10.0.0.7")
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "ready")
+        self.assertEqual(guest.boot_signal, "agent")
+
+    def test_backoff(self):
+        waiter = ReadinessWaiter(StubClient(
+            probes={"10.0.0.7": [[]] * 7 + [["ssh"]]}))
+        guest = GuestState("pve", 100, address="10.0.0.7")
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "booting")
+        self.assertEqual(guest.interval, readiness.PROBE_INTERVAL)
+        intervals = []
+        for _ in range(6):
+            self.poll(waiter, guest)
+            intervals.append(guest.interval)
+        self.assertEqual(intervals, [1.5, 2.25, 3.375, 5.0, 5.0, 5.0])
+        self.assertAlmostEqual(guest.next_probe_at - time.time(), 5.0,
+                               places=1)
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "booted")
+        self.assertEqual(guest.interval, readiness.PROBE_INTERVAL)
+
+    def test_expected_time(self):
+        waiter = ReadinessWaiter(StubClient())
+        waiter._history["time_to_boot"].extend([8.0, 8.0])
+        guest = GuestState("pve", 100, address="10.0.0.7",
+                           started_at=time.time() - 4.0)
+        guest.state = "booting"
+        guest.configured = True
+        guest.interval = readiness.MAX_PROBE_INTERVAL
+        self.poll(waiter, guest)
+        # Expected to boot 6s after its start, so probed then, not in 5s.
+        self.assertAlmostEqual(guest.next_probe_at, guest.started_at + 6.0,
+                               places=1)
+        self.assertEqual(guest.interval, readiness.PROBE_INTERVAL)
+
+    def test_timeout(self):
+        waiter = ReadinessWaiter(StubClient(), timeout=60)
+        guest = GuestState("pve", 100, address="10.0.0.7",
+                           started_at=time.time() - 61)
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "timeout")
+        self.assertTrue(guest.done)
+        self.assertIsNone(guest.time_to_boot)
+
+    def test_denied_marker(self):
+        client = StubClient(probes={"10.0.0.7": [["ssh"]] +
+                                    [["ssh", "denied"]] * 3})
+        waiter = ReadinessWaiter(client)
+        guest = GuestState("pve", 100, address="10.0.0.7")
+        self.poll(waiter, guest)
+        self.assertEqual(guest.state, "booted")
+        self.poll(waiter, guest, 2)
+        self.assertEqual(guest.marker_failures, 2)
+        self.assertFalse(guest.done)
+        self.poll(waiter, guest)
+        # Booted, but cloud-init cannot be checked: given up on.
+        self.assertEqual(guest.state, "booted")
+        self.assertTrue(guest.done)
+        self.assertIsNone(guest.time_to_cloud_init)
+
+    def test_wait(self):
+        client = StubClient(probes={"10.0.0.7": [["ssh"], ["cloud-init"]]})
+        waiter = ReadinessWaiter(client)
+        results = []
+        try:
+            guest = waiter.add("pve", 100, address="10.0.0.7",
+                               callback=results.append)
+            self.assertTrue(waiter.wait(timeout=10))
+        finally:
+            waiter.stop()
+        self.assertEqual(guest.state, "ready")
+        self.assertEqual(results, [guest])
+        self.assertEqual(list(waiter._history["time_to_cloud_init"]),
+                         [guest.time_to_cloud_init])
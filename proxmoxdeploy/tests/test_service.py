@@ -0,0 +1,125 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .. import cache
+from ..fake import FakeProxmoxAPI, FakeProxmoxNode
+from ..ippool import IPPoolManager
+from ..proxmox import ProxmoxClient
+from ..service import DeployService, create_server
+from shutil import rmtree
+import httplib
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+
+class DeployServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = os.path.join(self.directory, "cache")
+        images_dir = os.path.join(self.directory, "images")
+        os.mkdir(images_dir)
+        with open(os.path.join(images_dir, "disk1.img"), "wb") as image:
+            image.truncate(1024 ** 2)
+        self.node = FakeProxmoxNode()
+        # The leases are kept in the cache directory of the test.
+        ip_pools = IPPoolManager({"lan": {"subnet": "192.168.1.0/29"}})
+        self.service = DeployService(
+            ProxmoxClient(FakeProxmoxAPI(self.node)), "pve", images_dir,
+            ip_pools=ip_pools)
+        self.service.start()
+        self.server = create_server(self.service, listen=("127.0.0.1", 0))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        cache.CACHE_DIR = self.cache_dir
+        rmtree(self.directory)
+
+    def request(self, method, path, data=None):
+        connection = httplib.HTTPConnection("127.0.0.1",
+                                            self.server.server_port)
+        try:
+            body = json.dumps(data) if data is not None else None
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            return (response.status, json.loads(response.read()))
+        finally:
+            connection.close()
+
+    def test_submit(self):
+        code, job = self.request("POST", "/deploys",
+                                 {"name": "test", "image": "disk1.img",
+                                  "ssh_root_keys": []})
+        self.assertEqual(code, 202)
+        self.service.wait()
+        code, job = self.request("GET", "/deploys/{0}".format(job['id']))
+        self.assertEqual(code, 200)
+        self.assertEqual(job['status'], "completed")
+        self.assertIn(job['vmid'], self.node.vms)
+
+        code, status = self.request("GET", "/status")
+        self.assertEqual(code, 200)
+        self.assertEqual(status['jobs']['completed'], 1)
+        self.assertEqual(status['images'], 1)
+        self.assertIn("create_vm", status['average_phases'])
+
+    def test_invalid_request(self):
+        code, response = self.request("POST", "/deploys", {"name": "test"})
+        self.assertEqual(code, 400)
+        self.assertEqual(response['error'], "Missing required field: image")
+        code, response = self.request("POST", "/deploys", ["test"])
+        self.assertEqual(code, 400)
+        code, response = self.request("POST", "/deploys",
+                                      {"name": "test", "image": "disk9.img"})
+        self.assertEqual(code, 400)
+        self.assertEqual(self.service.list_jobs(), [])
+
+    def test_internal_error(self):
+        def submit(request):
+            raise RuntimeError("Cluster is gone")
+        self.service.submit = submit
+        code, response = self.request("POST", "/deploys",
+                                      {"name": "test", "image": "disk1.img"})
+        self.assertEqual(code, 500)
+        self.assertEqual(response['error'], "Cluster is gone")
+
+    def test_not_found(self):
+        self.assertEqual(self.request("GET", "/deploys/1")[0], 404)
+        self.assertEqual(self.request("POST", "/status", {})[0], 404)
+
+    def test_release_address(self):
+        pool = self.service.ip_pools['lan']
+        used = pool.status()['used']
+        # The VM can't be created, as its id is taken.
+        self.node.vms[200] = {"name": "other", "status": "stopped"}
+        code, job = self.request("POST", "/deploys",
+                                 {"name": "test", "image": "disk1.img",
+                                  "vmid": 200, "ip_pool": "lan",
+                                  "ssh_root_keys": []})
+        self.assertEqual(code, 202)
+        self.service.wait()
+        job = self.service.get_job(job['id'])
+        self.assertEqual(job.status, "failed")
+        self.assertIn(job.journal.cloudinit['ip_address'], pool)
+        self.assertEqual(pool.status()['used'], used)
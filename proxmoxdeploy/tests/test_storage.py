@@ -0,0 +1,112 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..fake import FakeProxmoxAPI, FakeProxmoxNode
+from ..proxmox import ProxmoxClient
+from ..storage import StorageProfile, get_storage_profile, parse_size
+import unittest
+
+
+class ParseSizeTest(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(parse_size("8k"), 8)
+        self.assertEqual(parse_size("8K"), 8)
+        self.assertEqual(parse_size("1M"), 1024)
+        self.assertEqual(parse_size("0.5m"), 512)
+        self.assertEqual(parse_size("2G"), 2 * 1024 ** 2)
+
+    def test_bytes(self):
+        self.assertEqual(parse_size("65536"), 64)
+        self.assertEqual(parse_size(131072), 128)
+        self.assertEqual(parse_size(" 16k "), 16)
+
+
+class StorageProfileTest(unittest.TestCase):
+    def test_dir(self):
+        profile = get_storage_profile("dir")
+        self.assertEqual(profile.disk_format, "qcow2")
+        self.assertEqual(profile.preallocation, "metadata")
+        self.assertIsNone(profile.size_multiple)
+        self.assertEqual(profile.get_create_options("qcow2"),
+                         ["preallocation=metadata"])
+        # Metadata preallocation only exists for qcow2.
+        self.assertEqual(profile.get_create_options("raw"), [])
+
+    def test_dir_raw(self):
+        profile = get_storage_profile("nfs", {"format": "raw"})
+        self.assertEqual(profile.disk_format, "raw")
+        self.assertIsNone(profile.preallocation)
+        profile = get_storage_profile("dir", {"format": "vmdk"})
+        self.assertEqual(profile.disk_format, "qcow2")
+
+    def test_lvm(self):
+        self.assertEqual(get_storage_profile("lvmthin").size_multiple, 4096)
+        profile = get_storage_profile("lvm", extent_size=32768)
+        self.assertEqual(profile.disk_format, "raw")
+        self.assertEqual(profile.size_multiple, 32768)
+        self.assertEqual(profile.get_create_options("raw"), [])
+        self.assertEqual(profile.get_disk_format("qcow2"), "raw")
+
+    def test_zfs(self):
+        self.assertEqual(get_storage_profile("zfspool").size_multiple, 8)
+        profile = get_storage_profile("zfspool", {"blocksize": "64k"})
+        self.assertEqual(profile.size_multiple, 64)
+
+    def test_overrides(self):
+        profile = get_storage_profile(
+            "dir", overrides={"cluster-size": "1M", "preallocation": "full"})
+        self.assertEqual(profile.cluster_size, 1024)
+        self.assertEqual(profile.get_create_options("qcow2"),
+                         ["cluster_size=1048576", "preallocation=full"])
+        profile = get_storage_profile("dir", overrides={"format": "raw"})
+        self.assertEqual(profile.disk_format, "raw")
+        self.assertIsNone(profile.preallocation)
+        self.assertRaises(ValueError, get_storage_profile, "lvm",
+                          overrides={"format": "qcow2"})
+        self.assertRaises(ValueError, get_storage_profile, "dir",
+                          overrides={"format": "raw",
+                                     "preallocation": "metadata2"})
+
+    def test_round_size(self):
+        profile = StorageProfile("lvm", "raw", size_multiple=4096)
+        self.assertEqual(profile.round_size(1), 4096)
+        self.assertEqual(profile.round_size(4096), 4096)
+        self.assertEqual(profile.round_size(4097), 8192)
+        self.assertEqual(StorageProfile("dir", "qcow2").round_size(4097),
+                         4097)
+
+
+class ClientStorageProfileTest(unittest.TestCase):
+    def test_learned(self):
+        node = FakeProxmoxNode(storages=[
+            {"storage": "local", "type": "dir", "path": "/var/lib/vz",
+             "content": "images", "format": "raw", "avail": 1024 ** 3},
+            {"storage": "local-lvm", "type": "lvmthin", "vgname": "pve",
+             "content": "images", "avail": 1024 ** 3},
+            {"storage": "tank", "type": "zfspool", "blocksize": "16k",
+             "content": "images", "avail": 1024 ** 3},
+        ])
+        api = ProxmoxClient(FakeProxmoxAPI(node), storage_overrides={
+            "local": {"format": "qcow2", "cluster-size": "128k"}})
+        profile = api.get_storage_profile("pve", "local")
+        self.assertEqual((profile.disk_format, profile.cluster_size),
+                         ("qcow2", 128))
+        # The extent size of the volume group of the fake node.
+        self.assertEqual(api.get_storage_profile("pve", "local-lvm")
+                         .size_multiple, 4096)
+        self.assertEqual(api.get_storage_profile("pve", "tank")
+                         .size_multiple, 16)
@@ -0,0 +1,135 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..throttle import NodeThrottle, TokenBucket
+import threading
+import time
+import unittest
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(1000)
+        start = time.time()
+        bucket.consume(1000)
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_rate(self):
+        bucket = TokenBucket(1000, burst=100)
+        start = time.time()
+        bucket.consume(100)
+        bucket.consume(300)
+        # The burst is used up at once, the rest is added at the rate.
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+    def test_parent(self):
+        parent = TokenBucket(1000, burst=100)
+        bucket = TokenBucket(100000, parent=parent)
+        start = time.time()
+        bucket.consume(300)
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+
+class WrapTest(unittest.TestCase):
+    def test_unthrottled(self):
+        self.assertEqual(NodeThrottle().wrap("qemu-img info x"),
+                         "qemu-img info x")
+        self.assertFalse(NodeThrottle().active)
+
+    def test_priorities(self):
+        throttle = NodeThrottle(ionice_class="best-effort", ionice_level=7,
+                                nice=10)
+        self.assertTrue(throttle.active)
+        self.assertEqual(throttle.wrap("gunzip 'a b'"),
+                         "ionice -c 2 -n 7 nice -n 10 gunzip 'a b'")
+
+    def test_idle(self):
+        # The idle class has no priority levels.
+        throttle = NodeThrottle(ionice_class="idle", ionice_level=3)
+        self.assertEqual(throttle.wrap("true"), "ionice -c 3 true")
+
+    def test_unknown_class(self):
+        self.assertRaises(ValueError, NodeThrottle, ionice_class="fast")
+
+
+class ConvertingTest(unittest.TestCase):
+    def test_unlimited(self):
+        throttle = NodeThrottle(storage_rates={"local-lvm": 1000})
+        with throttle.converting("pve", "local") as rate:
+            self.assertIsNone(rate)
+
+    def test_default_rate(self):
+        throttle = NodeThrottle(storage_rates={"*": 1000},
+                                max_conversions=4)
+        with throttle.converting("pve", "local") as rate:
+            self.assertEqual(rate, 250)
+
+    def test_fixed_share(self):
+        throttle = NodeThrottle(storage_rates={"local-lvm": 1000})
+        with throttle.converting("pve", "local-lvm") as first:
+            with throttle.converting("pve", "local-lvm") as second:
+                self.assertEqual(first + second, 1000)
+
+    def test_slots(self):
+        throttle = NodeThrottle(storage_rates={"local-lvm": 1000},
+                                max_conversions=1)
+        started = threading.Event()
+
+        def convert():
+            with throttle.converting("pve", "local-lvm"):
+                started.set()
+
+        with throttle.converting("pve", "local-lvm"):
+            thread = threading.Thread(target=convert)
+            thread.start()
+            self.assertFalse(started.wait(0.2))
+            # Other nodes have their own slots.
+            with throttle.converting("pve2", "local-lvm") as rate:
+                self.assertEqual(rate, 1000)
+        self.assertTrue(started.wait(5))
+        thread.join()
+
+
+class WaitForNodeTest(unittest.TestCase):
+    def setUp(self):
+        self.throttle = NodeThrottle(storage_rates={"*": 1000},
+                                     max_iowait=0.3, max_conversions=1,
+                                     backoff=0.01, max_backoff=0.02)
+
+    def test_not_configured(self):
+        NodeThrottle().wait_for_node("pve", lambda: self.fail())
+
+    def test_backoff(self):
+        iowaits = [0.9, 0.8, 0.1]
+        self.throttle.wait_for_node("pve", lambda: iowaits.pop(0))
+        self.assertEqual(iowaits, [])
+        # Halved twice, then raised once.
+        self.assertAlmostEqual(self.throttle.get_rate_factor("pve"), 0.35)
+        self.assertEqual(self.throttle.get_rate_factor("pve2"), 1.0)
+        with self.throttle.converting("pve", "local") as rate:
+            self.assertEqual(rate, 350)
+        with self.throttle.converting("pve2", "local") as rate:
+            self.assertEqual(rate, 1000)
+
+    def test_restore(self):
+        iowaits = [0.9] * 6 + [0.1]
+        self.throttle.wait_for_node("pve", lambda: iowaits.pop(0))
+        # Halved down to the minimum of 0.1, then raised once.
+        self.assertAlmostEqual(self.throttle.get_rate_factor("pve"), 0.2)
+        for _ in range(10):
+            self.throttle.wait_for_node("pve", lambda: 0.1)
+        self.assertEqual(self.throttle.get_rate_factor("pve"), 1.0)
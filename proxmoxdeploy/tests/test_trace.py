@@ -0,0 +1,108 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .. import cache
+from ..cloudinit.templates import QUESTIONS
+from ..deploy import deploy
+from ..fake import FakeProxmoxAPI, FakeProxmoxNode
+from ..journal import DeployJournal
+from ..proxmox import ProxmoxClient
+from ..trace import TraceRecorder, create_replay_api, \
+    get_recorded_deployment, load_trace, summarize_trace
+from openssh_wrapper import SSHError
+from shutil import rmtree
+import os
+import tempfile
+import unittest
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = os.path.join(self.directory, "cache")
+        self.image = os.path.join(self.directory, "disk1.img")
+        with open(self.image, "wb") as image:
+            image.truncate(1024 ** 2)
+        self.trace = os.path.join(self.directory, "trace.jsonl")
+
+    def tearDown(self):
+        cache.CACHE_DIR = self.cache_dir
+        rmtree(self.directory)
+
+    def record(self):
+        """
+        Records a deployment to a fake node into the trace.
+        """
+        node = FakeProxmoxNode()
+        api = ProxmoxClient(FakeProxmoxAPI(node))
+        recorder = TraceRecorder(self.trace)
+        recorder.install(api._get_ssh_session())
+        proxmox = {"node": node.name, "storage": "local-lvm", "cpu": 1,
+                   "cpu_family": "host", "memory": 512, "disk": 1,
+                   "vmid": 100}
+        cloudinit = QUESTIONS.flatten_answers()
+        cloudinit.update(name="test", image=self.image, ssh_root_keys=[],
+                         start_vm=True)
+        recorder.record_deployment(proxmox, cloudinit)
+        try:
+            deploy(api, DeployJournal(proxmox=proxmox, cloudinit=cloudinit))
+        finally:
+            recorder.close()
+        return node
+
+    def test_record(self):
+        node = self.record()
+        events = load_trace(self.trace)
+        summary = summarize_trace(events)
+        self.assertEqual(summary['api']['count'], node.api_calls)
+        self.assertEqual(summary['command']['count'], node.commands)
+        # The image and the seed ISO.
+        self.assertEqual(summary['upload']['count'], 2)
+        self.assertGreaterEqual(summary['upload']['bytes'], 1024 ** 2)
+        proxmox, cloudinit = get_recorded_deployment(events)
+        self.assertEqual(proxmox['vmid'], 100)
+        self.assertEqual(cloudinit['name'], "test")
+
+    def test_replay(self):
+        self.record()
+        events = load_trace(self.trace)
+        proxmox, cloudinit = get_recorded_deployment(events)
+        node = FakeProxmoxNode()
+        replay = create_replay_api(events, node=node, speed=100)
+        deploy(ProxmoxClient(replay),
+               DeployJournal(proxmox=proxmox, cloudinit=cloudinit))
+        # Every call was answered from the trace, none by the fake node.
+        session = replay._backend.session
+        self.assertEqual(session.unmatched, [])
+        self.assertGreater(session.matched, 0)
+        self.assertEqual(node.api_calls, 0)
+        self.assertEqual(node.commands, 0)
+        self.assertEqual(node.vms, {})
+
+    def test_replay_error(self):
+        self.record()
+        events = load_trace(self.trace)
+        failed = [event for event in events if event['type'] == "command" and
+                  event['command'].startswith("pvesm alloc")]
+        self.assertEqual(len(failed), 1)
+        failed[0].update(error="Connection lost", error_type="SSHError")
+        replay = create_replay_api(events, node=FakeProxmoxNode(),
+                                   speed=100)
+        proxmox, cloudinit = get_recorded_deployment(events)
+        self.assertRaises(SSHError, deploy, ProxmoxClient(replay),
+                          DeployJournal(proxmox=proxmox, cloudinit=cloudinit))
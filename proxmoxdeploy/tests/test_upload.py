@@ -0,0 +1,123 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from ..exceptions import SSHCommandInvocationException, \
+    UploadCancelledException
+from ..metrics import TransferMonitor
+from ..upload import BufferPool, StreamingUploader
+from openssh_wrapper import SSHError
+from shutil import rmtree
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+
+
+class LocalClient(object):
+    """
+    Stand-in for an openssh_wrapper connection, which runs commands locally
+    instead of on a remote host.
+    """
+    def __init__(self, command=None):
+        self.command = command
+
+    def ssh_command(self, command, forward_ssh_agent):
+        return ["sh", "-c", self.command or command]
+
+    def get_env(self):
+        return dict(os.environ)
+
+
+class CountingLimiter(object):
+    def __init__(self):
+        self.consumed = 0
+
+    def consume(self, amount):
+        self.consumed += amount
+
+
+class StreamingUploaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.urandom(64 * 1024 + 123)
+        self.source = os.path.join(self.directory, "disk.img")
+        with open(self.source, "wb") as source:
+            source.write(self.data)
+        self.target = os.path.join(self.directory, "uploaded.img")
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def upload(self, uploader, client=None, **kwargs):
+        progress = TransferMonitor().start("disk.img", len(self.data))
+        with open(self.source, "rb") as source:
+            uploader.upload(client or LocalClient(), source, self.target,
+                            progress=progress, **kwargs)
+        progress.finish()
+        return progress
+
+    def get_uploaded(self):
+        with open(self.target, "rb") as target:
+            return target.read()
+
+    def test_zero_copy(self):
+        pool = BufferPool(count=2, size=4096)
+        uploader = StreamingUploader(pool=pool, poll_interval=0.01)
+        progress = self.upload(uploader)
+        self.assertEqual(self.get_uploaded(), self.data)
+        self.assertEqual(progress.bytes_sent, len(self.data))
+        # The file was passed to the process, not copied through buffers.
+        self.assertEqual(pool.peak_in_use, 0)
+
+    def test_copy(self):
+        pool = BufferPool(count=2, size=4096)
+        uploader = StreamingUploader(pool=pool, poll_interval=0.01)
+        digest = hashlib.sha256()
+        limiter = CountingLimiter()
+        progress = self.upload(uploader, digest=digest, limiter=limiter)
+        self.assertEqual(self.get_uploaded(), self.data)
+        self.assertEqual(digest.hexdigest(),
+                         hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(progress.bytes_sent, len(self.data))
+        self.assertEqual(limiter.consumed, len(self.data))
+        self.assertEqual(pool.peak_bytes, 4096)
+        self.assertEqual(pool.in_use, 0)
+
+    def test_zero_copy_disabled(self):
+        pool = BufferPool(count=1, size=4096)
+        uploader = StreamingUploader(pool=pool, zero_copy=False)
+        progress = self.upload(uploader)
+        self.assertEqual(self.get_uploaded(), self.data)
+        self.assertEqual(progress.bytes_sent, len(self.data))
+        self.assertEqual(pool.peak_in_use, 1)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        cancel.set()
+        uploader = StreamingUploader(poll_interval=0.01)
+        for digest in (None, hashlib.sha256()):
+            self.assertRaises(UploadCancelledException, self.upload,
+                              uploader, LocalClient("sleep 5"),
+                              digest=digest, cancel=cancel)
+
+    def test_failure(self):
+        uploader = StreamingUploader(poll_interval=0.01)
+        self.assertRaises(SSHCommandInvocationException, self.upload,
+                          uploader, LocalClient("cat >/dev/null; exit 1"))
+        self.assertRaises(SSHError, self.upload, uploader,
+                          LocalClient("exit 255"))
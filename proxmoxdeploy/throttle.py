@@ -0,0 +1,228 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+"""
+Throttling of the load proxmox-deploy puts on the network and on Proxmox
+nodes.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import pipes
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+
+class TokenBucket(object):
+    """
+    Limits the rate of a resource, such as bytes sent, shared by several
+    threads. Every consumer takes tokens from the bucket, which fills up at a
+    fixed rate, and waits while the bucket is empty.
+    """
+    def __init__(self, rate, burst=None, parent=None):
+        """
+        Parameters
+        ----------
+        rate: float
+            Tokens added per second.
+        burst: float
+            Maximum amount of tokens in the bucket. Defaults to one second
+            worth of tokens.
+        parent: TokenBucket
+            Bucket that tokens are taken from as well, for example a bucket
+            for all nodes together, shared by the buckets of single nodes.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.parent = parent
+        self._tokens = self.burst
+        self._updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Takes tokens from the bucket, waiting until enough are available.
+        Amounts larger than the burst are taken in parts.
+        """
+        while amount > 0:
+            part = min(amount, self.burst)
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                self._tokens -= part
+                delay = -self._tokens / self.rate if self._tokens < 0 else 0
+            # Tokens are taken even if they are not yet available, so waiting
+            # consumers are served in order.
+            if delay > 0:
+                time.sleep(delay)
+            if self.parent is not None:
+                self.parent.consume(part)
+            amount -= part
+
+
+class NodeThrottle(object):
+    """
+    Throttles the heavy work run on a Proxmox node, such as decompressing and
+    converting images, so running guests don't suffer from deployments.
+
+    Heavy commands run with a lower I/O and CPU priority. Conversions into a
+    storage are limited to the bandwidth configured for the storage. At most
+    max_conversions conversions run into a storage of a node at the same
+    time, each with an equal, fixed share of the bandwidth, so together they
+    never exceed it. Further conversions wait for a free slot.
+
+    Before heavy work starts on a node, its I/O wait is checked. While it is
+    above the threshold, work is postponed with an exponential back-off, and
+    the bandwidth of later conversions on the node is halved. While it is
+    below, the bandwidth is restored in small steps. The I/O wait is only
+    checked before work starts: qemu-img takes its rate limit once, so the
+    bandwidth of a running conversion does not change.
+    """
+    def __init__(self, ionice_class=None, ionice_level=None, nice=None,
+                 storage_rates=None, max_iowait=None, max_conversions=2,
+                 backoff=5.0, max_backoff=60.0):
+        """
+        Parameters
+        ----------
+        ionice_class: str
+            I/O scheduling class of heavy commands, one of IONICE_CLASSES.
+        ionice_level: int
+            Priority within the I/O scheduling class, 0 (highest) to 7.
+        nice: int
+            CPU niceness of heavy commands.
+        storage_rates: dict
+            Maps storage names to the maximum bandwidth of conversions into
+            the storage, in bytes per second. The rate of "*" applies to
+            storages that are not listed.
+        max_iowait: float
+            I/O wait of the node, as a fraction of cpu time, above which heavy
+            work is postponed.
+        max_conversions: int
+            Maximum amount of conversions into a rate limited storage of a
+            node at the same time.
+        backoff: float
+            Seconds to postpone work for the first time the I/O wait is too
+            high. Doubled every next time, up to max_backoff.
+        max_backoff: float
+            Maximum amount of seconds to postpone work at once.
+        """
+        if ionice_class is not None and ionice_class not in IONICE_CLASSES:
+            raise ValueError("Unknown I/O scheduling class: {0}"
+                             .format(ionice_class))
+        self.ionice_class = ionice_class
+        self.ionice_level = ionice_level
+        self.nice = nice
+        self.storage_rates = storage_rates or {}
+        self.max_iowait = max_iowait
+        self.max_conversions = max_conversions
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._rate_factors = defaultdict(lambda: 1.0)
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """
+        True if heavy work is throttled in any way.
+        """
+        return (self.ionice_class is not None or self.nice is not None or
+                bool(self.storage_rates) or self.max_iowait is not None)
+
+    def wrap(self, command):
+        """
+        Prefixes a command with ionice and nice, to run it with the configured
+        priorities.
+        """
+        prefix = []
+        if self.ionice_class is not None:
+            prefix += ["ionice", "-c", str(IONICE_CLASSES[self.ionice_class])]
+            if self.ionice_level is not None and self.ionice_class != "idle":
+                prefix += ["-n", str(self.ionice_level)]
+        if self.nice is not None:
+            prefix += ["nice", "-n", str(self.nice)]
+        if not prefix:
+            return command
+        return " ".join(pipes.quote(arg) for arg in prefix) + " " + command
+
+    def get_rate_factor(self, node):
+        """
+        Fraction of the configured bandwidth that conversions on a node may
+        currently use, lowered while its I/O wait is high.
+        """
+        with self._lock:
+            return self._rate_factors[node]
+
+    @contextmanager
+    def converting(self, node, storage):
+        """
+        Context manager around a conversion into a storage of a node. Waits
+        for a free slot if the storage is rate limited, and yields the
+        bandwidth the conversion may use in bytes per second, or None if it
+        is not limited.
+        """
+        rate = self.storage_rates.get(storage, self.storage_rates.get("*"))
+        if not rate:
+            yield None
+            return
+        with self._lock:
+            slots = self._slots.get((node, storage))
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_conversions)
+                self._slots[(node, storage)] = slots
+        slots.acquire()
+        try:
+            yield int(rate * self.get_rate_factor(node) /
+                      self.max_conversions)
+        finally:
+            slots.release()
+
+    def wait_for_node(self, node, get_iowait):
+        """
+        Blocks while the I/O wait of the node is above the threshold.
+
+        Parameters
+        ----------
+        node: str
+            Name of the node.
+        get_iowait: callable
+            Returns the current I/O wait of the node, as a fraction of cpu
+            time.
+        """
+        if self.max_iowait is None:
+            return
+        delay = self.backoff
+        while True:
+            iowait = get_iowait()
+            with self._lock:
+                factor = self._rate_factors[node]
+                if iowait <= self.max_iowait:
+                    self._rate_factors[node] = min(1.0, factor + 0.1)
+                    return
+                self._rate_factors[node] = max(0.1, factor / 2)
+            logger.info("I/O wait of node {0} is {1:.0%}, waiting {2:.1f}s "
+                        "before continuing".format(node, iowait, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
@@ -0,0 +1,321 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+"""
+Record and replay of the remote work done during deployments. A trace is a
+file with one JSON event per line, for every API call, remote command and
+upload, including its payload size, result and latency.
+"""
+
+from .fake import FakeProxmoxAPI, FakeSession
+from collections import defaultdict, deque
+from openssh_wrapper import SSHError
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _CountingFile(object):
+    """
+    Wraps a file object, and counts the bytes read from it.
+    """
+    def __init__(self, _file):
+        self._file = _file
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _event_key(event):
+    if event['type'] == "api":
+        return ("api", event['method'].upper(), event['url'],
+                json.dumps(event['data'], sort_keys=True, default=str),
+                json.dumps(event['params'], sort_keys=True, default=str))
+    if event['type'] == "command":
+        return ("command", event['command'])
+    return ("upload", event['remote_path'])
+
+
+class TraceRecorder(object):
+    """
+    Records every API call, command and upload made through a proxmoxer SSH
+    session into a trace file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.started_at = time.time()
+        self._file = open(filename, "w")
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def write(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event, default=str) + "\n")
+            self._file.flush()
+
+    def record_deployment(self, proxmox, cloudinit):
+        """
+        Records the answers of a deployment, so it can be replayed later.
+        """
+        self.write({"type": "deployment", "proxmox": proxmox,
+                    "cloudinit": cloudinit})
+
+    def _call(self, event, func, *args, **kwargs):
+        # API requests are executed as commands by proxmoxer SSH sessions.
+        # Only record the outermost call.
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            event['error'] = str(e)
+            event['error_type'] = type(e).__name__
+            raise
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                event['start'] = start - self.started_at
+                event['latency'] = time.time() - start
+                event['thread'] = threading.current_thread().name
+                if 'error' not in event:
+                    event.update(self._describe_result(event, result))
+                self.write(event)
+        return result
+
+    def _describe_result(self, event, result):
+        if event['type'] == "api":
+            return {"status_code": result.status_code,
+                    "response": result.content,
+                    "response_size": len(result.content or "")}
+        if event['type'] == "command":
+            stdout, stderr = result
+            return {"stdout": stdout, "stderr": stderr,
+                    "response_size": len(stdout) + len(stderr)}
+        return {}
+
+    def install(self, session):
+        """
+        Starts recording all calls made through the given session.
+
+        Parameters
+        ----------
+        session: ProxmoxBaseSSHSession subclass
+            Session to record, usually ProxmoxClient._get_ssh_session().
+        """
+        request = session.request
+        _exec = session._exec
+        upload_file_obj = session.upload_file_obj
+
+        def recording_request(method, url, data=None, params=None,
+                              headers=None):
+            event = {"type": "api", "method": method, "url": url,
+                     "data": data, "params": params,
+                     "request_size": len(json.dumps(data, default=str))}
+            return self._call(event, request, method, url, data=data,
+                              params=params, headers=headers)
+
+        def recording_exec(cmd):
+            event = {"type": "command", "command": cmd,
+                     "request_size": len(str(cmd))}
+            return self._call(event, _exec, cmd)
+
+        def counting_upload(file_obj, remote_path, event):
+            counting_file = _CountingFile(file_obj)
+            try:
+                return upload_file_obj(counting_file, remote_path)
+            finally:
+                event['request_size'] = counting_file.bytes_read
+
+        def recording_upload(file_obj, remote_path):
+            event = {"type": "upload", "remote_path": remote_path}
+            return self._call(event, counting_upload, file_obj, remote_path,
+                              event)
+
+        session.request = recording_request
+        session._exec = recording_exec
+        session.upload_file_obj = recording_upload
+
+        if hasattr(session, "upload_stream"):
+            upload_stream = session.upload_stream
+
+            def recording_stream(file_obj, remote_path, **kwargs):
+                event = {"type": "upload", "remote_path": remote_path,
+                         "request_size": os.fstat(file_obj.fileno()).st_size}
+                return self._call(event, upload_stream, file_obj,
+                                  remote_path, **kwargs)
+            session.upload_stream = recording_stream
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def load_trace(filename):
+    """
+    Loads the events of a trace file.
+    """
+    with open(filename) as _file:
+        return [json.loads(line) for line in _file if line.strip()]
+
+
+class _RecordedResponse(object):
+    def __init__(self, content, status_code):
+        self.status_code = status_code
+        self.content = content
+        self.text = content
+        self.headers = {"content-type": "application/json"}
+
+
+class ReplaySession(object):
+    """
+    Session that answers calls with the results recorded in a trace, after
+    the recorded latency. Calls are matched on their method and URL, command
+    or upload path, in recorded order. Calls that are not in the trace are
+    passed to a fallback session, such as a FakeSession.
+    """
+    def __init__(self, events, fallback=None, speed=1.0):
+        """
+        Parameters
+        ----------
+        events: list of dicts
+            Events of the trace.
+        fallback: session
+            Session to pass unmatched calls to.
+        speed: float
+            Replay speed, recorded latencies are divided by this factor.
+        """
+        self.fallback = fallback
+        self.speed = speed
+        self.matched = 0
+        self.unmatched = []
+        self._events = defaultdict(deque)
+        for event in events:
+            if event['type'] in ("api", "command", "upload"):
+                self._events[_event_key(event)].append(event)
+        self._lock = threading.Lock()
+
+    def _match(self, event):
+        key = _event_key(event)
+        with self._lock:
+            if self._events[key]:
+                self.matched += 1
+                return self._events[key].popleft()
+            self.unmatched.append(key)
+        logger.debug("Call not in trace: {0}".format(key))
+        return None
+
+    def _replay(self, recorded):
+        time.sleep(recorded['latency'] / self.speed)
+        if 'error' in recorded:
+            if recorded.get("error_type") == "SSHError":
+                raise SSHError(recorded['error'])
+            raise RuntimeError(recorded['error'])
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        recorded = self._match({"type": "api", "method": method, "url": url,
+                                "data": data, "params": params})
+        if recorded is None:
+            return self.fallback.request(method, url, data=data,
+                                         params=params, headers=headers)
+        self._replay(recorded)
+        return _RecordedResponse(recorded['response'],
+                                 recorded['status_code'])
+
+    def _exec(self, cmd):
+        recorded = self._match({"type": "command", "command": cmd})
+        if recorded is None:
+            return self.fallback._exec(cmd)
+        self._replay(recorded)
+        return (recorded['stdout'], recorded['stderr'])
+
+    def upload_file_obj(self, file_obj, remote_path):
+        recorded = self._match({"type": "upload", "remote_path": remote_path})
+        if recorded is None:
+            return self.fallback.upload_file_obj(file_obj, remote_path)
+        while file_obj.read(64 * 1024):
+            pass
+        self._replay(recorded)
+
+
+def create_replay_api(events, node=None, speed=1.0):
+    """
+    Creates a ProxmoxAPI stand-in that replays a trace, falling back to a
+    fake node for calls that are not in the trace.
+
+    Parameters
+    ----------
+    events: list of dicts
+        Events of the trace.
+    node: FakeProxmoxNode
+        Fake node for unmatched calls. A default node is created if not given.
+    speed: float
+        Replay speed, recorded latencies are divided by this factor.
+    """
+    api = FakeProxmoxAPI(node)
+    session = ReplaySession(events, fallback=FakeSession(api.node),
+                            speed=speed)
+    return FakeProxmoxAPI(api.node, session=session)
+
+
+def get_recorded_deployment(events):
+    """
+    Get the answers of the deployment recorded in a trace.
+
+    Returns
+    -------
+    Tuple containing (proxmox answers, cloud-init answers), or None.
+    """
+    for event in events:
+        if event['type'] == "deployment":
+            return (event['proxmox'], event['cloudinit'])
+    return None
+
+
+def summarize_trace(events):
+    """
+    Summarizes a trace per type of call.
+
+    Returns
+    -------
+    Dict mapping call types to dicts with their "count", total "latency" and
+    total "bytes" sent and received, and the "duration" of the whole trace.
+    """
+    summary = {"duration": 0.0}
+    for event in events:
+        if event['type'] not in ("api", "command", "upload"):
+            continue
+        totals = summary.setdefault(event['type'], {"count": 0,
+                                                    "latency": 0.0,
+                                                    "bytes": 0})
+        totals['count'] += 1
+        totals['latency'] += event['latency']
+        totals['bytes'] += event.get("request_size", 0) + \
+            event.get("response_size", 0)
+        summary['duration'] = max(summary['duration'],
+                                  event['start'] + event['latency'])
+    return summary
@@ -0,0 +1,225 @@
+# proxmox-deploy is cli-based deployment tool for Proxmox
+#
+# Copyright (c) 2015 Nick Douma <n.douma@nekoconeko.nl>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+from .exceptions import SSHCommandInvocationException, \
+    UploadCancelledException
+from contextlib import contextmanager
+from openssh_wrapper import SSHError
+from Queue import Queue
+import errno
+import logging
+import os
+import pipes
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 1024 ** 2
+DEFAULT_BUFFER_COUNT = 8
+
+
+class BufferPool(object):
+    """
+    Fixed pool of reusable buffers. Uploads borrow a buffer for every block
+    they send, and block while all buffers are in use. The memory used for
+    buffering by all concurrent uploads together is therefore never more than
+    count * size bytes.
+    """
+    def __init__(self, count=DEFAULT_BUFFER_COUNT, size=DEFAULT_BUFFER_SIZE):
+        self.count = count
+        self.size = size
+        self.in_use = 0
+        self.peak_in_use = 0
+        self._buffers = Queue()
+        self._lock = threading.Lock()
+        for _ in range(count):
+            self._buffers.put(bytearray(size))
+
+    @property
+    def capacity(self):
+        return self.count * self.size
+
+    @property
+    def peak_bytes(self):
+        """
+        Highest amount of buffer memory that was in use at the same time.
+        """
+        return self.peak_in_use * self.size
+
+    @contextmanager
+    def buffer(self):
+        """
+        Context manager that borrows a buffer from the pool.
+        """
+        buf = self._buffers.get()
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        try:
+            yield buf
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._buffers.put(buf)
+
+
+class StreamingUploader(object):
+    """
+    Uploads files by streaming them into ``cat`` on the remote host, over the
+    same SSH connection settings proxmoxer uses.
+
+    If the contents of the file do not have to be inspected or throttled
+    locally, the file itself becomes the stdin of the ssh process, so the data
+    never passes through Python. Otherwise the file is copied in blocks
+    through a shared BufferPool, which bounds the memory used by concurrent
+    uploads.
+    """
+    def __init__(self, pool=None, zero_copy=True, poll_interval=0.5):
+        """
+        Parameters
+        ----------
+        pool: BufferPool
+            Buffers to copy through. A default pool is created if not given.
+        zero_copy: bool
+            Whether to pass files directly to ssh when possible.
+        poll_interval: float
+            Interval in seconds to check progress and cancellation of
+            zero-copy uploads.
+        """
+        self.pool = pool or BufferPool()
+        self.zero_copy = zero_copy
+        self.poll_interval = poll_interval
+
+    def install(self, session):
+        """
+        Makes the session upload through this uploader. Sessions with an
+        ``upload_stream`` method are preferred by ProxmoxClient over
+        ``upload_file_obj``.
+
+        Parameters
+        ----------
+        session: ProxmoxOpenSSHSession
+            Session to install on, usually ProxmoxClient._get_ssh_session().
+        """
+        ssh_client = session.ssh_client
+
+        def upload_stream(file_obj, remote_path, progress=None, digest=None,
+                          cancel=None, limiter=None):
+            return self.upload(ssh_client, file_obj, remote_path,
+                               progress=progress, digest=digest,
+                               cancel=cancel, limiter=limiter)
+        session.upload_stream = upload_stream
+
+    def upload(self, ssh_client, file_obj, remote_path, progress=None,
+               digest=None, cancel=None, limiter=None):
+        """
+        Uploads an open file.
+
+        Parameters
+        ----------
+        ssh_client: SSHConnection
+            openssh_wrapper connection to the remote host.
+        file_obj: file
+            File to upload, opened in binary mode.
+        remote_path: str
+            Path to write the file to on the remote host.
+        progress: TransferProgress
+            Progress to report the bytes sent to.
+        digest: hashlib hash object
+            Hash to feed the contents of the file into.
+        cancel: threading.Event
+            Aborts the upload when set.
+        limiter: TokenBucket
+            Limits the rate of the upload, in bytes per second.
+        """
+        command = ssh_client.ssh_command(
+            "cat > {0}".format(pipes.quote(remote_path)), False)
+        zero_copy = self.zero_copy and digest is None and limiter is None
+        pipe = subprocess.Popen(
+            command, stdin=file_obj if zero_copy else subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=ssh_client.get_env())
+        try:
+            if zero_copy:
+                self._wait(pipe, file_obj, progress, cancel)
+            else:
+                self._copy(pipe, file_obj, progress, digest, cancel, limiter)
+        except:
+            if pipe.poll() is None:
+                pipe.kill()
+            pipe.wait()
+            raise
+
+        stderr = pipe.stderr.read().strip()
+        if pipe.returncode == 255:
+            raise SSHError(stderr)
+        if pipe.returncode != 0:
+            raise SSHCommandInvocationException(
+                "Upload to {0} failed".format(remote_path), stderr=stderr)
+
+    def _wait(self, pipe, file_obj, progress, cancel):
+        """
+        Waits for ssh to read the file. The file offset is shared with the ssh
+        process, so it tells how far the upload is.
+        """
+        fd = file_obj.fileno()
+        sent = 0
+        while True:
+            finished = pipe.poll() is not None
+            if progress is not None:
+                position = os.lseek(fd, 0, os.SEEK_CUR)
+                progress.update(position - sent)
+                sent = position
+            if finished:
+                break
+            if cancel is None:
+                time.sleep(self.poll_interval)
+            elif cancel.wait(self.poll_interval):
+                raise UploadCancelledException("Upload was cancelled")
+
+    def _copy(self, pipe, file_obj, progress, digest, cancel, limiter):
+        """
+        Copies the file into the stdin of ssh, one pooled buffer at a time.
+        """
+        stdin = pipe.stdin.fileno()
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise UploadCancelledException("Upload was cancelled")
+            with self.pool.buffer() as buf:
+                size = file_obj.readinto(buf)
+                if not size:
+                    break
+                view = memoryview(buf)[:size]
+                if digest is not None:
+                    digest.update(view)
+                written = 0
+                try:
+                    while written < size:
+                        written += os.write(stdin, view[written:])
+                except OSError as e:
+                    # ssh exited early, its exit status tells why.
+                    if e.errno != errno.EPIPE:
+                        raise
+                    break
+            if limiter is not None:
+                limiter.consume(size)
+            if progress is not None:
+                progress.update(size)
+        pipe.stdin.close()
+        pipe.wait()